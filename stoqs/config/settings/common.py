@@ -129,6 +129,14 @@ DATABASES = {
 }
 DATABASES['default']['ATOMIC_REQUESTS'] = True
 
+# Set DB_CONN_MAX_AGE to keep connections open between requests for that many seconds (inherited by
+# the campaign databases below), each process then holds at most DB_POOL_MAX_CONNECTIONS of them,
+# closing the least recently used campaigns' first.  Connections idle for more than
+# DB_POOL_HEALTH_CHECK_SECONDS are checked before they are reused.
+DATABASES['default']['CONN_MAX_AGE'] = env.int('DB_CONN_MAX_AGE', default=0)
+DB_POOL_MAX_CONNECTIONS = env.int('DB_POOL_MAX_CONNECTIONS', default=8)
+DB_POOL_HEALTH_CHECK_SECONDS = env.int('DB_POOL_HEALTH_CHECK_SECONDS', default=30)
+
 DEFAULT_AUTO_FIELD='django.db.models.AutoField'
 
 # Functional tests require a separate MAPSERVER_DATABASE_URL setting
@@ -148,6 +156,21 @@ for campaign in env.list('STOQS_CAMPAIGNS', default=[]):
     DATABASES[campaign]['NAME'] = campaign
     MAPSERVER_DATABASES[campaign] = MAPSERVER_DATABASES.get('default').copy()
     MAPSERVER_DATABASES[campaign]['NAME'] = campaign
+
+# Campaign directory for the landing page (utils/CampaignDirectory.py): number of threads reading the
+# databases, age after which an entry is refreshed in the background, the same for a database that could
+# not be read, and the longest a page load waits for databases that have not been read yet
+CAMPAIGN_DIRECTORY_WORKERS = env.int('CAMPAIGN_DIRECTORY_WORKERS', default=8)
+CAMPAIGN_DIRECTORY_STALE_SECONDS = env.int('CAMPAIGN_DIRECTORY_STALE_SECONDS', default=300)
+CAMPAIGN_DIRECTORY_RETRY_SECONDS = env.int('CAMPAIGN_DIRECTORY_RETRY_SECONDS', default=30)
+CAMPAIGN_DIRECTORY_FILL_TIMEOUT = env.int('CAMPAIGN_DIRECTORY_FILL_TIMEOUT', default=30)
+
+# Run each distinct aggregate, count and list query of a QueryUI request only once (utils/STOQSQManager.py)
+QUERY_MEMO = env.bool('QUERY_MEMO', default=True)
+
+# "Get actual count" returns the query planner's row estimate (EXPLAIN) of MeasuredParameter selections
+# at or above this many rows and does an exact count only for smaller selections
+COUNT_ESTIMATE_THRESHOLD = env.int('COUNT_ESTIMATE_THRESHOLD', default=1000000)
     
 # GENERAL CONFIGURATION
 # ------------------------------------------------------------------------------
@@ -334,6 +357,32 @@ MAPSERVER_HOST = env('MAPSERVER_HOST', default='localhost:8080')
 MAPFILE_DIR = env('MAPFILE_DIR', default='/dev/shm')
 URL_MAPFILE_DIR = env('URL_MAPFILE_DIR', default='/dev/shm')
 
+# Optional declarative partitioning of the stoqs_measuredparameter table, applied when a
+# database is created by loaders/load.py, or to an existing database with loaders/partition.py.
+# MP_PARTITION = 'parameter' partitions BY LIST (parameter_id), one partition per Parameter,
+# MP_PARTITION = 'measurement' partitions BY HASH (measurement_id) into MP_PARTITION_MODULUS
+# partitions.  The default of '' leaves the table unpartitioned.
+MP_PARTITION = env('MP_PARTITION', default='')
+MP_PARTITION_MODULUS = env.int('MP_PARTITION_MODULUS', default=16)
+
+# Index profile applied to new databases by loaders/load.py, see loaders/index_profile.py.
+# 'btree' keeps the B-tree indexes that migrate creates, 'brin' replaces them with BRIN
+# indexes on the columns that the loaders write in nearly sorted order.
+INDEX_PROFILE = env('INDEX_PROFILE', default='btree')
+
+# Store Sample.depth and SampledParameter.datavalue as double precision instead of the legacy
+# numeric(100, 30).  Leave False for databases that have not been converted with loaders/float_storage.py
+# so that migrations match the existing schema; the query code works with either.
+SAMPLE_FLOAT_STORAGE = env.bool('SAMPLE_FLOAT_STORAGE', default=False)
+
+# Save ActivityParameterArrays after each Activity is loaded so that section plots
+# and X3D of unconstrained or time/depth constrained selections are built without the Measurement join.
+# Roughly doubles the storage used by the measured data.
+SAVE_PARAMETER_ARRAYS = env.bool('SAVE_PARAMETER_ARRAYS', default=True)
+
+# Build the time-depth pyramid of ParameterTimeBuckets (see loaders/pyramid.py) after each Activity is loaded
+SAVE_PARAMETER_PYRAMID = env.bool('SAVE_PARAMETER_PYRAMID', default=True)
+
 # To allow running Jupyter notebooks in Vagrant's or Docker's host browser
 # See: https://fsdev.io/how-to-install-jupyter-notebook-in-a-dockerized-django-project/
 NOTEBOOK_ARGUMENTS = [
@@ -69,6 +69,37 @@ def getStrideText(stride):
         return ' (stride=%d)' % stride
 
 
+def runSaildroneLoader(url, cName, cDesc, aName, pName, pColor, aTypeName, parmList, dbAlias,
+                       stride, startDatetime=None, endDatetime=None):
+    '''
+    Load a Saildrone deployment file, a module level function so that CANONLoader.loadSaildrone()
+    can run it in the worker processes of LoadScript.load_urls()
+    '''
+    loader = DAPloaders.Trajectory_Loader(url = url,
+                        campaignName = cName,
+                        campaignDescription = cDesc,
+                        dbAlias = dbAlias,
+                        activityName = aName,
+                        activitytypeName = aTypeName,
+                        platformName = pName,
+                        platformColor = pColor,
+                        platformTypeName = 'glider',
+                        stride = stride,
+                        startDatetime = startDatetime,
+                        endDatetime = endDatetime,
+                        dataStartDatetime = None)
+
+    loader.include_names = parmList
+    loader.auxCoords = {}
+    for parm in parmList:
+        loader.auxCoords[parm] = {'latitude': 'latitude', 'longitude': 'longitude', 'time': 'time', 'depth': 0.0}
+        loader.plotTimeSeriesDepth = dict.fromkeys(parmList + [ALTITUDE, SIGMAT, SPICE], 0.0)
+    try:
+        loader.process_data()
+    except (DAPloaders.OpendapError, IndexError) as e:
+        loader.logger.warn(f"Skipping over {url} due to Execption: {e}")
+
+
 class CANONLoader(LoadScript):
     '''
     Common routines for loading all CANON data
@@ -198,14 +229,21 @@ class CANONLoader(LoadScript):
         else:
             urls = self.dorado_urls
 
+        loads = []
         for url in urls:
+            aname = url.split('/')[-1] + getStrideText(stride)
+            loads.append((url, aname, DAPloaders.runDoradoLoader,
+                          (url, self.campaignName, self.campaignDescription, aname,
+                           pname, self.colors[pname], 'auv', 'AUV mission',
+                           self.dorado_parms, self.dbAlias, stride),
+                          dict(grdTerrain=self.grdTerrain, plotTimeSeriesDepth=0.0,
+                               plankton_proxies=plankton_proxies)))
+
+        for url, aname, mps_loaded, error in self.load_urls(loads):
             dfile = url.split('/')[-1]
-            aname = dfile + getStrideText(stride)
             try:
-                mps_loaded = DAPloaders.runDoradoLoader(url, self.campaignName, self.campaignDescription, aname, 
-                                           pname, self.colors[pname], 'auv', 'AUV mission', 
-                                           self.dorado_parms, self.dbAlias, stride, grdTerrain=self.grdTerrain,
-                                           plotTimeSeriesDepth=0.0, plankton_proxies=plankton_proxies)
+                if error:
+                    raise error
                 if mps_loaded:
                     if aname.startswith("Dorado389"):
                         # Legacy Gulper loads
@@ -276,6 +314,7 @@ class CANONLoader(LoadScript):
         stride = stride or self.stride
         files = getattr(self, f'{pname}_files')
         base = getattr(self, f'{pname}_base')
+        loads = []
         for (aname, f) in zip([ a + getStrideText(stride) for a in files], files):
             url = os.path.join(base, f)
             # shorten the activity names
@@ -288,14 +327,19 @@ class CANONLoader(LoadScript):
             else:
                 setattr(self, f'{pname}s_aux_coords', None)
                 aux_coords = None
+            # Early LRAUV data had time coord of 'Time', override with auxCoords setting from load script
+            loads.append((url, aname, DAPloaders.runLrauvLoader,
+                          (url, self.campaignName, self.campaignDescription, aname,
+                           pname, self.colors[pname], 'auv', 'LRAUV log',
+                           parameters, self.dbAlias, stride),
+                          dict(grdTerrain=self.grdTerrain, command_line_args=self.args,
+                               plotTimeSeriesDepth=0, auxCoords=aux_coords,
+                               critSimpleDepthTime=critSimpleDepthTime)))
+
+        for url, aname, _, error in self.load_urls(loads):
             try:
-                # Early LRAUV data had time coord of 'Time', override with auxCoords setting from load script
-                DAPloaders.runLrauvLoader(url, self.campaignName, self.campaignDescription, aname, 
-                                          pname, self.colors[pname], 'auv', 'LRAUV log',
-                                          parameters, self.dbAlias, stride, 
-                                          grdTerrain=self.grdTerrain, command_line_args=self.args,
-                                          plotTimeSeriesDepth=0, auxCoords=aux_coords,
-                                          critSimpleDepthTime=critSimpleDepthTime)
+                if error:
+                    raise error
                 psl.load_lrauv_samples(pname, aname, url, self.dbAlias)
                 lrauv_ml.load_missions(pname, aname, url, self.dbAlias)
             except DAPloaders.NoValidData:
@@ -1324,34 +1368,19 @@ class CANONLoader(LoadScript):
             self.logger.info(f'Using load {pname} attributes set in load script')
             parameters = getattr(self, f'{platform_name}_parms')
 
+        loads = []
         for (aName, f) in zip([ a.split('.')[0] + getStrideText(stride) for a in self.saildrone_files], self.saildrone_files):
             url = self.saildrone_base + f
-            try:
-                loader = DAPloaders.Trajectory_Loader(url = url,
-                                    campaignName = self.campaignName,
-                                    campaignDescription = self.campaignDescription,
-                                    dbAlias = self.dbAlias,
-                                    activityName = aName,
-                                    activitytypeName = activity_type_name,
-                                    platformName = platform_name,
-                                    platformColor = self.colors[platform_name],
-                                    platformTypeName = 'glider',
-                                    stride = stride,
-                                    startDatetime = startdate,
-                                    endDatetime = enddate,
-                                    dataStartDatetime = None)
-            except webob.exc.HTTPError as e:
-                self.logger.warn(f"Skipping over {url}")
+            loads.append((url, aName, runSaildroneLoader,
+                          (url, self.campaignName, self.campaignDescription, aName, platform_name,
+                           self.colors[platform_name], activity_type_name, parameters, self.dbAlias,
+                           stride, startdate, enddate), {}))
 
-            loader.include_names = parameters
-            loader.auxCoords = {}
-            for parm in parameters:
-                loader.auxCoords[parm] = {'latitude': 'latitude', 'longitude': 'longitude', 'time': 'time', 'depth': 0.0}
-                loader.plotTimeSeriesDepth = dict.fromkeys(parameters + [ALTITUDE, SIGMAT, SPICE], 0.0)
-            try:
-                loader.process_data()
-            except (DAPloaders.OpendapError, IndexError) as e:
-                self.logger.warn(f"Skipping over {url} due to Execption: {e}")
+        for url, aName, _, error in self.load_urls(loads):
+            if isinstance(error, webob.exc.HTTPError):
+                self.logger.warn(f"Skipping over {url}")
+            elif error:
+                raise error
 
     def loadSubSamples(self):
         '''
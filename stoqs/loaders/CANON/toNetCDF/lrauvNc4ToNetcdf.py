@@ -43,6 +43,9 @@ import logging
 import socket
 import json
 import csv
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
 import requests
 import xarray as xr
 
@@ -65,6 +68,16 @@ class MissingCoordinate(Exception):
     pass
 
 
+def _resample_group(in_file, path, group, pkeys, t_index, resampleFreq):
+    '''Return InterpolatorWriter.resample_group() of group in the nc4 file at path, run in the worker
+    processes of InterpolatorWriter.resample_groups()
+    '''
+    pw = InterpolatorWriter()
+    pw.in_file = in_file
+    with netCDF4.Dataset(path, mode='r') as df:
+        return pw.resample_group(df.groups[group], group, pkeys, t_index, resampleFreq)
+
+
 class InterpolatorWriter(BaseWriter):
     logger = logging.getLogger(__name__)
     sh = logging.StreamHandler()
@@ -660,20 +673,20 @@ class InterpolatorWriter(BaseWriter):
     def outlier_mask(self, signal, name, threshold=4):
         # This method is really only good for single point spikes as it relies on a difference between adjacent points
         # See: https://ocefpaf.github.io/python4oceanographers/blog/2015/03/16/outlier_detection/
-        signal = signal.copy()
-        difference = np.abs(signal - np.median(signal))
+        values = np.asarray(signal)
+        median = np.median(values)
+        difference = np.abs(values - median)
         median_difference = np.median(difference)
         if median_difference == 0:
-            spike = 0
+            mask = np.zeros(len(values), dtype=bool)
         else:
-            spike = difference / float(median_difference)
+            mask = difference / float(median_difference) > threshold
 
-        mask = spike > threshold
         if mask.any():
-            self.logger.info(f"Found {name} outliers {signal[mask].values} at times {signal[mask].index.tolist()}, indexes: {np.where(mask == True)[0]}")
-            self.logger.info(f"Median of {len(signal)} signal points: {np.median(signal)}")
+            self.logger.info(f"Found {name} outliers {values[mask]} at times {signal.index[mask].tolist()}, indexes: {np.where(mask)[0]}")
+            self.logger.info(f"Median of {len(signal)} signal points: {median}")
 
-        return mask
+        return pd.Series(mask, index=signal.index)
 
     def var_series(self, in_file, data_array, time_array, args, tmin=0, tmax=time.time(), angle=False):
         '''Return a Pandas series of the coordinate with invalid and out of range time values removed'''
@@ -734,6 +747,24 @@ class InterpolatorWriter(BaseWriter):
 
         return da
 
+    def fix_segments(self, times, fix_times):
+        '''Return for each pair of consecutive fix_times an array of the indexes of the times that
+        are strictly between them.  Sorted times are searched once for all the fixes, otherwise
+        each segment is found with a comparison of all the times.
+        '''
+        fix_times = pd.DatetimeIndex(fix_times)
+        if not pd.DatetimeIndex(times).is_monotonic_increasing:
+            return [np.where(np.logical_and(times > fix_times[i], times < fix_times[i+1]))[0]
+                            for i in range(len(fix_times) - 1)]
+
+        values = pd.DatetimeIndex(times).values
+        starts = np.searchsorted(values, fix_times.values[:-1], side='right')
+        ends = np.searchsorted(values, fix_times.values[1:], side='left')
+        # Nothing is between a NaT fix and another one
+        ends[fix_times[:-1].isna() | fix_times[1:].isna()] = 0
+
+        return [np.arange(start, end) for start, end in zip(starts, ends)]
+
     def nudge_coords(self, in_file, args, max_sec_diff_at_end=10, nudge_to_platform=None, nudge_interval=15, replace_with_platform=None):
         '''Given a ds object to an LRAUV .nc4 file return adjusted longitude
         and latitude arrays that reconstruct the trajectory so that the dead
@@ -794,21 +825,26 @@ class InterpolatorWriter(BaseWriter):
 
         if args.remove_gps_outliers:
             # Identify any bad GPS fixes 
-            bad_lat_fix_index = np.where(lat_fix.isna())
-            bad_lon_fix_index = np.where(lon_fix.isna())
+            bad_fixes = set(np.where(lat_fix.isna())[0]) | set(np.where(lon_fix.isna())[0])
 
         self.logger.info(f"{'seg#':4s}  {'end_sec_diff':12s} {'end_lon_diff':12s} {'end_lat_diff':12s} {'len(segi)':9s} {'seg_min':>9s} {'u_drift (cm/s)':14s} {'v_drift (cm/s)':14s} {'start datetime of segment':>29}")
         
+        # Work on copies of the values and times as numpy arrays, the nudged segments are collected
+        # in lists and concatenated once at the end
+        lon_values = lon.to_numpy(copy=True)
+        lat_values = lat.to_numpy(copy=True)
+        lon_ns = lon.index.asi8
+        lon_nudged = [np.array([])]
+        lat_nudged = [np.array([])]
+        dt_nudged = [np.array([], dtype='datetime64[ns]')]
+
         # Any dead reckoned points before first GPS fix - usually empty as GPS fix happens before dive
-        lon_nudged = np.array([])
-        lat_nudged = np.array([])
-        dt_nudged = np.array([], dtype='datetime64[ns]')
         if lat_fix.any():
             segi = np.where(lat.index < lat_fix.index[0])[0]
-            if lon[:].iloc[segi].any():
-                lon_nudged = lon.iloc[segi]
-                lat_nudged = lat.iloc[segi]
-                dt_nudged = lon.index[segi]
+            if lon_values[segi].any():
+                lon_nudged = [lon_values[segi]]
+                lat_nudged = [lat_values[segi]]
+                dt_nudged = [lon.index.values[segi]]
                 self.logger.debug(f"Filled _nudged arrays with {len(segi)} values starting at {lat.index[0]} which were before the first GPS fix at {lat_fix.index[0]}")
         else:
             self.logger.warning(f"No values in lat_fix. Returning from nudge_coords() with original coords")
@@ -822,15 +858,13 @@ class InterpolatorWriter(BaseWriter):
        
         seg_count = 0 
         seg_minsum = 0
-        for i in range(len(lat_fix) - 1):
+        for i, segi in enumerate(self.fix_segments(lat.index, lat_fix.index)):
             # Segment of dead reckoned (under water) positions, each surrounded by GPS fixes
-            segi = np.where(np.logical_and(lat.index > lat_fix.index[i], 
-                                           lat.index < lat_fix.index[i+1]))[0]
             if args.remove_gps_outliers:
-                if i in bad_lat_fix_index[0] or i in bad_lon_fix_index[0]:
+                if i in bad_fixes:
                     self.logger.debug(f"Setting to NaN dead reckoned values found between bad GPS times of {lat_fix.index[i]} and {lat_fix.index[i+1]}")
-                    lon[segi] = np.nan
-                    lat[segi] = np.nan
+                    lon_values[segi] = np.nan
+                    lat_values[segi] = np.nan
                     continue
 
             if not segi.any():
@@ -841,35 +875,33 @@ class InterpolatorWriter(BaseWriter):
             if end_sec_diff > max_sec_diff_at_end:
                 self.logger.warning(f"end_sec_diff ({end_sec_diff}) > max_sec_diff_at_end ({max_sec_diff_at_end})")
 
-            end_lon_diff = lon_fix.iloc[i+1] - lon.iloc[segi[-1]]
-            end_lat_diff = lat_fix.iloc[i+1] - lat.iloc[segi[-1]]
-            seg_min = (lat.index[segi][-1] - lat.index[segi][0]).total_seconds() / 60
+            end_lon_diff = lon_fix.iloc[i+1] - lon_values[segi[-1]]
+            end_lat_diff = lat_fix.iloc[i+1] - lat_values[segi[-1]]
+            seg_secs = (lat.index[segi[-1]] - lat.index[segi[0]]).total_seconds()
+            seg_min = seg_secs / 60
             seg_minsum += seg_min
             
             # Compute approximate horizontal drift rate as a sanity check
-            u_drift = (end_lat_diff * cos(lat_fix.iloc[i+1]) * 60 * 185300
-                        / (lat.index[segi][-1] - lat.index[segi][0]).total_seconds())
-            v_drift = (end_lat_diff * 60 * 185300 
-                        / (lat.index[segi][-1] - lat.index[segi][0]).total_seconds())
-            self.logger.info(f"{i:4d}: {end_sec_diff:12.3f} {end_lon_diff:12.7f} {end_lat_diff:12.7f} {len(segi):-9d} {seg_min:9.2f} {u_drift:14.2f} {v_drift:14.2f} {lat.index[segi][-1]}")
+            u_drift = end_lat_diff * cos(lat_fix.iloc[i+1]) * 60 * 185300 / seg_secs
+            v_drift = end_lat_diff * 60 * 185300 / seg_secs
+            self.logger.info(f"{i:4d}: {end_sec_diff:12.3f} {end_lon_diff:12.7f} {end_lat_diff:12.7f} {len(segi):-9d} {seg_min:9.2f} {u_drift:14.2f} {v_drift:14.2f} {lat.index[segi[-1]]}")
 
             # Start with zero adjustment at begining and linearly ramp up to the diff at the end
-            lon_nudge = np.interp( lon.index[segi].astype(np.int64), 
-                                  [lon.index[segi].astype(np.int64)[0], lon.index[segi].astype(np.int64)[-1]],
-                                  [0, end_lon_diff] )
-            lat_nudge = np.interp( lat.index[segi].astype(np.int64), 
-                                  [lat.index[segi].astype(np.int64)[0], lat.index[segi].astype(np.int64)[-1]],
-                                  [0, end_lat_diff] )
+            seg_ns = lon_ns[segi]
+            lon_nudge = np.interp(seg_ns, [seg_ns[0], seg_ns[-1]], [0, end_lon_diff])
+            lat_nudge = np.interp(seg_ns, [seg_ns[0], seg_ns[-1]], [0, end_lat_diff])
+            seg_lons = lon_values[segi] + lon_nudge
+            seg_lats = lat_values[segi] + lat_nudge
 
             # Sanity checks
-            if np.max(np.abs(lon.iloc[segi] + lon_nudge)) > 180 or np.max(np.abs(lat.iloc[segi] + lon_nudge)) > 90:
+            if np.max(np.abs(seg_lons)) > 180 or np.max(np.abs(seg_lats)) > 90:
                 self.logger.warning(f"Nudged coordinate is way out of reasonable range - segment {seg_count}")
-                self.logger.warning(f" max(abs(lon)) = {np.max(np.abs(lon.iloc[segi] + lon_nudge))}")
-                self.logger.warning(f" max(abs(lat)) = {np.max(np.abs(lat.iloc[segi] + lat_nudge))}")
+                self.logger.warning(f" max(abs(lon)) = {np.max(np.abs(seg_lons))}")
+                self.logger.warning(f" max(abs(lat)) = {np.max(np.abs(seg_lats))}")
 
-            lon_nudged = np.append(lon_nudged, lon.iloc[segi] + lon_nudge)
-            lat_nudged = np.append(lat_nudged, lat.iloc[segi] + lat_nudge)
-            dt_nudged = np.append(dt_nudged, lon.index[segi])
+            lon_nudged.append(seg_lons)
+            lat_nudged.append(seg_lats)
+            dt_nudged.append(lon.index.values[segi])
             seg_count += 1
         
         # Any dead reckoned points after first GPS fix - not possible to nudge, just copy in
@@ -877,15 +909,18 @@ class InterpolatorWriter(BaseWriter):
         segi = np.where(lat.index > lat_fix.index[-1])[0][:-1]
         seg_min = 0
         if segi.any():
-            lon_nudged = np.append(lon_nudged, lon.iloc[segi])
-            lat_nudged = np.append(lat_nudged, lat.iloc[segi])
-            dt_nudged = np.append(dt_nudged, lon.index[segi])
+            lon_nudged.append(lon_values[segi])
+            lat_nudged.append(lat_values[segi])
+            dt_nudged.append(lon.index.values[segi])
             seg_min = (lat.index[segi][-1] - lat.index[segi][0]).total_seconds() / 60
        
         self.logger.info(f"{seg_count+1:4d}: {'-':>12} {'-':>12} {'-':>12} {len(segi):-9d} {seg_min:9.2f} {'-':>14} {'-':>14}")
         self.segment_count = seg_count
         self.segment_minsum = seg_minsum
 
+        lon_nudged = np.concatenate(lon_nudged)
+        lat_nudged = np.concatenate(lat_nudged)
+        dt_nudged = np.concatenate(dt_nudged)
         self.logger.info(f"Points in final series = {len(dt_nudged)}")
 
         return pd.Series(lon_nudged, index=dt_nudged), pd.Series(lat_nudged, index=dt_nudged)
@@ -1200,6 +1235,84 @@ class InterpolatorWriter(BaseWriter):
         # End processNc4
 
 
+    def resample_group(self, subgroup, group, pkeys, t_index, resampleFreq):
+        '''Resample the pkeys variables of subgroup onto t_index, return a list of (key, attributes,
+        series) for the ones found.  Reads only subgroup so that groups can be resampled in parallel.
+        '''
+        results = []
+        for p in pkeys:
+            try:
+                key = p["rename"]
+                var = p["name"]
+                ts = self.createSeries(subgroup.variables, var, var+'_'+'time')
+                attr = {}
+
+                # don't store or try to interpolate empty time series
+                if ts.size == 0:
+                    self.logger.info('Variable ' + var + ' empty so skipping')
+                    continue
+
+                for name in subgroup.variables[var].ncattrs():
+                    attr[name] = getattr(subgroup.variables[var],name)
+
+                # Potential override of attributes from json data
+                for name in ('units', 'standard_name'):
+                    try:
+                        attr[name] = p[name]
+                    except KeyError:
+                        continue
+                # This could be generalized, but for now simply be explicit
+                # https://mbari.slack.com/archives/C04ETLY6T7V/p1712181310294609?thread_ts=1712073883.974969&cid=C04ETLY6T7V
+                if key == 'particulatebackscatteringcoeff470nm':
+                    attr['long_name'] = 'Particulate backscattering coefficient at 470nm'
+                if key == 'particulatebackscatteringcoeff650nm':
+                    attr['long_name'] = 'Particulate backscattering coefficient at 650nm'
+
+                # resample using the mean then interpolate on to the time dimension
+                ts_resample = ts.resample(resampleFreq.lower()).mean()[:]
+                i = self.interpolate(ts_resample, t_index)
+
+                if key.find('pitch') != -1 or key.find('roll') != -1 or key.find('yaw') != -1 or key.find('angle') != -1 or key.find('rate') != -1:
+                    i = i * 180.0 / numpy.pi
+
+                # store for later processing into the netCDF
+                results.append((key, attr, i))
+
+                # plotting for debugging
+                '''fig, axes = plt.subplots(3)
+                plt.legend(loc='best')
+                axes[0].set_title('raw ' + var + ' data')
+                ts.plot(ax=axes[0],color='r')
+                axes[1].set_title('resampled')
+                ts_resample.plot(ax=axes[1],color='g')
+                axes[2].set_title('interpolated')
+                i.plot(ax=axes[2],color='b')
+                plt.show()'''
+
+                self.logger.info('Found in group ' + group + ' parameter ' + var + ' renaming to ' + key)
+            except KeyError as e:
+                self.logger.debug(f"{e} not in {self.in_file}")
+                continue
+            except Exception as e:
+                self.logger.error(e)
+                continue
+
+        return results
+
+    def resample_groups(self, path, groups, parm, t_index, resampleFreq, workers=1):
+        '''Return the resample_group() results of each of groups in order.  With more than 1 worker the
+        groups are resampled in that many processes that each open the nc4 file at path, and only this
+        process collects the results for write_netcdf().  The workers are spawned rather than forked so
+        that they don't inherit the HDF5 library state of the open self.df.
+        '''
+        if workers <= 1 or len(groups) <= 1:
+            return [self.resample_group(self.df.groups[group], group, parm[group], t_index, resampleFreq)
+                        for group in groups]
+
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+            return list(executor.map(_resample_group, repeat(self.in_file), repeat(path), groups,
+                                     [parm[group] for group in groups], repeat(t_index), repeat(resampleFreq)))
+
     def processResampleNc4File(self, in_file, out_file, parm, resampleFreq, rad_to_deg, args):
         self.reset()
         coord_ts = {}
@@ -1246,88 +1359,14 @@ class InterpolatorWriter(BaseWriter):
         nudge_to_platform=None
         nudge_interval=None
         replace_with_platform=None
-        for group in self.df.groups:
-            g = None
-            variables = None
-
-            if group in list(parm.keys()):
-                g = group
-            else:
-                continue
-
-            times = []
-            subgroup = None
-            pkeys = None
-
-            try:
-                subgroup = self.df.groups[g]
-                pkeys = parm[g]
-
-            except Exception as e:
-                self.logger.error(e)
-                raise e
-
-            if subgroup is not None and pkeys is not None:
-                # Create pandas time series for each parameter and store attributes
-                for p in pkeys:
-                    try:
-                        key = p["rename"]
-                        var = p["name"]
-                        ts = self.createSeries(subgroup.variables, var, var+'_'+'time')
-                        attr = {}
-
-                        # don't store or try to interpolate empty time series
-                        if ts.size == 0:
-                            self.logger.info('Variable ' + var + ' empty so skipping')
-                            continue
-
-                        for name in subgroup.variables[var].ncattrs():
-                            attr[name] = getattr(subgroup.variables[var],name)
-
-                        # Potential override of attributes from json data
-                        for name in ('units', 'standard_name'):
-                            try:
-                                attr[name] = p[name]
-                            except KeyError:
-                                continue
-                        # This could be generalized, but for now simply be explicit
-                        # https://mbari.slack.com/archives/C04ETLY6T7V/p1712181310294609?thread_ts=1712073883.974969&cid=C04ETLY6T7V
-                        if key == 'particulatebackscatteringcoeff470nm':
-                            attr['long_name'] = 'Particulate backscattering coefficient at 470nm'
-                        if key == 'particulatebackscatteringcoeff650nm':
-                            attr['long_name'] = 'Particulate backscattering coefficient at 650nm'
-
-                        self.all_attrib[key] = attr
-
-                        # resample using the mean then interpolate on to the time dimension
-                        ts_resample = ts.resample(resampleFreq.lower()).mean()[:]
-                        i = self.interpolate(ts_resample, t_resample.index)
-
-                        if key.find('pitch') != -1 or key.find('roll') != -1 or key.find('yaw') != -1 or key.find('angle') != -1 or key.find('rate') != -1:
-                            i = i * 180.0 / numpy.pi
-
-                        # store for later processing into the netCDF
-                        self.all_sub_ts[key] = i
-                        self.all_coord[key] = { 'time':'time', 'depth':'depth', 'latitude':'latitude', 'longitude':'longitude'}
-
-                        # plotting for debugging
-                        '''fig, axes = plt.subplots(3)
-                        plt.legend(loc='best')
-                        axes[0].set_title('raw ' + var + ' data')
-                        ts.plot(ax=axes[0],color='r')
-                        axes[1].set_title('resampled')
-                        ts_resample.plot(ax=axes[1],color='g')
-                        axes[2].set_title('interpolated')
-                        i.plot(ax=axes[2],color='b')
-                        plt.show()'''
-
-                        self.logger.info('Found in group ' + group + ' parameter ' + var + ' renaming to ' + key)
-                    except KeyError as e:
-                        self.logger.debug(f"{e} not in {in_file}")
-                        continue
-                    except Exception as e:
-                        self.logger.error(e)
-                        continue
+        # Resample the groups, in parallel with --workers, and collect the results in group order
+        groups = [group for group in self.df.groups if group in parm]
+        workers = getattr(args, 'workers', 1)
+        for results in self.resample_groups(f"/tmp/{base_name}", groups, parm, t_resample.index, resampleFreq, workers):
+            for key, attr, i in results:
+                self.all_attrib[key] = attr
+                self.all_sub_ts[key] = i
+                self.all_coord[key] = { 'time':'time', 'depth':'depth', 'latitude':'latitude', 'longitude':'longitude'}
 
         # add in navigation
         self.createNav(t_resample, resampleFreq)
@@ -47,6 +47,102 @@ bcal = { 'BED00': Polynomial(1, 1, 0),
          'BED11': Polynomial(0.3953, 23.522, -11.29),
        }
 
+# Arrays of the conversions of the rotations of a record of quaternions, see quaternion_rotations()
+Rotations = namedtuple('Rotations', ['rx', 'ry', 'rz', 'px', 'py', 'pz', 'prot', 'mx', 'my', 'mz', 'diffrot', 'difftumble'])
+
+
+def _angle_axis(q):
+    '''
+    Return the angles and axes of the (w, x, y, z) rows of q computed as euclid's Quaternion.get_angle_axis() does,
+    and a mask of the rows for which it raises a math domain error
+    '''
+    w, x, y, z = q.T
+    over = w > 1
+    if over.any():
+        with np.errstate(invalid='ignore', divide='ignore'):
+            d = np.sqrt(w ** 2 + x ** 2 + y ** 2 + z ** 2)
+            w, x, y, z = (np.where(over, c / d, c) for c in (w, x, y, z))
+
+    bad = (w > 1) | (w < -1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        angle = 2 * np.arccos(w)
+        s = np.sqrt(1 - w ** 2)
+        axes = np.column_stack((x / s, y / s, z / s))
+    axes[s < 0.001] = (1, 0, 0)
+
+    return angle, axes, bad
+
+
+def _use_previous(angle, axes, bad, msg, offset=0):
+    '''
+    Replace the angles and axes of the bad rows with those of the previous rows, as the sample by sample code does.
+    Like it, fail if there is no good previous row.
+    '''
+    for i in np.flatnonzero(bad):
+        if i == 0 or bad[i - 1]:
+            raise ValueError('math domain error')
+        print('math domain error')
+        print(msg % (i + offset))
+        angle[i] = angle[i - 1]
+        axes[i] = axes[i - 1]
+
+
+def quaternion_rotations(quats):
+    '''
+    Convert a record of N (w, x, y, z) quaternions, e.g. BEDS.quatList, to the Euler angles, angle-axis rotations, and
+    rotations between successive samples computed sample by sample with the euclid package in BEDS.processRotations(),
+    as arrays for the whole record at once.  The N-1 rotations between samples are preceded by 0.
+    '''
+    q = np.asarray(quats, dtype=np.float64).reshape(-1, 4)
+    w, x, y, z = q.T
+
+    # Quaternion.get_euler() returns heading, attitude, bank (For X3D we get: yRot, zRot, xRot)
+    t = x * y + z * w
+    north = t > 0.4999
+    south = t < -0.4999
+    with np.errstate(invalid='ignore'):
+        heading = np.arctan2(2 * y * w - 2 * x * z, 1 - 2 * y ** 2 - 2 * z ** 2)
+        attitude = np.arcsin(2 * t)
+        bank = np.arctan2(2 * x * w - 2 * y * z, 1 - 2 * x ** 2 - 2 * z ** 2)
+    heading = np.where(north, 2 * np.arctan2(x, w), np.where(south, -2 * np.arctan2(x, w), heading))
+    attitude = np.where(north, np.pi / 2, np.where(south, -np.pi / 2, attitude))
+    bank = np.where(north | south, 0.0, bank)
+
+    # Quaternion.get_angle_axis() of each sample
+    prot, paxes, bad = _angle_axis(q)
+    _use_previous(prot, paxes, bad, 'WARNING: Using previous quaternion at index %d')
+
+    # dq = Quaternion(*quat) * Quaternion(*last_quat).conjugated() with the terms in the order of Quaternion.__mul__()
+    Aw, Ax, Ay, Az = q[1:].T
+    Bw, Bx, By, Bz = q[:-1].T
+    Bx, By, Bz = -Bx, -By, -Bz
+    dq = np.column_stack((-Ax * Bx - Ay * By - Az * Bz + Aw * Bw,
+                          Ax * Bw + Ay * Bz - Az * By + Aw * Bx,
+                          -Ax * Bz + Ay * Bw + Az * Bx + Aw * By,
+                          Ax * By - Ay * Bx + Az * Bw + Aw * Bz))
+    diffrot, maxes, bad = _angle_axis(dq)
+    _use_previous(diffrot, maxes, bad, 'WARNING: Using previous quaternion difference at index %d', offset=1)
+    # Vector3.normalize() leaves zero length axes alone
+    mag = np.sqrt(maxes[:, 0] ** 2 + maxes[:, 1] ** 2 + maxes[:, 2] ** 2)
+    maxes = maxes / np.where(mag != 0, mag, 1)[:, np.newaxis]
+
+    # Angle between the axis of each rotation and the one before it, the first is the axis of the first sample
+    last = np.concatenate((paxes[:1], maxes[:-1]))[:len(maxes)]
+    dot = last[:, 0] * maxes[:, 0] + last[:, 1] * maxes[:, 1] + last[:, 2] * maxes[:, 2]
+    denom = (np.sqrt(last[:, 0] ** 2 + last[:, 1] ** 2 + last[:, 2] ** 2) *
+             np.sqrt(maxes[:, 0] ** 2 + maxes[:, 1] ** 2 + maxes[:, 2] ** 2))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        ratio = dot / denom
+        difftumble = np.abs(np.arccos(ratio))
+    difftumble[(denom == 0) | (np.abs(ratio) > 1)] = 0.0
+
+    zero = np.zeros(1)
+    return Rotations(bank, heading, attitude, paxes[:, 0], paxes[:, 1], paxes[:, 2], prot,
+                     np.concatenate((zero, maxes[:, 0])), np.concatenate((zero, maxes[:, 1])),
+                     np.concatenate((zero, maxes[:, 2])), np.concatenate((zero, diffrot)),
+                     np.concatenate((zero, difftumble)))
+
+
 class NoPressureData(Exception):
     pass
 
@@ -580,11 +676,68 @@ class BEDS(object):
 
     def processRotations(self, useMatlabCode=False):
         '''
-        For member quatList of quaternion tuples produce additional useful member lists for graphical display and analysis
+        For member quatList of quaternion tuples produce additional useful member lists for graphical display and analysis.
+        The euclid package conversions are done for the whole record at once by quaternion_rotations(), the Matlab code
+        conversions, the Euler angle comparison and the most verbose output are done sample by sample.
         '''
         # "Quaternions came from Hamilton after his really good work had been done; and, though beautifully ingenious, 
         # have been an unmixed evil to those who have touched them in any way, including Clerk Maxwell." - Lord Kelvin, 1892.
 
+        if useMatlabCode or getattr(self.args, 'compare_euler', False) or self.args.verbose > 1:
+            self._processRotationsBySample(useMatlabCode)
+        else:
+            self._processRotationsBatched()
+
+        self.angle_rate_comment = 'Calculated with: np.absolute(np.concatenate(([0], np.diff(self.angle)))) * self.rateHz * 180.0 / np.pi'
+        self.angle_rate = np.absolute(np.concatenate(([0], np.diff(self.angle)))) * self.rateHz * 180.0 / np.pi
+        self.angle_count_comment = 'Calculated with: np.cumsum(np.absolute(np.concatenate(([0], np.diff(self.angle))))) / 2. / np.pi'
+        self.angle_count = np.cumsum(np.absolute(np.concatenate(([0], np.diff(self.angle))))) / 2. / np.pi
+
+        # Rate of rotation in deg/sec - pure rotation and tumbling
+        self.rotrate = np.absolute(self.diffrot * self.rateHz * 180.0 / np.pi)
+        self.tumblerate = np.absolute(self.difftumble * self.rateHz * 180.0 / np.pi)
+
+        # Cumultative rotation count - pure rotation and tumbling - filter noisy diffrot before doing cumsum
+        diffrot_filt = savgol_filter(np.absolute(self.diffrot), 11, 3)
+        self.rotcount = np.cumsum(diffrot_filt) / 2. / np.pi
+        self.tumblecount = np.cumsum(np.absolute(self.difftumble)) / 2. / np.pi
+
+    def _processRotationsBatched(self):
+        '''
+        Same as _processRotationsBySample(useMatlabCode=False) with the conversions of all the quaternions done together
+        '''
+        rot = quaternion_rotations(self.quatList)
+        self.euler_comment = 'Converted from recorded Quaternion with Python euclid package Quaternion.get_euler() method'
+        self.p_angle_axis_comment = 'Converted from recorded Quaternion measurement with Python euclid package Quaternion.get_angle_axis() method'
+        self.m_angle_axis_comment = 'Computed with dq = Quaternion(*quat) * Quaternion(*last_quat).conjugated(); dq.get_angle_axis()'
+
+        self.rx, self.ry, self.rz = rot.rx, rot.ry, rot.rz
+        self.mx, self.my, self.mz = rot.mx, rot.my, rot.mz
+        self.px, self.py, self.pz = rot.px, rot.py, rot.pz
+        self.angle = rot.prot
+        self.diffrot = rot.diffrot
+        self.difftumble = rot.difftumble
+
+        # Other modules and the tests use the lists
+        self.rxList, self.ryList, self.rzList = self.rx.tolist(), self.ry.tolist(), self.rz.tolist()
+        self.mxList, self.myList, self.mzList = self.mx.tolist(), self.my.tolist(), self.mz.tolist()
+        self.pxList, self.pyList, self.pzList = self.px.tolist(), self.py.tolist(), self.pz.tolist()
+        self.protList = self.angle.tolist()
+        self.diffrotList = self.diffrot.tolist()
+        self.difftumbleList = self.difftumble.tolist()
+
+        if self.args.verbose:
+            fmtStr = "%2d. xRot, yRot, zRot, diffrot, diffrot_sum = %6.3f %6.3f %6.3f %6.3f %6.3f"
+            fmtStr += "  px, py, pz, prot = %6.3f %6.3f %6.3f %6.3f"
+            diffrot_sum = np.cumsum(self.diffrot)
+            for i in range(len(self.rx)):
+                print(fmtStr % (i+1, self.rx[i], self.ry[i], self.rz[i], self.diffrot[i], diffrot_sum[i],
+                                self.px[i], self.py[i], self.pz[i], self.angle[i]))
+
+    def _processRotationsBySample(self, useMatlabCode=False):
+        '''
+        Convert the quaternions one at a time with the euclid package or the Matlab code
+        '''
         # If readBEDsFile() processes multiple BED files then subsequent self.quatLists will include concatenated data, initialize appended to lists
         self.rxList = []
         self.ryList = []
@@ -732,23 +885,9 @@ class BEDS(object):
         self.py = np.array(self.pyList)
         self.pz = np.array(self.pzList)
         self.angle = np.array(self.protList)
-        self.angle_rate_comment = 'Calculated with: np.absolute(np.concatenate(([0], np.diff(self.angle)))) * self.rateHz * 180.0 / np.pi'
-        self.angle_rate = np.absolute(np.concatenate(([0], np.diff(self.angle)))) * self.rateHz * 180.0 / np.pi
-        self.angle_count_comment = 'Calculated with: np.cumsum(np.absolute(np.concatenate(([0], np.diff(self.angle))))) / 2. / np.pi'
-        self.angle_count = np.cumsum(np.absolute(np.concatenate(([0], np.diff(self.angle))))) / 2. / np.pi
-
         self.diffrot = np.array(self.diffrotList)
         self.difftumble = np.array(self.difftumbleList)
 
-        # Rate of rotation in deg/sec - pure rotation and tumbling
-        self.rotrate = np.absolute(self.diffrot * self.rateHz * 180.0 / np.pi)
-        self.tumblerate = np.absolute(self.difftumble * self.rateHz * 180.0 / np.pi)
-
-        # Cumultative rotation count - pure rotation and tumbling - filter noisy diffrot before doing cumsum
-        diffrot_filt = savgol_filter(np.absolute(self.diffrot), 11, 3)
-        self.rotcount = np.cumsum(diffrot_filt) / 2. / np.pi
-        self.tumblecount = np.cumsum(np.absolute(self.difftumble)) / 2. / np.pi
-
     def computeTide(self):
         '''Use MB-System command to run OSTP2 model for computing tides from time and location
         '''
@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+'''
+Compare the rotations that BEDS.processRotations() computes for a whole record of quaternions at once
+with quaternion_rotations() against the sample by sample conversions with the euclid package.
+
+Usage: python -m unittest testBEDSrotations
+'''
+
+import unittest
+import numpy as np
+from argparse import Namespace
+from BEDS import BEDS
+from euclid import Quaternion, Vector3
+
+
+class TestBatchedRotations(unittest.TestCase):
+
+    def process(self, quatList, batched):
+        beds = BEDS()
+        beds.args = Namespace(verbose=0, compare_euler=False)
+        beds.rateHz = 10.0
+        beds.quatList = quatList
+        if batched:
+            beds.processRotations()
+        else:
+            beds._processRotationsBySample()
+
+        return beds
+
+    def compare(self, quatList):
+        '''Compare the batched conversions with the sample by sample euclid ones
+        '''
+        sample = self.process(quatList, batched=False)
+        batch = self.process(quatList, batched=True)
+        for name in ('rx', 'ry', 'rz', 'px', 'py', 'pz', 'angle', 'mx', 'my', 'mz', 'diffrot', 'difftumble'):
+            expected, actual = getattr(sample, name), getattr(batch, name)
+            self.assertEqual(expected.shape, actual.shape, name)
+            self.assertTrue(np.allclose(expected, actual, rtol=0, atol=1e-12, equal_nan=True), name)
+
+    def testAxes(self):
+        '''Rotations about each axis and back
+        '''
+        quatList = []
+        for axis in (Vector3(1, 0, 0), Vector3(0, 1, 0), Vector3(0, 0, 1)):
+            for angle in np.append(np.linspace(0.0, np.pi, 5), np.linspace(np.pi, 0.0, 5)):
+                q = Quaternion.new_rotate_axis(angle, axis)
+                quatList.append((q.w, q.x, q.y, q.z))
+        self.compare(quatList)
+
+    def testTumbling(self):
+        '''Random walks of rotations with still periods, as recorded with 4 significant digits
+        '''
+        rs = np.random.RandomState(0)
+        for scale in (0.005, 0.05, 0.5):
+            q = Quaternion()
+            quatList = []
+            for _ in range(1000):
+                x, y, z = rs.normal(0, scale, 3) * (rs.rand() > 0.3)
+                q = (q * Quaternion(1, x, y, z).normalized()).normalized()
+                quatList.append(tuple(float('{:0.4}'.format(v)) for v in (q.w, q.x, q.y, q.z)))
+            self.compare(quatList)
+
+    def testEdges(self):
+        '''Gimbal lock, unnormalized and out of domain quaternions
+        '''
+        quatList = []
+        for t in np.linspace(0.4995, 0.5003, 20):
+            quatList.extend([(float(np.sqrt(t)), float(np.sqrt(t)), 0.0, 0.0), (0.7071, 0.0, 0.0, 0.7072),
+                             (1.00001, 0.0, 0.0, 0.0), (0.5, 0.0, 0.0, 0.0)])
+        quatList.extend([(1.0, 0.0, 0.0, 0.0), (-1.00001, 0.0, 0.0, 0.0), (0.9, 0.1, 0.0, 0.0)])
+        self.compare(quatList)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -26,11 +26,12 @@ MBARI Dec 29, 2011
 '''
 
 # Force lookup of models to THE specific stoqs module.
+import json
 import os
 import re
 import sys
 from argparse import Namespace
-from django.contrib.gis.geos import LineString, Point
+from django.contrib.gis.geos import GEOSGeometry, Point
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), "../"))  # config is one dir up
 if 'DJANGO_SETTINGS_MODULE' not in os.environ:
     os.environ['DJANGO_SETTINGS_MODULE'] = 'config.settings.local'
@@ -38,7 +39,7 @@ from django.conf import settings
 
 from django.db.models import Max
 from django.db.utils import IntegrityError, DatabaseError
-from django.db import transaction
+from django.db import connections, transaction
 from jdcal import gcal2jd, jd2gcal
 from stoqs.models import (Activity, InstantPoint, Measurement, MeasuredParameter,
                           NominalLocation, Resource, ResourceType, ActivityResource,
@@ -46,17 +47,20 @@ from stoqs.models import (Activity, InstantPoint, Measurement, MeasuredParameter
 from datetime import datetime, timedelta
 from psycopg2.errors import UniqueViolation
 import pytz
-from pydap.client import open_url
 import pydap.model
 import math
 from cftime import num2date, date2num
 import logging
 import socket
+import threading
+from contextlib import closing
+from queue import Empty, Full, Queue
 import seawater.eos80 as sw
 from utils.utils import mode, simplify_points
 from loaders import (STOQS_Loader, SkipRecord, HasMeasurement, MEASUREDINSITU, FileNotFound,
-                     SIGMAT, SPICE, SPICINESS, ALTITUDE)
+                     SIGMAT, SPICE, SPICINESS, ALTITUDE, METADATA_LOCK, advisory_lock, in_load_worker)
 from loaders.SampleLoaders import get_closest_instantpoint, ClosestTimeNotFoundException
+from loaders.local_netcdf import close_dataset, open_dataset
 import numpy as np
 import psycopg2
 from collections import defaultdict
@@ -93,6 +97,18 @@ LONGITUDE = 'longitude'
 #   TODO: Load these data as trajectoryProfile with point simplification (removal of redundant data points).
 BATCH_SIZE=10000
 
+# Number of Parameter slices that load_trajectory() reads ahead from the dataset while the previous
+# ones are inserted with bulk_create(); 0 reads each slice just before it's inserted
+PREFETCH_SLICES=2
+
+# Number of records of a coordinate group that load_trajectory() loads in each transaction; after each
+# one the index of the next record is saved in a Resource named CHECKPOINT, from which --resume restarts
+CHECKPOINT_RECORDS=100000
+CHECKPOINT='load_checkpoint'
+
+# Tolerance in degrees of the ST_SimplifyPreserveTopology() of an Activity's Measurements for its maptrack
+MAPTRACK_TOLERANCE=.001
+
 if settings.DEBUG:
     BaseDatabaseWrapper.make_debug_cursor = lambda self, cursor: CursorWrapper(cursor, self)
 
@@ -133,6 +149,59 @@ class CoordNotEqual(Exception):
     pass
 
 
+class SegmentNotLoaded(Exception):
+    pass
+
+
+def prefetch(keys, read, depth=PREFETCH_SLICES):
+    '''Generate (key, read(key)) for each of keys, in order, with the reads done in a reader thread
+    that stays at most depth results ahead of the consumer.  An exception raised by read() stops
+    the reader and is raised here when the consumer gets to its key.  Use with contextlib.closing()
+    so that the reader is stopped when the consumer leaves early.
+    '''
+    keys = list(keys)
+    if depth < 1:
+        for key in keys:
+            yield key, read(key)
+        return
+
+    queue = Queue(maxsize=depth)
+    stop = threading.Event()
+
+    def produce():
+        for key in keys:
+            try:
+                item = (key, read(key), None)
+            except Exception as e:
+                item = (key, None, e)
+            # Block while the queue is full, but give up when the consumer has gone away
+            while not stop.is_set():
+                try:
+                    queue.put(item, timeout=0.1)
+                    break
+                except Full:
+                    pass
+            if stop.is_set() or item[2] is not None:
+                return
+
+    reader = threading.Thread(target=produce, name='prefetch', daemon=True)
+    reader.start()
+    try:
+        for _ in keys:
+            key, values, error = queue.get()
+            if error is not None:
+                raise error
+            yield key, values
+    finally:
+        stop.set()
+        # Unblock a put() so that the reader notices stop right away
+        try:
+            queue.get_nowait()
+        except Empty:
+            pass
+        reader.join()
+
+
 class Base_Loader(STOQS_Loader):
     '''
     A base class for data load operations.  This shouldn't be instantiated directly,
@@ -166,7 +235,7 @@ class Base_Loader(STOQS_Loader):
         @param platformName: A string that is the name of the platform. 
                              If that name for a Platform exists in the DB, it will be used.
         @param platformColor: An RGB hex string represnting the color of the platform. 
-        @param url: The OPeNDAP URL for the data source
+        @param url: The OPeNDAP URL for the data source, or a file:// URL or path of a local NetCDF file
         @param dbAlias: The name of the database alias as defined in settings.py
         @param campaignName: A string describing the Campaign in which this activity belongs. 
                              If that name for a Campaign exists in the DB, it will be used.
@@ -206,11 +275,15 @@ class Base_Loader(STOQS_Loader):
         self.grdTerrain = grdTerrain
         self.command_line_args = command_line_args
         self.coord_dicts = {}
+        self.checkpoints = {}
+        # Coordinates loaded by _bulk_load_coordinates(), to be reused by axes with the same values
+        self.instantpoints = {}
+        self.measurements = {}
 
         self.url = url
         self.varsLoaded = []
         try:
-            self.ds = open_url(url)
+            self.ds = open_dataset(url)
         except (socket.error, pydap.exceptions.ServerError, pydap.exceptions.ClientError):
             message = 'Failed in attempt to open_url("%s")' % url
             self.logger.warn(message)
@@ -805,84 +878,6 @@ class Base_Loader(STOQS_Loader):
 
         return count 
 
-    def _equal_coords(self, load_groups, coor_groups):
-        '''Peek at the data in the axes and mark with True values those elements that match.
-        This is a special fix for realtime LRAUV data from shore_i.nc files.
-        Tested with:
-        1. Initial short mission
-        http://dods.mbari.org/opendap/data/lrauv/whoidhs/realtime/sbdlogs/2019/201906/20190609T194744/shore_i.nc
-        2. Unequal array lengths
-        http://dods.mbari.org/opendap/data/lrauv/whoidhs/realtime/sbdlogs/2019/201906/20190609T202208/shore_i.nc
-        3. Very unequal lengths, pad with 41 zeros; fails with duplicate key value
-        http://dods.mbari.org/opendap/data/lrauv/whoidhs/realtime/sbdlogs/2019/201906/20190612T024430/shore_i.nc
-        4. Horrendously bad result with coordinates and data represented badly in STOQS UI section plots.
-        (Implemented temporary fix by not loading salinity; problem occurs with loading both temperature & salinity)
-        http://dods.mbari.org/opendap/data/lrauv/makai/realtime/sbdlogs/2020/202010/20201008T014813/shore_i.nc
-    
-        The role of this method is to identify truly equal coordinates of variables to be loaded for the 
-        calling routine to determine whether a bulk_create() may be done or whether the variables need to be
-        loaded the old fashioned (slower) way - one element at a time, reusing previously loaded coordinates.
-
-        N.B.: In Janurary 2022 stoqs/loaders/CANON/toNetCDF/lrauvNc4ToNetcdf.py was modified to re-interpolate
-        the decimated data to '2S' frequency and use common coordinate axes for all variables - so this finction
-        isn't really needed for those new shore_i.nc files.
-        '''
-        coord_equals = {}
-        if len(coor_groups) == 1:
-            self.logger.info(f"Single set of coordinates as would be found in a modern shore_i.nc file")
-            return coord_equals
-        for count, (axes, ac) in enumerate(coor_groups.items()):
-            self.logger.info(f"Initializing coord_equals to all False for axes {axes}")
-            self.logger.info(f"Number of {ac[TIME]} values: {len(self.ds[ac[TIME]])}")
-            coord_equals[axes] = np.full(len(self.ds[ac[TIME]]), False)
-
-            variable = load_groups[axes][0]
-            if count > 0:
-                if len(last_times) < len(self.ds[ac[TIME]]):
-                    self.logger.info(f"len(last_times) ({len(last_times)}) < len(self.ds[ac[TIME]]) ({len(self.ds[ac[TIME]])})")
-                    num_pad = len(self.ds[ac[TIME]]) - len(last_times)
-                    self.logger.info(f"Padding last_ coordinate arrays with {num_pad} zero(s) to match (taking a chance) the self.ds coordinate arrays")
-                    last_times = np.pad(last_times, [(0, num_pad)], mode='constant', constant_values=0)
-                    last_depths = np.pad(last_depths, [(0, num_pad)], mode='constant', constant_values=0)
-                    last_latitudes = np.pad(last_latitudes, [(0, num_pad)], mode='constant', constant_values=0)
-                    last_longitudes = np.pad(last_longitudes, [(0, num_pad)], mode='constant', constant_values=0)
-
-                if len(last_times) > len(self.ds[ac[TIME]]):
-                    self.logger.warn(f"len(last_times) ({len(last_times)}) > len(self.ds[ac[TIME]]) ({len(self.ds[ac[TIME]])})")
-                    self.logger.warn(f"Not Padding self.ds arrays - not able to attempt a fix")
-                    continue
-
-                self.logger.debug(f"Comparing coords with those from {last_variables}")
-                times_equal = np.equal(last_times, self.ds[ac[TIME]])
-                self.logger.debug(f"  {variable} times: {times_equal}")
-                self.logger.debug(f"    {list(last_times[:])}")
-                self.logger.debug(f"    {list(self.ds[ac[TIME]])}")
-                depths_equal = np.equal(last_depths, self.ds[ac[DEPTH]][ac[DEPTH]])
-                self.logger.debug(f"  {variable} depths: {depths_equal}")
-                self.logger.debug(f"    {list(last_depths[:])}")
-                self.logger.debug(f"    {list(self.ds[ac[DEPTH]][ac[DEPTH]])}")
-                latitudes_equal = np.equal(last_latitudes, self.ds[ac[LATITUDE]][ac[LATITUDE]])
-                self.logger.debug(f"  {variable} latitudes: {latitudes_equal}")
-                self.logger.debug(f"    {list(last_latitudes[:])}")
-                self.logger.debug(f"    {list(self.ds[ac[LATITUDE]][ac[LATITUDE]])}")
-                longitudes_equal = np.equal(last_longitudes, self.ds[ac[LONGITUDE]][ac[LONGITUDE]])
-                self.logger.debug(f"  {variable} longitudes: {longitudes_equal}")
-                self.logger.debug(f"    {list(last_longitudes[:])}")
-                self.logger.debug(f"    {list(self.ds[ac[LONGITUDE]][ac[LONGITUDE]])}")
-                coord_equals[axes] = np.logical_and(np.logical_and(times_equal, 
-                                                                   depths_equal), 
-                                                    np.logical_and(latitudes_equal, 
-                                                                   longitudes_equal))
-                self.logger.debug(f"  {variable} .logical_and(): {coord_equals[axes]}")
-        
-            last_times = self.ds[ac[TIME]]
-            last_depths = self.ds[ac[DEPTH]][ac[DEPTH]]
-            last_latitudes = self.ds[ac[LATITUDE]][ac[LATITUDE]]
-            last_longitudes = self.ds[ac[LONGITUDE]][ac[LONGITUDE]]
-            last_variables = load_groups[axes]
-
-        return coord_equals
-
     def get_load_structure(self):
         '''Return data structure organized by Parameters with common coordinates.
         This supports the use of bulk_create() to speed the loading of data.
@@ -1176,19 +1171,93 @@ class Base_Loader(STOQS_Loader):
 
         return meass, dup_times, mask
 
+    def _read_values(self, pname, tindx, multidim_trajectory=False):
+        '''Return the strided slice of pname's values and a description of it, values is None
+        if the slice can't be made.  Called from the prefetch() reader thread.
+        '''
+        try:
+            if isinstance(self.ds[pname], pydap.model.GridType):
+                constraint_string = f"(GridType) using python slice: ds['{pname}']['{pname}'][{tindx[0]}:{tindx[-1]}:{self.stride}]"
+                values = self.ds[pname][pname].data[tindx[0]:tindx[-1]:self.stride]
+            elif multidim_trajectory:
+                self.logger.info(f"(multidim) loading {pname} from multidimensional trajectory file")
+                constraint_string = f"using python slice: ds['{pname}'][0][0][{tindx[0]}:{tindx[-1]}:{self.stride}]"
+                # TODO: Deal with (as yet unseen) case where multiple trajectories exist in a netCDF file
+                values = self.ds[pname].data[0][0][tindx[0]:tindx[-1]:self.stride]
+            else:
+                constraint_string = f"(default) using python slice: ds['{pname}'][{tindx[0]}:{tindx[-1]}:{self.stride}]"
+                values = self.ds[pname].data[tindx[0]:tindx[-1]:self.stride]
+        except ValueError:
+            return None, ''
+
+        return values, constraint_string
+
+    def _checkpoints(self):
+        '''Return the checkpoint Resources of the Activity for loads from self.url keyed by (axes, stride)
+        '''
+        checkpoints = {}
+        for resource in Resource.objects.using(self.dbAlias).filter(activityresource__activity=self.activity,
+                                                                    name=CHECKPOINT, uristring=self.url):
+            checkpoint = json.loads(resource.value)
+            checkpoints[(checkpoint['axes'], checkpoint['stride'])] = resource
+
+        return checkpoints
+
+    def _segments(self, axes, tindx, add_to_activity=None):
+        '''Generate the (start, end) indices of the segments of tindx to load in turn, starting after
+        the checkpoint of axes if --resume was given
+        '''
+        start, end = tindx[0], tindx[-1]
+        checkpoint = self.checkpoints.get((axes, self.stride))
+        if checkpoint:
+            if getattr(self.command_line_args, 'resume', False):
+                start = json.loads(checkpoint.value)['next']
+                self.logger.info(f'Resuming load of axes {axes} from {self.url} at index {start} of {tindx[0]}:{end}')
+            else:
+                self.logger.warning(f'{self.activity} has a checkpoint from an interrupted load of {self.url}, '
+                                    f'use --resume to continue it')
+        if add_to_activity:
+            # _meass_from_activity() matches all of the Measurements of add_to_activity at once
+            yield start, end
+            return
+
+        step = CHECKPOINT_RECORDS * self.stride
+        for seg_start in range(start, end, step):
+            yield seg_start, min(seg_start + step, end)
+
+    def _save_checkpoint(self, axes, tindx):
+        '''Record that the records of axes up to the end of segment tindx are loaded, called within
+        the transaction that loaded them
+        '''
+        value = json.dumps({'axes': axes, 'stride': self.stride, 'next': int(tindx[-1])})
+        resource = self.checkpoints.get((axes, self.stride))
+        if resource:
+            resource.value = value
+            resource.save(using=self.dbAlias)
+            return
+
+        resourceType, _ = ResourceType.objects.using(self.dbAlias).get_or_create(
+                        name=CHECKPOINT, description='Index of the next record to load from a URL')
+        resource = Resource.objects.using(self.dbAlias).create(name=CHECKPOINT, value=value, uristring=self.url,
+                                                               resourcetype=resourceType)
+        ActivityResource.objects.using(self.dbAlias).create(activity=self.activity, resource=resource)
+        self.checkpoints[(axes, self.stride)] = resource
+
+    def _delete_checkpoints(self):
+        '''Remove the checkpoints of a load that has completed
+        '''
+        for resource in self.checkpoints.values():
+            resource.delete(using=self.dbAlias)
+        self.checkpoints = {}
+
     def load_trajectory(self, add_to_activity=None):
-        '''Stream trajectory data directly from pydap proxies to generators fed to bulk_create() calls
+        '''Stream trajectory data directly from pydap proxies to generators fed to bulk_create() calls.
+        The values of the next Parameters are fetched by a prefetch() reader thread during the inserts.
+        Each segment of CHECKPOINT_RECORDS records is committed with a checkpoint for --resume.
         '''
         multidim_trajectory = False
         load_groups, coor_groups = self.get_load_structure()
-        coords_equal_hash = {}
-        if 'shore_i.nc' in self.url:
-            try:
-                # Variables from same NetCDF4 group in realtime LRAUV data have different axis names,
-                # but same coord values. Find them to not load duplicate measurements.
-                coords_equal_hash = self._equal_coords(load_groups, coor_groups)
-            except ValueError as e:
-                self.logger.warning(f"Skipping {self.url}: {e}")
+        self.checkpoints = self._checkpoints()
 
         total_loaded = 0
         mask = []
@@ -1206,117 +1275,109 @@ class Base_Loader(STOQS_Loader):
                 self.logger.warn(f'Failed to getTimeBegEndIndices() for axes {k} from {self.url}')
                 continue
 
-            for i, pname in enumerate(pnames):
-                self.logger.debug(f'{i}, {pname}')
-                if i == 0:
-                    # First time through, bulk load the coordinates: instant_points and measurements
-                    if DEPTH not in ac:
-                        self.logger.warn(f'{self.param_by_key[pname]} does not have {DEPTH} in {ac}. Skipping.')
-                        continue
-                    if ac[DEPTH] not in self.ds and isinstance(ac[DEPTH], (int, float)):
-                        # Likely u and v parameters from nemesis glider data where there is no depth_uv coordinate in the NetCDF
-                        self.logger.info(f'{self.param_by_key[pname]} does not have {DEPTH} in {self.url}.')
-                        self.logger.info(f'ac[DEPTH] = {ac[DEPTH]}. Assume that this depth coordinate was provided in auxCoords')
-                        self.logger.info(f'Loading coordinates for axes {k}')
-                        meass, dup_times, mask = self._load_coords_from_dsg_ds(tindx, ac, pnames, k, multidim_trajectory=multidim_trajectory)
-                    elif ac[DEPTH] in self.ds and ac[LATITUDE] in self.ds and ac[LONGITUDE] in self.ds:
-                        try:
-                            # Expect CF Discrete Sampling Geometry or EPIC dataset
-                            self.logger.info(f'Loading coordinates for axes {k}')
-                            if coords_equal_hash == {}:
-                                if add_to_activity:
-                                    meass, dup_times, mask = self._meass_from_activity(add_to_activity, tindx, ac)
+            # Load the records in segments, each in its own transaction followed by a checkpoint of the
+            # next index to load, so that a failed load can be resumed
+            for tindx in self._segments(k, tindx, add_to_activity):
+                # Read the Parameters' values in a reader thread while the previous ones are inserted
+                read = lambda pname, tindx=tindx: self._read_values(pname, tindx, multidim_trajectory)
+                segment_counts = {}
+                try:
+                    with transaction.atomic(using=self.dbAlias), closing(prefetch(pnames, read)) as slices:
+                        for i, (pname, (values, constraint_string)) in enumerate(slices):
+                            self.logger.debug(f'{i}, {pname}')
+                            if i == 0:
+                                # First time through, bulk load the coordinates: instant_points and measurements
+                                if DEPTH not in ac:
+                                    self.logger.warn(f'{self.param_by_key[pname]} does not have {DEPTH} in {ac}. Skipping.')
+                                    continue
+                                if ac[DEPTH] not in self.ds and isinstance(ac[DEPTH], (int, float)):
+                                    # Likely u and v parameters from nemesis glider data where there is no depth_uv coordinate in the NetCDF
+                                    self.logger.info(f'{self.param_by_key[pname]} does not have {DEPTH} in {self.url}.')
+                                    self.logger.info(f'ac[DEPTH] = {ac[DEPTH]}. Assume that this depth coordinate was provided in auxCoords')
+                                    self.logger.info(f'Loading coordinates for axes {k}')
+                                    meass, dup_times, mask = self._load_coords_from_dsg_ds(tindx, ac, pnames, k, multidim_trajectory=multidim_trajectory)
+                                elif ac[DEPTH] in self.ds and ac[LATITUDE] in self.ds and ac[LONGITUDE] in self.ds:
+                                    try:
+                                        # Expect CF Discrete Sampling Geometry or EPIC dataset.  Coordinates shared with
+                                        # previously loaded axes are reused by _bulk_load_coordinates()
+                                        self.logger.info(f'Loading coordinates for axes {k}')
+                                        if add_to_activity:
+                                            meass, dup_times, mask = self._meass_from_activity(add_to_activity, tindx, ac)
+                                        else:
+                                            meass, dup_times, mask = self._load_coords_from_dsg_ds(tindx, ac, pnames, k)
+                                    except CoordNotEqual as e:
+                                        self.logger.exception(e)
+                                        sys.exit(-1)
+                                    except ValueError as e:
+                                        # Likely ValueError: not enough values to unpack (expected 5, got 0) from good_coords()
+                                        self.logger.debug(str(e))
+                                        self.logger.warn(f'No good coordinates for {pname} - skipping it')
+                                        continue
+                                    except OverflowError as e:
+                                        # Likely unable to convert a udunit to a value as in time from:
+                                        # http://legacy.cencoos.org:8080/thredds/dodsC/gliders/Line66/Nemesis/nemesis_201705/nemesis_20170518T203246_rt0.nc.ascii?time[149:1:149]
+                                        # = -4.31865376e+107  (should be a value like 1.495143822559231E9)
+                                        self.logger.debug(str(e))
+                                        raise SegmentNotLoaded(f'OverflowError when converting coordinates for {pname}')
                                 else:
-                                    meass, dup_times, mask = self._load_coords_from_dsg_ds(tindx, ac, pnames, k)
+                                    # Expect instrument (time-coordinate-only) dataset
+                                    self.logger.warn(f'{pname} has no {ac[DEPTH]} coordinate - processing as time-coordinate-only, e.g. LOPC')
+                                    meass = self._load_coords_from_instr_ds(tindx, ac)
+
+                            if values is None:
+                                raise SegmentNotLoaded(f'Stride of {self.stride} likely greater than range of data: {tindx[0]}:{tindx[-1]}')
+
+                            # Test whether we need to make values iterable
+                            try:
+                                self.logger.debug(f"len(values) = {len(values)}")
+                            except TypeError:
+                                # Likely values is a single valued array, e.g. nemesis u, v data
+                                values = [float(values)]
+
+                            if mask:
+                                # Mask the values and dup_times where coordinates are bad
+                                # Need values as a list() because of LOPC test below
+                                values = list(self._mask_data(values, mask))
+                                if not values:
+                                    self.logger.warning(f'Coordinates likely bad - check them here:')
+                                    self.logger.warning(f"Depth data: {self.url}.ascii?{ac[DEPTH]}[{tindx[0]}:{self.stride}:{tindx[-1] - 1}]")
+                                    self.logger.warning(f"Latitude data: {self.url}.ascii?{ac[LATITUDE]}[{tindx[0]}:{self.stride}:{tindx[-1] - 1}]")
+                                    self.logger.warning(f"Longitude data: {self.url}.ascii?{ac[LONGITUDE]}[{tindx[0]}:{self.stride}:{tindx[-1] - 1}]")
+                                    raise SegmentNotLoaded(f'No values of {pname} with good coordinates')
+
+                            self.logger.info(f"Time data: {self.url}.ascii?{ac[TIME]}[{tindx[0]}:{self.stride}:{tindx[-1] - 1}]")
+                            if hasattr(values[0], '__iter__'):
+                                # For data like LOPC data - expect all values to be non-nan, load array and the sum of it
+                                self.param_by_key[pname].description = 'Sum of counts saved in datavalue, spectrum of counts saved in dataarray'
+                                self.param_by_key[pname].save(using=self.dbAlias)
+                                mps = (MeasuredParameter(measurement=me, parameter=self.param_by_key[pname], 
+                                                            dataarray=list(va), datavalue=sum(va)) 
+                                                            for me, va in zip(meass, values))
                             else:
-                                meass, dup_times, mask = self._load_coords_from_dsg_ds(tindx, ac, pnames, k, coords_equal_hash[k])
-                        except CoordNotEqual as e:
-                            self.logger.exception(e)
-                            sys.exit(-1)
-                        except ValueError as e:
-                            # Likely ValueError: not enough values to unpack (expected 5, got 0) from good_coords()
-                            self.logger.debug(str(e))
-                            self.logger.warn(f'No good coordinates for {pname} - skipping it')
-                            continue
-                        except OverflowError as e:
-                            # Likely unable to convert a udunit to a value as in time from:
-                            # http://legacy.cencoos.org:8080/thredds/dodsC/gliders/Line66/Nemesis/nemesis_201705/nemesis_20170518T203246_rt0.nc.ascii?time[149:1:149]
-                            # = -4.31865376e+107  (should be a value like 1.495143822559231E9)
-                            self.logger.debug(str(e))
-                            self.logger.warn(f'OverflowError when converting coordinates for {pname} - skipping it')
-                            return total_loaded
-                    else:
-                        # Expect instrument (time-coordinate-only) dataset
-                        self.logger.warn(f'{pname} has no {ac[DEPTH]} coordinate - processing as time-coordinate-only, e.g. LOPC')
-                        meass = self._load_coords_from_instr_ds(tindx, ac)
-                else:
-                    # Parameters after the first one
-                    if k in coords_equal_hash:
-                        if coords_equal_hash[k].all():
-                            # For follow-on Parameters using same axes, pass in equal coordinates boolean array
-                            meass, dup_times, mask = self._load_coords_from_dsg_ds(tindx, ac, pnames, k, coords_equal_hash[k])
-                        else:
-                            # Load Parameter one element at a time - the old fashioned (slower) way
-                            self.logger.warning(f"Parameter {pname} does not share the same coordinates of previously loaded Parameters, skipping for now.")
-                            self.logger.debug(f"coords_equal_hash[{k}] = {coords_equal_hash[k]}")
-                            continue
-                            # TODO: Implement one element at a time loader method
-                try:
-                    if isinstance(self.ds[pname], pydap.model.GridType):
-                        constraint_string = f"(GridType) using python slice: ds['{pname}']['{pname}'][{tindx[0]}:{tindx[-1]}:{self.stride}]"
-                        values = self.ds[pname][pname].data[tindx[0]:tindx[-1]:self.stride]
-                    elif multidim_trajectory:
-                        self.logger.info(f"(multidim) loading {pname} from multidimensional trajectory file")
-                        constraint_string = f"using python slice: ds['{pname}'][0][0][{tindx[0]}:{tindx[-1]}:{self.stride}]"
-                        # TODO: Deal with (as yet unseen) case where multiple trajectories exist in a netCDF file
-                        values = self.ds[pname].data[0][0][tindx[0]:tindx[-1]:self.stride]
-                    else:
-                        constraint_string = f"(default) using python slice: ds['{pname}'][{tindx[0]}:{tindx[-1]}:{self.stride}]"
-                        values = self.ds[pname].data[tindx[0]:tindx[-1]:self.stride]
-                except ValueError:
-                    self.logger.warn(f'Stride of {self.stride} likely greater than range of data: {tindx[0]}:{tindx[-1]}')
-                    self.logger.warn(f'Skipping load of {self.url}')
+                                # Need to bulk_create() all values, set bad ones to None and remove them after insert
+                                values = self._good_value_generator(pname, values)
+                                mps = (MeasuredParameter(measurement=me, parameter=self.param_by_key[pname], 
+                                                            datavalue=va) for me, va, dt in zip(
+                                                            meass, values, dup_times) if not dt)
+
+                            # All items but meass are generators, so we can call len() on it
+                            self.logger.info(f'Bulk loading {len(meass)} {self.param_by_key[pname]} datavalues into MeasuredParameter {constraint_string} with batch_size = {BATCH_SIZE}')
+                            mps = self._measuredparameter_with_measurement(meass, mps)
+                            mps = MeasuredParameter.objects.using(self.dbAlias).bulk_create(mps, batch_size=BATCH_SIZE)
+                            segment_counts[self.param_by_key[pname]] = segment_counts.get(self.param_by_key[pname], 0) + len(mps)
+
+                        self._save_checkpoint(k, tindx)
+                except SegmentNotLoaded as e:
+                    # The segment is rolled back and the checkpoints are kept so that the load isn't taken as complete
+                    self.logger.warning(f'{e} - skipping load of {self.url} from index {tindx[0]}')
                     return total_loaded
 
-                # Test whether we need to make values iterable
-                try:
-                    self.logger.debug(f"len(values) = {len(values)}")
-                except TypeError:
-                    # Likely values is a single valued array, e.g. nemesis u, v data
-                    values = [float(values)]
-
-                if mask:
-                    # Mask the values and dup_times where coordinates are bad
-                    # Need values as a list() because of LOPC test below
-                    values = list(self._mask_data(values, mask))
-                    if not values:
-                        self.logger.warning(f'Coordinates likely bad - check them here:')
-                        self.logger.warning(f"Depth data: {self.url}.ascii?{ac[DEPTH]}[{tindx[0]}:{self.stride}:{tindx[-1] - 1}]")
-                        self.logger.warning(f"Latitude data: {self.url}.ascii?{ac[LATITUDE]}[{tindx[0]}:{self.stride}:{tindx[-1] - 1}]")
-                        self.logger.warning(f"Longitude data: {self.url}.ascii?{ac[LONGITUDE]}[{tindx[0]}:{self.stride}:{tindx[-1] - 1}]")
-                        return total_loaded
-
-                self.logger.info(f"Time data: {self.url}.ascii?{ac[TIME]}[{tindx[0]}:{self.stride}:{tindx[-1] - 1}]")
-                if hasattr(values[0], '__iter__'):
-                    # For data like LOPC data - expect all values to be non-nan, load array and the sum of it
-                    self.param_by_key[pname].description = 'Sum of counts saved in datavalue, spectrum of counts saved in dataarray'
-                    self.param_by_key[pname].save(using=self.dbAlias)
-                    mps = (MeasuredParameter(measurement=me, parameter=self.param_by_key[pname], 
-                                                dataarray=list(va), datavalue=sum(va)) 
-                                                for me, va in zip(meass, values))
-                else:
-                    # Need to bulk_create() all values, set bad ones to None and remove them after insert
-                    values = self._good_value_generator(pname, values)
-                    mps = (MeasuredParameter(measurement=me, parameter=self.param_by_key[pname], 
-                                                datavalue=va) for me, va, dt in zip(
-                                                meass, values, dup_times) if not dt)
+                for parameter, count in segment_counts.items():
+                    self.parameter_counts[parameter] = self.parameter_counts.get(parameter, 0) + count
+                    total_loaded += count
 
-                # All items but meass are generators, so we can call len() on it
-                self.logger.info(f'Bulk loading {len(meass)} {self.param_by_key[pname]} datavalues into MeasuredParameter {constraint_string} with batch_size = {BATCH_SIZE}')
-                mps = self._measuredparameter_with_measurement(meass, mps)
-                mps = MeasuredParameter.objects.using(self.dbAlias).bulk_create(mps, batch_size=BATCH_SIZE)
-                self.parameter_counts[self.param_by_key[pname]] = len(mps)
-                total_loaded += len(mps)
+        # Every segment of every coordinate group has been committed
+        self._delete_checkpoints()
 
         return total_loaded
 
@@ -1609,42 +1670,70 @@ class Base_Loader(STOQS_Loader):
 
         return total_loaded
 
-    def _measurement_with_instantpoint(self, ips, meass):
-        for ip, meas in zip(ips, meass):
-            meas.instantpoint = ip
-            yield meas
-       
-    def _bulk_load_coordinates(self, ips, meass, dup_times, ac, axes):
+    def _read_loaded_coordinates(self, timevalues):
+        '''Add the InstantPoints of the Activity in the range of timevalues that are not in
+        self.instantpoints, e.g. from a previous load that this one appends to, to the maps of
+        loaded coordinates
+        '''
+        ips = (InstantPoint.objects.using(self.dbAlias)
+                           .filter(activity=self.activity, timevalue__gte=min(timevalues),
+                                   timevalue__lte=max(timevalues)))
+        new_ips = {ip.id: ip for ip in ips if ip.timevalue not in self.instantpoints}
+        if not new_ips:
+            return
+        self.logger.info(f'Reusing {len(new_ips)} InstantPoints already in the database')
+        for ip in new_ips.values():
+            self.instantpoints[ip.timevalue] = ip
+        for meas in Measurement.objects.using(self.dbAlias).filter(instantpoint_id__in=list(new_ips)):
+            meas.instantpoint = new_ips[meas.instantpoint_id]
+            self.measurements[(meas.instantpoint_id, float(meas.depth), meas.geom.x, meas.geom.y)] = meas
 
-        self.logger.info(f'Calling bulk_create() for InstantPoints in ips generator')
+    def _bulk_load_coordinates(self, ips, meass, dup_times, ac, axes):
+        '''Bulk create the InstantPoints and Measurements of axes that haven't already been loaded
+        from other axes.  Datasets with several time bases share InstantPoints through the timevalue
+        map in self.instantpoints, and Measurements through self.measurements.  Return the Measurement
+        of each good coordinate and a mask that is True for the bad and repeated ones.
+        '''
         # Create mask array in case any coordinate is None, so that we can know which MPs to bulk_create()
         mask = []
-        ips_to_load = []
-        meas_to_load = []
+        coords = []
         for ip, meas, dt in zip(ips, meass, dup_times):
             if not ip or not meas or dt:
                 mask.append(True)
             else:
                 mask.append(False)
+                coords.append((len(mask) - 1, ip, meas))
+        if not coords:
+            return [], mask
+
+        self._read_loaded_coordinates([ip.timevalue for _, ip, _ in coords])
+        ips_to_load = []
+        for _, ip, _ in coords:
+            if ip.timevalue not in self.instantpoints:
+                self.instantpoints[ip.timevalue] = ip
                 ips_to_load.append(ip)
-                meas_to_load.append(meas)
-       
-        try:
-            self.ips = InstantPoint.objects.using(self.dbAlias).bulk_create(ips_to_load, batch_size=BATCH_SIZE)
-        except IntegrityError as e:
-            # Some data sets (e.g. Waveglider) share time coordinates with different depths
-            # Report the reuse of previous self.ips values
-            if hasattr(self, 'ips'):
-                self.logger.info(f"Duplicate time values for axes {axes}. Reusing previously loaded time values for {ac['time']}")
-            else:
-                self.logger.error(f"{e}")
-                self.logger.error(f"It's likely that the {ac['time']} variable in {self.url} has a duplicate value")
-                raise DuplicateData(f"Duplicate data from {self.url} in {self.dbAlias}")
+        self.logger.info(f'Calling bulk_create() for {len(ips_to_load)} of {len(coords)} InstantPoints for axes {axes}')
+        InstantPoint.objects.using(self.dbAlias).bulk_create(ips_to_load, batch_size=BATCH_SIZE)
 
-        meass = self._measurement_with_instantpoint(self.ips, meas_to_load)
+        meass = []
+        meas_to_load = []
+        keys = set()
+        for index, ip, meas in coords:
+            meas.instantpoint = self.instantpoints[ip.timevalue]
+            key = (meas.instantpoint.id, float(meas.depth), meas.geom.x, meas.geom.y)
+            if key in keys:
+                # Repeated coordinate in these axes, its value would duplicate a MeasuredParameter
+                self.logger.debug(f"Repeated coordinate for axes {axes} at index {index}")
+                mask[index] = True
+                continue
+            keys.add(key)
+            if key not in self.measurements:
+                self.measurements[key] = meas
+                meas_to_load.append(meas)
+            meass.append(self.measurements[key])
 
-        self.logger.info(f'Calling bulk_create() for Measurements in meass generator with batch_size = {BATCH_SIZE}')
-        meass = Measurement.objects.using(self.dbAlias).bulk_create(meass, batch_size=BATCH_SIZE)
+        self.logger.info(f'Calling bulk_create() for {len(meas_to_load)} of {len(meass)} Measurements with batch_size = {BATCH_SIZE}')
+        Measurement.objects.using(self.dbAlias).bulk_create(meas_to_load, batch_size=BATCH_SIZE)
 
         return meass, mask
 
@@ -1663,6 +1752,24 @@ class Base_Loader(STOQS_Loader):
         if num:
             self.logger.info(f'Deleted {num} inf {pname} MeasuredParameters')
 
+    def _maptrack(self):
+        '''Return the LineString of the Activity's Measurements in time order simplified by PostGIS,
+        so that the geometries are not read into Python, or None if there are fewer than 2 of them
+        '''
+        sql = '''SELECT ST_SimplifyPreserveTopology(ST_MakeLine(stoqs_measurement.geom
+                            ORDER BY stoqs_instantpoint.timevalue, stoqs_measurement.id), %s),
+                        COUNT(*)
+                 FROM stoqs_measurement
+                 INNER JOIN stoqs_instantpoint ON (stoqs_measurement.instantpoint_id = stoqs_instantpoint.id)
+                 WHERE stoqs_instantpoint.activity_id = %s'''
+        with connections[self.dbAlias].cursor() as cursor:
+            cursor.execute(sql, [MAPTRACK_TOLERANCE, self.activity.id])
+            track, count = cursor.fetchone()
+        if count < 2:
+            return None
+
+        return GEOSGeometry(track)
+
     def _post_process_updates(self, mps_loaded, featureType='', add_to_activity=None):
 
         #
@@ -1675,13 +1782,9 @@ class Base_Loader(STOQS_Loader):
         if not hasattr(self, 'activity') and hasattr(self, 'associatedActivityName'):
             self.activity = Activity.objects.using(self.dbAlias).get(name=self.associatedActivityName)
 
-        linestringPoints = Measurement.objects.using(self.dbAlias).filter(instantpoint__activity=self.activity
-                                                       ).order_by('instantpoint__timevalue').values_list('geom')
-        try:
-            path = LineString([p[0] for p in linestringPoints]).simplify(tolerance=.001)
-        except (TypeError, ValueError) as e:
-            # Likely "LineString requires at least 2 points, got 1."
-            self.logger.warn('%s', e)
+        path = self._maptrack()
+        if path is None:
+            self.logger.warn('Activity %s has fewer than 2 Measurements for a path', self.activity)
             self.logger.info('Leaving path set to None')
         else:
             if len(path) == 2:
@@ -1764,7 +1867,8 @@ class Base_Loader(STOQS_Loader):
         # Add resources after loading data to capture additional metadata that may be added
         #
         try:
-            self.addResources()
+            with advisory_lock(self.dbAlias, METADATA_LOCK):
+                self.addResources()
         except IntegrityError as e:
             self.logger.error('Failed to properly addResources: %s', e)
 
@@ -1773,8 +1877,11 @@ class Base_Loader(STOQS_Loader):
         #
         self.updateActivityMinMaxDepth(act_to_update)
         self.updateActivityParameterStats(act_to_update)
-        self.updateCampaignStartEnd()
-        self.assignParameterGroup(groupName=MEASUREDINSITU)
+        self.saveActivityParameterArrays(act_to_update)
+        self.saveParameterTimePyramid(act_to_update)
+        with advisory_lock(self.dbAlias, METADATA_LOCK):
+            self.updateCampaignStartEnd()
+            self.assignParameterGroup(groupName=MEASUREDINSITU)
         if featureType == TRAJECTORY:
             if hasattr(self, 'critSimpleDepthTime'):
                 # Loader may have this attribute set, e.g. for BED that need less simplification
@@ -1840,9 +1947,20 @@ class Base_Loader(STOQS_Loader):
 
         return mps_loaded, path, self.parameter_counts
 
-    def process_data(self, featureType='', add_to_activity=None): 
-        '''Bulk copy measurement data into database
+    def close(self):
+        '''Close the file of a dataset read from local disk
+        '''
+        close_dataset(self.ds)
+
+    def process_data(self, featureType='', add_to_activity=None):
+        '''Bulk copy measurement data into database, the dataset is closed when done
         '''
+        try:
+            return self._process_data(featureType, add_to_activity)
+        finally:
+            self.close()
+
+    def _process_data(self, featureType='', add_to_activity=None): 
 
         self.coord_dicts = {}
         for v in self.include_names:
@@ -1853,28 +1971,30 @@ class Base_Loader(STOQS_Loader):
             except VariableHasBadCoordinatesAttribute as e:
                 self.logger.error(str(e))
 
-        self.initDB()
-
         path = None
         parmCount = {}
         self.parameter_counts = {}
         for key in self.include_names:
             parmCount[key] = 0
 
-        if getattr(self, 'command_line_args', False):
-            if self.command_line_args.append:
-                self.dataStartDatetime = (InstantPoint.objects.using(self.dbAlias)
-                                            .filter(activity__name=self.getActivityName())
-                                            .aggregate(Max('timevalue'))['timevalue__max'])
-
         self.param_by_key = {}
         self.mv_by_key = {}
         self.fv_by_key = {}
 
-        for key in (set(self.include_names) & set(self.ds.keys())):
-            parameter_name, _ = self.parameter_name(key)
-            self.param_by_key[key] = self.getParameterByName(parameter_name)
-            self.parameter_counts[self.param_by_key[key]] = 0
+        # Platform, Parameter and the other shared rows are created one loader at a time
+        with advisory_lock(self.dbAlias, METADATA_LOCK):
+            self.initDB()
+
+            if getattr(self, 'command_line_args', False):
+                if self.command_line_args.append:
+                    self.dataStartDatetime = (InstantPoint.objects.using(self.dbAlias)
+                                                .filter(activity__name=self.getActivityName())
+                                                .aggregate(Max('timevalue'))['timevalue__max'])
+
+            for key in (set(self.include_names) & set(self.ds.keys())):
+                parameter_name, _ = self.parameter_name(key)
+                self.param_by_key[key] = self.getParameterByName(parameter_name)
+                self.parameter_counts[self.param_by_key[key]] = 0
 
         for key in self.ds.keys():
             self.mv_by_key[key] = self.getmissing_value(key)
@@ -1917,24 +2037,29 @@ class Base_Loader(STOQS_Loader):
             return mps_loaded, path, parmCount
 
         if mps_loaded:
-            # Bulk loading may introduce None values, remove them
-            MeasuredParameter.objects.using(self.dbAlias).filter(datavalue=None, dataarray=None).delete()
-
-            # Removing Nones above may leave a Parameter without any MeasuredParameters, remove them
-            for parameter in self.parameter_counts.copy().keys():
-                mp_count = MeasuredParameter.objects.using(self.dbAlias).filter(parameter=parameter).count()
-                self.logger.info(f"{parameter.name:40} count: {mp_count:6}")
-                if mp_count == 0:
-                    self.logger.info(f"Deleting Parameter because it has no valid data: {parameter}")
-                    try:
-                        del parmCount[parameter.name.split(' ')[0]]
-                        del self.parameter_counts[parameter]
-                        del self.parameter_dict[parameter.name]
-                    except KeyError as e:
-                        self.logger.warning(f"{e} not from Activity {self.activity}")
-                    parameter.delete(using=self.dbAlias)
-                else:
-                    parmCount[parameter.name.split(' ')[0]] = mp_count
+            with advisory_lock(self.dbAlias, METADATA_LOCK):
+                # Bulk loading may introduce None values, remove them
+                MeasuredParameter.objects.using(self.dbAlias).filter(datavalue=None, dataarray=None).delete()
+
+                # Removing Nones above may leave a Parameter without any MeasuredParameters, remove them
+                for parameter in self.parameter_counts.copy().keys():
+                    mp_count = MeasuredParameter.objects.using(self.dbAlias).filter(parameter=parameter).count()
+                    self.logger.info(f"{parameter.name:40} count: {mp_count:6}")
+                    if mp_count == 0:
+                        try:
+                            del parmCount[parameter.name.split(' ')[0]]
+                            del self.parameter_counts[parameter]
+                            del self.parameter_dict[parameter.name]
+                        except KeyError as e:
+                            self.logger.warning(f"{e} not from Activity {self.activity}")
+                        if in_load_worker():
+                            # Another worker may have just found this Parameter and not yet saved its data
+                            self.logger.info(f"Leaving Parameter without valid data for LoadScript.load_urls() to delete: {parameter}")
+                        else:
+                            self.logger.info(f"Deleting Parameter because it has no valid data: {parameter}")
+                            parameter.delete(using=self.dbAlias)
+                    else:
+                        parmCount[parameter.name.split(' ')[0]] = mp_count
             path = self._post_process_updates(mps_loaded, featureType, add_to_activity=add_to_activity)
 
         return mps_loaded, path, parmCount
@@ -36,9 +36,14 @@ from cftime import date2num
 import seawater.eos80 as sw
 import csv
 import requests
-from contextlib import closing
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import closing, contextmanager
 import logging
 from utils.utils import percentile, median, mode, simplify_points, spiciness
+from loaders.bathymetry import bottom_depths
+from loaders.partition import add_parameter_partition
+from loaders.pyramid import build_pyramid
 from tempfile import NamedTemporaryFile
 import pprint
 from netCDF4 import Dataset
@@ -67,6 +72,14 @@ SPICE = 'spice'
 SPICINESS = 'Spiciness'
 ALTITUDE = 'altitude'
 
+# Advisory lock held while rows shared by the Activities of a database, e.g. Platforms and Parameters,
+# are created and updated so that URLs can be loaded in parallel - see LoadScript.load_urls()
+METADATA_LOCK = 'stoqs load metadata'
+
+# True in the worker processes of LoadScript.load_urls(), where a Parameter left without MeasuredParameters
+# may be one that another worker has just created, the parent deletes them after all the loads - see in_load_worker()
+_load_worker = False
+
 if settings.DEBUG:
     BaseDatabaseWrapper.make_debug_cursor = lambda self, cursor: CursorWrapper(cursor, self)
 
@@ -77,6 +90,40 @@ def cmd_exists(cmd):
         stdout=subprocess.PIPE, stderr=subprocess.PIPE) == 0
     
 
+@contextmanager
+def advisory_lock(dbAlias, name):
+    '''Hold the Postgres session advisory lock for name in dbAlias for the duration of the with block.
+    The lock is taken on the same connection more than once without blocking and isn't released
+    by a transaction rollback.
+    '''
+    with connections[dbAlias].cursor() as cursor:
+        cursor.execute('SELECT pg_advisory_lock(hashtext(%s))', [name])
+    try:
+        yield
+    finally:
+        with connections[dbAlias].cursor() as cursor:
+            cursor.execute('SELECT pg_advisory_unlock(hashtext(%s))', [name])
+
+
+def in_load_worker():
+    '''Return True in a worker process of LoadScript.load_urls()
+    '''
+    return _load_worker
+
+
+def _locked_load(dbAlias, aname, load, args, kwargs):
+    '''Run load(*args, **kwargs) for Activity aname in a worker process of LoadScript.load_urls(),
+    the worker's Django connections are its own and are closed when it's done
+    '''
+    global _load_worker
+    _load_worker = True
+    try:
+        with advisory_lock(dbAlias, f'activity {aname}'):
+            return load(*args, **kwargs)
+    finally:
+        connections.close_all()
+
+
 class SkipRecord(Exception):
     pass
 
@@ -176,6 +223,10 @@ class LoadScript(object):
                             help='Stride value (default=1)')
         self.parser.add_argument('-a', '--append', action='store_true', 
                             help='Append data to existing activity - for use in repetative runs')
+        self.parser.add_argument('--resume', action='store_true',
+                            help='Continue interrupted trajectory loads from their last checkpoint')
+        self.parser.add_argument('--workers', action='store', type=int, default=1,
+                            help='Number of URLs to load in parallel, each in its own process (default=1)')
         self.parser.add_argument('--startdate', action='store', 
                             help='For loaders that use it set startdate, in format YYYYMMDD')
         self.parser.add_argument('--enddate', action='store', 
@@ -241,6 +292,54 @@ class LoadScript(object):
         self.commandline = ' '.join(sys.argv)
         self.logger.info('Executing command: %s', self.commandline)
 
+    def load_urls(self, loads):
+        '''Run loads, a list of (url, aname, load, args, kwargs) tuples where load is a module level
+        function such as DAPloaders.runLrauvLoader(), and return a list of (url, aname, result, error)
+        for them in the order they finished.  With --workers greater than 1 the loads run in that many
+        processes, otherwise one after another in this one.  The caller does the steps that depend on
+        the result of a load and the campaign wide steps that follow all of them.
+        '''
+        results = []
+        workers = getattr(self.args, 'workers', 1)
+        if workers <= 1 or len(loads) <= 1:
+            for url, aname, load, args, kwargs in loads:
+                try:
+                    results.append((url, aname, load(*args, **kwargs), None))
+                except Exception as e:
+                    results.append((url, aname, None, e))
+            return results
+
+        # The Parameters created by the loads have larger ids
+        last_parameter_id = m.Parameter.objects.using(self.dbAlias).aggregate(Max('id'))['id__max'] or 0
+
+        # Forked workers must not share this process' database connections
+        connections.close_all()
+        try:
+            with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('fork')) as executor:
+                futures = {executor.submit(_locked_load, self.dbAlias, aname, load, args, kwargs): (url, aname)
+                                for url, aname, load, args, kwargs in loads}
+                for future in as_completed(futures):
+                    url, aname = futures[future]
+                    try:
+                        results.append((url, aname, future.result(), None))
+                    except Exception as e:
+                        results.append((url, aname, None, e))
+        finally:
+            # After all of the workers have exited, whether or not their loads succeeded
+            self.delete_empty_parameters(last_parameter_id)
+
+        return results
+
+    def delete_empty_parameters(self, last_parameter_id):
+        '''Delete the Parameters created after last_parameter_id that have no MeasuredParameters or
+        SampledParameters, as Base_Loader.process_data() does when loads aren't run in parallel
+        '''
+        empty = (m.Parameter.objects.using(self.dbAlias)
+                    .filter(id__gt=last_parameter_id, measuredparameter__isnull=True, sampledparameter__isnull=True))
+        for parameter in empty:
+            self.logger.info(f"Deleting Parameter because it has no valid data: {parameter}")
+            parameter.delete(using=self.dbAlias)
+
     def addTerrainResources(self):
         '''
         If X3D Terrain information is specified then add as Resources to Campaign.  To be called after process_command_line().
@@ -612,6 +711,7 @@ class STOQS_Loader(object):
                 parm = self.parameter_dict[parameter_name]
                 if created:
                     self.logger.debug(f"Added parameter {parameter_name} from {self.url} to database {self.dbAlias}")
+                    add_parameter_partition(self.dbAlias, parm)
 
             if not parm.standard_name and ds[variable].attributes.get('standard_name'):
                 # Add standard_name if found in a later Activity (dataset)
@@ -1261,6 +1361,54 @@ class STOQS_Loader(object):
 
         self.logger.info('Updated statistics for act_to_update.name = %s', act_to_update.name)
 
+    @classmethod
+    def save_activityparameter_arrays(cls, dbAlias, activity):
+        '''Class method so that existing databases can be backfilled, e.g. by tools/backfill_parameter_arrays.py.
+        Replace the ActivityParameterArrays of activity with arrays packed by the database. Return number saved.
+        '''
+        order = 'ORDER BY ip.timevalue, me.depth'
+        with transaction.atomic(using=dbAlias):
+            m.ActivityParameterArray.objects.using(dbAlias).filter(activity=activity).delete()
+            with connections[dbAlias].cursor() as cursor:
+                cursor.execute(f'''INSERT INTO stoqs_activityparameterarray
+                                       (activity_id, parameter_id, epochseconds, depth, latitude, longitude, datavalue)
+                                   SELECT ip.activity_id, mp.parameter_id,
+                                          array_agg(EXTRACT(EPOCH FROM ip.timevalue)::double precision {order}),
+                                          array_agg(me.depth {order}),
+                                          array_agg(ST_Y(me.geom) {order}),
+                                          array_agg(ST_X(me.geom) {order}),
+                                          array_agg(mp.datavalue {order})
+                                   FROM stoqs_measuredparameter mp
+                                   INNER JOIN stoqs_measurement me ON mp.measurement_id = me.id
+                                   INNER JOIN stoqs_instantpoint ip ON me.instantpoint_id = ip.id
+                                   WHERE ip.activity_id = %s
+                                   GROUP BY ip.activity_id, mp.parameter_id''', [activity.id])
+                return cursor.rowcount
+
+    def saveActivityParameterArrays(self, act_to_update=None):
+        '''
+        Post-load step: pack the MeasuredParameters of the Activity into one ActivityParameterArray
+        per Parameter for fast plotting.  Must follow the addition of derived Parameters (sigmat, altitude).
+        '''
+        if not settings.SAVE_PARAMETER_ARRAYS:
+            return
+        if not act_to_update:
+            act_to_update = self.activity
+        num_saved = self.save_activityparameter_arrays(self.dbAlias, act_to_update)
+        self.logger.info('Saved %d ActivityParameterArrays for act_to_update.name = %s', num_saved, act_to_update.name)
+
+    def saveParameterTimePyramid(self, act_to_update=None):
+        '''
+        Post-load step: build the time-depth pyramid of ParameterTimeBuckets for the Activity.
+        Must follow the addition of derived Parameters (sigmat, altitude).
+        '''
+        if not settings.SAVE_PARAMETER_PYRAMID:
+            return
+        if not act_to_update:
+            act_to_update = self.activity
+        num_saved = build_pyramid(self.dbAlias, act_to_update)
+        self.logger.info('Saved %d ParameterTimeBuckets for act_to_update.name = %s', num_saved, act_to_update.name)
+
     def insertSimpleDepthTimeSeries(self, critSimpleDepthTime=10):
         '''
         Read the time series of depth values for this activity, simplify it and insert the values in the
@@ -1562,69 +1710,60 @@ class STOQS_Loader(object):
         self.logger.info("Using Parameters '%s' and '%s' to compute sigmat and spice", temp_pn, sal_pn)
         return temp_pn, sal_pn
 
-    def _combined_temp_sal(self, temp_pn, sal_pn, ms):
-        '''Use Parameter-Parameter like query to get paired T & S values.
-        We need to do this in case we have missing/bad values for one and not the other.
+    def _combined_temp_sal(self, temp_pn, sal_pn, activity=None):
+        '''Use conditional aggregation of the Measurements of activity to get paired T & S values
+        as arrays in time order.  We need to do this in case we have missing/bad values for one and not
+        the other.  Joining from the Activity keeps the statement small however many Measurements it has.
         '''
-        temps = []
-        salts = []
-        mids = []
-        depths = []
-        lats = []
-        with connections[self.dbAlias].cursor() as cursor:
-            sql = f"""
-            SELECT DISTINCT mp_x.datavalue AS temp,
-                            mp_y.datavalue AS sal,
-                            stoqs_measurement.id AS mid,
-                            stoqs_measurement.depth AS depth,
-                            ST_Y(stoqs_measurement.geom) AS lat,
-                            stoqs_instantpoint.timevalue as time
-            FROM stoqs_measuredparameter
-            INNER JOIN stoqs_measurement ON (stoqs_measuredparameter.measurement_id = stoqs_measurement.id)
+        pids = dict(m.Parameter.objects.using(self.dbAlias).filter(name__in=(temp_pn, sal_pn))
+                                       .values_list('name', 'id'))
+        params = [pids[temp_pn], pids[sal_pn], pids[temp_pn], pids[sal_pn]]
+        conditions = ['stoqs_measuredparameter.parameter_id IN (%s, %s)']
+        if activity:
+            conditions.append('stoqs_instantpoint.activity_id = %s')
+            params.append(activity.id)
+        if self.dataStartDatetime:
+            conditions.append('stoqs_instantpoint.timevalue > %s')
+            params.append(self.dataStartDatetime)
+        sql = f"""
+            SELECT MAX(stoqs_measuredparameter.datavalue)
+                       FILTER (WHERE stoqs_measuredparameter.parameter_id = %s) AS temp,
+                   MAX(stoqs_measuredparameter.datavalue)
+                       FILTER (WHERE stoqs_measuredparameter.parameter_id = %s) AS sal,
+                   stoqs_measurement.id AS mid,
+                   stoqs_measurement.depth AS depth,
+                   ST_Y(stoqs_measurement.geom) AS lat
+            FROM stoqs_measurement
             INNER JOIN stoqs_instantpoint ON (stoqs_measurement.instantpoint_id = stoqs_instantpoint.id)
-            INNER JOIN stoqs_activity ON (stoqs_instantpoint.activity_id = stoqs_activity.id)
-            INNER JOIN stoqs_platform ON (stoqs_activity.platform_id = stoqs_platform.id)
-            INNER JOIN stoqs_measurement m_x ON m_x.instantpoint_id = stoqs_instantpoint.id
-            INNER JOIN stoqs_measuredparameter mp_x ON mp_x.measurement_id = m_x.id
-            INNER JOIN stoqs_parameter p_x ON mp_x.parameter_id = p_x.id
-            INNER JOIN stoqs_measurement m_y ON m_y.instantpoint_id = stoqs_instantpoint.id
-            INNER JOIN stoqs_measuredparameter mp_y ON mp_y.measurement_id = m_y.id
-            INNER JOIN stoqs_parameter p_y ON mp_y.parameter_id = p_y.id
-            WHERE (p_x.name = '{temp_pn}')
-              AND (p_y.name = '{sal_pn}')
-              AND (stoqs_measurement.id IN ({','.join([str(meas.id) for meas in ms])}))
-            ORDER BY stoqs_instantpoint.timevalue;
+            INNER JOIN stoqs_measuredparameter ON (stoqs_measuredparameter.measurement_id = stoqs_measurement.id)
+            WHERE {' AND '.join(conditions)}
+            GROUP BY stoqs_measurement.id, stoqs_instantpoint.timevalue
+            ORDER BY stoqs_instantpoint.timevalue, stoqs_measurement.id
             """
-            cursor.execute(sql)
-            for row in cursor.fetchall():
-                temps.append(row[0])
-                salts.append(row[1])
-                mids.append(row[2])
-                depths.append(row[3])
-                lats.append(row[4])
-        return temps, salts, mids, depths, lats
-
-    def _calculate_sigmat_mps(self, temps, salts, mids, depths, lats, p_sigmat, salinity_standard_name):
+        with connections[self.dbAlias].cursor() as cursor:
+            cursor.execute(sql, params)
+            rows = cursor.fetchall()
+
+        if not rows:
+            return (np.array([]),) * 5
+        temps, salts, mids, depths, lats = (np.array(col, dtype=float) for col in zip(*rows))
+        paired = np.isfinite(temps) & np.isfinite(salts)
+
+        return temps[paired], salts[paired], mids[paired].astype(int), depths[paired], lats[paired]
+
+    def _calculate_sigmat_mps(self, temps, salts, mids, depths, lats, p_sigmat):
         '''Return calculated sigmat list of MeasuredParameters
         '''
-        meass = m.Measurement.objects.using(self.dbAlias).filter(id__in=mids).order_by('instantpoint__timevalue')
         sigmats = sw.pden(salts, temps, sw.pres(depths, lats)) - 1000.0
-        sigmat_mps = []
-        for meas, sigmat in zip(meass, sigmats):
-            sigmat_mp = m.MeasuredParameter(measurement=meas, parameter=p_sigmat, datavalue=sigmat)
-            sigmat_mps.append(sigmat_mp)
-        return sigmat_mps
+        return [m.MeasuredParameter(measurement_id=mid, parameter=p_sigmat, datavalue=sigmat)
+                    for mid, sigmat in zip(mids.tolist(), sigmats.tolist())]
 
-    def _calculate_spice_mps(self, temps, salts, mids, p_spice, salinity_standard_name):
+    def _calculate_spice_mps(self, temps, salts, mids, p_spice):
         '''Return calculated spice list of MeasuredParameters
         '''
-        meass = m.Measurement.objects.using(self.dbAlias).filter(id__in=mids).order_by('instantpoint__timevalue')
         spices = spiciness(temps, salts)
-        spice_mps = []
-        for meas, spice in zip(meass, spices):
-            spice_mp = m.MeasuredParameter(measurement=meas, parameter=p_spice, datavalue=spice)
-            spice_mps.append(spice_mp)
-        return spice_mps
+        return [m.MeasuredParameter(measurement_id=mid, parameter=p_spice, datavalue=spice)
+                    for mid, spice in zip(mids.tolist(), spices.tolist())]
 
     def _get_sea_water_parameters(self):
         '''Check for more than one set of sea_water_temperature nand sea_water_salinity standard names as in
@@ -1703,53 +1842,57 @@ class STOQS_Loader(object):
         if self.dataStartDatetime:
             ms = ms.filter(instantpoint__timevalue__gt=self.dataStartDatetime)
 
-        # Create our new Parameters
-        p_sigmat, _ = m.Parameter.objects.using(self.dbAlias).get_or_create(
-                standard_name='sea_water_sigma_t',
-                long_name='Sigma-T',
-                units='kg m-3',
-                name=SIGMAT,
-        )
-        if 'spice' in self.include_names:
-            p_spice, _ = m.Parameter.objects.using(self.dbAlias).get_or_create( 
-                    name='stoqs_spice',
-                    defaults={'long_name': SPICINESS}
-            )
-        else:
-            p_spice, _ = m.Parameter.objects.using(self.dbAlias).get_or_create( 
-                    name=SPICE,
-                    defaults={'long_name': SPICINESS}
+        count = ms.count()
+
+        # Create our new Parameters, one loader at a time
+        with advisory_lock(self.dbAlias, METADATA_LOCK):
+            p_sigmat, _ = m.Parameter.objects.using(self.dbAlias).get_or_create(
+                    standard_name='sea_water_sigma_t',
+                    long_name='Sigma-T',
+                    units='kg m-3',
+                    name=SIGMAT,
             )
-        # Update with descriptions, being kind to legacy databases
-        p_sigmat.description = ("Calculated in STOQS loader from Measured Parameters having standard_names"
-                                " sea_water_temperature and sea_water_salinity, and pressure converted from depth"
-                                " using seawater.eos80 module: sw.pden(s, t, sw.pres(me.depth, me.geom.y)) - 1000.0.")
-        p_sigmat.save(using=self.dbAlias)
-        p_spice.description = ("Calculated in STOQS loader from Measured Parameters having standard_names"
-                               " sea_water_temperature and sea_water_salinity using algorithm from Flament (2002):"
-                               " http://www.satlab.hawaii.edu/spice.")
-        p_spice.save(using=self.dbAlias)
-
-        self.parameter_counts[p_sigmat] = ms.count()
-        self.parameter_counts[p_spice] = ms.count()
-        self.assignParameterGroup(groupName=MEASUREDINSITU)
-        self.assignParameterGroup(groupName=MEASUREDINSITU)
+            if 'spice' in self.include_names:
+                p_spice, _ = m.Parameter.objects.using(self.dbAlias).get_or_create( 
+                        name='stoqs_spice',
+                        defaults={'long_name': SPICINESS}
+                )
+            else:
+                p_spice, _ = m.Parameter.objects.using(self.dbAlias).get_or_create( 
+                        name=SPICE,
+                        defaults={'long_name': SPICINESS}
+                )
+            # Update with descriptions, being kind to legacy databases
+            p_sigmat.description = ("Calculated in STOQS loader from Measured Parameters having standard_names"
+                                    " sea_water_temperature and sea_water_salinity, and pressure converted from depth"
+                                    " using seawater.eos80 module: sw.pden(s, t, sw.pres(me.depth, me.geom.y)) - 1000.0.")
+            p_sigmat.save(using=self.dbAlias)
+            p_spice.description = ("Calculated in STOQS loader from Measured Parameters having standard_names"
+                                   " sea_water_temperature and sea_water_salinity using algorithm from Flament (2002):"
+                                   " http://www.satlab.hawaii.edu/spice.")
+            p_spice.save(using=self.dbAlias)
+            add_parameter_partition(self.dbAlias, p_sigmat)
+            add_parameter_partition(self.dbAlias, p_spice)
+
+            self.parameter_counts[p_sigmat] = count
+            self.parameter_counts[p_spice] = count
+            self.assignParameterGroup(groupName=MEASUREDINSITU)
+            self.assignParameterGroup(groupName=MEASUREDINSITU)
 
         self.logger.info(f'Calculating {self.parameter_counts[p_sigmat]} sigmat & spice MeasuredParameters')
         temp_pn, sal_pn = self._best_ts_parameter_names(ms, salinity_standard_name)
-        temps, salts, mids, depths, lats = self._combined_temp_sal(temp_pn, sal_pn, ms)
-        sigmat_mps = self._calculate_sigmat_mps(temps, salts, mids, depths, lats, p_sigmat, salinity_standard_name)
-        spice_mps = self._calculate_spice_mps(temps, salts, mids, p_spice, salinity_standard_name)
+        temps, salts, mids, depths, lats = self._combined_temp_sal(temp_pn, sal_pn, activity)
+        sigmat_mps = self._calculate_sigmat_mps(temps, salts, mids, depths, lats, p_sigmat)
+        spice_mps = self._calculate_spice_mps(temps, salts, mids, p_spice)
 
-        self.logger.info(f'Bulk loading {self.parameter_counts[p_sigmat]} sigmat MeasuredParameters')
-        m.MeasuredParameter.objects.using(self.dbAlias).bulk_create(sigmat_mps)
-        self.logger.info(f'Bulk loading {self.parameter_counts[p_spice]} spice MeasuredParameters')
-        m.MeasuredParameter.objects.using(self.dbAlias).bulk_create(spice_mps)
+        self.logger.info(f'Bulk loading {len(sigmat_mps)} sigmat and {len(spice_mps)} spice MeasuredParameters')
+        m.MeasuredParameter.objects.using(self.dbAlias).bulk_create(sigmat_mps + spice_mps)
 
     def addAltitude(self, activity=None):
         ''' 
-        For all measurements lookup the water depth from a GMT grd file using grdtrack(1), 
-        subtract the depth and add altitude as a new Parameter to the Measurement
+        For all measurements lookup the water depth from a GMT grd file using loaders/bathymetry.py,
+        or grdtrack(1) if it can't read the file, subtract the depth and add altitude as a new
+        Parameter to the Measurement
         To be called from load script after process_command_line().
         '''
         # Read the bounding box of the terrain file. The grdtrack command quietly does not write any lines for points outside of the grid.
@@ -1784,23 +1927,82 @@ class STOQS_Loader(object):
 
             bbox = Polygon.from_bbox( (xmin, ymin, xmax, ymax) )
 
-        # Build file of Measurement lon & lat for grdtrack to process
-        xyFileName = NamedTemporaryFile(dir='/dev/shm', prefix='STOQS_LatLon_', suffix='.txt').name
-        xyFH = open(xyFileName, 'w')
         ms = m.Measurement.objects.using(self.dbAlias).filter(geom__within=bbox)
         if activity:
             ms = ms.filter(instantpoint__activity=activity)
         ms = ms.order_by('instantpoint__activity__id', 'instantpoint__timevalue').values('id', 'geom', 'depth').distinct()
         mList = []
         depthList = []
+        lons = []
+        lats = []
         for me in ms:
             mList.append(me['id'])
             depthList.append(me['depth'])
-            xyFH.write("%f %f\n" % (me['geom'].x, me['geom'].y))
-
-        xyFH.close()
+            lons.append(me['geom'].x)
+            lats.append(me['geom'].y)
         inputFileCount = len(mList)
-        self.logger.debug('Wrote file %s with %d records', xyFileName, inputFileCount)
+
+        try:
+            bdepths = bottom_depths(self.grdTerrain, lons, lats)
+        except (KeyError, ValueError, TypeError, OSError) as e:
+            self.logger.warning(f'Cannot interpolate {self.grdTerrain} in process ({e}), using grdtrack')
+            bdepths = self._grdtrack_depths(lons, lats)
+
+        # Create our new Parameter, one loader at a time
+        with advisory_lock(self.dbAlias, METADATA_LOCK):
+            self.logger.debug('Getting or creating new altitude Parameter')
+            try:
+                p_alt, _ = m.Parameter.objects.using(self.dbAlias).get_or_create(
+                        standard_name='height_above_sea_floor',
+                        long_name='Altitude',
+                        description=("Calculated in STOQS loader by using GMT's grdtrack(1) program on the Platform's"
+                                     " latitude, longitude values and differencing the Platform's depth with the"
+                                     " bottom depth data in file %s." % self.grdTerrain.split('/')[-1]),
+                        units='m',
+                        name=ALTITUDE,
+                        origin='https://github.com/stoqs/stoqs/blob/45f53d134d336fdbdb38f73959a2ce3be4148227/stoqs/loaders/__init__.py#L1216-L1322'
+                )
+            except IntegrityError:
+                # A bit of a mystery why sometimes this Exception happens (simply get p_alt if it happens):
+                # IntegrityError: duplicate key value violates unique constraint "stoqs_parameter_name_key"
+                p_alt = m.Parameter.objects.using(self.dbAlias).get(name=ALTITUDE)
+            add_parameter_partition(self.dbAlias, p_alt)
+
+            self.parameter_counts[p_alt] = inputFileCount
+            self.assignParameterGroup(groupName=MEASUREDINSITU)
+
+        # Add the bottom depths differenced with the Measurement depths as altitude MeasuredParameters
+        self.logger.info("Saving altitude MeasuredParameters")
+        alt_mps = []
+        for mid, bdepth, depth in zip(mList, bdepths, depthList):
+            if np.isnan(bdepth):
+                continue
+            alt_mps.append(m.MeasuredParameter(datavalue=-float(bdepth) - depth, measurement_id=mid, parameter=p_alt))
+        count = len(alt_mps)
+        self.logger.info(f'Bulk loading {count} altitude MeasuredParameters')
+        try:
+            m.MeasuredParameter.objects.using(self.dbAlias).bulk_create(alt_mps)
+        except IntegrityError as e:
+            self.logger.warning("Cannot load altitudes: %s", e)
+        self.logger.info("Done saving altitude MeasuredParameters")
+
+        # Sanity check
+        if inputFileCount != count:
+            self.logger.warn('Counts are not equal! inputFileCount = %s, count of bottom depths = %s', inputFileCount, count)
+
+        return
+
+    def _grdtrack_depths(self, lons, lats):
+        '''
+        Return bottom depths at lons, lats from self.grdTerrain using GMT's grdtrack(1), for grids that
+        loaders/bathymetry.py can't read.  Lines that grdtrack writes without a value get NaN.
+        '''
+        # Build file of Measurement lon & lat for grdtrack to process
+        xyFileName = NamedTemporaryFile(dir='/dev/shm', prefix='STOQS_LatLon_', suffix='.txt').name
+        with open(xyFileName, 'w') as xyFH:
+            for lon, lat in zip(lons, lats):
+                xyFH.write("%f %f\n" % (lon, lat))
+        self.logger.debug('Wrote file %s with %d records', xyFileName, len(lons))
 
         # Requires GMT (yum install GMT)
         bdepthFileName = NamedTemporaryFile(dir='/dev/shm', prefix='STOQS_BDepth', suffix='.txt').name
@@ -1820,60 +2022,17 @@ class STOQS_Loader(object):
                              ' finish writing to %s for more than 10 million records', bdepthFileName)
             time.sleep(300)
 
-        # Create our new Parameter
-        self.logger.debug('Getting or creating new altitude Parameter')
-        try:
-            p_alt, _ = m.Parameter.objects.using(self.dbAlias).get_or_create(
-                    standard_name='height_above_sea_floor',
-                    long_name='Altitude',
-                    description=("Calculated in STOQS loader by using GMT's grdtrack(1) program on the Platform's"
-                                 " latitude, longitude values and differencing the Platform's depth with the"
-                                 " bottom depth data in file %s." % self.grdTerrain.split('/')[-1]),
-                    units='m',
-                    name=ALTITUDE,
-                    origin='https://github.com/stoqs/stoqs/blob/45f53d134d336fdbdb38f73959a2ce3be4148227/stoqs/loaders/__init__.py#L1216-L1322'
-            )
-        except IntegrityError:
-            # A bit of a mystery why sometimes this Exception happens (simply get p_alt if it happens):
-            # IntegrityError: duplicate key value violates unique constraint "stoqs_parameter_name_key"
-            p_alt = m.Parameter.objects.using(self.dbAlias).get(name=ALTITUDE)
-
-        self.parameter_counts[p_alt] = ms.count()
-        self.assignParameterGroup(groupName=MEASUREDINSITU)
-
-        # Read values from the grid sampling (bottom depths) and add datavalues to the altitude parameter using the save Measurements
-        self.logger.info("Saving altitude MeasuredParameters")
-        meass = m.Measurement.objects.using(self.dbAlias).filter(id__in=mList).order_by('instantpoint__activity__id', 'instantpoint__timevalue')
-        count = 0
-        alt_mps = []
+        bdepths = []
         with open(bdepthFileName) as altFH:
-            try:
-                with transaction.atomic():
-                    for line, meas in zip(altFH, meass):
-                        try:
-                            bdepth = line.split()[2]
-                        except IndexError:
-                            # Likely list index out of range
-                            continue
-                        alt = -float(bdepth)-depthList.pop(0)
-                        mp_alt = m.MeasuredParameter(datavalue=alt, measurement=meas, parameter=p_alt)
-                        alt_mps.append(mp_alt)
-                        count += 1
-            except IntegrityError as e:
-                self.logger.warn(e)
-            except DatabaseError as e:
-                self.logger.warn(e)
-            self.logger.info(f'Bulk loading {count} altitude MeasuredParameters')
-            try:
-                m.MeasuredParameter.objects.using(self.dbAlias).bulk_create(alt_mps)
-            except IntegrityError as e:
-                self.logger.warning("Cannot load altitudes: %s", e)
-        self.logger.info("Done saving altitude MeasuredParameters")
+            for line in altFH:
+                try:
+                    bdepths.append(float(line.split()[2]))
+                except IndexError:
+                    # Likely list index out of range
+                    bdepths.append(np.nan)
 
-        # Cleanup and sanity check
+        # Cleanup
         os.remove(xyFileName)
         os.remove(bdepthFileName)
-        if inputFileCount != count:
-            self.logger.warn('Counts are not equal! inputFileCount = %s, count from grdtrack output = %s', inputFileCount, count)
 
-        return
+        return np.array(bdepths)
@@ -0,0 +1,149 @@
+'''
+Look up bottom depths in GMT grd bathymetry files in process, instead of running grdtrack(1)
+on a file of positions.  Both the old GMT format, with the z values of the rows from the top
+of the grid in a flat variable, and the new COARDS format, with x or lon and y or lat coordinate
+variables, are read.  NetCDF 3 (classic) files are memory-mapped, others are read with netCDF4.
+
+The grid is read in tiles of TILE by TILE nodes as positions fall in them.  The tiles and the
+open grids are cached, so the loads of the Activities of a campaign read each tile only once.
+Values are interpolated bilinearly with scipy's RegularGridInterpolator, positions outside of
+the grid get NaN.
+'''
+
+from functools import lru_cache
+
+import netCDF4
+import numpy as np
+from scipy.interpolate import RegularGridInterpolator
+from scipy.io import netcdf_file
+
+# Number of grid nodes on a side of the tiles that are read and interpolated at once
+TILE = 512
+
+# Number of tiles kept in memory for each grid, 64 float64 tiles are about 130 MB
+CACHE_TILES = 64
+
+
+@lru_cache(maxsize=4)
+def open_grid(path):
+    '''Return the Grid for the grd file at path, cached so that its tiles are reused
+    '''
+    return Grid(path)
+
+
+def bottom_depths(path, lons, lats):
+    '''Return the values of the grd file at path interpolated to lons and lats, NaN outside
+    of the grid.  Bathymetry grids are elevations, below sea level they are negative depths.
+    '''
+    return open_grid(path).interpolate(lons, lats)
+
+
+class Grid(object):
+    '''Bathymetry grid read in cached tiles, with node coordinates x and y in increasing order
+    '''
+    def __init__(self, path):
+        self.path = path
+        try:
+            self.nc = netcdf_file(path, mmap=True)
+            self.mmapped = True
+        except TypeError:
+            # Not a NetCDF 3 file, e.g. a compressed NetCDF 4 grid
+            self.nc = netCDF4.Dataset(path)
+            self.nc.set_auto_maskandscale(False)
+            self.mmapped = False
+
+        variables = self.nc.variables
+        zvar = variables['z']
+        if 'dimension' in variables:
+            # Old GMT format, rows from the top of the grid, node_offset of 1 is pixel registration
+            nx, ny = (int(n) for n in variables['dimension'][:])
+            offset = 0.5 if int(getattr(zvar, 'node_offset', 0)) else 0.0
+            self.x = self._nodes(variables['x_range'][:], nx, offset)
+            self.y = self._nodes(variables['y_range'][:], ny, offset)
+            self.z = self._data(zvar).reshape(ny, nx)
+            self.flip_y = True
+            self.flip_x = False
+        else:
+            xname = 'lon' if 'lon' in variables else 'x'
+            yname = 'lat' if 'lat' in variables else 'y'
+            x = np.asarray(variables[xname][:], dtype='f8')
+            y = np.asarray(variables[yname][:], dtype='f8')
+            self.flip_x = x[-1] < x[0]
+            self.flip_y = y[-1] < y[0]
+            self.x = x[::-1] if self.flip_x else x
+            self.y = y[::-1] if self.flip_y else y
+            self.z = self._data(zvar)
+
+        self.scale = float(getattr(zvar, 'scale_factor', 1.0))
+        self.add_offset = float(getattr(zvar, 'add_offset', 0.0))
+        self.fill = getattr(zvar, '_FillValue', getattr(zvar, 'missing_value', None))
+        self.tile = lru_cache(maxsize=CACHE_TILES)(self._read_tile)
+
+    @staticmethod
+    def _nodes(xrange, n, offset):
+        xmin, xmax = (float(v) for v in xrange)
+        if offset:
+            return xmin + (np.arange(n) + offset) * (xmax - xmin) / n
+        return np.linspace(xmin, xmax, n)
+
+    def _data(self, var):
+        if self.mmapped:
+            return var.data
+        if var.ndim == 1:
+            return var[:]
+        return var
+
+    @property
+    def bounds(self):
+        '''(xmin, ymin, xmax, ymax) of the grid nodes
+        '''
+        return self.x[0], self.y[0], self.x[-1], self.y[-1]
+
+    def _read_tile(self, ti, tj):
+        '''Return an interpolator for the nodes of tile row ti and column tj, which overlaps the
+        next tiles by a node so that every position in the tile is surrounded by its nodes
+        '''
+        ny, nx = len(self.y), len(self.x)
+        r0, c0 = ti * TILE, tj * TILE
+        r1, c1 = min(r0 + TILE + 1, ny), min(c0 + TILE + 1, nx)
+        rows = slice(ny - r1, ny - r0) if self.flip_y else slice(r0, r1)
+        cols = slice(nx - c1, nx - c0) if self.flip_x else slice(c0, c1)
+        raw = np.asarray(self.z[rows, cols])
+        if self.flip_y:
+            raw = raw[::-1]
+        if self.flip_x:
+            raw = raw[:, ::-1]
+
+        values = raw * self.scale + self.add_offset
+        if self.fill is not None:
+            values[raw == self.fill] = np.nan
+
+        return RegularGridInterpolator((self.y[r0:r1], self.x[c0:c1]), values,
+                                       bounds_error=False, fill_value=np.nan)
+
+    def interpolate(self, lons, lats):
+        '''Return the grid bilinearly interpolated to the positions, NaN outside of the grid
+        '''
+        lons = np.asarray(lons, dtype='f8')
+        lats = np.asarray(lats, dtype='f8')
+        values = np.full(lons.shape, np.nan)
+        xmin, ymin, xmax, ymax = self.bounds
+        inside = np.flatnonzero((lons >= xmin) & (lons <= xmax) & (lats >= ymin) & (lats <= ymax))
+        if not inside.size:
+            return values
+
+        # Index of the node below and left of each position, the last one is in the tile before
+        rows = np.clip(np.searchsorted(self.y, lats[inside], side='right') - 1, 0, len(self.y) - 2)
+        cols = np.clip(np.searchsorted(self.x, lons[inside], side='right') - 1, 0, len(self.x) - 2)
+        ntiles = (len(self.x) - 2) // TILE + 1
+        keys = rows // TILE * ntiles + cols // TILE
+
+        # Interpolate the positions of each tile together
+        order = np.argsort(keys, kind='stable')
+        inside, keys = inside[order], keys[order]
+        for group in np.split(np.arange(len(keys)), np.flatnonzero(np.diff(keys)) + 1):
+            key = keys[group[0]]
+            idx = inside[group]
+            values[idx] = self.tile(key // ntiles, key % ntiles)((lats[idx], lons[idx]))
+
+        return values
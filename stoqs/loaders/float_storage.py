@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+'''
+Convert the Sample.depth and SampledParameter.datavalue columns of an existing database
+between the legacy numeric(100, 30) type and double precision.  Set SAMPLE_FLOAT_STORAGE
+to match after converting so that migrate agrees with the database:
+
+    loaders/float_storage.py --db stoqs_canon_october2020
+    export SAMPLE_FLOAT_STORAGE=True
+
+Values with more than about 15 significant digits lose precision in double precision,
+no STOQS sample data comes close to that.
+'''
+
+import os
+import sys
+app_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), "../"))
+sys.path.insert(0, app_dir)
+if 'DJANGO_SETTINGS_MODULE' not in os.environ:
+    os.environ['DJANGO_SETTINGS_MODULE']='config.settings.local'
+import django
+django.setup()
+
+import logging
+from django.db import connections, transaction
+
+logger = logging.getLogger(__name__)
+
+DOUBLE = 'double precision'
+NUMERIC = 'numeric(100,30)'
+SAMPLE_COLUMNS = (('stoqs_sample', 'depth'), ('stoqs_sampledparameter', 'datavalue'))
+
+
+def column_types(dbAlias):
+    '''Return dictionary of (table, column): data type for the SAMPLE_COLUMNS
+    '''
+    types = {}
+    with connections[dbAlias].cursor() as cursor:
+        for table, column in SAMPLE_COLUMNS:
+            cursor.execute('''SELECT format_type(a.atttypid, a.atttypmod) FROM pg_attribute a
+                              WHERE a.attrelid = %s::regclass AND a.attname = %s''', [table, column])
+            types[(table, column)] = cursor.fetchone()[0]
+
+    return types
+
+
+def convert_sample_columns(dbAlias, to_type=DOUBLE):
+    '''Alter the SAMPLE_COLUMNS to to_type, their indexes are rebuilt by PostgreSQL
+    '''
+    with transaction.atomic(using=dbAlias):
+        with connections[dbAlias].cursor() as cursor:
+            for (table, column), data_type in column_types(dbAlias).items():
+                if data_type == to_type:
+                    logger.info(f'{table}.{column} is already {to_type}')
+                    continue
+                logger.info(f'Converting {table}.{column} from {data_type} to {to_type}')
+                cursor.execute(f'ALTER TABLE {table} ALTER COLUMN {column} TYPE {to_type} USING {column}::{to_type}')
+        with connections[dbAlias].cursor() as cursor:
+            for table in set(t for t, _ in SAMPLE_COLUMNS):
+                cursor.execute(f'ANALYZE {table}')
+
+
+if __name__ == '__main__':
+    import argparse
+    from argparse import RawTextHelpFormatter
+
+    parser = argparse.ArgumentParser(formatter_class=RawTextHelpFormatter, description=__doc__)
+    parser.add_argument('--db', action='store', required=True, help='Database alias, e.g. stoqs_canon_october2020')
+    parser.add_argument('--numeric', action='store_true', help='Convert back to the legacy numeric(100, 30) type')
+    parser.add_argument('--status', action='store_true', help='Report the column types and exit')
+    args = parser.parse_args()
+
+    if not args.status:
+        convert_sample_columns(args.db, NUMERIC if args.numeric else DOUBLE)
+    for (table, column), data_type in column_types(args.db).items():
+        print(f'{table}.{column}: {data_type}')
@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+'''
+Index profiles for the large, load-ordered columns of a STOQS database.
+
+The trajectory loaders write InstantPoints, Measurements and MeasuredParameters in (nearly)
+time order so timevalue, depth within a profile and measurement_id are naturally
+correlated with the physical row order.  A BRIN index on such a column is a few
+pages in size compared to a B-tree that can be as large as the column itself, and it
+is far cheaper to maintain during a load.  Columns without physical ordering (e.g.
+MeasuredParameter.datavalue and parameter_id) keep their B-tree indexes.
+
+    btree - What migrate creates from models.py: B-tree indexes everywhere
+    brin  - BRIN indexes on the naturally ordered columns listed in BRIN_COLUMNS
+
+Databases created by loaders/load.py get the INDEX_PROFILE setting applied after migrate.
+To change the profile of an existing database:
+
+    loaders/index_profile.py --db stoqs_canon_october2020 --profile brin
+'''
+
+import os
+import sys
+app_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), "../"))
+sys.path.insert(0, app_dir)
+if 'DJANGO_SETTINGS_MODULE' not in os.environ:
+    os.environ['DJANGO_SETTINGS_MODULE']='config.settings.local'
+import django
+django.setup()
+
+import logging
+from django.conf import settings
+from django.db import connections, transaction
+
+logger = logging.getLogger(__name__)
+
+BTREE = 'btree'
+BRIN = 'brin'
+BRIN_COLUMNS = (('stoqs_instantpoint', 'timevalue'),
+                ('stoqs_measurement', 'depth'),
+                ('stoqs_measuredparameter', 'measurement_id'))
+PROFILES = {BTREE: {tc: BTREE for tc in BRIN_COLUMNS},
+            BRIN: {tc: BRIN for tc in BRIN_COLUMNS}}
+
+# Small ranges keep BRIN selective for the yo-yo depths of AUV and glider Measurements
+BRIN_PAGES_PER_RANGE = 32
+
+
+class IndexProfileError(Exception):
+    pass
+
+
+def _column_indexes(cursor, table, column):
+    '''Return list of (index name, access method) for the non-unique single column
+    indexes on table.column
+    '''
+    cursor.execute('''SELECT ic.relname, am.amname FROM pg_index x
+                      JOIN pg_class ic ON ic.oid = x.indexrelid
+                      JOIN pg_class t ON t.oid = x.indrelid
+                      JOIN pg_am am ON am.oid = ic.relam
+                      JOIN pg_attribute a ON a.attrelid = t.oid AND a.attnum = x.indkey[0]
+                      WHERE t.relname = %s AND a.attname = %s AND x.indnatts = 1
+                        AND NOT x.indisprimary AND NOT x.indisunique''', [table, column])
+    return cursor.fetchall()
+
+
+def apply_index_profile(dbAlias, profile=None):
+    '''Make the indexes on the columns in PROFILES[profile] use the profile's access method,
+    dropping any other single column indexes on those columns
+    '''
+    profile = profile or settings.INDEX_PROFILE
+    if profile not in PROFILES:
+        raise IndexProfileError(f'Index profile must be one of {list(PROFILES.keys())}, not {profile!r}')
+
+    with transaction.atomic(using=dbAlias):
+        with connections[dbAlias].cursor() as cursor:
+            for (table, column), method in PROFILES[profile].items():
+                existing = _column_indexes(cursor, table, column)
+                for name, amname in existing:
+                    if amname != method:
+                        logger.info(f'Dropping {amname} index {name} on {table}.{column}')
+                        cursor.execute(f'DROP INDEX {name}')
+                if method not in [amname for _, amname in existing]:
+                    name = f'{table}_{column}_{method}'
+                    logger.info(f'Creating {method} index {name} on {table}.{column}')
+                    if method == BRIN:
+                        cursor.execute(f'''CREATE INDEX {name} ON {table} USING brin ({column})
+                                           WITH (pages_per_range = {BRIN_PAGES_PER_RANGE})''')
+                    else:
+                        cursor.execute(f'CREATE INDEX {name} ON {table} ({column})')
+
+
+def index_sizes(dbAlias, tables=None):
+    '''Return list of (table, index name, access method, bytes) for the indexes of tables,
+    including the partitions of partitioned indexes
+    '''
+    tables = tables or sorted(set(t for t, _ in BRIN_COLUMNS))
+    with connections[dbAlias].cursor() as cursor:
+        cursor.execute('''SELECT t.relname, ic.relname, am.amname,
+                                 (SELECT SUM(pg_relation_size(pt.relid)) FROM pg_partition_tree(ic.oid) pt)
+                          FROM pg_index x
+                          JOIN pg_class ic ON ic.oid = x.indexrelid
+                          JOIN pg_class t ON t.oid = x.indrelid
+                          JOIN pg_am am ON am.oid = ic.relam
+                          WHERE t.relname = ANY(%s)
+                          ORDER BY t.relname, ic.relname''', [list(tables)])
+        return cursor.fetchall()
+
+
+if __name__ == '__main__':
+    import argparse
+    from argparse import RawTextHelpFormatter
+
+    parser = argparse.ArgumentParser(formatter_class=RawTextHelpFormatter, description=__doc__)
+    parser.add_argument('--db', action='store', required=True, help='Database alias, e.g. stoqs_canon_october2020')
+    parser.add_argument('--profile', action='store', choices=list(PROFILES.keys()), default=settings.INDEX_PROFILE,
+                        help='Index profile to apply')
+    parser.add_argument('--sizes', action='store_true', help='Report index sizes and exit')
+    args = parser.parse_args()
+
+    if not args.sizes:
+        apply_index_profile(args.db, args.profile)
+    for table, name, method, size in index_sizes(args.db):
+        print(f'{table:25s} {name:60s} {method:6s} {size / 2**20:10.2f} MB')
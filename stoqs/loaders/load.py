@@ -38,6 +38,8 @@ from slacker import Slacker
 from stoqs.models import ResourceType, Resource, Campaign, CampaignResource, MeasuredParameter, \
                          SampledParameter, Activity, Parameter, Platform
 from loaders.timing import MINUTES
+from loaders.partition import convert_measuredparameter, PARAMETER, MEASUREMENT
+from loaders.index_profile import apply_index_profile, BTREE, BRIN
 
 def tail(f, n):
     return subprocess.getoutput(f"tail -{n} {f}")
@@ -694,6 +696,16 @@ local   all             all                                     peer
                 except TypeError:
                     call_command('migrate', settings='config.settings.local', interactive=False, database=db)
 
+                mp_partition = getattr(self.args, 'mp_partition', None) or settings.MP_PARTITION
+                if mp_partition:
+                    self.logger.info(f'Partitioning stoqs_measuredparameter in {db} by {mp_partition}')
+                    convert_measuredparameter(db, mp_partition)
+
+                index_profile = getattr(self.args, 'index_profile', None) or settings.INDEX_PROFILE
+                if index_profile != BTREE and not self.args.drop_indexes:
+                    self.logger.info(f'Applying {index_profile} index profile to {db}')
+                    apply_index_profile(db, index_profile)
+
                 if create_only:
                     return
 
@@ -784,6 +796,10 @@ fi''').format(**{'log':log_file, 'db': db, 'email': self.args.email})
                 self._create_indexes()
                 call_command('makemigrations', 'stoqs', settings='config.settings.local', noinput=True)
                 call_command('migrate', settings='config.settings.local', noinput=True, database=db)
+                index_profile = getattr(self.args, 'index_profile', None) or settings.INDEX_PROFILE
+                if index_profile != BTREE:
+                    self.logger.info(f'Applying {index_profile} index profile to {db}')
+                    apply_index_profile(db, index_profile)
 
             if not appending:
                 # Record details of the database load to the database
@@ -911,6 +927,12 @@ To get any stdout/stderr output you must use -v, the default is no output.
         parser.add_argument('--grant_everyone_select', action='store_true', help='Grant everyone role select privileges on all relations')
         parser.add_argument('--add_resource', action='store_true', help='Add a Resource to all databases: e.g. for zNear & zFar')
         parser.add_argument('--drop_indexes', action='store_true', help='Before load drop indexes and create them following the load')
+        parser.add_argument('--mp_partition', action='store', choices=[PARAMETER, MEASUREMENT],
+                            help=('Partition the MeasuredParameter table of newly created databases by LIST on parameter_id'
+                                  ' or HASH on measurement_id, overrides the MP_PARTITION setting'))
+        parser.add_argument('--index_profile', action='store', choices=[BTREE, BRIN],
+                            help=('Index profile for newly created databases: brin uses BRIN indexes on naturally ordered'
+                                  ' columns, overrides the INDEX_PROFILE setting'))
         parser.add_argument('--pg_dump', action='store_true', help='Store a pg_dump(1) with "-Fc" option file on the server')
         parser.add_argument('--noinput', action='store_true', help='Execute without asking for a response, e.g. for --clobber')
         parser.add_argument('--drop_if_fail', action='store_true', help='Drop database if fail to load data')
@@ -0,0 +1,163 @@
+'''
+Open NetCDF files on local disk as pydap datasets, so that the loaders in DAPloaders.py can read
+them without going through an OPeNDAP server.  The dataset has the structure that a Hyrax server
+gives a NetCDF file: global attributes in NC_GLOBAL, a BaseType for each dimension (coordinate)
+variable and a GridType, with the coordinate variables as maps, for each of the other variables
+whose dimensions all have coordinate variables.  The rest are BaseTypes.
+The data are read from the file with netCDF4 only when sliced, without scaling or masking, the
+same raw values that OPeNDAP delivers.
+
+Strided slices along the first (usually time) axis are read as whole, chunk-aligned blocks that
+are then strided in memory.  HDF5 reads whole chunks anyway and its strided reads are slow,
+so this is much faster for the small strides that loaders use.
+'''
+
+import os
+import threading
+from urllib.parse import unquote, urlparse
+
+import netCDF4
+import numpy as np
+from pydap.client import open_url
+from pydap.model import BaseType, DatasetType, GridType
+
+# Minimum number of values read in each block of a strided slice
+READ_BLOCK = 2**20
+
+# The netCDF and HDF5 libraries are not thread safe, reads from all files are serialized
+_lock = threading.Lock()
+
+
+def local_path(url):
+    '''Return the file system path of url if it's a file:// URL or an existing file, otherwise None
+    '''
+    if url.startswith('file://'):
+        return unquote(urlparse(url).path)
+    if os.path.isfile(url):
+        return url
+
+    return None
+
+
+def open_dataset(url):
+    '''Return a pydap dataset for url, read directly from the file if it's local, otherwise
+    through OPeNDAP with pydap's open_url()
+    '''
+    path = local_path(url)
+    if path is None:
+        return open_url(url)
+
+    return open_file(path)
+
+
+def open_file(path):
+    '''Return a pydap DatasetType for the NetCDF file at path
+    '''
+    nc = netCDF4.Dataset(path)
+    nc.set_auto_maskandscale(False)
+    dataset = DatasetType(os.path.basename(path),
+                          attributes={'NC_GLOBAL': _attributes(nc)})
+    dataset._nc = nc
+    unlimited = [name for name, dim in nc.dimensions.items() if dim.isunlimited()]
+    if unlimited:
+        dataset.attributes['DODS_EXTRA'] = {'Unlimited_Dimension': unlimited[0]}
+
+    coords = {}
+    for name, dim in nc.dimensions.items():
+        if name in nc.variables:
+            coords[name] = (LocalArray(nc.variables[name]), _attributes(nc.variables[name]))
+        else:
+            coords[name] = (np.arange(dim.size, dtype='i'), {})
+        dataset[name] = BaseType(name, coords[name][0], (name,), coords[name][1])
+
+    for name, var in nc.variables.items():
+        if name in nc.dimensions:
+            continue
+        if not var.dimensions or not all(dim in nc.variables for dim in var.dimensions):
+            dataset[name] = BaseType(name, LocalArray(var), var.dimensions, _attributes(var))
+            continue
+        grid = GridType(name, _attributes(var))
+        grid[name] = BaseType(name, LocalArray(var), var.dimensions, _attributes(var))
+        for dim in var.dimensions:
+            grid[dim] = BaseType(dim, coords[dim][0], (dim,), coords[dim][1])
+        dataset[name] = grid
+
+    return dataset
+
+
+def close_dataset(dataset):
+    '''Close the NetCDF file of a dataset returned by open_file(), datasets opened through OPeNDAP
+    have nothing to close
+    '''
+    nc = getattr(dataset, '_nc', None)
+    if nc is not None and nc.isopen():
+        with _lock:
+            nc.close()
+
+
+def _attributes(obj):
+    return {k: obj.getncattr(k) for k in obj.ncattrs()}
+
+
+class LocalArray(object):
+    '''Lazy array for a netCDF4 Variable, read when sliced like the data of an OPeNDAP variable
+    '''
+    def __init__(self, var):
+        self.var = var
+        self.dtype = var.dtype
+        self.shape = var.shape
+        # Contiguous variables are read in blocks of READ_BLOCK records
+        chunking = var.chunking()
+        if isinstance(chunking, list):
+            self.chunk = chunking[0] if chunking else 1
+        else:
+            self.chunk = min(self.shape[0], READ_BLOCK) if self.shape else 1
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    def __len__(self):
+        if not self.shape:
+            raise TypeError('len() of unsized object')
+        return self.shape[0]
+
+    def __array__(self, dtype=None):
+        values = self[...]
+        return values.astype(dtype) if dtype else values
+
+    def __iter__(self):
+        return iter(self[...])
+
+    def __getitem__(self, index):
+        index = index if isinstance(index, tuple) else (index,)
+        first = index[0] if index else Ellipsis
+        if isinstance(first, slice) and self.shape and 1 < (first.step or 1) < self.chunk:
+            return self._read_strided(first, index[1:])
+
+        with _lock:
+            return np.asarray(self.var[index])
+
+    def _read_strided(self, first, rest):
+        '''Read first, a strided slice of the first axis, in chunk-aligned blocks of at least
+        READ_BLOCK values and take every step'th value of them in memory
+        '''
+        start, stop, step = first.indices(self.shape[0])
+        block = self.chunk * max(1, READ_BLOCK // (self.chunk * max(1, int(np.prod(self.shape[1:])))))
+        parts = []
+        b0 = start - start % self.chunk
+        while b0 < stop:
+            b1 = min(b0 + block, stop)
+            # First index >= b0 of the strided sequence
+            i0 = start + -(-(max(b0, start) - start) // step) * step
+            if i0 < b1:
+                with _lock:
+                    values = np.asarray(self.var[(slice(i0, b1),) + rest])
+                parts.append(values[::step])
+            b0 = b1
+
+        if not parts:
+            with _lock:
+                return np.asarray(self.var[(slice(start, stop, step),) + rest])
+
+        return np.concatenate(parts)
@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+'''
+Declarative partitioning of the stoqs_measuredparameter table.
+
+Two strategies are supported:
+    parameter   - PARTITION BY LIST (parameter_id): one partition per Parameter plus a
+                  DEFAULT partition.  Queries constrained by Parameter (the most common
+                  STOQS UI selection) prune to a single partition.  New partitions are
+                  created by the loaders as Parameters are added to the database.
+    measurement - PARTITION BY HASH (measurement_id) into a fixed number of partitions.
+                  Spreads large campaigns evenly and keeps the measurement joins local.
+
+Databases created by loaders/load.py are converted after migrate when the MP_PARTITION
+setting is not empty.  To convert an existing database:
+
+    loaders/partition.py --db stoqs_canon_october2020 --mode parameter
+
+Django has no notion of this partitioning: the model is unchanged and the conversion is
+done directly in SQL, copying the column definitions, constraints and indexes that migrate
+created.  Because the primary key of a partitioned table must include the partition key
+the foreign key from stoqs_measuredparameterresource to stoqs_measuredparameter(id) can't
+be kept; it is dropped with a warning.
+'''
+
+import os
+import sys
+app_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), "../"))
+sys.path.insert(0, app_dir)
+if 'DJANGO_SETTINGS_MODULE' not in os.environ:
+    os.environ['DJANGO_SETTINGS_MODULE']='config.settings.local'
+import django
+django.setup()
+
+import logging
+from django.conf import settings
+from django.db import connections, transaction, DatabaseError
+
+logger = logging.getLogger(__name__)
+
+PARAMETER = 'parameter'
+MEASUREDPARAMETER_TABLE = 'stoqs_measuredparameter'
+MEASUREMENT = 'measurement'
+PARTITION_KEYS = {PARAMETER: 'parameter_id', MEASUREMENT: 'measurement_id'}
+
+# Cache of partition mode for each database, filled by partition_mode()
+_modes = {}
+
+
+class PartitionError(Exception):
+    pass
+
+
+def partition_mode(dbAlias):
+    '''Return PARAMETER or MEASUREMENT if stoqs_measuredparameter is partitioned in dbAlias,
+    None otherwise.  The answer is cached for the life of the process.
+    '''
+    if dbAlias not in _modes:
+        with connections[dbAlias].cursor() as cursor:
+            cursor.execute('''SELECT pt.partstrat FROM pg_partitioned_table pt
+                              JOIN pg_class c ON c.oid = pt.partrelid
+                              WHERE c.relname = %s''', [MEASUREDPARAMETER_TABLE])
+            row = cursor.fetchone()
+        _modes[dbAlias] = {'l': PARAMETER, 'h': MEASUREMENT}.get(row[0]) if row else None
+
+    return _modes[dbAlias]
+
+
+def add_parameter_partition(dbAlias, parameter):
+    '''Create the LIST partition for parameter if the database is partitioned by parameter.
+    Safe to call repeatedly.  Should rows for this parameter already be in the DEFAULT
+    partition the partition can't be created; they stay where they are and a warning is logged.
+    '''
+    if partition_mode(dbAlias) != PARAMETER:
+        return
+
+    table = f'{MEASUREDPARAMETER_TABLE}_p{parameter.id}'
+    try:
+        with transaction.atomic(using=dbAlias):
+            with connections[dbAlias].cursor() as cursor:
+                cursor.execute(f'''CREATE TABLE IF NOT EXISTS {table} PARTITION OF {MEASUREDPARAMETER_TABLE}
+                                   FOR VALUES IN ({int(parameter.id)})''')
+    except DatabaseError as e:
+        logger.warning(f'Could not create partition {table} for Parameter {parameter}: {e}')
+        logger.warning(f'MeasuredParameters for {parameter} will be stored in {MEASUREDPARAMETER_TABLE}_default')
+    else:
+        logger.debug(f'Partition {table} for Parameter {parameter} is in database {dbAlias}')
+
+
+def _fetch(cursor, sql, params=None):
+    cursor.execute(sql, params)
+    return cursor.fetchall()
+
+
+def convert_measuredparameter(dbAlias, mode=None, modulus=None):
+    '''Convert an existing stoqs_measuredparameter table into a partitioned table, copying
+    all of its rows.  Everything is done in one transaction so a failure leaves the original
+    table in place.
+    '''
+    mode = mode or settings.MP_PARTITION
+    modulus = modulus or settings.MP_PARTITION_MODULUS
+    if mode not in PARTITION_KEYS:
+        raise PartitionError(f'Partition mode must be one of {list(PARTITION_KEYS.keys())}, not {mode!r}')
+    if partition_mode(dbAlias):
+        raise PartitionError(f'{MEASUREDPARAMETER_TABLE} in {dbAlias} is already partitioned'
+                             f' by {partition_mode(dbAlias)}')
+
+    key = PARTITION_KEYS[mode]
+    old = f'{MEASUREDPARAMETER_TABLE}_unpartitioned'
+    seq = f'{MEASUREDPARAMETER_TABLE}_partitioned_id_seq'
+    with transaction.atomic(using=dbAlias):
+        with connections[dbAlias].cursor() as cursor:
+            cursor.execute(f'LOCK TABLE {MEASUREDPARAMETER_TABLE} IN ACCESS EXCLUSIVE MODE')
+
+            # Foreign keys into this table can't reference id alone once partitioned
+            for table, name in _fetch(cursor, '''SELECT conrelid::regclass::text, conname FROM pg_constraint
+                                                 WHERE confrelid = %s::regclass AND contype = 'f' ''',
+                                                 [MEASUREDPARAMETER_TABLE]):
+                logger.warning(f'Dropping foreign key constraint {name} on {table}')
+                cursor.execute(f'ALTER TABLE {table} DROP CONSTRAINT {name}')
+
+            # Save constraints (other than the primary key) and indexes to recreate on the new table
+            constraints = _fetch(cursor, '''SELECT conname, pg_get_constraintdef(oid) FROM pg_constraint
+                                            WHERE conrelid = %s::regclass AND contype IN ('u', 'f')''',
+                                            [MEASUREDPARAMETER_TABLE])
+            indexes = _fetch(cursor, '''SELECT i.indexname, i.indexdef FROM pg_indexes i
+                                        WHERE i.tablename = %s AND i.indexname NOT IN (
+                                            SELECT conname FROM pg_constraint WHERE conrelid = %s::regclass)''',
+                                        [MEASUREDPARAMETER_TABLE, MEASUREDPARAMETER_TABLE])
+
+            cursor.execute(f'ALTER TABLE {MEASUREDPARAMETER_TABLE} RENAME TO {old}')
+            if mode == PARAMETER:
+                cursor.execute(f'''CREATE TABLE {MEASUREDPARAMETER_TABLE} (LIKE {old} INCLUDING DEFAULTS)
+                                   PARTITION BY LIST ({key})''')
+                for (parameter_id,) in _fetch(cursor, 'SELECT id FROM stoqs_parameter ORDER BY id'):
+                    cursor.execute(f'''CREATE TABLE {MEASUREDPARAMETER_TABLE}_p{parameter_id}
+                                       PARTITION OF {MEASUREDPARAMETER_TABLE} FOR VALUES IN ({parameter_id})''')
+                cursor.execute(f'CREATE TABLE {MEASUREDPARAMETER_TABLE}_default PARTITION OF {MEASUREDPARAMETER_TABLE} DEFAULT')
+            else:
+                cursor.execute(f'''CREATE TABLE {MEASUREDPARAMETER_TABLE} (LIKE {old} INCLUDING DEFAULTS)
+                                   PARTITION BY HASH ({key})''')
+                for remainder in range(modulus):
+                    cursor.execute(f'''CREATE TABLE {MEASUREDPARAMETER_TABLE}_h{remainder}
+                                       PARTITION OF {MEASUREDPARAMETER_TABLE}
+                                       FOR VALUES WITH (MODULUS {modulus}, REMAINDER {remainder})''')
+
+            # The IDENTITY column of the original table becomes a plain sequence default
+            cursor.execute(f'CREATE SEQUENCE {seq} OWNED BY {MEASUREDPARAMETER_TABLE}.id')
+            cursor.execute(f"SELECT setval('{seq}', COALESCE((SELECT MAX(id) FROM {old}), 0) + 1, false)")
+            cursor.execute(f"ALTER TABLE {MEASUREDPARAMETER_TABLE} ALTER COLUMN id SET DEFAULT nextval('{seq}')")
+
+            logger.info(f'Copying rows from {old} into partitions of {MEASUREDPARAMETER_TABLE}')
+            cursor.execute(f'INSERT INTO {MEASUREDPARAMETER_TABLE} SELECT * FROM {old}')
+            logger.info(f'Copied {cursor.rowcount} rows')
+            cursor.execute(f'DROP TABLE {old}')
+
+            # Constraint and index names are free again, recreate them with their original names
+            cursor.execute(f'''ALTER TABLE {MEASUREDPARAMETER_TABLE}
+                               ADD CONSTRAINT {MEASUREDPARAMETER_TABLE}_pkey PRIMARY KEY (id, {key})''')
+            for name, definition in constraints:
+                cursor.execute(f'ALTER TABLE {MEASUREDPARAMETER_TABLE} ADD CONSTRAINT {name} {definition}')
+            for name, definition in indexes:
+                cursor.execute(definition)
+
+    with connections[dbAlias].cursor() as cursor:
+        cursor.execute(f'ANALYZE {MEASUREDPARAMETER_TABLE}')
+
+    _modes.pop(dbAlias, None)
+    logger.info(f'{MEASUREDPARAMETER_TABLE} in {dbAlias} is now partitioned by {partition_mode(dbAlias)}')
+
+
+def partition_sizes(dbAlias):
+    '''Return list of (partition name, estimated rows, total bytes) for the partitions of
+    stoqs_measuredparameter, largest first
+    '''
+    with connections[dbAlias].cursor() as cursor:
+        return _fetch(cursor, '''SELECT c.relname, c.reltuples::bigint, pg_total_relation_size(c.oid)
+                                 FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+                                 WHERE i.inhparent = %s::regclass
+                                 ORDER BY pg_total_relation_size(c.oid) DESC''', [MEASUREDPARAMETER_TABLE])
+
+
+if __name__ == '__main__':
+    import argparse
+    from argparse import RawTextHelpFormatter
+
+    parser = argparse.ArgumentParser(formatter_class=RawTextHelpFormatter, description=__doc__)
+    parser.add_argument('--db', action='store', required=True, help='Database alias, e.g. stoqs_canon_october2020')
+    parser.add_argument('--mode', action='store', choices=list(PARTITION_KEYS.keys()), default=settings.MP_PARTITION or PARAMETER,
+                        help='Partition by LIST on parameter_id or HASH on measurement_id')
+    parser.add_argument('--modulus', action='store', type=int, default=settings.MP_PARTITION_MODULUS,
+                        help='Number of partitions for --mode measurement')
+    parser.add_argument('--status', action='store_true', help='Report partitioning of the database and exit')
+    args = parser.parse_args()
+
+    if args.status:
+        print(f'{MEASUREDPARAMETER_TABLE} in {args.db} partitioned by: {partition_mode(args.db)}')
+        for name, rows, size in partition_sizes(args.db):
+            print(f'{name:40s} {rows:12d} rows {size / 2**20:10.1f} MB')
+    else:
+        convert_measuredparameter(args.db, args.mode, args.modulus)
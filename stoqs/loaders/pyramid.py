@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+'''
+Multi-resolution time-depth pyramid of MeasuredParameter aggregates.
+
+For each Activity and Parameter the datavalues are aggregated (min, mean, max and count)
+into time buckets of BASE_SECONDS * 2**level seconds for levels 0 to NUM_LEVELS - 1,
+separately for each nominal depth (timeseriesprofile data) and each DEPTH_BIN meter
+depth bin.  Level 0 is built from the MeasuredParameters and each higher level from the
+one below it, so the whole pyramid is about twice the size of level 0.
+
+The loaders build the pyramid after each Activity is loaded (see SAVE_PARAMETER_PYRAMID
+in the settings).  The parametertime plot and gridded section plots read from the coarsest
+level that still meets their resolution.  To build it for an existing database:
+
+    loaders/pyramid.py --db stoqs_canon_october2020
+'''
+
+import os
+import sys
+app_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), "../"))
+sys.path.insert(0, app_dir)
+if 'DJANGO_SETTINGS_MODULE' not in os.environ:
+    os.environ['DJANGO_SETTINGS_MODULE']='config.settings.local'
+import django
+django.setup()
+
+import logging
+from django.db import connections, transaction
+from stoqs import models as m
+
+logger = logging.getLogger(__name__)
+
+BASE_SECONDS = 60
+NUM_LEVELS = 11                     # 1 minute to about 17 hour buckets
+DEPTH_BIN = 1.0                     # meters
+PYRAMID_TABLE = 'stoqs_parametertimebucket'
+
+
+def bucket_seconds(level):
+    '''Width in seconds of the time buckets at level
+    '''
+    return BASE_SECONDS * 2**level
+
+
+def choose_level(resolution):
+    '''Return the coarsest level whose buckets are no wider than resolution seconds,
+    None if resolution is finer than level 0 and the MeasuredParameters need to be read.
+    '''
+    if resolution < BASE_SECONDS:
+        return None
+
+    level = 0
+    while level < NUM_LEVELS - 1 and bucket_seconds(level + 1) <= resolution:
+        level += 1
+
+    return level
+
+
+def build_pyramid(dbAlias, activity):
+    '''Replace the pyramid of all Parameters of activity, return the number of buckets saved
+    '''
+    num_saved = 0
+    with transaction.atomic(using=dbAlias):
+        m.ParameterTimeBucket.objects.using(dbAlias).filter(activity=activity).delete()
+        with connections[dbAlias].cursor() as cursor:
+            secs = bucket_seconds(0)
+            cursor.execute(f'''INSERT INTO {PYRAMID_TABLE} (activity_id, parameter_id, level, timebucket,
+                                   nominaldepth, depthbin, min, mean, max, count)
+                               SELECT ip.activity_id, mp.parameter_id, 0,
+                                      to_timestamp(floor(EXTRACT(EPOCH FROM ip.timevalue) / {secs}) * {secs}),
+                                      nl.depth, floor(me.depth / {DEPTH_BIN}) * {DEPTH_BIN},
+                                      min(mp.datavalue), avg(mp.datavalue), max(mp.datavalue), count(mp.datavalue)
+                               FROM stoqs_measuredparameter mp
+                               INNER JOIN stoqs_measurement me ON mp.measurement_id = me.id
+                               INNER JOIN stoqs_instantpoint ip ON me.instantpoint_id = ip.id
+                               LEFT OUTER JOIN stoqs_nominallocation nl ON me.nominallocation_id = nl.id
+                               WHERE ip.activity_id = %s AND me.depth IS NOT NULL
+                                     AND mp.datavalue IS NOT NULL AND mp.datavalue <> 'NaN'
+                               GROUP BY 1, 2, 4, 5, 6''', [activity.id])
+            num_saved += cursor.rowcount
+
+            for level in range(1, NUM_LEVELS):
+                secs = bucket_seconds(level)
+                cursor.execute(f'''INSERT INTO {PYRAMID_TABLE} (activity_id, parameter_id, level, timebucket,
+                                       nominaldepth, depthbin, min, mean, max, count)
+                                   SELECT activity_id, parameter_id, %s,
+                                          to_timestamp(floor(EXTRACT(EPOCH FROM timebucket) / {secs}) * {secs}),
+                                          nominaldepth, depthbin,
+                                          min(min), sum(mean * count) / sum(count), max(max), sum(count)
+                                   FROM {PYRAMID_TABLE}
+                                   WHERE activity_id = %s AND level = %s
+                                   GROUP BY 1, 2, 4, 5, 6''', [level, activity.id, level - 1])
+                num_saved += cursor.rowcount
+
+    return num_saved
+
+
+if __name__ == '__main__':
+    import argparse
+    from argparse import RawTextHelpFormatter
+
+    parser = argparse.ArgumentParser(formatter_class=RawTextHelpFormatter, description=__doc__)
+    parser.add_argument('--db', action='store', required=True, help='Database alias, e.g. stoqs_canon_october2020')
+    parser.add_argument('--activity', action='store', help='Build for just the Activity with this name')
+    args = parser.parse_args()
+
+    acts = m.Activity.objects.using(args.db).order_by('startdate')
+    if args.activity:
+        acts = acts.filter(name=args.activity)
+    for act in acts:
+        print(f'{act.name}: {build_pyramid(args.db, act)} buckets')
@@ -8,7 +8,10 @@ MBARI Jan 3, 2012
 
 import logging
 import threading
+import time
+from collections import OrderedDict
 from django.conf import settings
+from django.db import connections
 from django.db.utils import ConnectionDoesNotExist
 from django.http import HttpResponseBadRequest
 
@@ -16,6 +19,114 @@ logger = logging.getLogger(__name__)
 _thread_local_vars = threading.local()
 
 
+class CampaignConnectionPool(object):
+    '''
+    Least recently used bookkeeping of the persistent (CONN_MAX_AGE) campaign database connections
+    opened by this process.  Django keeps a connection for each thread and alias, without a cap a
+    process serving requests for dozens of campaigns holds open a connection to each one of them.
+    Connections belong to the thread that opened them, so those of other threads that are over
+    the cap are marked and closed by their own thread at the end of its next request.
+    '''
+    def __init__(self, max_connections=None, health_check_seconds=None):
+        self._max_connections = max_connections
+        self._health_check_seconds = health_check_seconds
+        self._lock = threading.Lock()
+        self._lru = OrderedDict()           # (thread ident, alias): time of last use
+        self._evict = set()
+        self.stats = dict(checkouts=0, reuses=0, evictions=0, health_check_failures=0)
+
+    @property
+    def max_connections(self):
+        if self._max_connections is None:
+            return settings.DB_POOL_MAX_CONNECTIONS
+        return self._max_connections
+
+    @property
+    def health_check_seconds(self):
+        if self._health_check_seconds is None:
+            return settings.DB_POOL_HEALTH_CHECK_SECONDS
+        return self._health_check_seconds
+
+    def checkout(self, alias):
+        '''Mark alias as the most recently used connection of this thread, closing its connection
+        if it's been idle longer than health_check_seconds and is no longer usable
+        '''
+        key = (threading.get_ident(), alias)
+        conn = connections[alias]
+        with self._lock:
+            self.stats['checkouts'] += 1
+            last_used = self._lru.get(key)
+
+        if conn.connection is not None:
+            if last_used and time.time() - last_used > self.health_check_seconds and not conn.is_usable():
+                logger.info(f'Closing unusable connection to {alias}')
+                conn.close()
+                with self._lock:
+                    self.stats['health_check_failures'] += 1
+            else:
+                with self._lock:
+                    self.stats['reuses'] += 1
+
+        with self._lock:
+            self._lru[key] = time.time()
+            self._lru.move_to_end(key)
+
+    def release(self):
+        '''Called at the end of a request: forget the connections Django has closed and close the least
+        recently used connections over max_connections
+        '''
+        ident = threading.get_ident()
+        with self._lock:
+            # Connections opened without a checkout(), e.g. to 'default' for sessions
+            for conn in connections.all(initialized_only=True):
+                if conn.connection is not None and (ident, conn.alias) not in self._lru:
+                    self._lru[(ident, conn.alias)] = time.time()
+
+            for key in [k for k in self._lru if k[0] == ident]:
+                try:
+                    closed = connections[key[1]].connection is None
+                except ConnectionDoesNotExist:
+                    closed = True
+                if closed:
+                    del self._lru[key]
+                    self._evict.discard(key)
+
+            excess = len(self._lru) - len(self._evict) - self.max_connections
+            for key in self._lru:
+                if excess <= 0:
+                    break
+                if key not in self._evict:
+                    self._evict.add(key)
+                    excess -= 1
+
+            for key in [k for k in self._evict if k[0] == ident]:
+                if connections[key[1]].in_atomic_block:
+                    # Can't close in the middle of a transaction, try again at the next release()
+                    continue
+                logger.debug(f'Evicting connection to {key[1]}')
+                connections[key[1]].close()
+                del self._lru[key]
+                self._evict.discard(key)
+                self.stats['evictions'] += 1
+
+    def open_count(self):
+        with self._lock:
+            return len(self._lru)
+
+    def status(self):
+        '''Return dictionary of the statistics and open connections for the debug endpoint
+        '''
+        with self._lock:
+            now = time.time()
+            return dict(self.stats, max_connections=self.max_connections, open=len(self._lru),
+                        pending_evictions=len(self._evict),
+                        connections=[{'thread': t, 'alias': a, 'idle_seconds': round(now - u, 1)}
+                                     for (t, a), u in self._lru.items()])
+
+
+connection_pool = CampaignConnectionPool()
+
+
 class RouterMiddleware(object):
 
     def __init__(self, get_response):
@@ -30,6 +141,7 @@ class RouterMiddleware(object):
 
         # Code to be executed for each request/response after
         # the view is called.
+        connection_pool.release()
 
         return response
 
@@ -52,6 +164,7 @@ class RouterMiddleware(object):
             # Add as a META tag for those views that wish to use the dbAlias
             
             request.META['dbAlias'] = _thread_local_vars.dbAlias
+            connection_pool.checkout(_thread_local_vars.dbAlias)
 
         # See http://dustinfarris.com/2012/2/sharing-django-users-and-sessions-across-projects/
         if request.path.startswith('/admin'):
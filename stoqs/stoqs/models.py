@@ -10,6 +10,7 @@ MBARI 17 March 2012
 '''
 
 
+from django.conf import settings
 from django.contrib.gis.db import models
 from django.contrib.postgres.fields import ArrayField
 
@@ -38,6 +39,18 @@ class UUIDField(models.CharField) :
             return super(UUIDField, self).pre_save(model_instance, add)
 
 
+def SampleValueField(**kwargs):
+    '''
+    Sample depths and SampledParameter datavalues were originally stored as numeric(100, 30), which are read
+    as Python Decimals.  With settings.SAMPLE_FLOAT_STORAGE they are double precision, like MeasuredParameter.
+    Existing databases may be converted with loaders/float_storage.py.
+    '''
+    if getattr(settings, 'SAMPLE_FLOAT_STORAGE', False):
+        return models.FloatField(**kwargs)
+    else:
+        return models.DecimalField(max_digits=100, decimal_places=30, **kwargs)
+
+
 class ResourceType(models.Model):
     '''
     Type of Resource. Example names: nc_global, quick-look-plot.
@@ -440,7 +453,7 @@ class Sample(models.Model):
     '''
     uuid = UUIDField(editable=False)
     instantpoint = models.ForeignKey(InstantPoint, on_delete=models.CASCADE)
-    depth= models.DecimalField(max_digits=100, db_index=True, decimal_places=30)
+    depth= SampleValueField(db_index=True)
     geom = models.PointField(srid=4326, spatial_index=True, dim=2)
     name = models.CharField(max_length=128, db_index=True)
     sampletype = models.ForeignKey(SampleType, on_delete=models.CASCADE, blank=True, null=True, default=None) 
@@ -552,6 +565,47 @@ class ActivityParameterHistogram(models.Model):
     bincount = models.IntegerField()
 
 
+class ActivityParameterArray(models.Model):
+    '''
+    All the MeasuredParameter data of a Parameter in an Activity packed into time ordered arrays.  Written
+    after the load by STOQS_Loader.saveActivityParameterArrays() so that utils/Viz can build section plots
+    and X3D without the Measurement and InstantPoint joins.
+    '''
+    activity = models.ForeignKey(Activity, on_delete=models.CASCADE)
+    parameter = models.ForeignKey(Parameter, on_delete=models.CASCADE)
+    epochseconds = ArrayField(models.FloatField())
+    depth = ArrayField(models.FloatField())
+    latitude = ArrayField(models.FloatField())
+    longitude = ArrayField(models.FloatField())
+    datavalue = ArrayField(models.FloatField(null=True))
+    class Meta(object):
+        verbose_name = 'Activity Parameter Array'
+        verbose_name_plural = 'Activity Parameter Array'
+        app_label = 'stoqs'
+        unique_together = ['activity', 'parameter']
+
+
+class ParameterTimeBucket(models.Model):
+    '''
+    Aggregate of the MeasuredParameter datavalues of a Parameter in an Activity over a time bucket and depth bin
+    at one level of the pyramid built by loaders/pyramid.py.  Used for parametertime and gridded section plots.
+    '''
+    activity = models.ForeignKey(Activity, on_delete=models.CASCADE)
+    parameter = models.ForeignKey(Parameter, on_delete=models.CASCADE)
+    level = models.SmallIntegerField(db_index=True)
+    timebucket = models.DateTimeField(db_index=True)
+    nominaldepth = models.FloatField(null=True)
+    depthbin = models.FloatField()
+    min = models.FloatField()
+    mean = models.FloatField()
+    max = models.FloatField()
+    count = models.IntegerField()
+    class Meta(object):
+        verbose_name = 'Parameter Time Bucket'
+        verbose_name_plural = 'Parameter Time Buckets'
+        app_label = 'stoqs'
+
+
 class MeasuredParameter(models.Model):
     '''
     Association class pairing Measurements with Parameters.  This is where the measured values are stored -- in the datavalue field.
@@ -574,7 +628,7 @@ class SampledParameter(models.Model):
     uuid = UUIDField(editable=False)
     sample = models.ForeignKey(Sample, on_delete=models.CASCADE) 
     parameter = models.ForeignKey(Parameter, on_delete=models.CASCADE) 
-    datavalue = models.DecimalField(max_digits=100, db_index=True, decimal_places=30)
+    datavalue = SampleValueField(db_index=True)
     analysismethod = models.ForeignKey(AnalysisMethod, on_delete=models.CASCADE, null=True)
     class Meta(object):
         verbose_name = 'Sampled Parameter'
@@ -18,13 +18,33 @@ import time
 import json
 import time
 import logging
+import shutil
+import subprocess
+import tempfile
+import threading
 
+import netCDF4
+import numpy as np
+import pandas as pd
+import seawater.eos80 as sw
+from argparse import Namespace
+from contextlib import closing
 from datetime import timedelta
 from django.conf import settings
-from django.test import TestCase
+from django.contrib.gis.geos import LineString
+from django.db import connection
+from django.test import SimpleTestCase, TestCase, TransactionTestCase
 from django.urls import reverse
-from stoqs.models import MeasuredParameter, ActivityParameter, ParameterResource, Parameter
+from stoqs.models import (Activity, MeasuredParameter, ActivityParameter, ParameterResource, Parameter,
+                          InstantPoint, Measurement, Resource)
 from CCE.loadCCE_2015 import lores_event_times
+from CANON.toNetCDF.lrauvNc4ToNetcdf import InterpolatorWriter
+from loaders import DAPloaders, LoadScript, SIGMAT, SPICE, bathymetry, cmd_exists
+from loaders.DAPloaders import CHECKPOINT, MAPTRACK_TOLERANCE, Trajectory_Loader, prefetch
+from loaders import local_netcdf
+from loaders.local_netcdf import open_dataset
+from pydap.model import BaseType, DatasetType, GridType
+from utils.utils import spiciness
 
 logger = logging.getLogger('stoqs.tests')
 settings.LOGGING['loggers']['stoqs.tests']['level'] = 'INFO'
@@ -84,3 +104,669 @@ class MeasuredParameterTestCase(TestCase):
         self.assertEquals(len(prs), len(ps), 'Should not have more that one units for a Parameter name')
 
         
+
+
+class PrefetchTestCase(SimpleTestCase):
+    '''Read strided slices of a local NetCDF file through pydap with the reader thread
+    used by Base_Loader.load_trajectory()
+    '''
+    pnames = ['temperature', 'salinity', 'oxygen', 'nitrate']
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        path = os.path.join(self.tmpdir, 'prefetch_test.nc')
+        with netCDF4.Dataset(path, 'w') as nc:
+            nc.createDimension('time', 1000)
+            for i, pname in enumerate(self.pnames):
+                nc.createVariable(pname, 'f8', ('time',))[:] = np.arange(1000) + 1000 * i
+        self.ds = open_dataset(path)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _read(self, pname):
+        return self.ds[pname].data[10:990:3]
+
+    def _reader_alive(self):
+        return any(t.name == 'prefetch' and t.is_alive() for t in threading.enumerate())
+
+    def test_same_slices(self):
+        for depth in (0, 1, 2, 8):
+            with closing(prefetch(self.pnames, self._read, depth)) as slices:
+                got = list(slices)
+            self.assertEqual([pname for pname, _ in got], self.pnames)
+            for pname, values in got:
+                np.testing.assert_array_equal(values, self._read(pname))
+        self.assertFalse(self._reader_alive())
+
+    def test_backpressure(self):
+        depth = 1
+        reads = []
+
+        def read(pname):
+            reads.append(pname)
+            return self._read(pname)
+
+        with closing(prefetch(self.pnames * 5, read, depth)) as slices:
+            for consumed, _ in enumerate(slices, start=1):
+                time.sleep(0.05)
+                # depth slices in the queue and one more waiting to be put there
+                self.assertLessEqual(len(reads), consumed + depth + 1)
+
+    def test_error_propagation(self):
+        def read(pname):
+            if pname == 'oxygen':
+                raise OSError(f'Cannot read {pname}')
+            return self._read(pname)
+
+        consumed = []
+        with self.assertRaises(OSError):
+            with closing(prefetch(self.pnames, read)) as slices:
+                for pname, _ in slices:
+                    consumed.append(pname)
+        self.assertEqual(consumed, ['temperature', 'salinity'])
+        self.assertFalse(self._reader_alive())
+
+    def test_early_exit(self):
+        reads = []
+
+        def read(pname):
+            reads.append(pname)
+            return self._read(pname)
+
+        with closing(prefetch(self.pnames * 5, read, depth=2)) as slices:
+            for pname, _ in slices:
+                break
+        self.assertFalse(self._reader_alive())
+        self.assertLess(len(reads), len(self.pnames * 5))
+
+
+class LocalNetCDFTestCase(SimpleTestCase):
+    '''Read a local NetCDF file through the same pydap interface that OPeNDAP datasets have
+    '''
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'local_test.nc')
+        self.temperature = 10 + np.arange(5000) / 100
+        with netCDF4.Dataset(self.path, 'w') as nc:
+            nc.featureType = 'trajectory'
+            nc.createDimension('time', 5000)
+            nc.createVariable('time', 'f8', ('time',))[:] = np.arange(5000)
+            nc['time'].units = 'seconds since 2020-01-01'
+            nc.createVariable('temperature', 'f4', ('time',), chunksizes=[128])[:] = self.temperature
+            nc.createDimension('sample', 5000)
+            nc.createVariable('counts', 'i4', ('sample',))[:] = np.arange(5000)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_structure(self):
+        ds = open_dataset(f'file://{self.path}')
+        self.assertEqual(ds.attributes['NC_GLOBAL']['featureType'], 'trajectory')
+        self.assertIsInstance(ds['temperature'], GridType)
+        self.assertEqual(list(ds['temperature'].maps.keys()), ['time'])
+        self.assertEqual(ds['time'].units, 'seconds since 2020-01-01')
+        # No coordinate variable for sample, so counts is not a Grid
+        self.assertIsInstance(ds['counts'], BaseType)
+        self.assertEqual(ds['temperature'].shape, (5000,))
+
+    def test_strided_reads(self):
+        ds = open_dataset(self.path)
+        original = local_netcdf.READ_BLOCK
+        local_netcdf.READ_BLOCK = 300
+        try:
+            for sl in (slice(None), slice(10, 4990, 3), slice(127, 4000, 7), slice(1000, 1001, 2), slice(5, 4000, 500)):
+                np.testing.assert_allclose(ds['temperature']['temperature'].data[sl], self.temperature[sl], rtol=1e-6)
+                np.testing.assert_array_equal(ds['counts'].data[sl], np.arange(5000)[sl])
+        finally:
+            local_netcdf.READ_BLOCK = original
+
+    def test_close(self):
+        ds = open_dataset(self.path)
+        local_netcdf.close_dataset(ds)
+        self.assertFalse(ds._nc.isopen())
+        # Closing again, or a dataset without a local file, does nothing
+        local_netcdf.close_dataset(ds)
+        local_netcdf.close_dataset(DatasetType('remote'))
+
+
+class BathymetryTestCase(SimpleTestCase):
+    '''Interpolate small synthetic grids in the old and new GMT formats, with tiles of a few nodes
+    '''
+    x = np.linspace(-122.5, -121.5, 41)
+    y = np.linspace(36.5, 37.0, 21)
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.tile = bathymetry.TILE
+        bathymetry.TILE = 8
+        lons, lats = np.meshgrid(self.x, self.y)
+        self.plane = self._grids('plane', -1000.0 + 300.0 * (lons + 122) - 500.0 * (lats - 36.5))
+        self.bumpy = self._grids('bumpy', -1000.0 + 200.0 * np.sin(20 * lons) * np.cos(30 * lats))
+
+        rng = np.random.default_rng(0)
+        self.lons = rng.uniform(-122.6, -121.4, 5000)
+        self.lats = rng.uniform(36.45, 37.05, 5000)
+        # Corners of the grid
+        self.lons[:4] = self.x[0], self.x[-1], self.x[0], self.x[-1]
+        self.lats[:4] = self.y[0], self.y[0], self.y[-1], self.y[-1]
+        self.outside = (self.lons < self.x[0]) | (self.lons > self.x[-1]) | (self.lats < self.y[0]) | (self.lats > self.y[-1])
+
+    def tearDown(self):
+        bathymetry.TILE = self.tile
+        bathymetry.open_grid.cache_clear()
+        shutil.rmtree(self.tmpdir)
+
+    def _grids(self, name, z):
+        '''Write z as a compressed NetCDF 4 grid in the new format and a NetCDF 3 grid in the old format
+        '''
+        new = os.path.join(self.tmpdir, f'{name}_new.grd')
+        with netCDF4.Dataset(new, 'w') as nc:
+            nc.createDimension('lon', len(self.x))
+            nc.createDimension('lat', len(self.y))
+            nc.createVariable('lon', 'f8', ('lon',))[:] = self.x
+            nc.createVariable('lat', 'f8', ('lat',))[:] = self.y
+            nc.createVariable('z', 'f8', ('lat', 'lon'), zlib=True)[:] = z
+        old = os.path.join(self.tmpdir, f'{name}_old.grd')
+        with netCDF4.Dataset(old, 'w', format='NETCDF3_CLASSIC') as nc:
+            nc.createDimension('side', 2)
+            nc.createDimension('xysize', z.size)
+            nc.createVariable('x_range', 'f8', ('side',))[:] = [self.x[0], self.x[-1]]
+            nc.createVariable('y_range', 'f8', ('side',))[:] = [self.y[0], self.y[-1]]
+            nc.createVariable('spacing', 'f8', ('side',))[:] = [self.x[1] - self.x[0], self.y[1] - self.y[0]]
+            nc.createVariable('dimension', 'i4', ('side',))[:] = [len(self.x), len(self.y)]
+            var = nc.createVariable('z', 'f8', ('xysize',))
+            var.node_offset = 0
+            # Rows from the top of the grid
+            var[:] = z[::-1].ravel()
+
+        return new, old
+
+    def test_plane(self):
+        expected = -1000.0 + 300.0 * (self.lons + 122) - 500.0 * (self.lats - 36.5)
+        for path in self.plane:
+            values = bathymetry.bottom_depths(path, self.lons, self.lats)
+            self.assertTrue(np.isnan(values[self.outside]).all())
+            np.testing.assert_allclose(values[~self.outside], expected[~self.outside], rtol=0, atol=1e-6)
+
+    def test_formats_and_cache(self):
+        new, old = self.bumpy
+        values = bathymetry.bottom_depths(new, self.lons, self.lats)
+        np.testing.assert_allclose(bathymetry.bottom_depths(old, self.lons, self.lats), values, equal_nan=True)
+        # A second lookup, as for the next Activity, reuses the grid and its tiles
+        grid = bathymetry.open_grid(new)
+        misses = grid.tile.cache_info().misses
+        np.testing.assert_array_equal(bathymetry.bottom_depths(new, self.lons, self.lats), values)
+        self.assertIs(bathymetry.open_grid(new), grid)
+        self.assertEqual(grid.tile.cache_info().misses, misses)
+
+    def test_grdtrack(self):
+        if cmd_exists('grdtrack'):
+            grdtrack = ['grdtrack']
+        elif cmd_exists('gmt'):
+            grdtrack = ['gmt', 'grdtrack']
+        else:
+            self.skipTest('GMT is not installed')
+
+        new, _ = self.bumpy
+        inside = ~self.outside
+        xy = '\n'.join(f'{lon:.8f} {lat:.8f}' for lon, lat in zip(self.lons[inside], self.lats[inside]))
+        # Bilinear interpolation, as in loaders/bathymetry.py
+        output = subprocess.run(grdtrack + [f'-G{new}', '-nl'], input=xy, capture_output=True, text=True,
+                                check=True).stdout
+        expected = np.array([float(line.split()[2]) for line in output.splitlines()])
+        values = bathymetry.bottom_depths(new, self.lons[inside], self.lats[inside])
+        np.testing.assert_allclose(values, expected, rtol=0, atol=1e-3)
+
+
+class LrauvResampleTestCase(SimpleTestCase):
+    '''Resample the groups of a synthetic LRAUV nc4 file serially and in worker processes and compare
+    the bytes of the results
+    '''
+    groups = {'CTD_Seabird': ('sea_water_temperature', 'sea_water_salinity'),
+              'WetLabsBB2FL': ('mass_concentration_of_chlorophyll_in_sea_water', 'Output470'),
+              'Aanderaa_O2': ('mass_concentration_of_oxygen_in_sea_water',),
+              'NAL9602': ('platform_pitch_angle',)}
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'lrauv.nc4')
+        rng = np.random.default_rng(0)
+        with netCDF4.Dataset(self.path, 'w') as nc:
+            for n, (group, names) in enumerate(self.groups.items()):
+                g = nc.createGroup(group)
+                for name in names:
+                    # Each variable has its own irregular time base
+                    secs = 1.6e9 + np.cumsum(rng.uniform(0.5, 1.5 + n, 3000))
+                    g.createDimension(f'{name}_time', len(secs))
+                    g.createVariable(f'{name}_time', 'f8', (f'{name}_time',))[:] = secs
+                    var = g.createVariable(name, 'f4', (f'{name}_time',))
+                    var.units = 'unitless'
+                    var.long_name = name
+                    var[:] = np.sin(secs / 300) + rng.normal(0, 0.1, len(secs))
+        self.parm = {group: [{'name': name, 'rename': f'{group}_{name}'} for name in names]
+                            for group, names in self.groups.items()}
+        self.t_index = pd.date_range(pd.to_datetime(1.6e9 + 100, unit='s'), periods=1000, freq='2s')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _resample(self, workers):
+        pw = InterpolatorWriter()
+        pw.in_file = self.path
+        with netCDF4.Dataset(self.path) as pw.df:
+            return pw.resample_groups(self.path, list(self.groups), self.parm, self.t_index, '2S', workers)
+
+    def test_parallel_resample(self):
+        serial = self._resample(workers=1)
+        parallel = self._resample(workers=len(self.groups))
+        self.assertEqual(sum(len(results) for results in serial), 6)
+        self.assertEqual(len(parallel), len(serial))
+        for serial_results, parallel_results in zip(serial, parallel):
+            self.assertEqual([key for key, _, _ in parallel_results], [key for key, _, _ in serial_results])
+            for (key, s_attr, s_ts), (_, p_attr, p_ts) in zip(serial_results, parallel_results):
+                self.assertEqual(p_attr, s_attr, key)
+                self.assertEqual(p_ts.index.asi8.tobytes(), s_ts.index.asi8.tobytes(), key)
+                self.assertEqual(p_ts.values.tobytes(), s_ts.values.tobytes(), key)
+
+
+class NudgeCoordsTestCase(SimpleTestCase):
+    '''Check properties of the GPS fix segments, nudged dead reckoned positions and outlier masks
+    of InterpolatorWriter on many random synthetic LRAUV nc4 files and signals
+    '''
+    trials = 50
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.rng = np.random.default_rng(0)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _write(self, secs, fix_secs):
+        path = os.path.join(self.tmpdir, 'lrauv.nc4')
+        n, nf = len(secs), len(fix_secs)
+        with netCDF4.Dataset(path, 'w') as nc:
+            for name, t, degrees in (('longitude', secs, -122 + np.cumsum(self.rng.normal(0, 1e-4, n))),
+                                     ('latitude', secs, 36.8 + np.cumsum(self.rng.normal(0, 1e-4, n))),
+                                     ('longitude_fix', fix_secs, -122 + self.rng.normal(0, 1e-2, nf)),
+                                     ('latitude_fix', fix_secs, 36.8 + self.rng.normal(0, 1e-2, nf))):
+                nc.createDimension(f'{name}_time', len(t))
+                nc.createVariable(f'{name}_time', 'f8', (f'{name}_time',))[:] = t
+                nc.createVariable(name, 'f8', (f'{name}_time',))[:] = np.radians(degrees)
+
+        return path
+
+    def test_fix_segments(self):
+        pw = InterpolatorWriter()
+        for _ in range(self.trials):
+            secs = np.sort(self.rng.integers(0, 500, self.rng.integers(1, 300)))
+            fix_secs = self.rng.integers(-10, 510, self.rng.integers(2, 20)).astype('f8')
+            if self.rng.random() < 0.5:
+                fix_secs.sort()
+            fix_secs[self.rng.random(len(fix_secs)) < 0.1] = np.nan
+            times = pd.to_datetime(secs, unit='s')
+            fix_times = pd.to_datetime(fix_secs, unit='s')
+            expected = [np.where(np.logical_and(times > fix_times[i], times < fix_times[i+1]))[0]
+                                for i in range(len(fix_times) - 1)]
+            for segi, exp in zip(pw.fix_segments(times, fix_times), expected):
+                self.assertEqual(segi.tolist(), exp.tolist())
+            # Unsorted times
+            shuffled = times[self.rng.permutation(len(times))]
+            for segi, fix0, fix1 in zip(pw.fix_segments(shuffled, fix_times), fix_times[:-1], fix_times[1:]):
+                self.assertEqual(sorted(segi.tolist()), np.where((shuffled > fix0) & (shuffled < fix1))[0].tolist())
+
+    def test_nudge_coords(self):
+        args = Namespace(remove_gps_outliers=False)
+        for _ in range(self.trials):
+            secs = 1.6e9 + np.cumsum(self.rng.uniform(0.1, 5, self.rng.integers(50, 500)))
+            fix_secs = np.sort(self.rng.uniform(secs[0] - 5, secs[-1] + 5, self.rng.integers(2, 20)))
+            pw = InterpolatorWriter()
+            path = self._write(secs, fix_secs)
+            with netCDF4.Dataset(path) as pw.df:
+                lons, lats = pw.nudge_coords(path, args)
+                lon = pw.var_series(path, pw.df['longitude'], pw.df['longitude_time'], args, angle=True)
+                lat = pw.var_series(path, pw.df['latitude'], pw.df['latitude_time'], args, angle=True)
+                lon_fix = pw.var_series(path, pw.df['longitude_fix'], pw.df['longitude_fix_time'], args, angle=True)
+                lat_fix = pw.var_series(path, pw.df['latitude_fix'], pw.df['latitude_fix_time'], args, angle=True)
+
+            self.assertTrue(lons.index.equals(lats.index))
+            self.assertTrue(lons.index.is_monotonic_increasing)
+            self.assertTrue(lons.index.isin(lon.index).all())
+            segments = 0
+            for i in range(len(fix_secs) - 1):
+                seg = (lons.index > lon_fix.index[i]) & (lons.index < lon_fix.index[i+1])
+                if not seg.any():
+                    continue
+                segments += 1
+                # Unchanged at the start of the segment, on the next fix at its end
+                start, end = lons.index[seg][0], lons.index[seg][-1]
+                if start != end:
+                    self.assertAlmostEqual(lons.loc[start], lon.loc[start], places=9)
+                    self.assertAlmostEqual(lats.loc[start], lat.loc[start], places=9)
+                self.assertAlmostEqual(lons.loc[end], lon_fix.iloc[i+1], places=9)
+                self.assertAlmostEqual(lats.loc[end], lat_fix.iloc[i+1], places=9)
+            self.assertEqual(pw.segment_count, segments)
+
+    def test_outlier_mask(self):
+        pw = InterpolatorWriter()
+        for _ in range(self.trials):
+            values = self.rng.normal(0, 1, self.rng.integers(3, 200))
+            values[self.rng.random(len(values)) < 0.05] *= 100
+            signal = pd.Series(values, index=pd.date_range('2020-01-01', periods=len(values), freq='s'))
+            difference = np.abs(values - np.median(values))
+            mask = pw.outlier_mask(signal, 'longitude_fix')
+            self.assertTrue(mask.index.equals(signal.index))
+            self.assertEqual(mask.tolist(), (difference / np.median(difference) > 4).tolist())
+        mask = pw.outlier_mask(pd.Series(np.ones(10)), 'latitude_fix')
+        self.assertFalse(mask.any())
+
+
+def write_trajectory(path, secs, coords, variables, attrs=None, axis=None):
+    '''Write a CF trajectory file at path with the variables, a dict of name: values, at the times secs in
+    seconds since 2020-01-01 and at coords, a dict of depth, latitude and longitude values.  attrs is a
+    dict of the additional attributes of the variables by name, its _FillValue is the fill value.  With
+    axis the time dimension and coordinates are suffixed with it and added to an existing file at path.
+    '''
+    sfx = f'_{axis}' if axis else ''
+    with netCDF4.Dataset(path, 'a' if axis and os.path.exists(path) else 'w') as nc:
+        nc.Conventions = 'CF-1.6'
+        nc.featureType = 'trajectory'
+        nc.createDimension(f'time{sfx}', len(secs))
+        for name, units, values in (('time', 'seconds since 2020-01-01 00:00:00', secs),
+                                    ('depth', 'm', coords['depth']),
+                                    ('latitude', 'degrees_north', coords['latitude']),
+                                    ('longitude', 'degrees_east', coords['longitude'])):
+            var = nc.createVariable(f'{name}{sfx}', 'f8', (f'time{sfx}',))
+            var.standard_name = name
+            var.units = units
+            var[:] = values
+        for name, values in variables.items():
+            var_attrs = dict((attrs or {}).get(name, {}))
+            var = nc.createVariable(name, 'f8', (f'time{sfx}',), fill_value=var_attrs.pop('_FillValue', None))
+            var.setncatts(var_attrs)
+            var.coordinates = ' '.join(f'{coord}{sfx}' for coord in ('time', 'depth', 'latitude', 'longitude'))
+            var[:] = values
+
+
+class MultipleTimeAxesTestCase(TestCase):
+    '''Load a trajectory file with three independent time axes: temperature every 2 s, salinity
+    every 4 s at the same times and positions as some of the temperatures, and chlorophyll every
+    6 s at odd seconds
+    '''
+    multi_db = False
+    axes = {'temperature': ('a', 0, 2, 60), 'salinity': ('b', 0, 4, 30), 'chlorophyll': ('c', 1, 6, 20)}
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'multiple_time_axes.nc')
+        for pname, (axis, start, step, num) in self.axes.items():
+            secs = start + step * np.arange(num)
+            write_trajectory(self.path, secs, {'depth': secs / 10, 'latitude': 36.8 + secs / 10000,
+                                               'longitude': -122.0 + secs / 10000}, {pname: secs}, axis=axis)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_load(self):
+        loader = Trajectory_Loader(url=self.path, campaignName='Multiple time axes test',
+                                   campaignDescription='Synthetic data', dbAlias='default',
+                                   activityName='multiple_time_axes', activitytypeName='test',
+                                   platformName='synthetic', platformColor='ff0000',
+                                   platformTypeName='auv', stride=1)
+        loader.include_names = list(self.axes.keys())
+        loader.process_data()
+
+        for pname, (_, _, _, num) in self.axes.items():
+            self.assertEqual(MeasuredParameter.objects.filter(parameter__name__startswith=pname).count(), num)
+        # The salinity times are a subset of the temperature times, the chlorophyll times are all new
+        secs = set()
+        for _, start, step, num in self.axes.values():
+            secs |= set(start + step * np.arange(num))
+        ips = InstantPoint.objects.filter(activity=loader.activity)
+        self.assertEqual(ips.count(), len(secs))
+        self.assertEqual(Measurement.objects.filter(instantpoint__activity=loader.activity).count(), len(secs))
+        # Salinity shares the Measurements of temperature
+        shared = (MeasuredParameter.objects.filter(parameter__name__startswith='salinity')
+                                           .values_list('measurement', flat=True))
+        self.assertEqual(MeasuredParameter.objects.filter(parameter__name__startswith='temperature',
+                                                          measurement__in=shared).count(), 30)
+
+
+class FailingLoader(Trajectory_Loader):
+    '''Fail reading the salinity values of the records from index 50 on, as on a lost connection
+    '''
+    def _read_values(self, pname, tindx, multidim_trajectory=False):
+        if pname == 'salinity' and tindx[0] == 50:
+            raise OSError('Simulated loss of connection')
+        return super()._read_values(pname, tindx, multidim_trajectory)
+
+
+class SkippingLoader(Trajectory_Loader):
+    '''Find no salinity values in the records from index 50 on, which stops the load without an exception
+    '''
+    def _read_values(self, pname, tindx, multidim_trajectory=False):
+        if pname == 'salinity' and tindx[0] == 50:
+            return None, ''
+        return super()._read_values(pname, tindx, multidim_trajectory)
+
+
+class ResumeTestCase(TestCase):
+    '''Interrupt a load of 4 segments of 25 records in its third segment, resume it and compare
+    the result with a clean load of the same file
+    '''
+    multi_db = False
+    pnames = ['temperature', 'salinity']
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'resume.nc')
+        secs = np.arange(100) * 2
+        write_trajectory(self.path, secs, {'depth': secs / 10, 'latitude': 36.8 + secs / 10000,
+                                           'longitude': -122.0 + secs / 10000},
+                         {pname: 10 * i + secs / 100 for i, pname in enumerate(self.pnames)})
+        self.checkpoint_records = DAPloaders.CHECKPOINT_RECORDS
+        DAPloaders.CHECKPOINT_RECORDS = 25
+
+    def tearDown(self):
+        DAPloaders.CHECKPOINT_RECORDS = self.checkpoint_records
+        shutil.rmtree(self.tmpdir)
+
+    def _loader(self, activityName, loader_class=Trajectory_Loader, resume=False):
+        loader = loader_class(url=self.path, campaignName='Resume test', campaignDescription='Synthetic data',
+                              dbAlias='default', activityName=activityName, activitytypeName='test',
+                              platformName='synthetic', platformColor='ff0000', platformTypeName='auv', stride=1,
+                              command_line_args=Namespace(append=False, resume=resume))
+        loader.include_names = list(self.pnames)
+        return loader
+
+    def _values(self, activity):
+        return sorted(MeasuredParameter.objects.filter(measurement__instantpoint__activity=activity)
+                                       .values_list('parameter__name', 'measurement__instantpoint__timevalue',
+                                                    'measurement__depth', 'datavalue'))
+
+    def test_resume(self):
+        clean = self._loader('clean_load')
+        clean.process_data()
+
+        failing = self._loader('resumed_load', FailingLoader)
+        with self.assertRaises(OSError):
+            failing.process_data()
+        # The first two segments are committed, the third is rolled back
+        activity = failing.activity
+        self.assertEqual(InstantPoint.objects.filter(activity=activity).count(), 50)
+        self.assertEqual(MeasuredParameter.objects.filter(measurement__instantpoint__activity=activity).count(), 100)
+        checkpoint = Resource.objects.get(activityresource__activity=activity, name=CHECKPOINT)
+        self.assertEqual(json.loads(checkpoint.value)['next'], 50)
+
+        resumed = self._loader('resumed_load', resume=True)
+        resumed.process_data()
+        self.assertEqual(resumed.activity.id, activity.id)
+        self.assertEqual(len(self._values(activity)), 200)
+        self.assertEqual(self._values(activity), self._values(clean.activity))
+        self.assertFalse(Resource.objects.filter(activityresource__activity=activity, name=CHECKPOINT).exists())
+
+    def test_stopped_load_is_resumable(self):
+        clean = self._loader('clean_load')
+        clean.process_data()
+
+        # The segment that stops the load is rolled back and its checkpoint is kept
+        skipping = self._loader('resumed_load', SkippingLoader)
+        skipping.process_data()
+        activity = skipping.activity
+        self.assertEqual(InstantPoint.objects.filter(activity=activity).count(), 50)
+        self.assertEqual(MeasuredParameter.objects.filter(measurement__instantpoint__activity=activity).count(), 100)
+        checkpoint = Resource.objects.get(activityresource__activity=activity, name=CHECKPOINT)
+        self.assertEqual(json.loads(checkpoint.value)['next'], 50)
+
+        resumed = self._loader('resumed_load', resume=True)
+        resumed.process_data()
+        self.assertEqual(self._values(activity), self._values(clean.activity))
+        self.assertFalse(Resource.objects.filter(activityresource__activity=activity, name=CHECKPOINT).exists())
+
+
+class SigmaTSpiceTestCase(TestCase):
+    '''Compare the sigmat and spice that the load adds with values computed one Measurement at a
+    time from its temperature and salinity, with some salinities missing
+    '''
+    multi_db = False
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'sigmat.nc')
+        secs = np.arange(200) * 2
+        salinity = 33.0 + np.sin(secs / 50)
+        salinity[[10, 11, 150]] = -999.0
+        write_trajectory(self.path, secs, {'depth': secs / 2, 'latitude': 36.8 + secs / 10000,
+                                           'longitude': -122.0 + secs / 10000},
+                         {'temperature': 14.0 - secs / 100, 'salinity': salinity},
+                         {'temperature': {'standard_name': 'sea_water_temperature', '_FillValue': -999.0},
+                          'salinity': {'standard_name': 'sea_water_salinity', '_FillValue': -999.0}})
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_sigmat_spice(self):
+        loader = Trajectory_Loader(url=self.path, campaignName='SigmaT test', campaignDescription='Synthetic data',
+                                   dbAlias='default', activityName='sigmat_load', activitytypeName='test',
+                                   platformName='synthetic', platformColor='ff0000', platformTypeName='auv', stride=1)
+        loader.include_names = ['temperature', 'salinity']
+        loader.process_data()
+
+        mps = MeasuredParameter.objects.filter(measurement__instantpoint__activity=loader.activity)
+        temps = dict(mps.filter(parameter__name='temperature').values_list('measurement', 'datavalue'))
+        salts = dict(mps.filter(parameter__name='salinity').values_list('measurement', 'datavalue'))
+        sigmats = dict(mps.filter(parameter__name=SIGMAT).values_list('measurement', 'datavalue'))
+        spices = dict(mps.filter(parameter__name=SPICE).values_list('measurement', 'datavalue'))
+        self.assertEqual(len(salts), 197)
+        self.assertEqual(set(sigmats), set(salts))
+        self.assertEqual(set(spices), set(salts))
+        for meas in Measurement.objects.filter(id__in=salts):
+            t, s = temps[meas.id], salts[meas.id]
+            sigmat = sw.pden(s, t, sw.pres(meas.depth, meas.geom.y)) - 1000.0
+            self.assertAlmostEqual(sigmats[meas.id], float(sigmat), places=6)
+            self.assertAlmostEqual(spices[meas.id], float(spiciness([t], [s])[0]), places=6)
+
+
+class MaptrackTestCase(TestCase):
+    '''Compare the maptrack simplified in the database with the LineString.simplify() of the
+    Measurement geometries in Python that it replaced
+    '''
+    multi_db = False
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'maptrack.nc')
+        secs = np.arange(2000) * 2
+        # A meandering track with a zig-zag smaller than the tolerance
+        write_trajectory(self.path, secs, {'depth': secs % 100 / 2,
+                                           'latitude': 36.8 + 0.05 * np.sin(secs / 500) + 0.0002 * (secs % 4),
+                                           'longitude': -122.0 + secs / 40000},
+                         {'temperature': 14.0 - secs / 1000})
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_maptrack(self):
+        loader = Trajectory_Loader(url=self.path, campaignName='Maptrack test', campaignDescription='Synthetic data',
+                                   dbAlias='default', activityName='maptrack_load', activitytypeName='test',
+                                   platformName='synthetic', platformColor='ff0000', platformTypeName='auv', stride=1)
+        loader.include_names = ['temperature']
+        loader.process_data()
+
+        maptrack = Activity.objects.get(id=loader.activity.id).maptrack
+        geoms = (Measurement.objects.filter(instantpoint__activity=loader.activity)
+                            .order_by('instantpoint__timevalue').values_list('geom', flat=True))
+        python_track = LineString(list(geoms)).simplify(tolerance=MAPTRACK_TOLERANCE)
+        self.assertLess(len(maptrack), len(geoms) / 10)
+        self.assertLessEqual(abs(len(maptrack) - len(python_track)), max(2, len(python_track) / 10))
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT ST_HausdorffDistance(ST_GeomFromText(%s), ST_GeomFromText(%s))',
+                           [maptrack.wkt, python_track.wkt])
+            self.assertLessEqual(cursor.fetchone()[0], 2 * MAPTRACK_TOLERANCE)
+
+
+class ParallelLoadTestCase(TransactionTestCase):
+    '''Load several synthetic files one after another and with LoadScript.load_urls() in parallel
+    worker processes, which commit on their own connections, and compare the results
+    '''
+    pnames = ['temperature', 'salinity']
+    nfiles = 4
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.paths = []
+        for n in range(self.nfiles):
+            path = os.path.join(self.tmpdir, f'parallel_{n}.nc')
+            secs = n * 1000 + np.arange(50) * 2
+            variables = {pname: 10 * i + n + secs / 100 for i, pname in enumerate(self.pnames)}
+            # oxygen is missing from the first file only, nitrate from all of them
+            variables['oxygen'] = np.ma.masked_all(len(secs)) if n == 0 else secs / 100
+            variables['nitrate'] = np.ma.masked_all(len(secs))
+            write_trajectory(path, secs, {'depth': n + secs % 100 / 10, 'latitude': 36.8 + secs / 10000,
+                                          'longitude': -122.0 + secs / 10000},
+                             variables, {'oxygen': {'_FillValue': -999.0}, 'nitrate': {'_FillValue': -999.0}})
+            self.paths.append(path)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _load(self, prefix, workers, pnames=None):
+        cl = LoadScript('default', 'Parallel test')
+        cl.dbAlias = 'default'
+        cl.args = Namespace(workers=workers)
+        loads = [(path, f'{prefix}_{n}', DAPloaders.runTrajectoryLoader,
+                  (path, cl.base_campaignName, 'Synthetic data', f'{prefix}_{n}', 'synthetic', 'ff0000',
+                   'auv', 'test', list(pnames or self.pnames), cl.dbAlias, 1), {})
+                            for n, path in enumerate(self.paths)]
+        results = cl.load_urls(loads)
+        self.assertEqual(len(results), self.nfiles)
+        for url, aname, _, error in results:
+            self.assertIsNone(error, f'Loading {url} into {aname} failed')
+
+    def _values(self, aname):
+        return sorted(MeasuredParameter.objects.filter(measurement__instantpoint__activity__name=aname)
+                                       .values_list('parameter__name', 'measurement__instantpoint__timevalue',
+                                                    'measurement__depth', 'datavalue'))
+
+    def test_parallel_load(self):
+        self._load('serial', workers=1)
+        self._load('parallel', workers=self.nfiles)
+        for n in range(self.nfiles):
+            self.assertEqual(len(self._values(f'parallel_{n}')), 100)
+            self.assertEqual(self._values(f'parallel_{n}'), self._values(f'serial_{n}'))
+        # The Parameters shared by all of the Activities are created once
+        for pname in self.pnames:
+            self.assertEqual(Parameter.objects.filter(name__startswith=pname).count(), 1)
+
+    def test_parallel_empty_parameters(self):
+        # The workers leave the Parameters without data for the parent to delete after all the loads, a
+        # Parameter without data in one file but with data in the others is kept
+        self._load('parallel', workers=self.nfiles, pnames=self.pnames + ['oxygen', 'nitrate'])
+        self.assertFalse(Parameter.objects.filter(name__startswith='nitrate').exists())
+        self.assertEqual(Parameter.objects.filter(name__startswith='oxygen').count(), 1)
+        self.assertEqual(MeasuredParameter.objects.filter(parameter__name__startswith='oxygen').count(),
+                         50 * (self.nfiles - 1))
+        for pname in self.pnames:
+            self.assertEqual(MeasuredParameter.objects.filter(parameter__name__startswith=pname).count(),
+                             50 * self.nfiles)
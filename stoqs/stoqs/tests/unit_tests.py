@@ -22,17 +22,35 @@ MBARI Dec 29, 2011
 @license: __license__
 '''
 
+import math
 import os
+import re
 import sys
 import time
 import json
 import time
 import logging
+import sqlparse
+import tracemalloc
 
+from datetime import datetime, timedelta
+from decimal import Decimal
 from django.conf import settings
-from django.test import TestCase
+from django.core.cache import cache
+from django.contrib.gis.geos import Point
+from django.db.models import F, FloatField, Max, Min, Sum
+from django.db import connections
+from django.test import RequestFactory, SimpleTestCase, TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext, override_settings
 from django.urls import reverse
-from stoqs.models import Activity, Parameter, Resource, MeasuredParameter
+from stoqs.db_router import CampaignConnectionPool
+from stoqs.models import (Activity, ActivityParameter, ActivityParameterArray, Campaign, CampaignResource,
+                          InstantPoint, Parameter, ParameterTimeBucket, Platform, PlatformType, Resource, Measurement, MeasuredParameter)
+from utils.CampaignDirectory import CACHE_KEY, CampaignDirectory
+from utils.MPQuery import MPQuery
+from utils.Parquet import Columnar
+from utils.PQuery import PQuery
+from utils.utils import postgresifySQL, EPOCH_STRING
 
 logger = logging.getLogger('stoqs.tests')
 settings.LOGGING['loggers']['stoqs.tests']['level'] = 'INFO'
@@ -232,6 +250,20 @@ class BaseAndMeasurementViewsTestCase(TestCase):
         self.assertTrue(str(response.content).find(loadedText) != -1, 
                 'Should find "%s" in string at %s, instead got: %s' % (
                     loadedText, req, response.content))
+
+    def test_manage_query_count(self):
+        req = reverse('stoqs:show-database', kwargs={'dbAlias': 'default'})
+        num_queries = []
+        for per_page in (1, 1000):
+            with CaptureQueriesContext(connections['default']) as ctx:
+                response = self.client.get(req, {'per_page': per_page})
+            self.assertEqual(response.status_code, 200, 'Status code should be 200 for %s' % req)
+            num_queries.append(len(ctx.captured_queries))
+            self.assertEqual(len(response.context['actList']), min(per_page, Activity.objects.count()))
+        self.assertEqual(num_queries[0], num_queries[1], 'Number of queries should not depend on number of Activities')
+
+        for act in response.context['actList']:
+            self.assertEqual(act.mCount, Measurement.objects.filter(instantpoint__activity__id=act.id).count())
         
 #    def test_admin_stoqs_that_should_be_there(self):
 #	'''Need to pass login credentials, and create the login...'''
@@ -342,6 +374,26 @@ class SummaryDataTestCase(TestCase):
         ##img_resp = self.client.get(img_url)
         ##self.assertEqual(img_resp.status_code, 200, 'Status code for image should be 200 for %s' % img_url)
 
+    def test_query_memo(self):
+        base = reverse('stoqs:stoqs-query-summary', kwargs={'dbAlias': 'default'})
+
+        # A standard QueryUI request: everything but the SQL, with a parameter plotted
+        qstring = ('except=spsql&except=mpsql&xaxis_min=1288216319000'
+                   '&xaxis_max=1288279374000&yaxis_min=-10&yaxis_max=50'
+                   '&parameterplotid=4&platformplotname=dorado&'
+                   'showdataas=scatter&pplr=1&ppsl=1')
+        req = base + '?' + qstring
+
+        with override_settings(QUERY_MEMO=False):
+            with CaptureQueriesContext(connections['default']) as unmemoized:
+                response = self.client.get(req)
+        self.assertEqual(response.status_code, 200, 'Status code should be 200 for %s' % req)
+        with CaptureQueriesContext(connections['default']) as memoized:
+            response = self.client.get(req)
+        self.assertEqual(response.status_code, 200, 'Status code should be 200 for %s' % req)
+
+        self.assertLess(len(memoized), len(unmemoized), 'Memoized request should run fewer queries')
+
     def test_parameterparameterplot1(self):
         base = reverse('stoqs:stoqs-query-summary', kwargs={'dbAlias': 'default'})
 
@@ -695,3 +747,825 @@ class ParquetTestCase(TestCase):
             logger.debug('req = %s', req)
             response = self.client.get(req)
             self.assertEqual(response.status_code, 200, 'Status code should be 200 for %s' % req)
+
+
+class ParquetEstimateTestCase(TestCase):
+    '''Calibrate the predictions of Columnar against extractions of synthetic selections: two Activities
+    with three Parameters measured at every, every other and every fourth Measurement.  Peak memory
+    is measured with tracemalloc, which unlike RSS doesn't depend on what earlier tests left allocated.
+    '''
+    fixtures = ['stoqs_test_data.json']
+    multi_db = False
+    num_measurements = 4000
+    strides = {'synthetic_a': 1, 'synthetic_b': 2, 'synthetic_c': 4}
+    error_factor = 2
+
+    def setUp(self):
+        platform = Platform.objects.create(name='synthetic', platformtype=PlatformType.objects.create(name='synthetic'))
+        parameters = {name: Parameter.objects.create(name=name, standard_name=name) for name in self.strides}
+        start = datetime(2020, 1, 1)
+        for a in range(2):
+            act = Activity.objects.create(name=f'synthetic_{a}.nc', comment='', platform=platform,
+                                          startdate=start + timedelta(seconds=a * self.num_measurements))
+            ips = InstantPoint.objects.bulk_create(InstantPoint(activity=act, timevalue=act.startdate + timedelta(seconds=i))
+                                                   for i in range(self.num_measurements))
+            ms = Measurement.objects.bulk_create(Measurement(instantpoint=ip, depth=i % 100,
+                                                             geom=Point(-122 + i * 1.e-5, 36.8, srid=4326))
+                                                 for i, ip in enumerate(ips))
+            for name, stride in self.strides.items():
+                mps = MeasuredParameter.objects.bulk_create(MeasuredParameter(measurement=m, parameter=parameters[name],
+                                                                              datavalue=i / 10.)
+                                                            for i, m in enumerate(ms) if i % stride == 0)
+                ActivityParameter.objects.create(activity=act, parameter=parameters[name], number=len(mps))
+        with connections['default'].cursor() as cursor:
+            cursor.execute('ANALYZE')
+
+    def _request(self, **params):
+        request = RequestFactory().get('/', dict(params, measurement__instantpoint__activity__platform__name='synthetic'))
+        request.META['dbAlias'] = 'default'
+        return request
+
+    def _predict(self, request):
+        col = Columnar()
+        where_clause, params = col.request_to_sql_where(request)
+        col._build_sql(where_clause=where_clause)
+        return col._predict(where_clause, params, *col.request_to_sql_where(request, measurements=False))
+
+    def _measure(self, request):
+        '''Return the records, pivoted rows and peak traced bytes of the extraction done by request_to_parquet()
+        '''
+        col = Columnar()
+        where_clause, params = col.request_to_sql_where(request)
+        sql = col._build_sql(where_clause=where_clause)
+        tracemalloc.start()
+        try:
+            df, _ = col._sql_to_df(sql, params, set_index=True)
+            dfp = df.pivot_table(index=col.context, columns=col.collect, values='datavalue')
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+
+        return len(df), dfp.shape[0], peak
+
+    def _assert_within(self, predicted, measured, factor, msg):
+        self.assertLessEqual(predicted, measured * factor, f'{msg}: predicted {predicted} > {factor} * {measured}')
+        self.assertGreaterEqual(predicted, measured / factor, f'{msg}: predicted {predicted} < {measured} / {factor}')
+
+    def test_stored_counts(self):
+        self._measure(self._request())    # Exclude pandas' one time allocations from the measurements
+        for params in ({}, {'parameter__name': 'synthetic_b'}, {'include': 'activity__name'}, {'collect': 'name'}):
+            prediction = self._predict(self._request(**params))
+            records, rows, peak = self._measure(self._request(**params))
+            self.assertEqual(prediction['records'], records, f'Records for {params}')
+            self.assertEqual(prediction['columns'], 1 if 'parameter__name' in params else len(self.strides))
+            self._assert_within(prediction['pivot_rows'], rows, 1.01, f'Pivoted rows for {params}')
+            self._assert_within(prediction['heap_bytes'], peak, self.error_factor, f'Peak bytes for {params}')
+
+    def test_planner_counts(self):
+        self._measure(self._request())
+        params = {'measurement__instantpoint__timevalue__gt': '2020-01-01 00:30:00', 'measurement__depth__lte': '80'}
+        prediction = self._predict(self._request(**params))
+        records, rows, peak = self._measure(self._request(**params))
+        self._assert_within(prediction['records'], records, self.error_factor, 'Records')
+        self._assert_within(prediction['pivot_rows'], rows, self.error_factor, 'Pivoted rows')
+        self._assert_within(prediction['heap_bytes'], peak, self.error_factor, 'Peak bytes')
+
+
+class ColumnarSQLTestCase(TestCase):
+    '''Columnar composes its WHERE clause with bound parameters: the selections must match the
+    equivalent ORM filters and exports of the same shape must share one prepared statement
+    '''
+    fixtures = ['stoqs_test_data.json']
+    multi_db = False
+
+    def _count(self, **params):
+        request = RequestFactory().get('/', params)
+        request.META['dbAlias'] = 'default'
+        col = Columnar()
+        where_clause, where_params = col.request_to_sql_where(request)
+        sql = col._build_sql(count=True, where_clause=where_clause)
+        text = col._as_string(sql)
+        for values in params.values():
+            for value in values if isinstance(values, list) else [values]:
+                self.assertNotIn(value, text, 'Request values should be bound parameters')
+
+        return col._sql_to_df(sql, where_params)[0]['count'][0]
+
+    def _prepared(self):
+        with connections['default'].cursor() as cursor:
+            cursor.execute("SELECT count(*) FROM pg_prepared_statements WHERE name LIKE 'columnar_%'")
+            return cursor.fetchone()[0]
+
+    def test_filters(self):
+        mps = MeasuredParameter.objects.filter(parameter__standard_name__isnull=False)
+        stime, etime = '2010-10-27 21:51:59', '2010-10-28 15:22:54'
+        for params, qs in (
+                ({'measurement__instantpoint__activity__platform__name': 'dorado'},
+                  mps.filter(measurement__instantpoint__activity__platform__name='dorado')),
+                ({'measurement__instantpoint__activity__platform__name': ['dorado', 'M1_Mooring']},
+                  mps.filter(measurement__instantpoint__activity__platform__name__in=['dorado', 'M1_Mooring'])),
+                ({'measurement__instantpoint__timevalue__gt': stime, 'measurement__instantpoint__timevalue__lt': etime},
+                  mps.filter(measurement__instantpoint__timevalue__gte=stime, measurement__instantpoint__timevalue__lte=etime)),
+                ({'measurement__depth__gte': '-10', 'measurement__depth__lte': '50'},
+                  mps.filter(measurement__depth__gte=-10, measurement__depth__lte=50)),
+                ({'parameter__name': ['temperature', 'salinity']},
+                  mps.filter(parameter__name__in=['temperature', 'salinity'])),
+                ({'parameter__name': "temperature'); DROP TABLE stoqs_parameter; --"}, mps.none())):
+            self.assertEqual(self._count(**params), qs.count(), f'Different count for {params}')
+        self.assertTrue(Parameter.objects.exists())
+
+    def test_prepared_statement_reuse(self):
+        self._count(measurement__instantpoint__activity__platform__name='dorado', measurement__depth__lte='50')
+        prepared = self._prepared()
+        self.assertGreater(prepared, 0)
+        for platforms, depth in ((['M1_Mooring'], '100'), (['dorado', 'M1_Mooring'], '20')):
+            self._count(measurement__instantpoint__activity__platform__name=platforms, measurement__depth__lte=depth)
+        self.assertEqual(self._prepared(), prepared, 'Exports of the same shape should share one prepared statement')
+
+    def test_prepared_statements_bounded(self):
+        max_prepared = Columnar.MAX_PREPARED_STATEMENTS
+        Columnar.MAX_PREPARED_STATEMENTS = 2
+        try:
+            for params in ({'measurement__instantpoint__activity__platform__name': 'dorado'},
+                           {'measurement__depth__lte': '50'},
+                           {'parameter__name': 'temperature'},
+                           {'measurement__instantpoint__activity__platform__name': 'dorado', 'measurement__depth__lte': '50'}):
+                self._count(**params)
+                self.assertLessEqual(self._prepared(), 2, f'Prepared statements not deallocated after {params}')
+            # A deallocated statement is prepared again when it's next used
+            self.assertEqual(self._count(measurement__instantpoint__activity__platform__name='dorado'),
+                             MeasuredParameter.objects.filter(parameter__standard_name__isnull=False,
+                                                              measurement__instantpoint__activity__platform__name='dorado').count())
+        finally:
+            Columnar.MAX_PREPARED_STATEMENTS = max_prepared
+
+
+class ActivityParameterArrayTestCase(TestCase):
+    fixtures = ['stoqs_test_data.json']
+    multi_db = False
+
+    def setUp(self):
+        from loaders import STOQS_Loader
+        for act in Activity.objects.all():
+            STOQS_Loader.save_activityparameter_arrays('default', act)
+
+    def test_arrays_match_measuredparameters(self):
+        for apa in ActivityParameterArray.objects.all():
+            mp_count = MeasuredParameter.objects.filter(measurement__instantpoint__activity=apa.activity,
+                                                        parameter=apa.parameter).count()
+            self.assertEqual(len(apa.datavalue), mp_count, f'Wrong length for {apa.activity} {apa.parameter}')
+            self.assertEqual(len(apa.epochseconds), len(apa.depth))
+            self.assertEqual(apa.epochseconds, sorted(apa.epochseconds), 'epochseconds should be time ordered')
+
+    def test_parameterplot_from_arrays(self):
+        base = reverse('stoqs:stoqs-query-summary', kwargs={'dbAlias': 'default'})
+
+        qstring = ('only=parameterplatformdatavaluepng&only=measuredparameterx3d'
+                   '&except=spsql&except=mpsql&xaxis_min=1288216319000'
+                   '&xaxis_max=1288279374000&yaxis_min=-10&yaxis_max=50'
+                   '&parameterplotid=4&platformplotname=dorado&showdataas=scatter')
+
+        req = base + '?' + qstring
+        response = self.client.get(req)
+        data = json.loads(response.content)
+        self.assertEqual(response.status_code, 200, 'Status code should be 200 for %s' % req)
+        self.assertTrue(data.get('parameterplatformdatavaluepng')[0], data.get('parameterplatformdatavaluepng')[2])
+        img_path = os.path.join(settings.MEDIA_ROOT, 'sections/', data.get('parameterplatformdatavaluepng')[0])
+        self.assertTrue(os.path.isfile(img_path), 'File %s was not created' % img_path)
+
+
+class ParameterTimeBucketTestCase(TestCase):
+    fixtures = ['stoqs_test_data.json']
+    multi_db = False
+
+    def setUp(self):
+        from loaders.pyramid import build_pyramid
+        for act in Activity.objects.all():
+            build_pyramid('default', act)
+
+    def _raw_buckets(self, secs):
+        '''Return dictionary of min, mean, max and count keyed by (activity, parameter, time bucket start)
+        computed from the MeasuredParameters
+        '''
+        values = {}
+        for mp in MeasuredParameter.objects.filter(datavalue__isnull=False, measurement__depth__isnull=False).values(
+                        'measurement__instantpoint__activity__id', 'parameter__id',
+                        'measurement__instantpoint__timevalue', 'datavalue'):
+            if math.isnan(mp['datavalue']):
+                continue
+            bucket = math.floor(mp['measurement__instantpoint__timevalue'].timestamp() / secs) * secs
+            key = (mp['measurement__instantpoint__activity__id'], mp['parameter__id'], bucket)
+            values.setdefault(key, []).append(mp['datavalue'])
+
+        return {k: (min(v), sum(v) / len(v), max(v), len(v)) for k, v in values.items()}
+
+    def test_pyramid_matches_raw_data(self):
+        from loaders.pyramid import bucket_seconds, NUM_LEVELS
+        for level in (0, 3, NUM_LEVELS - 1):
+            raw = self._raw_buckets(bucket_seconds(level))
+            qs = (ParameterTimeBucket.objects.filter(level=level)
+                    .values('activity__id', 'parameter__id', 'timebucket')
+                    .annotate(bmin=Min('min'), bmax=Max('max'), total=Sum('count'),
+                              wsum=Sum(F('mean') * F('count'), output_field=FloatField())))
+            self.assertEqual(qs.count(), len(raw), f'Wrong number of time buckets at level {level}')
+            for b in qs:
+                key = (b['activity__id'], b['parameter__id'], int(b['timebucket'].timestamp()))
+                rmin, rmean, rmax, rcount = raw[key]
+                self.assertEqual(b['total'], rcount, f'Wrong count for {key} at level {level}')
+                self.assertAlmostEqual(b['bmin'], rmin, places=4)
+                self.assertAlmostEqual(b['bmax'], rmax, places=4)
+                self.assertAlmostEqual(b['wsum'] / b['total'], rmean, delta=1e-6 * max(1.0, abs(rmean)))
+
+    def test_choose_level(self):
+        from loaders.pyramid import bucket_seconds, choose_level, BASE_SECONDS, NUM_LEVELS
+        self.assertIsNone(choose_level(BASE_SECONDS - 1))
+        self.assertEqual(choose_level(BASE_SECONDS), 0)
+        self.assertEqual(choose_level(bucket_seconds(4) + 1), 4)
+        self.assertEqual(choose_level(bucket_seconds(NUM_LEVELS + 2)), NUM_LEVELS - 1)
+
+    def test_level_of_time_selection(self):
+        from loaders.pyramid import choose_level
+        from utils.STOQSQManager import STOQSQManager
+        # A month long mooring deployment zoomed in to a day reads a finer level than the whole deployment
+        a = Activity(startdate=datetime(2020, 1, 1), enddate=datetime(2020, 2, 1))
+        qm = STOQSQManager(None, None, 'default')
+        month_level = choose_level(qm._selectedSeconds(a) / 800)
+        qm = STOQSQManager(None, None, 'default', time=('2020-01-10 00:00:00', '2020-01-11 00:00:00'))
+        self.assertEqual(qm._selectedSeconds(a), 86400)
+        day_level = choose_level(qm._selectedSeconds(a) / 800)
+        self.assertEqual(month_level, 5)
+        self.assertEqual(day_level, 0)
+        # Selections extending past or outside of the Activity
+        qm = STOQSQManager(None, None, 'default', time=('2019-12-31 00:00:00', '2020-01-01 12:00:00'))
+        self.assertEqual(qm._selectedSeconds(a), 43200)
+        qm = STOQSQManager(None, None, 'default', time=('2020-03-01 00:00:00', None))
+        self.assertEqual(qm._selectedSeconds(a), 0)
+
+    def test_parametertime_from_pyramid(self):
+        base = reverse('stoqs:stoqs-query-summary', kwargs={'dbAlias': 'default'})
+        # Plot SEA_WATER_SALINITY_HR from M1_Mooring with time series read from the pyramid
+        SEA_WATER_SALINITY_HR_id = Parameter.objects.get(name__contains='SEA_WATER_SALINITY_HR').id
+        qstring = ('only=parametertime&except=spsql&except=mpsql&'
+                   'xaxis_min=1288214585000&xaxis_max=1288309759000&'
+                   'yaxis_min=-200&yaxis_max=600&parametertab=1&'
+                   'secondsperpixel=216&parametertimeplotid={:d}&pplr=1&ppsl=1'
+                   ).format(SEA_WATER_SALINITY_HR_id)
+        req = base + '?' + qstring
+        response = self.client.get(req)
+        self.assertEqual(response.status_code, 200, 'Status code should be 200 for %s' % req)
+        data = json.loads(response.content)
+        self.assertIn('parametertime', data)
+
+
+# The regular expression rewritten raw SQL that PQuery's composed and parameterized SQL replaced,
+# kept here for the golden results of PQueryBuilderTestCase and for tools/pvquery_benchmark.py
+
+def _pvSQLfragments(pq, pvDict):
+    '''
+    Given a list dictionary @pvDict of [{parameter: (pmin, pmax)}] return SQL fragments for the FROM and WHERE portions
+    of a query. Deal with both Measured Parameters and Sampled Paramters.
+    '''
+    add_to_from = ''
+    from_sql = '' 
+    where_sql = '' 
+    i = 0
+    for pminmax in pvDict:
+        i = i + 1
+        for k,v in list(pminmax.items()):
+            if k in Parameter.objects.using(pq.request.META['dbAlias']).values_list('name', flat=True):
+                p = re.compile("[';]")
+                if p.search(v[0]) or p.search(v[1]):
+                    # Prevent SQL injection attacks
+                    raise Exception('Invalid ParameterValue constraint expression: %s, %s' % (k, v))
+
+                if pq.isParameterMeasured(k):
+                    from_sql += 'INNER JOIN stoqs_measurement m' + str(i) + ' '
+                    from_sql += 'on m' + str(i) + '.instantpoint_id = stoqs_instantpoint.id '
+                    from_sql += 'INNER JOIN stoqs_measuredparameter mp' + str(i) + ' '
+                    from_sql += 'on mp' + str(i) + '.measurement_id = m' + str(i) + '.id '
+                    from_sql += 'INNER JOIN stoqs_parameter p' + str(i) + ' '
+                    from_sql += 'on mp' + str(i) + '.parameter_id = p' + str(i) + '.id '
+
+                    where_sql += "(p" + str(i) + ".name = '" + k + "') AND "
+                    if v[0]:
+                        where_sql += "(mp" + str(i) + ".datavalue > " + str(v[0]) + ") AND "
+                    if v[1]:
+                        where_sql += "(mp" + str(i) + ".datavalue < " + str(v[1]) + ") AND "
+                    where_sql += "(mp" + str(i) + ".parameter_id = p" + str(i) + ".id) AND "
+
+                elif pq.isParameterSampled(k): # pragma: no cover
+                    from_sql += 'INNER JOIN stoqs_sample s' + str(i) + ' '
+                    from_sql += 'on s' + str(i) + '.instantpoint_id = stoqs_instantpoint.id '
+                    from_sql += 'INNER JOIN stoqs_sampledparameter sp' + str(i) + ' '
+                    from_sql += 'on sp' + str(i) + '.sample_id = s' + str(i) + '.id '
+                    from_sql += 'INNER JOIN stoqs_parameter p' + str(i) + ' '
+                    from_sql += 'on sp' + str(i) + '.parameter_id = p' + str(i) + '.id '
+
+                    where_sql += "(p" + str(i) + ".name = '" + k + "') AND "
+                    if v[0]:
+                        where_sql += "(sp" + str(i) + ".datavalue > " + str(v[0]) + ") AND "
+                    if v[1]:
+                        where_sql += "(sp" + str(i) + ".datavalue < " + str(v[1]) + ") AND "
+                    where_sql += "(sp" + str(i) + ".parameter_id = p" + str(i) + ".id) AND "
+
+    return add_to_from, from_sql, where_sql
+
+
+def addParameterValuesSelfJoins(pq, query, pvDict, select_items):
+    '''Given the Postgresified MeasuredParameter query string @query add the self joins that restrict it
+    to the parameter values in @pvDict and select the id and @select_items, the raw SQL that
+    PQuery.parameterValuesFilter() replaced
+    '''
+    q = query
+
+    add_to_from, from_sql, where_sql = _pvSQLfragments(pq, pvDict)
+
+    select_items = select_items.replace('stoqs_parameter', 'p1')
+    if add_to_from or from_sql or where_sql:
+        # Raw query must include the primary key
+        if q.find('FROM stoqs_sampledparameter') != -1:
+            select_items = 'stoqs_sampledparameter.id, ' + select_items
+        else:
+            select_items = 'stoqs_measuredparameter.id, ' + select_items
+
+        p = re.compile('SELECT .+? FROM')
+        q = p.sub('SELECT ' + select_items + ' FROM', q, count=1)
+        q = q.replace('SELECT FROM stoqs_measuredparameter', 'FROM ' + add_to_from + 'stoqs_measuredparameter')
+        q = q.replace('FROM stoqs_measuredparameter', 'FROM ' + add_to_from + 'stoqs_measuredparameter')
+        if q.find('WHERE') != -1:
+            q = q.replace('WHERE', from_sql + ' WHERE ' + where_sql, 1)
+        else:
+            q += from_sql + ' WHERE ' + where_sql
+            q = q[:-4]                              # Remove last 'AND '
+
+    return q
+
+
+def addParameterParameterSelfJoins(pq, query, pDict):
+    '''Given the Postgresified MeasuredParameter query string @query add the self joins that select
+    up to 4 Parameter (or coordinate) values of @pDict from the same Measurements, the raw SQL that
+    PQuery.parameterParameterSQL() replaced
+    '''
+    pq.logger.debug('initial query = %s', query)
+
+    select_order = ('x', 'y', 'z', 'c')
+    containsMeasuredFlag, containsSampleFlag = pq._getContainsFlags(select_order, pDict)
+
+    # Construct SELECT strings, must be in proper order, include depth for possible sigma-t calculation
+    xyzc_items = ''
+    for axis in select_order:
+        if axis in pDict:
+            if pDict[axis]:
+                try:
+                    if pq.isParameterMeasured(int(pDict[axis])):
+                        xyzc_items = xyzc_items + 'mp_' + axis + '.datavalue as ' + axis + ', '
+                    elif pq.isParameterSampled(int(pDict[axis])):
+                        xyzc_items = xyzc_items + 'sp_' + axis + '.datavalue as ' + axis + ', '
+                    else:
+                        # Default is to assume mp - supports legacy databases w/o the ParameterGroup assignment
+                        xyzc_items = xyzc_items + 'mp_' + axis + '.datavalue as ' + axis + ', '
+                except ValueError as e:
+                    if pDict[axis] == 'longitude':
+                        if containsSampleFlag and not containsMeasuredFlag:
+                            xyzc_items = xyzc_items + 'ST_X(stoqs_sample.geom) as ' + axis + ', '
+                        else:
+                            xyzc_items = xyzc_items + 'ST_X(stoqs_measurement.geom) as ' + axis + ', '
+                    elif pDict[axis] == 'latitude':
+                        if containsSampleFlag and not containsMeasuredFlag:
+                            xyzc_items = xyzc_items + 'ST_Y(stoqs_sample.geom) as ' + axis + ', '
+                        else:
+                            xyzc_items = xyzc_items + 'ST_Y(stoqs_measurement.geom) as ' + axis + ', '
+                    elif pDict[axis] == 'depth':
+                        if containsSampleFlag and not containsMeasuredFlag:
+                            xyzc_items = xyzc_items + 'stoqs_sample.depth as ' + axis + ', '
+                        else:
+                            xyzc_items = xyzc_items + 'stoqs_measurement.depth as ' + axis + ', '
+                    elif pDict[axis] == 'time':
+                        xyzc_items += "(DATE_PART('day', stoqs_instantpoint.timevalue - timestamp '%s') * 86400 + " % EPOCH_STRING
+                        xyzc_items += "DATE_PART('hour', stoqs_instantpoint.timevalue - timestamp '%s') * 3600 + " % EPOCH_STRING
+                        xyzc_items += "DATE_PART('minute', stoqs_instantpoint.timevalue - timestamp '%s') * 60 + " % EPOCH_STRING
+                        xyzc_items += "DATE_PART('second', stoqs_instantpoint.timevalue - timestamp '%s') ) / 86400 " % EPOCH_STRING
+                        xyzc_items += ' as ' + axis + ', '  
+                    else:
+                        logger.error('%s, but axis = %s is not a coordinate', e, pDict[axis])
+
+    # Identify the appropriate depth for the SELECT
+    if containsSampleFlag and not containsMeasuredFlag:
+        # Only Sampled
+        depth_item = 'DISTINCT stoqs_sample.depth, '
+    else:
+        # Only Measured -or- Sampled and Measured
+        depth_item = 'DISTINCT stoqs_measurement.depth, '
+
+    add_to_from = ''
+    select_items = depth_item + xyzc_items
+
+    # Construct INNER JOINS and WHERE sql for Sampled and Measured Parameter selections
+    # Use aliases for joins on each axis
+    where_sql = '' 
+    for axis, pid in list(pDict.items()):
+        if pid:
+            pq.logger.debug('axis, pid = %s, %s', axis, pid)
+            add_to_from += '\n'
+            try:
+                if pq.isParameterMeasured(int(pid)):
+                    add_to_from += '\nINNER JOIN stoqs_measurement m_' + axis + ' '
+                    add_to_from += '\non m_' + axis + '.instantpoint_id = stoqs_instantpoint.id'
+                    add_to_from += '\nINNER JOIN stoqs_measuredparameter mp_' + axis + ' '
+                    add_to_from += '\non mp_' + axis + '.measurement_id = m_' + axis + '.id '
+                    add_to_from += '\nINNER JOIN stoqs_parameter p_' + axis + ' '
+                    add_to_from += '\non mp_' + axis + '.parameter_id = p_' + axis + '.id '
+                elif pq.isParameterSampled(int(pid)):
+                    add_to_from += '\nINNER JOIN stoqs_sample s_' + axis + ' '
+                    add_to_from += '\non s_' + axis + '.instantpoint_id = stoqs_instantpoint.id'
+                    add_to_from += '\nINNER JOIN stoqs_sampledparameter sp_' + axis + ' '
+                    add_to_from += '\non sp_' + axis + '.sample_id = s_' + axis + '.id '
+                    add_to_from += '\nINNER JOIN stoqs_parameter p_' + axis + ' '
+                    add_to_from += '\non sp_' + axis + '.parameter_id = p_' + axis + '.id '
+                else:
+                    pq.logger.warn('Encountered parameter (id=%s) that is not in the Measured nor in the Sampled ParameterGroup', pid)
+                where_sql = where_sql + '(p_' + axis + '.id = ' + str(pid) + ') AND '
+            except ValueError:
+                # pid likely a coordinate, ignore
+                pass
+
+    # Modify original SQL with new joins and where sql - almost a total rewrite
+    # - Need to preserve subqueries with their own FROM and WHERE words
+    q = query
+    select_items = select_items[:-2] + ' '                      # Remove ', '
+    q = 'SELECT ' + select_items + q[q.find('FROM'):]           # Override original select items, finds first FROM which is what we want
+
+    if q.find('WHERE') == -1 and where_sql:
+        # Case where no filters applied from UI - no selections and no WHERE clause, add ours
+        q += ' WHERE ' + where_sql[:-4]                         # Remove last 'AND '
+    else:
+        # Insert our WHERE clause into the filters that are in the original query
+        pq.logger.debug('q = %s', q)
+        q = q.replace(' WHERE ', ' WHERE ' + where_sql, 1)      # Replace only first occurance to preserve subquery
+
+    # Brute-force fixup of query string to deal with Sample-only query
+    if containsSampleFlag and not containsMeasuredFlag:
+        q = q.replace('FROM stoqs_measuredparameter', 'FROM stoqs_sampledparameter')
+        q = q.replace('INNER JOIN stoqs_measurement ON (stoqs_measuredparameter.measurement_id = stoqs_measurement.id)', 
+                      'INNER JOIN stoqs_sample ON (stoqs_sampledparameter.sample_id = stoqs_sample.id)')
+        q = q.replace('INNER JOIN stoqs_instantpoint ON (stoqs_measurement.instantpoint_id = stoqs_instantpoint.id)',
+                      'INNER JOIN stoqs_instantpoint ON (stoqs_sample.instantpoint_id = stoqs_instantpoint.id)')
+        q = q.replace('INNER JOIN stoqs_parameter ON (stoqs_measuredparameter.parameter_id = stoqs_parameter.id)',
+                      'INNER JOIN stoqs_parameter ON (stoqs_sampledparameter.parameter_id = stoqs_parameter.id)')
+        q = q.replace('AND stoqs_measurement.depth', 'AND stoqs_sample.depth')
+
+    # Add stoqs_measurement inner join if missing and needed for the select
+    if select_items.find('stoqs_measurement') != -1:
+        p = re.compile('FROM stoqs_measuredparameter.* stoqs_measurement')
+        if not p.search(q):
+            put_before = ' inner join stoqs_measurement on stoqs_measurement.id = stoqs_measuredparameter.measurement_id '
+            put_before += ' inner join stoqs_instantpoint on stoqs_measurement.instantpoint_id = stoqs_instantpoint.id ' 
+            add_to_from = put_before + add_to_from
+
+    # Add stoqs_sample inner join if missing and needed for the select
+    if select_items.find('stoqs_sample') != -1:
+        p = re.compile('FROM stoqs_sampledparameter.* stoqs_sample')
+        if not p.search(q):
+            put_before = ' inner join stoqs_sample on stoqs_sample.id = stoqs_sampledparameter.sample_id '
+            put_before += ' inner join stoqs_instantpoint on stoqs_sample.instantpoint_id = stoqs_instantpoint.id ' 
+            add_to_from = put_before + add_to_from
+
+    if q.lower().find('where') == -1:
+        q += add_to_from
+    else:
+        q = q.replace(' WHERE ', add_to_from + ' WHERE ', 1)    # Replace only first occurance to preserve subquery
+
+    pq.logger.debug('q = %s', q)
+    q = sqlparse.format(q, reindent=True, keyword_case='upper')
+
+    return q
+
+
+def addSampleConstraint(pq, query):
+    '''Modify the addParameterParameterSelfJoins() @query to select only the points that have Samples
+    '''
+    q = query
+
+    # Remove any color and z selections
+    p = re.compile(r',\s.+datavalue AS c')
+    q = p.sub(' ', q)
+    p = re.compile(r',\s.+datavalue AS z')
+    q = p.sub(' ', q)
+
+    # Add sample name to SELECT for labeling the Parameter-Parameter plot
+    q = q.replace('FROM', ', stoqs_sample.name FROM', 1)                # Replace just first occurance
+
+    # Make sure we are getting stoqs_sample in our query - warning: very hackish
+    if q.find('FROM stoqs_measuredparameter') != -1:
+        if q.lower().find('inner join stoqs_sample on') == -1 :
+            add_to_from = ''
+            if q.lower().find('inner join stoqs_measurement on ') == -1:
+                add_to_from += ' inner join stoqs_measurement on stoqs_measurement.instantpoint_id = stoqs_instantpoint.id'
+            add_to_from += ' inner join stoqs_sample on stoqs_sample.instantpoint_id = stoqs_instantpoint.id'
+            if q.lower().find('where') == -1:
+                # No where clause, so add the inner joins we need - a bit of a hack
+                q += add_to_from + ' WHERE'
+            else:
+                q = q.replace('WHERE', add_to_from + ' WHERE', 1)       # Replace just first occurance
+
+        if not q.strip().lower().endswith('where'):
+            q += ' and '
+
+        q += ' stoqs_sample.id is not null'
+
+    pq.logger.debug('q = %s', q)
+    q = sqlparse.format(q, reindent=True, keyword_case='upper')
+
+    return q
+
+
+class PQueryBuilderTestCase(TestCase):
+    '''Golden results: the composed and parameterized SQL must select the same data as the
+    regular expression rewritten SQL that it replaced
+    '''
+    fixtures = ['stoqs_test_data.json']
+    multi_db = False
+
+    def setUp(self):
+        self.request = RequestFactory().get('/')
+        self.request.META['dbAlias'] = 'default'
+        self.temperature = Parameter.objects.get(name='temperature')
+
+    def _pq(self, **kwargs):
+        pq = PQuery(self.request)
+        pq.buildPQuerySet(**kwargs)
+        return pq
+
+    def _legacy_pv_ids(self, pq, pvDict):
+        qs_mp = MeasuredParameter.objects.select_related('measurement__instantpoint__activity__platform'
+                                                         ).filter(**pq._getQueryParms())
+        sql = addParameterValuesSelfJoins(pq, postgresifySQL(str(qs_mp.query)), pvDict, pq.rest_select_items)
+        return {mp.id for mp in MeasuredParameter.objects.raw(sql)}
+
+    def _legacy_pp_rows(self, pq, pDict, sampleFlag=False):
+        sql = addParameterParameterSelfJoins(pq, postgresifySQL(str(pq.qs_mp_constrained.query)), pDict)
+        if sampleFlag:
+            sql = addSampleConstraint(pq, sql)
+        with connections['default'].cursor() as cursor:
+            cursor.execute(sql)
+            # parameterParameterSQL() casts the legacy numeric Sample columns to double precision
+            return {tuple(float(v) if isinstance(v, Decimal) else v for v in row) for row in cursor.fetchall()}
+
+    def _pp_rows(self, pq, pDict, sampleFlag=False):
+        sql, params = pq.parameterParameterSQL(pDict, sampleFlag=sampleFlag)
+        with connections['default'].cursor() as cursor:
+            cursor.execute(sql, params)
+            return set(cursor.fetchall())
+
+    def test_parametervalues_match_self_joins(self):
+        for pvDict in ([{'sea_water_sigma_t': ('25.0', '25.33')}],
+                       [{'sea_water_sigma_t': ('25.0', '25.33')}, {'temperature': ('11.22', '13.19')}],
+                       [{'sea_water_sigma_t': ('25.0', '')}, {'temperature': ('', '13.19')}]):
+            pq = self._pq(measuredparametersgroup=[self.temperature.id], parametervalues=pvDict)
+            ids = set(pq.qs_mp_constrained.values_list('id', flat=True))
+            self.assertTrue(ids, f'No MeasuredParameters selected for {pvDict}')
+            self.assertEqual(ids, self._legacy_pv_ids(pq, pvDict), f'Different MeasuredParameters for {pvDict}')
+
+    def test_parametervalues_are_parameters(self):
+        pq = self._pq(parametervalues=[{'sea_water_sigma_t': ('25.0', '25.33')}])
+        sql, params = pq.qs_mp_constrained.query.sql_with_params()
+        self.assertIn('sea_water_sigma_t', params)
+        self.assertNotIn('sea_water_sigma_t', sql)
+        with self.assertRaises(Exception):
+            pq.parameterValuesFilter([{'sea_water_sigma_t': ("25.0'; DROP TABLE stoqs_parameter; --", '')}])
+
+    def test_prune_activities(self):
+        pq = PQuery(self.request)
+        self.assertIsNone(pq.pruneActivities([]))
+        acts = pq.pruneActivities([{'temperature': ('1000', '')}])
+        self.assertIsNotNone(acts)
+        self.assertFalse(ActivityParameter.objects.filter(activity__in=acts, parameter=self.temperature).exists())
+        pq = self._pq(parametervalues=[{'temperature': ('1000', '')}])
+        self.assertEqual(pq.qs_mp_constrained.count(), 0)
+
+        # Every Activity with data satisfying the constraint must survive pruning
+        pvDict = [{'sea_water_sigma_t': ('25.0', '25.33')}]
+        act_ids = set(pq.pruneActivities(pvDict).values_list('id', flat=True))
+        pq = self._pq(parametervalues=pvDict)
+        self.assertTrue(set(pq.qs_mp_constrained.values_list('measurement__instantpoint__activity__id', flat=True)
+                           ).issubset(act_ids))
+
+        act = Activity.objects.exclude(enddate__isnull=True).order_by('startdate').first()
+        acts = pq.pruneActivities([], tminmax=(None, act.startdate.strftime('%Y-%m-%d %H:%M:%S')))
+        self.assertIn(act, acts)
+        self.assertFalse(acts.filter(startdate__gt=act.startdate).exists())
+
+    def test_prune_is_a_subquery(self):
+        # Pruning adds no queries of its own to the parameter value selection
+        pq = PQuery(self.request)
+        with CaptureQueriesContext(connections['default']) as ctx:
+            pq.pruneActivities([{'temperature': ('1000', '')}], tminmax=('2010-10-27 00:00:00', None))
+        self.assertEqual(len(ctx.captured_queries), 0)
+        q = pq.parameterValuesFilter([{'temperature': ('1000', '')}])
+        with CaptureQueriesContext(connections['default']) as ctx:
+            self.assertFalse(MeasuredParameter.objects.filter(q).exists())
+        self.assertEqual(len(ctx.captured_queries), 1)
+
+    def test_prune_keeps_activities_without_statistics(self):
+        # An Activity with temperature data but no ActivityParameter for it can't be judged and must be kept
+        act = (MeasuredParameter.objects.filter(parameter=self.temperature)
+                .values_list('measurement__instantpoint__activity', flat=True).first())
+        ActivityParameter.objects.filter(activity__id=act, parameter=self.temperature).delete()
+        self.assertTrue(ActivityParameter.objects.filter(parameter=self.temperature).exists())
+        pq = PQuery(self.request)
+        acts = pq.pruneActivities([{'temperature': ('1000', '')}])
+        self.assertTrue(acts.filter(id=act).exists())
+        acts = pq.pruneActivities([{'temperature': ('', '-1000')}])
+        self.assertTrue(acts.filter(id=act).exists())
+
+    def test_parameterparameter_match_self_joins(self):
+        fl700_uncorr_id = Parameter.objects.get(name__contains='fl700_uncorr').id
+        B1006_barnacles_id = Parameter.objects.get(name='B1006_barnacles').id
+        sigma_t_id = Parameter.objects.get(name='sea_water_sigma_t').id
+        for kwargs, pDict in (({}, {'x': self.temperature.id, 'y': sigma_t_id}),
+                              ({'platforms': ['dorado'], 'depth': (-10, 50)}, {'x': self.temperature.id, 'y': sigma_t_id, 'c': 'depth'}),
+                              ({'time': ('2010-10-27 21:51:59', '2010-10-28 15:22:54')}, {'x': 'time', 'y': self.temperature.id}),
+                              ({}, {'x': fl700_uncorr_id, 'y': B1006_barnacles_id})):
+            pq = self._pq(**kwargs)
+            rows = self._pp_rows(pq, pDict)
+            if B1006_barnacles_id not in pDict.values():
+                self.assertTrue(rows, f'No Parameter-Parameter data for {kwargs}, {pDict}')
+            if 'time' in pDict.values():
+                # EXTRACT(EPOCH ...) is numeric and the legacy sum of DATE_PARTs is double precision
+                legacy_rows = sorted(self._legacy_pp_rows(pq, pDict))
+                self.assertEqual(len(rows), len(legacy_rows))
+                for row, legacy_row in zip(sorted(tuple(float(v) for v in row) for row in rows), legacy_rows):
+                    for v, legacy_v in zip(row, legacy_row):
+                        self.assertAlmostEqual(v, legacy_v, places=9, msg=f'Different data for {kwargs}, {pDict}')
+            else:
+                self.assertEqual(rows, self._legacy_pp_rows(pq, pDict), f'Different data for {kwargs}, {pDict}')
+
+        pDict = {'x': fl700_uncorr_id, 'y': B1006_barnacles_id}
+        pq = self._pq()
+        rows = self._pp_rows(pq, pDict, sampleFlag=True)
+        self.assertEqual(rows, self._legacy_pp_rows(pq, pDict, sampleFlag=True))
+        self.assertFalse([v for row in rows for v in row if isinstance(v, Decimal)])
+
+
+class MPQueryCountTestCase(TestCase):
+    '''The query planner's estimates of MeasuredParameter counts must be within error_factor of the
+    exact counts once the tables have been analyzed
+    '''
+    fixtures = ['stoqs_test_data.json']
+    multi_db = False
+    error_factor = 3
+
+    def setUp(self):
+        self.request = RequestFactory().get('/')
+        self.request.META['dbAlias'] = 'default'
+        with connections['default'].cursor() as cursor:
+            cursor.execute('ANALYZE')
+        self.temperature = Parameter.objects.get(name='temperature')
+        self.kwargs = {'measuredparametersgroup': [self.temperature.id], 'parameterstandardname': [],
+                       'platforms': [], 'time': (None, None), 'depth': (None, None), 'activitynames': [],
+                       'mplabels': [], 'parametervalues': [], 'parameterplot': (None, None),
+                       'showparameterplatformdata': None, 'get_actual_count': True}
+
+    def _mpq(self, **kwargs):
+        mpq = MPQuery(self.request)
+        mpq.buildMPQuerySet(**dict(self.kwargs, **kwargs))
+        mpq._count = None
+        return mpq
+
+    def test_estimate_error_bounds(self):
+        for kwargs in ({},
+                       {'platforms': ['dorado']},
+                       {'depth': (-10, 50)},
+                       {'time': ('2010-10-27 21:51:59', '2010-10-28 15:22:54')}):
+            estimate, approximate = self._mpq(**kwargs).getMPCountEstimate(threshold=0)
+            self.assertTrue(approximate)
+            count = self._mpq(**kwargs).getMPCount()
+            self.assertTrue(count, f'No MeasuredParameters selected for {kwargs}')
+            self.assertLessEqual(estimate, count * self.error_factor, f'Estimate too high for {kwargs}')
+            self.assertGreaterEqual(estimate, count / self.error_factor, f'Estimate too low for {kwargs}')
+
+    def test_exact_below_threshold(self):
+        mpq = self._mpq()
+        count, approximate = mpq.getMPCountEstimate(threshold=10**12)
+        self.assertFalse(approximate)
+        self.assertEqual(count, MeasuredParameter.objects.filter(parameter=self.temperature).count())
+
+        with override_settings(COUNT_ESTIMATE_THRESHOLD=0):
+            self.assertEqual(mpq.getMPCountEstimate(), (count, False), 'Known exact count should not be replaced by an estimate')
+            self.assertTrue(self._mpq().getMPCountEstimate()[1])
+
+
+class ConnectionPoolTestCase(SimpleTestCase):
+    '''Open connections to many campaign aliases, all pointing to the test database
+    '''
+    num_aliases = 100
+    max_connections = 5
+
+    def setUp(self):
+        self.aliases = [f'stoqs_pool_test_{i:03d}' for i in range(self.num_aliases)]
+        for alias in self.aliases:
+            connections.settings[alias] = dict(connections['default'].settings_dict)
+        self.pool = CampaignConnectionPool(max_connections=self.max_connections, health_check_seconds=0)
+
+    def tearDown(self):
+        for alias in self.aliases:
+            connections[alias].close()
+            del connections[alias]
+            del connections.settings[alias]
+
+    def _open_count(self):
+        return sum(1 for alias in self.aliases if connections[alias].connection is not None)
+
+    def test_open_connections_within_cap(self):
+        for alias in self.aliases:
+            self.pool.checkout(alias)
+            with connections[alias].cursor() as cursor:
+                cursor.execute('SELECT 1')
+            self.pool.release()
+            self.assertLessEqual(self._open_count(), self.max_connections)
+
+        self.assertEqual(self._open_count(), self.max_connections)
+        self.assertGreaterEqual(self.pool.stats['evictions'], self.num_aliases - self.max_connections)
+        # The most recently used connections are the ones kept open
+        for alias in self.aliases[-self.max_connections:]:
+            self.assertIsNotNone(connections[alias].connection, f'{alias} should still be open')
+
+    def test_reuse_and_health_check(self):
+        alias = self.aliases[0]
+        for _ in range(3):
+            self.pool.checkout(alias)
+            with connections[alias].cursor() as cursor:
+                cursor.execute('SELECT 1')
+            self.pool.release()
+        self.assertEqual(self.pool.stats['reuses'], 2)
+
+        # Simulate the server closing the connection
+        connections[alias].connection.close()
+        self.pool.checkout(alias)
+        self.assertEqual(self.pool.stats['health_check_failures'], 1)
+        self.assertIsNone(connections[alias].connection)
+        self.pool.release()
+
+
+class CampaignDirectoryTestCase(TransactionTestCase):
+    '''The campaign directory is read by worker threads on their own connections, so the Campaigns
+    they read must be committed
+    '''
+    unreachable = 'stoqs_directory_test_unreachable'
+
+    def setUp(self):
+        self.campaign = Campaign.objects.create(name='Directory test', description='Before',
+                                                startdate=datetime(2020, 1, 1), enddate=datetime(2020, 1, 2))
+        connections.settings[self.unreachable] = dict(connections['default'].settings_dict,
+                                                      NAME='stoqs_directory_test_no_such_database')
+        self.cd = CampaignDirectory(max_workers=2, stale_seconds=3600, fill_timeout=30)
+        self.cd.invalidate(['default', self.unreachable])
+
+    def tearDown(self):
+        self.cd.executor.shutdown(wait=True)
+        self.cd.invalidate(['default', self.unreachable])
+        connections[self.unreachable].close()
+        del connections[self.unreachable]
+        del connections.settings[self.unreachable]
+
+    def test_cache_hit(self):
+        campaigns = self.cd.campaigns(['default'])['default']
+        self.assertEqual([c['description'] for c in campaigns], ['Before'])
+
+        # A fresh entry is served from the cache without a query
+        Campaign.objects.filter(id=self.campaign.id).update(description='After')
+        with self.assertNumQueries(0):
+            campaigns = self.cd.campaigns(['default'])['default']
+        self.assertEqual([c['description'] for c in campaigns], ['Before'])
+
+    def test_refresh_after_change(self):
+        self.cd.campaigns(['default'])
+
+        # Change the Campaign and add a CampaignResource without loading an Activity
+        Campaign.objects.filter(id=self.campaign.id).update(enddate=datetime(2020, 1, 3))
+        resource = Resource.objects.create(name='title', value='Refreshed')
+        CampaignResource.objects.create(campaign=self.campaign, resource=resource)
+
+        # The stale entry is returned while it's refreshed in the background
+        self.cd.stale_seconds = 0
+        campaign = self.cd.campaigns(['default'])['default'][0]
+        self.assertEqual(campaign['resources'], {})
+        self.cd.executor.shutdown(wait=True)
+
+        campaign = cache.get(CACHE_KEY.format('default'))['campaigns'][0]
+        self.assertEqual(campaign['enddate'], datetime(2020, 1, 3))
+        self.assertEqual(campaign['resources'], {'title': 'Refreshed'})
+
+    def test_unreachable_database(self):
+        directory = self.cd.campaigns(['default', self.unreachable])
+        self.assertEqual([c['name'] for c in directory['default']], ['Directory test'])
+        self.assertEqual(directory[self.unreachable], [])
+
+        # The failed read is retried in the background after retry_seconds, not stale_seconds
+        entry = cache.get(CACHE_KEY.format(self.unreachable))
+        self.assertTrue(entry['failed'])
+        self.assertFalse(cache.get(CACHE_KEY.format('default'))['failed'])
+        self.cd.retry_seconds = 0
+        self.assertEqual(self.cd.campaigns([self.unreachable])[self.unreachable], [])
+        self.cd.executor.shutdown(wait=True)
+        self.assertGreater(cache.get(CACHE_KEY.format(self.unreachable))['read_time'], entry['read_time'])
@@ -17,7 +17,7 @@ from stoqs.views.app import (showMeasuredParameter, showSampledParameter,
                              showActivityParameterHistogram, showResourceActivity,
                              showSampleDT, showQuickLookPlots)
 from stoqs.views.query import queryData, queryMap, queryUI
-from stoqs.views.management import showCampaigns, showDatabase, showActivitiesMBARICustom
+from stoqs.views.management import showCampaigns, showConnectionPool, showDatabase, showActivitiesMBARICustom
 from stoqs.views.permalinks import generate_permalink, load_permalink
 from stoqs.views.parameterinfo import parameterinfo
 
@@ -84,6 +84,7 @@ urlpatterns = [
 
     # Management, base of campaign, etc.
     re_path(r'campaigns.(?P<fmt>[^/]{3,5})$', showCampaigns, {}, name='show-campaigns'),
+    re_path(r'connectionpool.json$', showConnectionPool, {}, name='show-connectionpool'),
     re_path(pre + r'mgmt$', showDatabase, {}, name='show-database'),
     re_path(pre + r'activitiesMBARICustom$', showActivitiesMBARICustom, {}, name='show-activities'),
 
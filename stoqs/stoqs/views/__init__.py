@@ -26,8 +26,7 @@ import csv
 import logging 
 import os
 import tempfile
-from utils.utils import postgresifySQL
-from utils.MPQuery import MPQuery, MPQuerySet
+from utils.MPQuery import MPQuerySet
 from utils.PQuery import PQuery
 from utils import encoders
 from utils.Parquet import Columnar
@@ -260,15 +259,14 @@ class BaseOutputer(object):
         fields = self.add_lon_lat_cols()
 
         if self.stoqs_object_name == 'measured_parameter':
-            # Check if the query contains parametervalue constraints, in which case we need to wrap RawQuerySet in an MPQuerySet
+            # Check if the query contains parametervalue constraints, in which case filter on the other Parameters' values
             pvConstraints = self.parameterValueConstraints()
             if pvConstraints:
                 pq = PQuery(self.request)
-                sql = postgresifySQL(str(self.qs.query))
-                sql = pq.addParameterValuesSelfJoins(sql, pvConstraints, select_items=MPQuery.rest_select_items)
-                self.qs = MPQuerySet(self.request.META['dbAlias'], sql, MPQuerySet.rest_columns)
-            else:
-                self.qs = MPQuerySet(self.request.META['dbAlias'], None, MPQuerySet.rest_columns, qs_mp=self.qs)
+                tminmax = (self.qparams.get('measurement__instantpoint__timevalue__gte'),
+                           self.qparams.get('measurement__instantpoint__timevalue__lte'))
+                self.qs = self.qs.filter(pq.parameterValuesFilter(pvConstraints, tminmax=tminmax))
+            self.qs = MPQuerySet(self.request.META['dbAlias'], None, MPQuerySet.rest_columns, qs_mp=self.qs)
 
         # Process request based on format requested
         if self.format == 'csv' or self.format == 'tsv':
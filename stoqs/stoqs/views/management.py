@@ -25,9 +25,13 @@ MBARI Jan 9, 2012
 from django.shortcuts import render
 from django.template import RequestContext
 from django.conf import settings
-from django.db import DatabaseError, connections
-from django.http import HttpResponse
+from django.core.paginator import Paginator
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+from django.http import HttpResponse, Http404
+from stoqs.db_router import connection_pool
 from utils import encoders
+from utils.CampaignDirectory import campaign_directory
 import stoqs.models as mod
 from datetime import datetime, timedelta
 import socket
@@ -37,13 +41,13 @@ import sys
 
 logger = logging.getLogger(__name__)
 
+ACTIVITIES_PER_PAGE = 100
+
 class Act():
     '''A tiny class to hold all the information for an Activity that includes perhaps additional data from other
     parts of the model. The types are simple things (characters and numbers) that can appear in a web page.
     '''
 
-    m_query = ''
-    mp_query = ''
     id = 0
     campaign = ''
     platform = ''
@@ -62,15 +66,30 @@ class Act():
 
 def showDatabase(request):
     '''Present summary view of the database. Show list of Activities, number of measured_paramaters, parameter names, platforms, etc.
-    Offer ability to delete Activities.
+    Offer ability to delete Activities.  The Activities are shown ACTIVITIES_PER_PAGE at a time, with their Measurement and
+    MeasuredParameter counts computed in the same query as the page, so the number of queries doesn't grow with the page size.
     '''
+    dbAlias = request.META['dbAlias']
+
+    # Count with correlated subqueries, joining both tables in one aggregate would multiply the counts.
+    # The loaders store num_measuredparameters, COALESCE evaluates the subquery only where it's missing.
+    m_count = (mod.Measurement.objects.using(dbAlias).filter(instantpoint__activity=OuterRef('pk'))
+                  .order_by().values('instantpoint__activity').annotate(c=Count('id')).values('c'))
+    mp_count = (mod.MeasuredParameter.objects.using(dbAlias).filter(measurement__instantpoint__activity=OuterRef('pk'))
+                   .order_by().values('measurement__instantpoint__activity').annotate(c=Count('id')).values('c'))
+    aList = (mod.Activity.objects.using(dbAlias).select_related('campaign', 'platform', 'activitytype')
+                .annotate(mCount=Coalesce(Subquery(m_count), 0),
+                          mpCount=Coalesce('num_measuredparameters', Subquery(mp_count), 0))
+                .order_by('startdate', 'id'))
+
+    try:
+        per_page = int(request.GET.get('per_page', ACTIVITIES_PER_PAGE))
+    except ValueError:
+        per_page = ACTIVITIES_PER_PAGE
+    page = Paginator(aList, max(1, per_page)).get_page(request.GET.get('page'))
 
-    aList = mod.Activity.objects.all().order_by('startdate')
-    
     actList = []
-    for a in aList:
-        qs_m = mod.Measurement.objects.filter(instantpoint__activity__id = a.id)
-        qs_mp = mod.MeasuredParameter.objects.filter(measurement__instantpoint__activity__id = a.id)
+    for a in page:
         act = Act()
         if a.campaign:
             act.campaignName = a.campaign.name
@@ -79,8 +98,6 @@ def showDatabase(request):
         if a.activitytype:
             act.activityTypeName = a.activitytype.name
 
-        act.m_query = str(qs_m.query)
-        act.mp_query = str(qs_mp.query)
         act.id = a.id
         act.name = a.name
         act.comment = a.comment
@@ -90,16 +107,18 @@ def showDatabase(request):
             act.enddate = a.enddate
             act.isoenddate = a.enddate.strftime('%Y%m%dT%H%M%S')
 
-        act.mCount = qs_m.count()
-        act.mpCount = qs_mp.count()
+        act.mCount = a.mCount
+        act.mpCount = a.mpCount
         act.parameters = ''
         actList.append(act)
 
-    pList = mod.Parameter.objects.all().order_by('name')    
+    pList = mod.Parameter.objects.using(dbAlias).all().order_by('name')    
 
     return render(request, 'management.html', context=
-                {'dbAlias': request.META['dbAlias'], 
+                {'dbAlias': dbAlias, 
                  'actList': actList,
+                 'page': page,
+                 'per_page': per_page,
                  'pList': pList,
                  }
                 ) 
@@ -109,7 +128,8 @@ def showDatabase(request):
 
 def showCampaigns(request,format=None):
     '''
-    Present list of Campaigns from scanning the DATABASES dictionary from settings.
+    Present list of Campaigns in the databases of the DATABASES dictionary from settings.  They are read from
+    the campaign directory cache, which is filled and refreshed by background threads.
     '''
 
     dbAliases = list(settings.DATABASES.keys())
@@ -119,50 +139,24 @@ def showCampaigns(request,format=None):
     logger.debug(list(settings.DATABASES.keys()))
   
     # Data structure hash of lists.  Possible to have multiple campaigns in a database
-    cHash = {}
-    rHash = {}
-    for dbAlias in list(settings.DATABASES.keys()):
-        # Initialize Campaign and Resource hash lists
-        cHash[dbAlias] = []
-        rHash[dbAlias] = []
-
-    for dbAlias in list(settings.DATABASES.keys()):
-        try:
-            logger.debug("Getting Campaign from dbAlias = %s", dbAlias)
-            cqs = mod.Campaign.objects.using(dbAlias).all()
-            for c in cqs:
-                logger.debug("Appending campaign name = %s to cHash with key (dbAlias) = %s", c.name, dbAlias)
-                cHash[dbAlias].append(c)
-                r = {}
-                for cr in mod.CampaignResource.objects.using(dbAlias).filter(campaign=c):
-                    r[cr.resource.name] = cr.resource.value
-                rHash[dbAlias].append(r)
-        except (mod.Campaign.DoesNotExist, mod.Resource.DoesNotExist):
-            logger.warn("Database alias %s does not exist", dbAlias)
-            continue
-        except DatabaseError:
-            # Will happen if database defined in privateSettings does not exist yet
-            logger.warn("Database alias %s returns django.db.DatabaseError", dbAlias)
-            continue
-
-        # Close the database connection, before connecting to the next database
-        connections.close_all()
+    cHash = campaign_directory.campaigns(dbAliases)
 
     # Create a hash keyed by startdate of the dbAliases and campaigns so that we display a time sorted list of campaigns
     timeSortHash = {}
     dummyTime = datetime(1970,1,1)
     for k in list(cHash.keys()):
         logger.debug('k = %s', k)
-        for c,r in zip(cHash[k], rHash[k]):
-            logger.debug('c.name = %s', c.name)
+        for c in cHash[k]:
+            r = c['resources']
+            logger.debug('c.name = %s', c['name'])
             # Use combination of dbAlias and startdate as different dbAlias's can have the same startdate
-            if c.startdate:
-                key = str(c.startdate) + '_' + c.name
+            if c['startdate']:
+                key = str(c['startdate']) + '_' + c['name']
                 timeSortHash[key] = {k: (c, r)}
                 logger.debug("Set timeSortHash['%s'] = %s", key, {k: (c, r)})
             else:
                 # Put in a dummy time, and increment it
-                key = str(dummyTime) + '_' + c.name
+                key = str(dummyTime) + '_' + c['name']
                 timeSortHash[key] = {k: (c, r)}
                 logger.debug("Set timeSortHash['%s'] = %s", key, {k: (c, r)})
                 dummyTime += timedelta(seconds=1)
@@ -180,16 +174,16 @@ def showCampaigns(request,format=None):
             description = ''
             startdate = ''
             enddate = ''
-            if c.description:
-                description = c.description
-            if c.startdate: 
-                startdate = c.startdate.strftime('%d %b %Y')
-            if c.enddate:
-                enddate = c.enddate.strftime('%d %b %Y')
+            if c['description']:
+                description = c['description']
+            if c['startdate']: 
+                startdate = c['startdate'].strftime('%d %b %Y')
+            if c['enddate']:
+                enddate = c['enddate'].strftime('%d %b %Y')
             
             sum_SampledParameter_count += int(r.get('SampledParameter_count', 0))
             sum_MeasuredParameter_count += int(r.get('MeasuredParameter_count', 0))
-            camList.append({'name': c.name, 'dbAlias': k, 'description': description,
+            camList.append({'name': c['name'], 'dbAlias': k, 'description': description,
                             'startdate': startdate, 'enddate': enddate,
                             'MeasuredParameter_count': r.get('MeasuredParameter_count', ''),
                             'SampledParameter_count': r.get('SampledParameter_count', ''),
@@ -209,6 +203,16 @@ def showCampaigns(request,format=None):
     else:
         return render(request, 'campaigns.html', context={'cList': camList })
 
+def showConnectionPool(request):
+    '''
+    Debugging aid: return the database connection pool statistics of the process that served the request.
+    '''
+    if not settings.DEBUG:
+        raise Http404('Connection pool statistics are available only with DEBUG')
+
+    return HttpResponse(json.dumps(connection_pool.status(), indent=2), content_type='application/json')
+
+
 def showActivitiesMBARICustom(request):
     '''Present list of Activities in the database.  Unlike showDatabase(), show show the Activities and their
     local attributes, no counts, or delete link.  This is so that it will display more quickly.
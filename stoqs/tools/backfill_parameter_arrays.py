@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+
+'''
+Save ActivityParameterArrays for the Activities of databases that were loaded before
+the loaders saved them, after migrate has created the stoqs_activityparameterarray table:
+
+    stoqs/manage.py migrate --database stoqs_canon_october2020
+    tools/backfill_parameter_arrays.py --db stoqs_canon_october2020
+
+Activities that already have ActivityParameterArrays are skipped unless --replace is given.
+'''
+
+import django
+import os
+import sys
+
+from timeit import default_timer
+
+# Insert Django App directory (parent of config) into python path
+sys.path.insert(0, os.path.abspath(os.path.join(
+                    os.path.dirname(__file__), "../")))
+if 'DJANGO_SETTINGS_MODULE' not in os.environ:
+    os.environ['DJANGO_SETTINGS_MODULE'] = 'config.settings.local'
+django.setup()
+
+from loaders import STOQS_Loader
+from stoqs.models import Activity, ActivityParameterArray
+
+
+def backfill(db, replace=False, verbose=False):
+    '''Save ActivityParameterArrays for all the Activities in db, return number saved
+    '''
+    done = set(ActivityParameterArray.objects.using(db).values_list('activity__id', flat=True).distinct())
+    total = 0
+    for act in Activity.objects.using(db).order_by('startdate'):
+        if act.id in done and not replace:
+            continue
+        start = default_timer()
+        num_saved = STOQS_Loader.save_activityparameter_arrays(db, act)
+        total += num_saved
+        if verbose:
+            print(f'{act.name[:80]:80s} {num_saved:4d} arrays {default_timer() - start:7.2f} s')
+
+    return total
+
+
+if __name__ == '__main__':
+    import argparse
+    from argparse import RawTextHelpFormatter
+
+    parser = argparse.ArgumentParser(formatter_class=RawTextHelpFormatter, description=__doc__)
+    parser.add_argument('--db', action='store', nargs='+', required=True, help='Database aliases to backfill')
+    parser.add_argument('--replace', action='store_true', help='Replace existing ActivityParameterArrays')
+    parser.add_argument('-v', '--verbose', action='store_true', help='Print timing for each Activity')
+    args = parser.parse_args()
+
+    for db in args.db:
+        print(f'{db}: saved {backfill(db, args.replace, args.verbose)} ActivityParameterArrays')
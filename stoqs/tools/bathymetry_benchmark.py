@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+
+'''
+Time the bottom depth lookups of STOQS_Loader.addAltitude() for random positions within a GMT
+grd file, interpolated in process by loaders/bathymetry.py, first with an empty tile cache and
+then with the tiles cached as for the next Activity of a load, and by grdtrack(1) if GMT is
+installed, e.g.:
+
+    tools/bathymetry_benchmark.py --grd loaders/Monterey25.grd --points 1000000
+'''
+
+import django
+import os
+import subprocess
+import sys
+
+from statistics import median
+from timeit import default_timer
+
+# Insert Django App directory (parent of config) into python path
+sys.path.insert(0, os.path.abspath(os.path.join(
+                    os.path.dirname(__file__), "../")))
+if 'DJANGO_SETTINGS_MODULE' not in os.environ:
+    os.environ['DJANGO_SETTINGS_MODULE'] = 'config.settings.local'
+django.setup()
+
+import numpy as np
+from loaders import bathymetry, cmd_exists
+
+
+def positions(grd, points):
+    '''Return points random lons and lats within the grid
+    '''
+    xmin, ymin, xmax, ymax = bathymetry.open_grid(grd).bounds
+    bathymetry.open_grid.cache_clear()
+    rng = np.random.default_rng(0)
+
+    return rng.uniform(xmin, xmax, points), rng.uniform(ymin, ymax, points)
+
+
+def time_in_process(grd, lons, lats, repeat, cached):
+    times = []
+    for _ in range(repeat):
+        if not cached:
+            bathymetry.open_grid.cache_clear()
+        start = default_timer()
+        bathymetry.bottom_depths(grd, lons, lats)
+        times.append(default_timer() - start)
+
+    return median(times)
+
+
+def time_grdtrack(grd, lons, lats, repeat):
+    cmd = ['grdtrack'] if cmd_exists('grdtrack') else ['gmt', 'grdtrack']
+    xy = '\n'.join(f'{lon:f} {lat:f}' for lon, lat in zip(lons, lats))
+    times = []
+    for _ in range(repeat):
+        start = default_timer()
+        subprocess.run(cmd + [f'-G{grd}'], input=xy, capture_output=True, text=True, check=True)
+        times.append(default_timer() - start)
+
+    return median(times)
+
+
+if __name__ == '__main__':
+    import argparse
+    from argparse import RawTextHelpFormatter
+
+    parser = argparse.ArgumentParser(formatter_class=RawTextHelpFormatter, description=__doc__)
+    parser.add_argument('--grd', action='store', required=True, help='Path of a GMT grd bathymetry file')
+    parser.add_argument('--points', action='store', type=int, default=100000, help='Number of positions to look up')
+    parser.add_argument('--repeat', action='store', type=int, default=3, help='Number of times to time each lookup')
+    args = parser.parse_args()
+
+    lons, lats = positions(args.grd, args.points)
+    print(f"{'Engine':20s} {'Seconds':>9s} {'Points/s':>12s}")
+    for engine, secs in (('In process, cold', time_in_process(args.grd, lons, lats, args.repeat, cached=False)),
+                         ('In process, cached', time_in_process(args.grd, lons, lats, args.repeat, cached=True))):
+        print(f"{engine:20s} {secs:9.3f} {args.points / secs:12.0f}")
+    if cmd_exists('grdtrack') or cmd_exists('gmt'):
+        secs = time_grdtrack(args.grd, lons, lats, args.repeat)
+        print(f"{'grdtrack':20s} {secs:9.3f} {args.points / secs:12.0f}")
+    else:
+        print('GMT is not installed, grdtrack not timed')
@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+
+'''
+Time repeated Parquet exports of the same shape, a Platform's data in a moving time window,
+with the SQL of utils.Parquet.Columnar executed through a server-side prepared statement and
+as a plain parameterized statement.  Short windows make planning a large part of each export, e.g.:
+
+    tools/columnar_benchmark.py --db stoqs_canon_october2020 --platform dorado --minutes 10 --repeat 20
+'''
+
+import django
+import os
+import sys
+
+from datetime import timedelta
+from statistics import median
+from timeit import default_timer
+
+# Insert Django App directory (parent of config) into python path
+sys.path.insert(0, os.path.abspath(os.path.join(
+                    os.path.dirname(__file__), "../")))
+if 'DJANGO_SETTINGS_MODULE' not in os.environ:
+    os.environ['DJANGO_SETTINGS_MODULE'] = 'config.settings.local'
+django.setup()
+
+from django.db.models import Max, Min
+from django.http import HttpRequest, QueryDict
+from stoqs.models import InstantPoint
+from utils.Parquet import Columnar
+
+
+def windows(db, platform, minutes, repeat):
+    '''Return list of repeat (start, end) time strings spread through the Platform's data
+    '''
+    tmin, tmax = (InstantPoint.objects.using(db).filter(activity__platform__name=platform)
+                                      .aggregate(Min('timevalue'), Max('timevalue')).values())
+    step = (tmax - tmin - timedelta(minutes=minutes)) / repeat
+    fmt = '%Y-%m-%d %H:%M:%S'
+
+    return [((tmin + i * step).strftime(fmt), (tmin + i * step + timedelta(minutes=minutes)).strftime(fmt))
+            for i in range(repeat)]
+
+
+def export(db, platform, stime, etime, prepared):
+    request = HttpRequest()
+    request.META = {'dbAlias': db}
+    request.GET = QueryDict(mutable=True)
+    request.GET['measurement__instantpoint__activity__platform__name'] = platform
+    request.GET['measurement__instantpoint__timevalue__gt'] = stime
+    request.GET['measurement__instantpoint__timevalue__lt'] = etime
+
+    col = Columnar()
+    col.PREPARED_STATEMENTS = prepared
+    where_clause, params = col.request_to_sql_where(request)
+    df, _ = col._sql_to_df(col._build_sql(where_clause=where_clause), params, set_index=True)
+    df.pivot_table(index=col.context, columns=col.collect, values='datavalue')
+
+    return len(df)
+
+
+def time_exports(db, platform, wins, prepared):
+    rows, times = 0, []
+    for stime, etime in wins:
+        start = default_timer()
+        rows += export(db, platform, stime, etime, prepared)
+        times.append(default_timer() - start)
+
+    return rows, median(times), times[0]
+
+
+if __name__ == '__main__':
+    import argparse
+    from argparse import RawTextHelpFormatter
+
+    parser = argparse.ArgumentParser(formatter_class=RawTextHelpFormatter, description=__doc__)
+    parser.add_argument('--db', action='store', required=True, help='Database alias')
+    parser.add_argument('--platform', action='store', required=True, help='Platform name')
+    parser.add_argument('--minutes', action='store', type=float, default=10, help='Length of each time window')
+    parser.add_argument('--repeat', action='store', type=int, default=20, help='Number of exports')
+    args = parser.parse_args()
+
+    wins = windows(args.db, args.platform, args.minutes, args.repeat)
+    print(f"{'':10s} {'Rows':>10s} {'First s':>9s} {'Median s':>9s}")
+    for label, prepared in (('Plain', False), ('Prepared', True)):
+        rows, secs, first = time_exports(args.db, args.platform, wins, prepared)
+        print(f"{label:10s} {rows:10d} {first:9.4f} {secs:9.4f}")
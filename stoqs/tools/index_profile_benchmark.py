@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+
+'''
+Compare the index profiles of loaders/index_profile.py on a synthetic campaign.
+For each profile the synthetic data are loaded into a scratch database and the
+index sizes, load throughput and the query latencies of tools/mpquery_benchmark.py
+are reported.  Create an empty database first, e.g.:
+
+    loaders/load.py --db stoqs_index_bench --create_only
+    STOQS_CAMPAIGNS=stoqs_index_bench tools/index_profile_benchmark.py --db stoqs_index_bench
+
+All data in the --db database are deleted before each profile is loaded.
+'''
+
+import django
+import os
+import sys
+
+from datetime import datetime, timedelta
+from timeit import default_timer
+
+# Insert Django App directory (parent of config) into python path
+sys.path.insert(0, os.path.abspath(os.path.join(
+                    os.path.dirname(__file__), "../")))
+if 'DJANGO_SETTINGS_MODULE' not in os.environ:
+    os.environ['DJANGO_SETTINGS_MODULE'] = 'config.settings.local'
+django.setup()
+
+import numpy as np
+from django.contrib.gis.geos import Point
+from django.db import connections
+from loaders.index_profile import apply_index_profile, index_sizes, PROFILES
+from stoqs.models import (Activity, ActivityParameter, Campaign, InstantPoint, Measurement,
+                          MeasuredParameter, Parameter, Platform, PlatformType)
+from tools.mpquery_benchmark import scenarios, time_scenario
+
+SYNTHETIC_CAMPAIGN = 'Synthetic index profile benchmark'
+BATCH_SIZE = 10000
+PARAMETERS = (('temperature', 'degC', 12.0, 3.0), ('salinity', 'psu', 33.5, 0.5), ('chlorophyll', 'ug/l', 2.0, 1.5))
+
+
+class BenchmarkError(Exception):
+    pass
+
+
+def clear(db):
+    '''Delete everything from db, refusing if it has a real Campaign in it
+    '''
+    names = list(Campaign.objects.using(db).values_list('name', flat=True))
+    if names and names != [SYNTHETIC_CAMPAIGN]:
+        raise BenchmarkError(f'{db} contains Campaign(s) {names}, use an empty scratch database')
+    with connections[db].cursor() as cursor:
+        cursor.execute('''TRUNCATE stoqs_measuredparameter, stoqs_measurement, stoqs_instantpoint,
+                          stoqs_activityparameter, stoqs_activity, stoqs_parameter, stoqs_platform,
+                          stoqs_platformtype, stoqs_campaign CASCADE''')
+
+
+def load_synthetic(db, n_activities, n_points):
+    '''Load n_activities AUV-like yo-yo trajectories of n_points each with the PARAMETERS,
+    in time order as the DAPloaders do. Return the number of rows inserted.
+    '''
+    rng = np.random.default_rng(42)
+    campaign = Campaign.objects.using(db).create(name=SYNTHETIC_CAMPAIGN)
+    platformtype = PlatformType.objects.using(db).create(name='auv')
+    platform = Platform.objects.using(db).create(name='synthetic_auv', platformtype=platformtype)
+    parameters = [Parameter.objects.using(db).create(name=n, units=u) for n, u, _, _ in PARAMETERS]
+
+    rows = 0
+    start = datetime(2020, 1, 1)
+    for a in range(n_activities):
+        times = [start + timedelta(seconds=int(s)) for s in np.arange(n_points) * 2]
+        depths = 50 + 50 * np.sin(np.arange(n_points) / 300.0)
+        lons = -122.0 + np.cumsum(rng.normal(0, 1e-5, n_points))
+        lats = 36.8 + np.cumsum(rng.normal(0, 1e-5, n_points))
+        activity = Activity.objects.using(db).create(name=f'synthetic_{a:04d}', campaign=campaign, platform=platform,
+                                                     startdate=times[0], enddate=times[-1], comment='',
+                                                     num_measuredparameters=n_points * len(PARAMETERS))
+        for i in range(0, n_points, BATCH_SIZE):
+            j = min(i + BATCH_SIZE, n_points)
+            ips = InstantPoint.objects.using(db).bulk_create(
+                    [InstantPoint(activity=activity, timevalue=t) for t in times[i:j]])
+            meass = Measurement.objects.using(db).bulk_create(
+                    [Measurement(instantpoint=ip, depth=d, geom=Point(x, y)) for ip, d, x, y in
+                     zip(ips, depths[i:j], lons[i:j], lats[i:j])])
+            mps = []
+            for parameter, (_, _, mean, std) in zip(parameters, PARAMETERS):
+                mps.extend(MeasuredParameter(measurement=me, parameter=parameter, datavalue=v) for me, v in
+                           zip(meass, rng.normal(mean, std, j - i)))
+            MeasuredParameter.objects.using(db).bulk_create(mps)
+            rows += len(ips) + len(meass) + len(mps)
+
+        for parameter, (_, _, mean, std) in zip(parameters, PARAMETERS):
+            ActivityParameter.objects.using(db).create(activity=activity, parameter=parameter, number=n_points,
+                                                       min=mean - 4 * std, max=mean + 4 * std,
+                                                       p025=mean - 2 * std, p975=mean + 2 * std)
+        start = times[-1] + timedelta(hours=1)
+
+    with connections[db].cursor() as cursor:
+        cursor.execute('ANALYZE')
+
+    return rows
+
+
+if __name__ == '__main__':
+    import argparse
+    from argparse import RawTextHelpFormatter
+
+    parser = argparse.ArgumentParser(formatter_class=RawTextHelpFormatter, description=__doc__)
+    parser.add_argument('--db', action='store', required=True, help='Scratch database alias')
+    parser.add_argument('--profiles', action='store', nargs='+', choices=list(PROFILES.keys()),
+                        default=list(PROFILES.keys()), help='Index profiles to compare')
+    parser.add_argument('--activities', action='store', type=int, default=10, help='Number of synthetic Activities')
+    parser.add_argument('--points', action='store', type=int, default=100000, help='Number of Measurements per Activity')
+    parser.add_argument('--repeat', action='store', type=int, default=3, help='Number of times to run each query')
+    args = parser.parse_args()
+
+    for profile in args.profiles:
+        clear(args.db)
+        apply_index_profile(args.db, profile)
+        start = default_timer()
+        rows = load_synthetic(args.db, args.activities, args.points)
+        load_secs = default_timer() - start
+
+        print(f'\n=== Profile {profile}: loaded {rows} rows in {load_secs:.1f} s ({rows / load_secs:.0f} rows/s)')
+        total = 0
+        for table, name, method, size in index_sizes(args.db):
+            print(f'{table:25s} {name:60s} {method:6s} {size / 2**20:10.2f} MB')
+            total += size
+        print(f"{'Total':92s} {total / 2**20:10.2f} MB")
+
+        print(f"{'Scenario':50s} {'Count':>10s} {'Count s':>9s} {'Rows s':>9s}")
+        for name, kwargs in scenarios(args.db):
+            count, count_secs, fetch_secs = time_scenario(args.db, kwargs, args.repeat)
+            print(f'{name[:50]:50s} {count:10d} {count_secs:9.3f} {fetch_secs:9.3f}')
@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+
+'''
+Time the resampling of the parameter groups of a synthetic LRAUV nc4 file, as done by
+InterpolatorWriter.processResampleNc4File(), serially and with --workers processes, and
+check that the results are the same, e.g.:
+
+    tools/lrauv_resample_benchmark.py --groups 8 --variables 4 --records 200000 --workers 4
+'''
+
+import django
+import os
+import shutil
+import sys
+import tempfile
+
+from statistics import median
+from timeit import default_timer
+
+# Insert Django App directory (parent of config) into python path
+sys.path.insert(0, os.path.abspath(os.path.join(
+                    os.path.dirname(__file__), "../")))
+sys.path.insert(0, os.path.abspath(os.path.join(
+                    os.path.dirname(__file__), "../loaders")))
+if 'DJANGO_SETTINGS_MODULE' not in os.environ:
+    os.environ['DJANGO_SETTINGS_MODULE'] = 'config.settings.local'
+django.setup()
+
+import netCDF4
+import numpy as np
+import pandas as pd
+from CANON.toNetCDF.lrauvNc4ToNetcdf import InterpolatorWriter
+
+
+def write_nc4(path, groups, variables, records):
+    '''Write a file of groups with variables that each have their own irregular time base of
+    about records values at 1 second intervals, return the parm dictionary for it
+    '''
+    rng = np.random.default_rng(0)
+    parm = {}
+    with netCDF4.Dataset(path, 'w') as nc:
+        for gn in range(groups):
+            group = f'Instrument{gn}'
+            g = nc.createGroup(group)
+            parm[group] = []
+            for vn in range(variables):
+                name = f'variable{vn}'
+                secs = 1.6e9 + np.cumsum(rng.uniform(0.5, 1.5, records))
+                g.createDimension(f'{name}_time', records)
+                g.createVariable(f'{name}_time', 'f8', (f'{name}_time',))[:] = secs
+                g.createVariable(name, 'f4', (f'{name}_time',), zlib=True)[:] = np.sin(secs / 300)
+                parm[group].append({'name': name, 'rename': f'{group}_{name}'})
+
+    return parm
+
+
+def time_resample(path, parm, t_index, resample_freq, workers, repeat):
+    pw = InterpolatorWriter()
+    pw.in_file = path
+    times = []
+    with netCDF4.Dataset(path) as pw.df:
+        for _ in range(repeat):
+            start = default_timer()
+            results = pw.resample_groups(path, list(parm), parm, t_index, resample_freq, workers)
+            times.append(default_timer() - start)
+
+    return results, median(times)
+
+
+def same_results(results, other):
+    return all(key == okey and ts.index.equals(ots.index) and ts.values.tobytes() == ots.values.tobytes()
+                    for group_results, other_results in zip(results, other)
+                    for (key, _, ts), (okey, _, ots) in zip(group_results, other_results))
+
+
+if __name__ == '__main__':
+    import argparse
+    from argparse import RawTextHelpFormatter
+
+    parser = argparse.ArgumentParser(formatter_class=RawTextHelpFormatter, description=__doc__)
+    parser.add_argument('--groups', action='store', type=int, default=8, help='Number of parameter groups')
+    parser.add_argument('--variables', action='store', type=int, default=4, help='Number of variables in each group')
+    parser.add_argument('--records', action='store', type=int, default=100000, help='Number of values of each variable')
+    parser.add_argument('--resampleFreq', action='store', default='2S', help='Resampling frequency')
+    parser.add_argument('--workers', action='store', type=int, default=4, help='Number of worker processes')
+    parser.add_argument('--repeat', action='store', type=int, default=3, help='Number of times to resample')
+    args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmpdir, 'benchmark.nc4')
+        parm = write_nc4(path, args.groups, args.variables, args.records)
+        t_index = pd.date_range(pd.to_datetime(1.6e9, unit='s'), periods=args.records // 2,
+                                freq=args.resampleFreq.lower())
+
+        serial, serial_secs = time_resample(path, parm, t_index, args.resampleFreq, 1, args.repeat)
+        parallel, parallel_secs = time_resample(path, parm, t_index, args.resampleFreq, args.workers, args.repeat)
+        print(f"{'Workers':10s} {'Seconds':>9s}")
+        print(f"{1:<10d} {serial_secs:9.3f}")
+        print(f"{args.workers:<10d} {parallel_secs:9.3f}")
+        print(f'Results are {"the same" if same_results(serial, parallel) else "DIFFERENT"}')
+    finally:
+        shutil.rmtree(tmpdir)
@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+
+'''
+Time the main MeasuredParameter query paths of utils/MPQuery.py against one or more
+databases.  Meant for comparing physical designs of the same campaign, e.g. a copy of
+a database with a partitioned stoqs_measuredparameter table (see loaders/partition.py):
+
+    createdb -T stoqs_canon_october2020 stoqs_canon_october2020_part
+    loaders/partition.py --db stoqs_canon_october2020_part --mode parameter
+    tools/mpquery_benchmark.py --db stoqs_canon_october2020 stoqs_canon_october2020_part
+
+The query constraints are built from the metadata of the first database so that the same
+selections are timed in each database.  Set STOQS_CAMPAIGNS so that each --db is configured.
+'''
+
+import django
+import os
+import sys
+
+from statistics import median
+from timeit import default_timer
+
+# Insert Django App directory (parent of config) into python path
+sys.path.insert(0, os.path.abspath(os.path.join(
+                    os.path.dirname(__file__), "../")))
+if 'DJANGO_SETTINGS_MODULE' not in os.environ:
+    os.environ['DJANGO_SETTINGS_MODULE'] = 'config.settings.local'
+django.setup()
+
+from django.db.models import Max, Min, Sum
+from django.http import HttpRequest
+from stoqs.models import Activity, ActivityParameter, InstantPoint, Parameter
+from utils.MPQuery import MPQuery, MPQuerySet
+
+ROWS = 1000
+
+
+def default_kwargs():
+    '''Constraint kwargs as sent by stoqs/views/query.py with nothing selected
+    '''
+    return {'measuredparametersgroup': [],
+            'parameterstandardname': [],
+            'platforms': [],
+            'time': (None, None),
+            'depth': (None, None),
+            'activitynames': [],
+            'mplabels': [],
+            'parametervalues': [],
+            'parameterplot': (None, None),
+            'showparameterplatformdata': None,
+            'get_actual_count': True}
+
+
+def scenarios(db, nparms=2):
+    '''Return list of (name, kwargs) for the most commonly used selections, using the
+    Parameters with the most MeasuredParameters in db
+    '''
+    parms = (ActivityParameter.objects.using(db).values('parameter__id', 'parameter__name')
+                                      .annotate(n=Sum('number')).order_by('-n')[:nparms])
+    tmin, tmax = InstantPoint.objects.using(db).aggregate(Min('timevalue'), Max('timevalue')).values()
+    tmid = tmin + (tmax - tmin) / 2
+    twindow = ((tmid - (tmax - tmin) / 20).strftime('%Y-%m-%d %H:%M:%S'),
+               (tmid + (tmax - tmin) / 20).strftime('%Y-%m-%d %H:%M:%S'))
+    activity = Activity.objects.using(db).order_by('-num_measuredparameters').values_list('name', flat=True).first()
+
+    scens = []
+    for parm in parms:
+        pid, pname = parm['parameter__id'], parm['parameter__name']
+        scens.append((f'{pname}', dict(default_kwargs(), parameterplot=(pid, None))))
+        scens.append((f'{pname} time window', dict(default_kwargs(), parameterplot=(pid, None), time=twindow)))
+        scens.append((f'{pname} depth < 50 m', dict(default_kwargs(), parameterplot=(pid, None), depth=(None, 50))))
+        scens.append((f'{pname} activity', dict(default_kwargs(), parameterplot=(pid, None), activitynames=[activity])))
+
+    if len(parms) > 1:
+        # Parameter value constraint on the second Parameter: its interquartile-ish range
+        pid, pname = parms[0]['parameter__id'], parms[0]['parameter__name']
+        cname = parms[1]['parameter__name']
+        pmin, pmax = (ActivityParameter.objects.using(db).filter(parameter__name=cname)
+                                        .aggregate(Min('p025'), Max('p975')).values())
+        pv = [{cname: (str(pmin + (pmax - pmin) / 4), str(pmax - (pmax - pmin) / 4))}]
+        scens.append((f'{pname} where {cname} in range', dict(default_kwargs(), parameterplot=(pid, None), parametervalues=pv)))
+
+    return scens
+
+
+def time_scenario(db, kwargs, repeat):
+    '''Return median seconds for the count and for fetching ROWS ordered rows
+    '''
+    count_times, fetch_times = [], []
+    for _ in range(repeat):
+        request = HttpRequest()
+        request.META = {'dbAlias': db}
+        mpq = MPQuery(request)
+
+        start = default_timer()
+        mpq.buildMPQuerySet(**kwargs)
+        count = mpq.getMPCount()
+        count_times.append(default_timer() - start)
+
+        start = default_timer()
+        qs_mp = mpq.getMeasuredParametersQS(MPQuerySet.rest_columns)
+        for _ in zip(range(ROWS), qs_mp):
+            pass
+        fetch_times.append(default_timer() - start)
+
+    return count, median(count_times), median(fetch_times)
+
+
+if __name__ == '__main__':
+    import argparse
+    from argparse import RawTextHelpFormatter
+
+    parser = argparse.ArgumentParser(formatter_class=RawTextHelpFormatter, description=__doc__)
+    parser.add_argument('--db', action='store', nargs='+', required=True, help='Database aliases to compare')
+    parser.add_argument('--repeat', action='store', type=int, default=3, help='Number of times to run each query')
+    parser.add_argument('--nparms', action='store', type=int, default=2, help='Number of Parameters to build queries for')
+    args = parser.parse_args()
+
+    print(f"{'Scenario':50s} {'Database':40s} {'Count':>10s} {'Count s':>9s} {f'{ROWS} rows s':>10s}")
+    for name, kwargs in scenarios(args.db[0], args.nparms):
+        # Parameter ids may differ between databases, look them up by name
+        pname = None
+        if kwargs['parameterplot'][0]:
+            pname = Parameter.objects.using(args.db[0]).get(id=kwargs['parameterplot'][0]).name
+        for db in args.db:
+            db_kwargs = dict(kwargs)
+            if pname:
+                db_kwargs['parameterplot'] = (Parameter.objects.using(db).get(name=pname).id, None)
+            count, count_secs, fetch_secs = time_scenario(db, db_kwargs, args.repeat)
+            print(f'{name[:50]:50s} {db[:40]:40s} {count:10d} {count_secs:9.3f} {fetch_secs:10.3f}')
@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+
+'''
+Time the reads that Base_Loader.load_trajectory() makes of a NetCDF file, the coordinates and
+then a strided slice of each data variable, with the file opened by the local backend of
+loaders/local_netcdf.py and through OPeNDAP from a pydap server on localhost serving the same
+file.  Both read the file the same way, the difference is the HTTP and DAP encoding overhead, e.g.:
+
+    tools/netcdf_benchmark.py --file Dorado389_2010_300_00_300_00_decim.nc --stride 2
+'''
+
+import django
+import os
+import sys
+import threading
+
+from statistics import median
+from timeit import default_timer
+from wsgiref.simple_server import WSGIRequestHandler, make_server
+
+# Insert Django App directory (parent of config) into python path
+sys.path.insert(0, os.path.abspath(os.path.join(
+                    os.path.dirname(__file__), "../")))
+if 'DJANGO_SETTINGS_MODULE' not in os.environ:
+    os.environ['DJANGO_SETTINGS_MODULE'] = 'config.settings.local'
+django.setup()
+
+from pydap.handlers.lib import BaseHandler
+from pydap.model import GridType
+from loaders.local_netcdf import open_dataset, open_file
+
+
+class QuietHandler(WSGIRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+def serve(path):
+    '''Serve the NetCDF file at path with pydap in a daemon thread and return its OPeNDAP URL
+    '''
+    server = make_server('localhost', 0, BaseHandler(open_file(path)), handler_class=QuietHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    return f'http://localhost:{server.server_port}/{os.path.basename(path)}'
+
+
+def read_all(url, stride):
+    '''Open url and read it as load_trajectory() does, return the number of values read
+    '''
+    ds = open_dataset(url)
+    count = 0
+    for name in ds.keys():
+        var = ds[name]
+        if isinstance(var, GridType):
+            var = var[name]
+        if not var.shape:
+            continue
+        count += var.data[0:var.shape[0]:stride].size
+
+    return count
+
+
+def time_reads(url, stride, repeat):
+    times = []
+    for _ in range(repeat):
+        start = default_timer()
+        count = read_all(url, stride)
+        times.append(default_timer() - start)
+
+    return count, median(times)
+
+
+if __name__ == '__main__':
+    import argparse
+    from argparse import RawTextHelpFormatter
+
+    parser = argparse.ArgumentParser(formatter_class=RawTextHelpFormatter, description=__doc__)
+    parser.add_argument('--file', action='store', required=True, help='Path of a local NetCDF file')
+    parser.add_argument('--stride', action='store', type=int, default=1, help='Stride of the reads')
+    parser.add_argument('--repeat', action='store', type=int, default=3, help='Number of times to read the file')
+    args = parser.parse_args()
+
+    print(f"{'Backend':10s} {'Values':>12s} {'Seconds':>9s} {'Values/s':>12s}")
+    for backend, url in (('Local', args.file), ('OPeNDAP', serve(args.file))):
+        count, secs = time_reads(url, args.stride, args.repeat)
+        print(f"{backend:10s} {count:12d} {secs:9.3f} {count / secs:12.0f}")
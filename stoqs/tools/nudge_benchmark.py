@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+
+'''
+Time InterpolatorWriter.nudge_coords() on a synthetic LRAUV nc4 file with dead reckoned positions
+every second and GPS fixes at regular intervals, and the finding of the dead reckoned points
+between each pair of fixes with one search of the sorted times against a comparison of all the
+times for each pair of fixes, as nudge_coords() did before, e.g.:
+
+    tools/nudge_benchmark.py --records 500000 --fixes 2000
+'''
+
+import django
+import os
+import shutil
+import sys
+import tempfile
+
+from argparse import Namespace
+from statistics import median
+from timeit import default_timer
+
+# Insert Django App directory (parent of config) into python path
+sys.path.insert(0, os.path.abspath(os.path.join(
+                    os.path.dirname(__file__), "../")))
+sys.path.insert(0, os.path.abspath(os.path.join(
+                    os.path.dirname(__file__), "../loaders")))
+if 'DJANGO_SETTINGS_MODULE' not in os.environ:
+    os.environ['DJANGO_SETTINGS_MODULE'] = 'config.settings.local'
+django.setup()
+
+import netCDF4
+import numpy as np
+import pandas as pd
+from CANON.toNetCDF.lrauvNc4ToNetcdf import InterpolatorWriter
+
+
+def write_nc4(path, records, fixes):
+    '''Write longitude and latitude in radians every second and fixes spread over the same time
+    '''
+    rng = np.random.default_rng(0)
+    secs = 1.6e9 + np.arange(records, dtype='f8')
+    fix_secs = np.linspace(secs[0] - 1, secs[-1] + 1, fixes)
+    with netCDF4.Dataset(path, 'w') as nc:
+        for name, t, degrees in (('longitude', secs, -122 + np.cumsum(rng.normal(0, 1e-5, records))),
+                                 ('latitude', secs, 36.8 + np.cumsum(rng.normal(0, 1e-5, records))),
+                                 ('longitude_fix', fix_secs, -122 + rng.normal(0, 1e-2, fixes)),
+                                 ('latitude_fix', fix_secs, 36.8 + rng.normal(0, 1e-2, fixes))):
+            nc.createDimension(f'{name}_time', len(t))
+            nc.createVariable(f'{name}_time', 'f8', (f'{name}_time',))[:] = t
+            nc.createVariable(name, 'f8', (f'{name}_time',))[:] = np.radians(degrees)
+
+    return pd.to_datetime(secs, unit='s'), pd.to_datetime(fix_secs, unit='s')
+
+
+def compare_segments(times, fix_times):
+    return [np.where(np.logical_and(times > fix_times[i], times < fix_times[i+1]))[0]
+                    for i in range(len(fix_times) - 1)]
+
+
+def time_it(func, repeat):
+    times = []
+    for _ in range(repeat):
+        start = default_timer()
+        result = func()
+        times.append(default_timer() - start)
+
+    return result, median(times)
+
+
+if __name__ == '__main__':
+    import argparse
+    from argparse import RawTextHelpFormatter
+
+    parser = argparse.ArgumentParser(formatter_class=RawTextHelpFormatter, description=__doc__)
+    parser.add_argument('--records', action='store', type=int, default=500000, help='Number of dead reckoned positions')
+    parser.add_argument('--fixes', action='store', type=int, default=2000, help='Number of GPS fixes')
+    parser.add_argument('--repeat', action='store', type=int, default=3, help='Number of times to time each')
+    args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmpdir, 'benchmark.nc4')
+        times, fix_times = write_nc4(path, args.records, args.fixes)
+        pw = InterpolatorWriter()
+        searched, search_secs = time_it(lambda: pw.fix_segments(times, fix_times), args.repeat)
+        compared, compare_secs = time_it(lambda: compare_segments(times, fix_times), args.repeat)
+        with netCDF4.Dataset(path) as pw.df:
+            _, nudge_secs = time_it(lambda: pw.nudge_coords(path, Namespace(remove_gps_outliers=False)), args.repeat)
+
+        print(f"{'Operation':25s} {'Seconds':>9s}")
+        print(f"{'Segments, searched':25s} {search_secs:9.3f}")
+        print(f"{'Segments, compared':25s} {compare_secs:9.3f}")
+        print(f"{'nudge_coords()':25s} {nudge_secs:9.3f}")
+        same = all(np.array_equal(s, c) for s, c in zip(searched, compared))
+        print(f'Segments are {"the same" if same else "DIFFERENT"}')
+    finally:
+        shutil.rmtree(tmpdir)
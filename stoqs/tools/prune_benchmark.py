@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+
+'''
+Time a selective parameter value query, with and without the Activity pruning of
+PQuery.pruneActivities().  The constraint is that the Parameter with the most
+MeasuredParameters exceeds the value reached by only the --fraction of Activities
+with the highest ActivityParameter max, so on a campaign with many Activities only
+a few of them can match, e.g.:
+
+    tools/prune_benchmark.py --db stoqs_canon_october2020 --fraction 0.05
+'''
+
+import django
+import os
+import sys
+
+from statistics import median
+from timeit import default_timer
+
+# Insert Django App directory (parent of config) into python path
+sys.path.insert(0, os.path.abspath(os.path.join(
+                    os.path.dirname(__file__), "../")))
+if 'DJANGO_SETTINGS_MODULE' not in os.environ:
+    os.environ['DJANGO_SETTINGS_MODULE'] = 'config.settings.local'
+django.setup()
+
+from django.db.models import Sum
+from django.http import HttpRequest
+from stoqs.models import Activity, ActivityParameter, MeasuredParameter
+from tools.mpquery_benchmark import default_kwargs
+from utils.PQuery import PQuery
+
+
+def constraint(db, fraction):
+    '''Return the selected Parameter id, a parameter value constraint satisfied in about
+    fraction of the Activities, and the number of those Activities
+    '''
+    parm = (ActivityParameter.objects.using(db).values('parameter__id', 'parameter__name')
+                                     .annotate(n=Sum('number')).order_by('-n').first())
+    maxes = list(ActivityParameter.objects.using(db).filter(parameter__id=parm['parameter__id'], max__isnull=False)
+                                  .order_by('-max').values_list('max', flat=True))
+    nacts = max(1, int(len(maxes) * fraction))
+    pmin = maxes[min(nacts, len(maxes) - 1)]
+
+    return parm['parameter__id'], [{parm['parameter__name']: (str(pmin), '')}], nacts
+
+
+def time_query(db, pq, qparams, pvDict, repeat):
+    times = []
+    for _ in range(repeat):
+        start = default_timer()
+        qs_mp = MeasuredParameter.objects.using(db).filter(**qparams).filter(pq.parameterValuesFilter(pvDict))
+        rows = len(list(qs_mp.values_list('id', flat=True)))
+        times.append(default_timer() - start)
+
+    return rows, median(times)
+
+
+if __name__ == '__main__':
+    import argparse
+    from argparse import RawTextHelpFormatter
+
+    parser = argparse.ArgumentParser(formatter_class=RawTextHelpFormatter, description=__doc__)
+    parser.add_argument('--db', action='store', required=True, help='Database alias')
+    parser.add_argument('--fraction', action='store', type=float, default=0.05, help='Fraction of Activities that may match')
+    parser.add_argument('--repeat', action='store', type=int, default=3, help='Number of times to run each query')
+    args = parser.parse_args()
+
+    pid, pvDict, nacts = constraint(args.db, args.fraction)
+    request = HttpRequest()
+    request.META = {'dbAlias': args.db}
+    pq = PQuery(request)
+    pq.kwargs = dict(default_kwargs(), measuredparametersgroup=[pid])
+    qparams = pq._getQueryParms()
+
+    print(f'Constraint {pvDict} may be met in {nacts} of {Activity.objects.using(args.db).count()} Activities')
+    pruned_rows, pruned_secs = time_query(args.db, pq, qparams, pvDict, args.repeat)
+    pq.pruneActivities = lambda *args, **kwargs: None
+    rows, secs = time_query(args.db, pq, qparams, pvDict, args.repeat)
+    print(f"{'':10s} {'Rows':>10s} {'Seconds':>9s}")
+    print(f"{'Unpruned':10s} {rows:10d} {secs:9.3f}")
+    print(f"{'Pruned':10s} {pruned_rows:10d} {pruned_secs:9.3f}")
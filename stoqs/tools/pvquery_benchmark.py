@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+
+'''
+Time MeasuredParameter selections with 1 to 6 simultaneous parameter value constraints
+built the old way, by rewriting Django's SQL string into self joins with
+stoqs.tests.unit_tests.addParameterValuesSelfJoins(), and the new way, with the parameterized EXISTS
+subqueries of PQuery.parameterValuesFilter().  The constraints are on the Parameters with
+the most MeasuredParameters in the database, each restricted to the middle half of its
+2.5 to 97.5 percentile range, e.g.:
+
+    tools/pvquery_benchmark.py --db stoqs_canon_october2020 --max_constraints 6
+'''
+
+import django
+import os
+import sys
+
+from statistics import median
+from timeit import default_timer
+
+# Insert Django App directory (parent of config) into python path
+sys.path.insert(0, os.path.abspath(os.path.join(
+                    os.path.dirname(__file__), "../")))
+if 'DJANGO_SETTINGS_MODULE' not in os.environ:
+    os.environ['DJANGO_SETTINGS_MODULE'] = 'config.settings.local'
+django.setup()
+
+from django.db import connections
+from django.db.models import Max, Min, Sum
+from django.http import HttpRequest
+from stoqs.models import ActivityParameter, MeasuredParameter
+from stoqs.tests.unit_tests import addParameterValuesSelfJoins
+from tools.mpquery_benchmark import default_kwargs
+from utils.PQuery import PQuery, PQuerySet
+from utils.utils import postgresifySQL
+
+
+def constraints(db, num):
+    '''Return the selected Parameter id and a list of num parameter value constraints
+    '''
+    parms = (ActivityParameter.objects.using(db).values('parameter__id', 'parameter__name')
+                                      .annotate(n=Sum('number')).order_by('-n')[:num])
+    pvDict = []
+    for parm in parms:
+        pmin, pmax = (ActivityParameter.objects.using(db).filter(parameter__id=parm['parameter__id'])
+                                        .aggregate(Min('p025'), Max('p975')).values())
+        pvDict.append({parm['parameter__name']: (str(pmin + (pmax - pmin) / 4), str(pmax - (pmax - pmin) / 4))})
+
+    return parms[0]['parameter__id'], pvDict
+
+
+def self_joins(db, pq, qparams, pvDict):
+    qs_mp = MeasuredParameter.objects.using(db).select_related(
+                'measurement__instantpoint__activity__platform').filter(**qparams)
+    sql = addParameterValuesSelfJoins(pq, postgresifySQL(str(qs_mp.query)), pvDict, pq.rest_select_items)
+    with connections[db].cursor() as cursor:
+        cursor.execute(sql)
+        return len(cursor.fetchall())
+
+
+def exists(db, pq, qparams, pvDict):
+    qs_mp = MeasuredParameter.objects.using(db).filter(**qparams).filter(pq.parameterValuesFilter(pvDict))
+    return len(list(qs_mp.values_list('id', *PQuerySet.rest_columns)))
+
+
+def time_query(func, db, pq, qparams, pvDict, repeat):
+    times = []
+    for _ in range(repeat):
+        start = default_timer()
+        rows = func(db, pq, qparams, pvDict)
+        times.append(default_timer() - start)
+
+    return rows, median(times)
+
+
+if __name__ == '__main__':
+    import argparse
+    from argparse import RawTextHelpFormatter
+
+    parser = argparse.ArgumentParser(formatter_class=RawTextHelpFormatter, description=__doc__)
+    parser.add_argument('--db', action='store', required=True, help='Database alias')
+    parser.add_argument('--max_constraints', action='store', type=int, default=6, help='Largest number of simultaneous constraints')
+    parser.add_argument('--repeat', action='store', type=int, default=3, help='Number of times to run each query')
+    args = parser.parse_args()
+
+    print(f"{'Constraints':>11s} {'Join rows':>10s} {'Join s':>9s} {'Exists rows':>11s} {'Exists s':>9s}")
+    for num in range(1, args.max_constraints + 1):
+        pid, pvDict = constraints(args.db, num)
+        request = HttpRequest()
+        request.META = {'dbAlias': args.db}
+        pq = PQuery(request)
+        pq.kwargs = dict(default_kwargs(), measuredparametersgroup=[pid])
+        qparams = pq._getQueryParms()
+
+        join_rows, join_secs = time_query(self_joins, args.db, pq, qparams, pvDict, args.repeat)
+        exists_rows, exists_secs = time_query(exists, args.db, pq, qparams, pvDict, args.repeat)
+        print(f'{len(pvDict):11d} {join_rows:10d} {join_secs:9.3f} {exists_rows:11d} {exists_secs:9.3f}')
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+
+'''
+Compare the time to read the parametertime series of each Activity and Parameter from the
+MeasuredParameter table, strided as STOQSQManager has done, with the time to read it from
+the ParameterTimeBucket pyramid of loaders/pyramid.py.  Build the pyramid first, e.g.:
+
+    loaders/pyramid.py --db stoqs_canon_october2020
+    tools/pyramid_benchmark.py --db stoqs_canon_october2020 --pixels 800
+'''
+
+import django
+import os
+import sys
+
+from statistics import median
+from timeit import default_timer
+
+# Insert Django App directory (parent of config) into python path
+sys.path.insert(0, os.path.abspath(os.path.join(
+                    os.path.dirname(__file__), "../")))
+if 'DJANGO_SETTINGS_MODULE' not in os.environ:
+    os.environ['DJANGO_SETTINGS_MODULE'] = 'config.settings.local'
+django.setup()
+
+from django.db.models import F, FloatField, Sum
+from loaders.pyramid import choose_level
+from stoqs.models import ActivityParameter, MeasuredParameter, ParameterTimeBucket
+
+
+def from_measuredparameters(db, ap, pixels):
+    qs_mp = MeasuredParameter.objects.using(db).filter(measurement__instantpoint__activity=ap.activity,
+                                                       parameter=ap.parameter)
+    stride = max(1, int(round(qs_mp.count() / pixels)))
+    qs_mp = qs_mp.values('measurement__instantpoint__timevalue', 'measurement__nominallocation__depth', 'datavalue')
+    return list(qs_mp.order_by('measurement__nominallocation__depth', 'measurement__instantpoint__timevalue')[::stride])
+
+
+def from_pyramid(db, ap, level):
+    qs = (ParameterTimeBucket.objects.using(db).filter(activity=ap.activity, parameter=ap.parameter, level=level)
+            .values('nominaldepth', 'timebucket')
+            .annotate(total=Sum('count'), wsum=Sum(F('mean') * F('count'), output_field=FloatField()))
+            .order_by('nominaldepth', 'timebucket'))
+    return list(qs)
+
+
+def time_read(func, db, ap, arg, repeat):
+    times = []
+    for _ in range(repeat):
+        start = default_timer()
+        rows = func(db, ap, arg)
+        times.append(default_timer() - start)
+
+    return len(rows), median(times)
+
+
+if __name__ == '__main__':
+    import argparse
+    from argparse import RawTextHelpFormatter
+
+    parser = argparse.ArgumentParser(formatter_class=RawTextHelpFormatter, description=__doc__)
+    parser.add_argument('--db', action='store', required=True, help='Database alias')
+    parser.add_argument('--pixels', action='store', type=int, default=800, help='Width of the parametertime plot')
+    parser.add_argument('--limit', action='store', type=int, default=20, help='Number of largest ActivityParameters to time')
+    parser.add_argument('--repeat', action='store', type=int, default=3, help='Number of times to run each query')
+    args = parser.parse_args()
+
+    print(f"{'Activity':50s} {'Parameter':30s} {'Level':>5s} {'MP rows':>8s} {'MP s':>8s} {'Pyr rows':>8s} {'Pyr s':>8s}")
+    for ap in (ActivityParameter.objects.using(args.db).select_related('activity', 'parameter')
+                                        .order_by('-number')[:args.limit]):
+        duration = (ap.activity.enddate - ap.activity.startdate).total_seconds()
+        level = choose_level(duration / args.pixels)
+        mp_rows, mp_secs = time_read(from_measuredparameters, args.db, ap, args.pixels, args.repeat)
+        if level is None:
+            print(f'{ap.activity.name[:50]:50s} {ap.parameter.name[:30]:30s} {"-":>5s} {mp_rows:8d} {mp_secs:8.3f}')
+            continue
+        pyr_rows, pyr_secs = time_read(from_pyramid, args.db, ap, level, args.repeat)
+        print(f'{ap.activity.name[:50]:50s} {ap.parameter.name[:30]:30s} {level:5d} {mp_rows:8d} {mp_secs:8.3f} '
+              f'{pyr_rows:8d} {pyr_secs:8.3f}')
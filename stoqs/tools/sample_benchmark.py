@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+
+'''
+Time the Sample heavy queries used by the STOQS UI against databases with legacy
+numeric(100, 30) and with double precision Sample.depth and SampledParameter.datavalue
+columns (see loaders/float_storage.py).  To compare before and after:
+
+    createdb -T stoqs_canon_october2020 stoqs_canon_october2020_float
+    loaders/float_storage.py --db stoqs_canon_october2020_float
+    tools/sample_benchmark.py --db stoqs_canon_october2020 stoqs_canon_october2020_float
+
+Each query is timed as it was written (values returned as stored, then converted to float
+as the plotting code does) and with the Cast to float done in the database.
+'''
+
+import django
+import os
+import sys
+
+from statistics import median
+from timeit import default_timer
+
+# Insert Django App directory (parent of config) into python path
+sys.path.insert(0, os.path.abspath(os.path.join(
+                    os.path.dirname(__file__), "../")))
+if 'DJANGO_SETTINGS_MODULE' not in os.environ:
+    os.environ['DJANGO_SETTINGS_MODULE'] = 'config.settings.local'
+django.setup()
+
+from django.db.models import FloatField
+from django.db.models.functions import Cast
+from loaders.float_storage import column_types
+from stoqs.models import Sample, SampledParameter
+
+
+def sample_depth_time(db, cast):
+    qs = Sample.objects.using(db)
+    if cast:
+        qs = qs.annotate(float_depth=Cast('depth', FloatField()))
+    qs = qs.values_list('instantpoint__timevalue', 'float_depth' if cast else 'depth',
+                        'instantpoint__activity__name', 'name').order_by('instantpoint__timevalue')
+    return [(t, float(d), a, n) for t, d, a, n in qs]
+
+
+def sampled_parameter_values(db, cast):
+    qs = SampledParameter.objects.using(db)
+    if cast:
+        qs = qs.annotate(float_depth=Cast('sample__depth', FloatField()),
+                         float_datavalue=Cast('datavalue', FloatField()))
+        qs = qs.values_list('parameter__name', 'float_depth', 'float_datavalue')
+    else:
+        qs = qs.values_list('parameter__name', 'sample__depth', 'datavalue')
+    return [(p, float(d), float(v)) for p, d, v in qs]
+
+
+def time_query(func, db, cast, repeat):
+    times = []
+    for _ in range(repeat):
+        start = default_timer()
+        rows = func(db, cast)
+        times.append(default_timer() - start)
+
+    return len(rows), median(times)
+
+
+if __name__ == '__main__':
+    import argparse
+    from argparse import RawTextHelpFormatter
+
+    parser = argparse.ArgumentParser(formatter_class=RawTextHelpFormatter, description=__doc__)
+    parser.add_argument('--db', action='store', nargs='+', required=True, help='Database aliases to compare')
+    parser.add_argument('--repeat', action='store', type=int, default=5, help='Number of times to run each query')
+    args = parser.parse_args()
+
+    print(f"{'Query':30s} {'Database':40s} {'Storage':16s} {'Cast':5s} {'Rows':>8s} {'Seconds':>9s}")
+    for func in (sample_depth_time, sampled_parameter_values):
+        for db in args.db:
+            storage = column_types(db)[('stoqs_sampledparameter', 'datavalue')]
+            for cast in (False, True):
+                rows, secs = time_query(func, db, cast, args.repeat)
+                print(f'{func.__name__:30s} {db[:40]:40s} {storage:16s} {str(cast):5s} {rows:8d} {secs:9.4f}')
@@ -0,0 +1,127 @@
+'''
+Cached directory of the Campaigns in all the databases in settings.DATABASES for the
+campaigns landing page.  Each database's entry is stored in the Django cache along with
+the time it was read.  Missing entries are read in parallel by a pool of threads, each with
+its own short-lived connection; stale entries are returned as they are and refreshed in the
+background so that page loads don't wait on a scan of all the databases.  The entry of a database
+that could not be read goes stale after retry_seconds instead of stale_seconds.
+'''
+
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DatabaseError, connections
+import stoqs.models as mod
+
+logger = logging.getLogger(__name__)
+
+CACHE_KEY = 'campaigndirectory_{}'
+
+
+class CampaignDirectory(object):
+    '''
+    Campaign descriptions, dates and CampaignResources keyed by database alias
+    '''
+    def __init__(self, max_workers=None, stale_seconds=None, fill_timeout=None, retry_seconds=None):
+        self.max_workers = max_workers or settings.CAMPAIGN_DIRECTORY_WORKERS
+        self.stale_seconds = stale_seconds if stale_seconds is not None else settings.CAMPAIGN_DIRECTORY_STALE_SECONDS
+        self.retry_seconds = retry_seconds if retry_seconds is not None else settings.CAMPAIGN_DIRECTORY_RETRY_SECONDS
+        self.fill_timeout = fill_timeout or settings.CAMPAIGN_DIRECTORY_FILL_TIMEOUT
+        self._executor = None
+        self._lock = threading.Lock()
+        self._refreshing = set()
+
+    @property
+    def executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers,
+                                                    thread_name_prefix='campaigndirectory')
+        return self._executor
+
+    def _read(self, dbAlias):
+        '''Read the Campaigns of dbAlias and their CampaignResources into a new cache entry.  They are
+        read again on every refresh because loaders may change them after the last Activity is loaded.
+        Runs in a worker thread that closes its connection.
+        '''
+        failed = False
+        try:
+            logger.debug("Getting Campaigns from dbAlias = %s", dbAlias)
+            resources = {}
+            for cr in mod.CampaignResource.objects.using(dbAlias).select_related('resource'):
+                resources.setdefault(cr.campaign_id, {})[cr.resource.name] = cr.resource.value
+            campaigns = []
+            for c in mod.Campaign.objects.using(dbAlias).all():
+                campaigns.append({'name': c.name, 'description': c.description,
+                                  'startdate': c.startdate, 'enddate': c.enddate,
+                                  'resources': resources.get(c.id, {})})
+        except DatabaseError:
+            # Will happen if database defined in privateSettings does not exist yet
+            logger.warning("Database alias %s returns django.db.DatabaseError", dbAlias)
+            campaigns = []
+            failed = True
+        finally:
+            connections[dbAlias].close()
+
+        entry = {'campaigns': campaigns, 'read_time': time.time(), 'failed': failed}
+        cache.set(CACHE_KEY.format(dbAlias), entry, timeout=None)
+
+        return entry
+
+    def _refresh(self, dbAlias):
+        try:
+            self._read(dbAlias)
+        except Exception:
+            logger.exception(f'Could not refresh campaign directory entry for {dbAlias}')
+        finally:
+            with self._lock:
+                self._refreshing.discard(dbAlias)
+
+    def _refresh_in_background(self, dbAlias):
+        with self._lock:
+            if dbAlias in self._refreshing:
+                return
+            self._refreshing.add(dbAlias)
+        self.executor.submit(self._refresh, dbAlias)
+
+    def campaigns(self, dbAliases=None):
+        '''Return dictionary of lists of Campaign dictionaries keyed by dbAlias.  Only the databases
+        that have never been read are waited for (up to fill_timeout seconds), stale entries are
+        returned and refreshed in the background.
+        '''
+        if dbAliases is None:
+            dbAliases = list(settings.DATABASES.keys())
+
+        entries = cache.get_many([CACHE_KEY.format(a) for a in dbAliases])
+        directory = {}
+        missing = {}
+        for dbAlias in dbAliases:
+            entry = entries.get(CACHE_KEY.format(dbAlias))
+            if entry is None:
+                missing[self.executor.submit(self._read, dbAlias)] = dbAlias
+                continue
+            max_age = self.retry_seconds if entry.get('failed') else self.stale_seconds
+            if time.time() - entry['read_time'] > max_age:
+                self._refresh_in_background(dbAlias)
+            directory[dbAlias] = entry['campaigns']
+
+        if missing:
+            logger.info(f'Reading Campaigns from {len(missing)} databases with {self.max_workers} threads')
+            done, not_done = wait(missing, timeout=self.fill_timeout)
+            for future in done:
+                directory[missing[future]] = future.result()['campaigns']
+            for future in not_done:
+                logger.warning(f'Campaigns of {missing[future]} not read within {self.fill_timeout} s, omitting for now')
+
+        return directory
+
+    def invalidate(self, dbAliases=None):
+        if dbAliases is None:
+            dbAliases = list(settings.DATABASES.keys())
+        cache.delete_many([CACHE_KEY.format(a) for a in dbAliases])
+
+
+campaign_directory = CampaignDirectory()
@@ -20,11 +20,13 @@ a Sample or a Measurement.
 @license: GPL
 '''
 from django.conf import settings
+from django.db.models import FloatField
+from django.db.models.functions import Cast
 from django.db.models.query import REPR_OUTPUT_SIZE, RawQuerySet, QuerySet
 from django.db import DatabaseError
 from datetime import datetime
 from stoqs.models import MeasuredParameter, Parameter, SampledParameter, ParameterGroupParameter, MeasuredParameterResource
-from .utils import postgresifySQL, getGet_Actual_Count, getParameterGroups
+from .utils import querysetSQL, plannerRowEstimate, getGet_Actual_Count, getParameterGroups
 from loaders import MEASUREDINSITU
 from loaders.SampleLoaders import SAMPLED
 from .PQuery import PQuery
@@ -87,7 +89,7 @@ class MPQuerySet(object):
         self.isRawQuerySet = False
         if query is None and qs_mp is not None:
             logger.debug('query is None and qs_mp is not None')
-            self.query = postgresifySQL(str(qs_mp.query))
+            self.query = querysetSQL(qs_mp)
             self.mp_query = qs_mp
         elif query is not None and qs_mp is None:
             logger.debug('query is not None and qs_mp is None')
@@ -303,7 +305,7 @@ class SPQuerySet(object):
         '''
         if query is None and qs_sp is not None:
             logger.debug('query is None and qs_sp is not None')
-            self.query = postgresifySQL(str(qs_sp.query))
+            self.query = querysetSQL(qs_sp)
             self.sp_query = qs_sp
         elif query is not None and qs_sp is None:
             logger.debug('query is not None and qs_sp is None')
@@ -340,12 +342,13 @@ class SPQuerySet(object):
         if minimal_values_list:
             # Likely for Flot contour plot
             try:
-                # Dictionaries
-                for mp in self.sp_query[:ITER_HARD_LIMIT]:
-                    row = { 'sample__depth': mp['sample__depth'],
+                # Dictionaries, cast in the database to avoid constructing Decimals from legacy numeric columns
+                for mp in self.sp_query.annotate(float_depth=Cast('sample__depth', FloatField()),
+                                                 float_datavalue=Cast('datavalue', FloatField()))[:ITER_HARD_LIMIT]:
+                    row = { 'sample__depth': mp['float_depth'],
                             'sample__instantpoint__timevalue': mp['sample__instantpoint__timevalue'],
                             'sample__instantpoint__activity__name': mp['sample__instantpoint__activity__name'],
-                            'datavalue': mp['datavalue'],
+                            'datavalue': mp['float_datavalue'],
                           }
                     yield row
 
@@ -660,30 +663,13 @@ class MPQuery(object):
             logger.debug('Adding parameter__id=%d filter to qs_mp', int(self.parameterID))
             qs_mp = qs_mp.filter(parameter__id=int(self.parameterID))
 
-        # Wrap MPQuerySet around either RawQuerySet or QuerySet to control the __iter__() items for lat/lon etc.
+        # Wrap MPQuerySet around the QuerySet to control the __iter__() items for lat/lon etc.
         if 'parametervalues' in self.kwargs:
             if self.kwargs['parametervalues']:
-                # Start with fresh qs_mp without .values()
-                qs_mp = MeasuredParameter.objects.using(self.request.META['dbAlias']).select_related(
-                            'measurement__instantpoint__activity__platform').filter(**qparams)
-                if self.parameterID:
-                    qs_mp = qs_mp.filter(parameter__id=int(self.parameterID))
-
-                if orderedFlag:
-                    qs_mp = qs_mp.order_by('measurement__instantpoint__activity__name', 'measurement__instantpoint__timevalue', 'parameter__name')
-
-                sql = postgresifySQL(str(qs_mp.query))
-                logger.debug('\n\nsql before query = %s\n\n', sql)
                 pq = PQuery(self.request)
-                sql = pq.addParameterValuesSelfJoins(sql, self.kwargs['parametervalues'], select_items=self.rest_select_items)
-                logger.debug('\n\nsql after parametervalue query = %s\n\n', sql)
-                qs_mpq = MPQuerySet(self.request.META['dbAlias'], sql, values_list)
-            else:
-                logger.debug('Building MPQuerySet with qs_mpquery = %s', str(qs_mp.query))
-                qs_mpq = MPQuerySet(self.request.META['dbAlias'], None, values_list, qs_mp=qs_mp)
-        else:
-            logger.debug('Building MPQuerySet with qs_mpquery = %s', str(qs_mp.query))
-            qs_mpq = MPQuerySet(self.request.META['dbAlias'], None, values_list, qs_mp=qs_mp)
+                qs_mp = qs_mp.filter(pq.parameterValuesFilter(self.kwargs['parametervalues'], tminmax=self.kwargs.get('time')))
+        logger.debug('Building MPQuerySet with qs_mpquery = %s', str(qs_mp.query))
+        qs_mpq = MPQuerySet(self.request.META['dbAlias'], None, values_list, qs_mp=qs_mp)
 
         if qs_mpq is None:
             logger.debug('qs_mpq.query = %s', str(qs_mpq.query))
@@ -724,26 +710,14 @@ class MPQuery(object):
         if orderedFlag:
             qs_sp = qs_sp.order_by('sample__instantpoint__activity__name', 'sample__instantpoint__timevalue', 'parameter__name')
 
-        # Wrap SPQuerySet around either RawQuerySet or QuerySet to control the __iter__() items for lat/lon etc.
+        # Wrap SPQuerySet around the QuerySet to control the __iter__() items for lat/lon etc.
         if 'parametervalues' in self.kwargs:
             if self.kwargs['parametervalues']:
-                # A depth of 4 is needed in order to see Platform
-                qs_sp = SampledParameter.objects.using(self.request.META['dbAlias']).select_related(
-                            'sample__instantpoint__activity__platform').filter(**qparams)
-                if orderedFlag:
-                    qs_sp = qs_sp.order_by('sample__instantpoint__activity__name', 'sample__instantpoint__timevalue', 'parameter__name')
-                sql = postgresifySQL(str(qs_sp.query))
-                logger.debug('\n\nsql before query = %s\n\n', sql)
                 pq = PQuery(self.request)
-                sql = pq.addParameterValuesSelfJoins(sql, self.kwargs['parametervalues'], select_items=self.sampled_rest_select_items)
-                logger.debug('\n\nsql after parametervalue query = %s\n\n', sql)
-                qs_spq = SPQuerySet(self.request.META['dbAlias'], sql, values_list)
-            else:
-                logger.debug('Building SPQuerySet for SampledParameter...')
-                qs_spq = SPQuerySet(self.request.META['dbAlias'], None, values_list, qs_sp=qs_sp)
-        else:
-            logger.debug('Building SPQuerySet for SampledParameter...')
-            qs_spq = SPQuerySet(self.request.META['dbAlias'], None, values_list, qs_sp=qs_sp)
+                qs_sp = qs_sp.filter(pq.parameterValuesFilter(self.kwargs['parametervalues'], 'sample__instantpoint',
+                                                          tminmax=self.kwargs.get('time')))
+        logger.debug('Building SPQuerySet for SampledParameter...')
+        qs_spq = SPQuerySet(self.request.META['dbAlias'], None, values_list, qs_sp=qs_sp)
 
         if qs_spq is None:
             logger.debug('qs_spq.query = %s', str(qs_spq.query))
@@ -773,6 +747,32 @@ class MPQuery(object):
         logger.debug('self._count = %d', self._count)
         return int(self._count)
 
+    def getMPCountEstimate(self, threshold=None):
+        '''
+        Return 2-tuple of the count of measured parameters giving the existing query and a flag that is
+        True if the count is the query planner's estimate.  Exact counts over the MeasuredParameter join
+        of large campaigns can take longer than everything else in the response, the estimate from
+        EXPLAIN takes milliseconds.  If the estimate is less than @threshold (default is
+        settings.COUNT_ESTIMATE_THRESHOLD) then the exact count from getMPCount() is returned.
+        '''
+        if threshold is None:
+            threshold = settings.COUNT_ESTIMATE_THRESHOLD
+
+        if not self._count:
+            dbAlias = self.request.META['dbAlias']
+            if self.initialQuery:
+                estimate = plannerRowEstimate(dbAlias, querysetSQL(MeasuredParameter.objects.using(dbAlias)))
+            else:
+                try:
+                    estimate = plannerRowEstimate(dbAlias, self.qs_mp_no_order.query)
+                except AttributeError as e:
+                    raise Exception('Could not get Measured Parameter count estimate: %s' % e)
+            logger.debug('estimate = %d, threshold = %d', estimate, threshold)
+            if estimate >= threshold:
+                return estimate, True
+
+        return self.getMPCount(), False
+
     def getLocalizedMPCount(self):
         '''
         Apply commas to the count number and return as a string
@@ -785,10 +785,8 @@ class MPQuery(object):
         Return SQL string that can be executed against the postgres database
         '''
         sql = 'Check "Get actual count" checkbox to see the SQL for your data selection'
-        if not self._count:
-            logger.debug('Calling self.getMPCount()...')
-            self._count = self.getMPCount()
-        if self._count:
+        count, _ = self.getMPCountEstimate()
+        if count:
             self.qs_mp = self.getMeasuredParametersQS(MPQuerySet.rest_columns)
             if self.qs_mp:
                 logger.debug('type(self.qs_mp) = %s', type(self.qs_mp))
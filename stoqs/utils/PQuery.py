@@ -14,11 +14,15 @@ The class hides the complexities of getting datavalues from both MeasuredParamet
 @license: GPL
 '''
 from django.conf import settings
+from django.core.exceptions import EmptyResultSet
+from django.db.models import Exists, OuterRef, Q
 from django.db.models.query import REPR_OUTPUT_SIZE, RawQuerySet, QuerySet
 from django.db import DatabaseError
 from datetime import datetime
-from stoqs.models import MeasuredParameter, Parameter, ParameterGroupParameter, MeasuredParameterResource
-from .utils import postgresifySQL, getGet_Actual_Count, EPOCH_STRING
+from psycopg2 import sql as psql
+from stoqs.models import (Activity, ActivityParameter, MeasuredParameter, SampledParameter, Parameter,
+                          ParameterGroupParameter, MeasuredParameterResource)
+from .utils import querysetSQL, getGet_Actual_Count, EPOCH_STRING
 from loaders.SampleLoaders import SAMPLED
 from loaders import MEASUREDINSITU
 import logging
@@ -67,16 +71,13 @@ class PQuerySet(object):
         appears to break the correct serialization of geometry types in the json response.
         Called by stoqs/views/__init__.py when MeasuredParameter REST requests are made.
         '''
-        self.query = query or postgresifySQL(str(qs_mp.query))
+        self.query = query or querysetSQL(qs_mp)
         self.values_list = values_list
         self.ordering = ('timevalue,')
         if qs_mp is None:
             self.mp_query = MeasuredParameter.objects.raw(query)
         else:
-            if qs_mp.exists():
-                self.mp_query = qs_mp
-            else:
-                self.mp_query = MeasuredParameter.objects.raw(query)
+            self.mp_query = qs_mp
  
     def __iter__(self): # pragma: no cover
         '''
@@ -279,6 +280,8 @@ class PQuery(object):
         '''
         self.request = request
         self.qs_mp = None
+        self.qs_mp_constrained = None
+        self.qparams = {}
         self.sql = None
         self._count = None
         self._Prows = []
@@ -371,26 +374,19 @@ class PQuery(object):
         of a values_list will break the JSON serialization of geometry types.
         '''
         qparams = self._getQueryParms()
+        self.qparams = qparams
+        qs_mp = MeasuredParameter.objects.using(self.request.META['dbAlias']).filter(**qparams)
+        if 'parametervalues' in self.kwargs:
+            if self.kwargs['parametervalues'] != [{}]:
+                qs_mp = qs_mp.filter(self.parameterValuesFilter(self.kwargs['parametervalues'], tminmax=self.kwargs.get('time')))
+
+        # Constrained QuerySet without .values() for building the Parameter-Parameter SQL
+        self.qs_mp_constrained = qs_mp
         if values_list:
-            qs_mp = MeasuredParameter.objects.using(self.request.META['dbAlias']
-                    ).filter(**qparams).values(*values_list)
-        else:
-            qs_mp = MeasuredParameter.objects.using(self.request.META['dbAlias']).filter(**qparams)
+            qs_mp = qs_mp.values(*values_list)
 
-        # Wrap PQuerySet around either RawQuerySet or QuerySet to control the __iter__() items for lat/lon etc.
+        # Wrap PQuerySet around the QuerySet to control the __iter__() items for lat/lon etc.
         qs_mpq = PQuerySet(None, values_list, qs_mp=qs_mp)
-        if 'parametervalues' in self.kwargs:
-            if self.kwargs['parametervalues'] != [{}]:
-                # A depth of 4 is needed in order to see Platform
-                qs_mp = MeasuredParameter.objects.using(
-                        self.request.META['dbAlias']).select_related(
-                                'measurement__instantpoint__activity__platform'
-                                ).filter(**qparams)
-                sql = postgresifySQL(str(qs_mp.query))
-                self.logger.debug('\n\nsql before query = %s\n\n', sql)
-                sql = self.addParameterValuesSelfJoins(sql, self.kwargs['parametervalues'], select_items=self.rest_select_items)
-                self.logger.debug('\n\nsql after parametervalue query = %s\n\n', sql)
-                qs_mpq = PQuerySet(sql, values_list)
 
         if qs_mpq:
             self.logger.debug('qs_mpq.query = %s', str(qs_mpq.query))
@@ -440,63 +436,82 @@ class PQuery(object):
 
         return sql
 
-    def _pvSQLfragments(self, pvDict):
+    def pruneActivities(self, pvDict, tminmax=None):
         '''
-        Given a list dictionary @pvDict of [{parameter: (pmin, pmax)}] return SQL fragments for the FROM and WHERE portions
-        of a query. Deal with both Measured Parameters and Sampled Paramters.
+        Planner step for parameter value queries: return a QuerySet of the Activities that may have data
+        satisfying every constraint in @pvDict, judged by the min and max of their ActivityParameters,
+        and that overlap the (start, end) @tminmax.  Activities without the statistics or dates needed
+        to judge them are kept.  Return None if there is nothing to prune them by.
         '''
-        add_to_from = ''
-        from_sql = '' 
-        where_sql = '' 
-        i = 0
+        dbAlias = self.request.META['dbAlias']
+        acts = Activity.objects.using(dbAlias)
         for pminmax in pvDict:
-            i = i + 1
-            # Experimenting in Aqua Data Studio, need to add SQL that looks like:
-            #    INNER JOIN stoqs_measurement m1 
-            #    ON m1.instantpoint_id = stoqs_instantpoint.id 
-            #        INNER JOIN stoqs_measuredparameter mp1 
-            #        ON mp1.measurement_id = m1.id 
-            #            INNER JOIN stoqs_parameter p1 
-            #            ON mp1.parameter_id = p1.id
-
-            for k,v in list(pminmax.items()):
-                if k in Parameter.objects.using(self.request.META['dbAlias']).values_list('name', flat=True):
-                    p = re.compile("[';]")
-                    if p.search(v[0]) or p.search(v[1]):
-                        # Prevent SQL injection attacks
-                        raise Exception('Invalid ParameterValue constraint expression: %s, %s' % (k, v))
-
-                    if self.isParameterMeasured(k):
-                        from_sql += 'INNER JOIN stoqs_measurement m' + str(i) + ' '
-                        from_sql += 'on m' + str(i) + '.instantpoint_id = stoqs_instantpoint.id '
-                        from_sql += 'INNER JOIN stoqs_measuredparameter mp' + str(i) + ' '
-                        from_sql += 'on mp' + str(i) + '.measurement_id = m' + str(i) + '.id '
-                        from_sql += 'INNER JOIN stoqs_parameter p' + str(i) + ' '
-                        from_sql += 'on mp' + str(i) + '.parameter_id = p' + str(i) + '.id '
-
-                        where_sql += "(p" + str(i) + ".name = '" + k + "') AND "
-                        if v[0]:
-                            where_sql += "(mp" + str(i) + ".datavalue > " + str(v[0]) + ") AND "
-                        if v[1]:
-                            where_sql += "(mp" + str(i) + ".datavalue < " + str(v[1]) + ") AND "
-                        where_sql += "(mp" + str(i) + ".parameter_id = p" + str(i) + ".id) AND "
-
-                    elif self.isParameterSampled(k): # pragma: no cover
-                        from_sql += 'INNER JOIN stoqs_sample s' + str(i) + ' '
-                        from_sql += 'on s' + str(i) + '.instantpoint_id = stoqs_instantpoint.id '
-                        from_sql += 'INNER JOIN stoqs_sampledparameter sp' + str(i) + ' '
-                        from_sql += 'on sp' + str(i) + '.sample_id = s' + str(i) + '.id '
-                        from_sql += 'INNER JOIN stoqs_parameter p' + str(i) + ' '
-                        from_sql += 'on sp' + str(i) + '.parameter_id = p' + str(i) + '.id '
-
-                        where_sql += "(p" + str(i) + ".name = '" + k + "') AND "
-                        if v[0]:
-                            where_sql += "(sp" + str(i) + ".datavalue > " + str(v[0]) + ") AND "
-                        if v[1]:
-                            where_sql += "(sp" + str(i) + ".datavalue < " + str(v[1]) + ") AND "
-                        where_sql += "(sp" + str(i) + ".parameter_id = p" + str(i) + ".id) AND "
-
-        return add_to_from, from_sql, where_sql
+            for name, (pmin, pmax) in list(pminmax.items()):
+                overlap = Q()
+                if pmin not in (None, ''):
+                    overlap &= Q(max__gt=float(pmin))
+                if pmax not in (None, ''):
+                    overlap &= Q(min__lt=float(pmax))
+                if not overlap:
+                    continue
+                # Keep the Activities whose statistics overlap and those without an ActivityParameter for name
+                aps = ActivityParameter.objects.using(dbAlias).filter(parameter__name=name)
+                in_range = Q(min__isnull=True) | Q(max__isnull=True)
+                acts = acts.filter(Q(id__in=aps.filter(in_range | overlap).values('activity_id')) |
+                                   ~Q(id__in=aps.values('activity_id')))
+
+        if tminmax:
+            if tminmax[1] is not None:
+                acts = acts.filter(startdate__lte=tminmax[1])
+            if tminmax[0] is not None:
+                acts = acts.filter(Q(enddate__isnull=True) | Q(enddate__gte=tminmax[0]))
+
+        if not acts.query.where:
+            return None
+
+        return acts
+
+    def parameterValuesFilter(self, pvDict, instantpoint='measurement__instantpoint', tminmax=None):
+        '''
+        Given a list dictionary @pvDict of [{parameter: (pmin, pmax)}] return a Q object of EXISTS subqueries
+        that restricts a MeasuredParameter QuerySet to the InstantPoints where each Parameter's datavalue is
+        between pmin and pmax.  Use @instantpoint='sample__instantpoint' to filter a SampledParameter QuerySet.
+        The values are passed as query parameters, so PostgreSQL can reuse the plan and there's no need for
+        the quoting and injection checks of the raw SQL self joins that this replaced.  A correlated EXISTS
+        on the Activities that pruneActivities() keeps for @pvDict and @tminmax lets PostgreSQL skip the
+        InstantPoints of the other Activities.
+        '''
+        dbAlias = self.request.META['dbAlias']
+        names = set(Parameter.objects.using(dbAlias).values_list('name', flat=True))
+        q = Q()
+        for pminmax in pvDict:
+            for name, (pmin, pmax) in list(pminmax.items()):
+                if name not in names:
+                    continue
+                if self.isParameterMeasured(name):
+                    sub = MeasuredParameter.objects.using(dbAlias).filter(
+                                measurement__instantpoint=OuterRef(instantpoint), parameter__name=name)
+                elif self.isParameterSampled(name):
+                    sub = SampledParameter.objects.using(dbAlias).filter(
+                                sample__instantpoint=OuterRef(instantpoint), parameter__name=name)
+                else:
+                    continue
+
+                try:
+                    if pmin not in (None, ''):
+                        sub = sub.filter(datavalue__gt=float(pmin))
+                    if pmax not in (None, ''):
+                        sub = sub.filter(datavalue__lt=float(pmax))
+                except (TypeError, ValueError):
+                    raise Exception('Invalid ParameterValue constraint expression: %s, %s' % (name, (pmin, pmax)))
+
+                q &= Exists(sub)
+
+        acts = self.pruneActivities(pvDict, tminmax)
+        if acts is not None:
+            q = Exists(acts.filter(id=OuterRef(instantpoint + '__activity'))) & q
+
+        return q
 
     def _getContainsFlags(self, select_order, pDict):
         '''
@@ -518,369 +533,129 @@ class PQuery(object):
    
         return containsMeasuredFlag, containsSampleFlag 
 
-    def addParameterValuesSelfJoins(self, query, pvDict, select_items= '''stoqs_instantpoint.timevalue as measurement__instantpoint__timevalue, 
-                                                                          stoqs_measurement.depth as measurement__depth,
-                                                                          stoqs_measurement.geom as measurement__geom,
-                                                                          stoqs_measuredparameter.datavalue as datavalue'''):
-        '''
-        Given a Postgresified MeasuredParameter query string @query' modify it to add the P self joins needed 
-        to restrict the data selection to the ParameterValues specified in @pvDict.  Add to the required
-        measuredparameter.id the select items in the comma separeated value string @select_items.
-        Return a Postgresified query string that can be used by Django's Manage.raw().
-        select_items can be altered as needed, examples:
-            For Flot contour plot we need just depth and time.
-            For KML output we need in addition: latitude, longitude, parameter name, and platform name
-            For REST we need about everything
-        '''
-        # Example original Postgresified SQL
-        #SELECT
-        #    stoqs_measuredparameter.id,
-        #    stoqs_measuredparameter.measurement_id,
-        #    stoqs_measuredparameter.parameter_id,
-        #    stoqs_measuredparameter.datavalue 
-        #FROM
-        #    stoqs_measuredparameter 
-        #        INNER JOIN stoqs_measurement 
-        #        ON (stoqs_measuredparameter.measurement_id = stoqs_measurement.id) 
-        #            INNER JOIN stoqs_instantpoint 
-        #            ON (stoqs_measurement.instantpoint_id = stoqs_instantpoint.id) 
-        #                INNER JOIN stoqs_parameter 
-        #                ON (stoqs_measuredparameter.parameter_id = stoqs_parameter.id) 
-        #                    INNER JOIN stoqs_activity 
-        #                    ON (stoqs_instantpoint.activity_id = stoqs_activity.id) 
-        #                        INNER JOIN stoqs_platform 
-        #                        ON (stoqs_activity.platform_id = stoqs_platform.id) 
-        #WHERE
-        #    (stoqs_instantpoint.timevalue <= '2012-09-13 18:19:04' AND
-        #    stoqs_instantpoint.timevalue >= '2012-09-13 05:16:48' AND
-        #    stoqs_parameter.name IN ('temperature') AND
-        #    stoqs_measurement.depth >= -5.66 AND
-        #    stoqs_platform.name IN ('dorado') AND
-        #    stoqs_measurement.depth <= 153.85 )
-
-        # Example Self-join SQL to insert into the string
-        #select
-        #    stoqs_measuredparameter.datavalue,
-        #    stoqs_parameter_1.name              as name_1,
-        #    stoqs_measuredparameter_1.datavalue as datavalue_1,
-        #    stoqs_measuredparameter_1.datavalue as datavalue_1b,
-        #    stoqs_parameter.name 
-        #from
-        #    stoqs_measuredparameter stoqs_measuredparameter_1 
-        #        inner join stoqs_parameter stoqs_parameter_1 
-        #        on stoqs_measuredparameter_1.parameter_id = stoqs_parameter_1.id 
-        #            inner join stoqs_measuredparameter 
-        #            stoqs_measuredparameter 
-        #            on stoqs_measuredparameter_1.measurement_id = 
-        #            stoqs_measuredparameter.measurement_id 
-        #                inner join stoqs_parameter stoqs_parameter 
-        #                on stoqs_parameter.id = stoqs_measuredparameter.
-        #                parameter_id 
-        #where
-        #    (stoqs_parameter_1.name ='sea_water_sigma_t') and
-        #    (stoqs_measuredparameter_1.datavalue >24.5) and
-        #    (stoqs_measuredparameter_1.datavalue <25.0) and
-        #    (stoqs_parameter.name ='temperature')
-
-        # Used by getParameterPlatformDatavaluePNG(): 'measurement__instantpoint__timevalue', 'measurement__depth', 'datavalue
-        # Used by REST requests in stoqs/views/__init__(): stoqs_parameter.name, stoqs_parameter.standard_name, stoqs_measurement.depth, stoqs_measurement.geom, stoqs_instantpoint.timevalue, stoqs_platform.name, stoqs_measuredparameter.datavalue, stoqs_parameter.units
-
-        q = query
-
-        add_to_from, from_sql, where_sql = self._pvSQLfragments(pvDict)
+    def _ppBaseQS(self, sampleOnly):
+        '''
+        Return the QuerySet of the current constraints to use as the subquery of parameterParameterSQL(),
+        for Sampled only selections the MeasuredParameter constraints are translated to SampledParameters
+        '''
+        if self.qs_mp_constrained is None:
+            self.getMeasuredParametersQS()
+        if not sampleOnly:
+            return self.qs_mp_constrained
 
-        select_items = select_items.replace('stoqs_parameter', 'p1')
-        if add_to_from or from_sql or where_sql:
-            # Raw query must include the primary key
-            if q.find('FROM stoqs_sampledparameter') != -1:
-                select_items = 'stoqs_sampledparameter.id, ' + select_items
-            else:
-                select_items = 'stoqs_measuredparameter.id, ' + select_items
-   
-            p = re.compile('SELECT .+? FROM')
-            q = p.sub('SELECT ' + select_items + ' FROM', q, count=1)
-            q = q.replace('SELECT FROM stoqs_measuredparameter', 'FROM ' + add_to_from + 'stoqs_measuredparameter')
-            q = q.replace('FROM stoqs_measuredparameter', 'FROM ' + add_to_from + 'stoqs_measuredparameter')
-            if q.find('WHERE') != -1:
-                q = q.replace('WHERE', from_sql + ' WHERE ' + where_sql, 1)
-            else:
-                q += from_sql + ' WHERE ' + where_sql
-                q = q[:-4]                              # Remove last 'AND '
+        # MeasuredParameterResource labels (the id__in constraint) apply only to MeasuredParameters
+        qparams = {k.replace('measurement__', 'sample__', 1): v for k, v in list(self.qparams.items()) if k != 'id__in'}
+        qs_sp = SampledParameter.objects.using(self.request.META['dbAlias']).filter(**qparams)
+        if self.kwargs.get('parametervalues', [{}]) != [{}]:
+            qs_sp = qs_sp.filter(self.parameterValuesFilter(self.kwargs['parametervalues'], 'sample__instantpoint',
+                                                            tminmax=self.kwargs.get('time')))
 
-        return q
+        return qs_sp
 
-    def addParameterParameterSelfJoins(self, query, pDict):
+    def parameterParameterSQL(self, pDict, latlonFlag=False, idsFlag=False, sampleFlag=False):
         '''
-        Given a Postgresified MeasuredParameter query string @query modify it to add the P self joins needed 
-        to return up to 4 parameter data values from the same measurements. The Parameter ids are specified
-        by the integer values in @pList.  The original @query string may be one that is modified by 
-        self.addParameterValuesSelfJoins() or not.  
-        Return a Postgresified query string that can be used by Django's Manage.raw().
+        Compose with psycopg2.sql a query that returns depth and up to 4 parameter data values (x, y, z, c)
+        from the same InstantPoints for the Parameter ids or coordinate names in @pDict.  Each axis gets its
+        own aliased join and the current constraints are applied with a parameterized subquery of the
+        QuerySet built by getMeasuredParametersQS(), so nothing is parsed out of Django's SQL string.
+        @latlonFlag adds lon and lat columns, @idsFlag adds the x and y datavalue ids (for MeasuredParameters)
+        before them, and @sampleFlag returns just the x and y values where there are Samples followed
+        by the Sample name.  Return the Composed query and its list of parameters for cursor.execute().
         Written for use by utils.Viz.ParamaterParameter()
-
-    Example query to emulate (designed in Aqua Data Studio Query Builder and Query Analyzer):
-
-SELECT
-    mp_x.datavalue AS x,
-    sp_y.datavalue AS y, 
-    mp_c.datavalue AS c
-FROM
-    stoqs_sample 
-        INNER JOIN stoqs_instantpoint 
-        ON stoqs_sample.instantpoint_id = stoqs_instantpoint.id 
-            INNER JOIN stoqs_measurement 
-            ON stoqs_instantpoint.id = stoqs_measurement.instantpoint_id 
-                INNER JOIN stoqs_activity 
-                ON stoqs_instantpoint.activity_id = stoqs_activity.id 
-                    INNER JOIN stoqs_platform 
-                    ON stoqs_activity.platform_id = stoqs_platform.id 
-
-                        INNER JOIN stoqs_sampledparameter sp_y
-                        ON sp_y.sample_id = stoqs_sample.id 
-                            INNER JOIN stoqs_parameter p_y 
-                            ON sp_y.parameter_id = p_y.id 
-
-                                INNER JOIN stoqs_measuredparameter mp_x
-                                ON mp_x.measurement_id = stoqs_measurement.id 
-                                    INNER JOIN stoqs_parameter p_x
-                                    ON mp_x.parameter_id = p_x.id 
-
-                                        INNER JOIN stoqs_measuredparameter mp_c 
-                                        ON mp_c.measurement_id = stoqs_measurement.id 
-                                            INNER JOIN stoqs_parameter p_c
-                                            ON mp_c.parameter_id = p_c.id 
-WHERE
-    ("stoqs_platform"."name" ='dorado') AND
-    (p_x.id =6) AND
-    (p_c.id =7) AND
-    (p_y.id =57)
-
-
-For sampledparameter to sampledparamter query an example is:
-
-  SELECT DISTINCT s_x.depth, sp_x.datavalue as x, sp_y.datavalue as y, p_x.id as px, p_y.id as py FROM stoqs_activity
-    INNER JOIN stoqs_instantpoint ip
-      on ip.activity_id = stoqs_activity.id
-      INNER JOIN stoqs_sample s_x
-        on s_x.instantpoint_id = ip.id
-          INNER JOIN stoqs_sample s_y
-            on s_y.instantpoint_id = ip.id
-              INNER JOIN stoqs_sampledparameter sp_y
-                on sp_y.sample_id = s_y.id
-                  INNER JOIN stoqs_parameter p_y
-                    on sp_y.parameter_id = p_y.id
-                      INNER JOIN stoqs_sampledparameter sp_x
-                        on sp_x.sample_id = s_x.id
-                          INNER JOIN stoqs_parameter p_x
-                            on sp_x.parameter_id = p_x.id
-    WHERE (p_y.id = 10) AND (p_x.id = 8);
-
-        '''
-
-        self.logger.debug('initial query = %s', query)
-
+        '''
         select_order = ('x', 'y', 'z', 'c')
         containsMeasuredFlag, containsSampleFlag = self._getContainsFlags(select_order, pDict)
-
-        # Construct SELECT strings, must be in proper order, include depth for possible sigma-t calculation
-        xyzc_items = ''
-        for axis in select_order:
-            if axis in pDict:
-                if pDict[axis]:
-                    try:
-                        if self.isParameterMeasured(int(pDict[axis])):
-                            xyzc_items = xyzc_items + 'mp_' + axis + '.datavalue as ' + axis + ', '
-                        elif self.isParameterSampled(int(pDict[axis])):
-                            xyzc_items = xyzc_items + 'sp_' + axis + '.datavalue as ' + axis + ', '
-                        else:
-                            # Default is to assume mp - supports legacy databases w/o the ParameterGroup assignment
-                            xyzc_items = xyzc_items + 'mp_' + axis + '.datavalue as ' + axis + ', '
-                    except ValueError as e:
-                        if pDict[axis] == 'longitude':
-                            if containsSampleFlag and not containsMeasuredFlag:
-                                xyzc_items = xyzc_items + 'ST_X(stoqs_sample.geom) as ' + axis + ', '
-                            else:
-                                xyzc_items = xyzc_items + 'ST_X(stoqs_measurement.geom) as ' + axis + ', '
-                        elif pDict[axis] == 'latitude':
-                            if containsSampleFlag and not containsMeasuredFlag:
-                                xyzc_items = xyzc_items + 'ST_Y(stoqs_sample.geom) as ' + axis + ', '
-                            else:
-                                xyzc_items = xyzc_items + 'ST_Y(stoqs_measurement.geom) as ' + axis + ', '
-                        elif pDict[axis] == 'depth':
-                            if containsSampleFlag and not containsMeasuredFlag:
-                                xyzc_items = xyzc_items + 'stoqs_sample.depth as ' + axis + ', '
-                            else:
-                                xyzc_items = xyzc_items + 'stoqs_measurement.depth as ' + axis + ', '
-                        elif pDict[axis] == 'time':
-                            xyzc_items += "(DATE_PART('day', stoqs_instantpoint.timevalue - timestamp '%s') * 86400 + " % EPOCH_STRING
-                            xyzc_items += "DATE_PART('hour', stoqs_instantpoint.timevalue - timestamp '%s') * 3600 + " % EPOCH_STRING
-                            xyzc_items += "DATE_PART('minute', stoqs_instantpoint.timevalue - timestamp '%s') * 60 + " % EPOCH_STRING
-                            xyzc_items += "DATE_PART('second', stoqs_instantpoint.timevalue - timestamp '%s') ) / 86400 " % EPOCH_STRING
-                            xyzc_items += ' as ' + axis + ', '  
-                        else:
-                            logger.error('%s, but axis = %s is not a coordinate', e, pDict[axis])
-
-        # Identify the appropriate depth for the SELECT
-        if containsSampleFlag and not containsMeasuredFlag:
-            # Only Sampled
-            depth_item = 'DISTINCT stoqs_sample.depth, '
+        sampleOnly = containsSampleFlag and not containsMeasuredFlag
+        if sampleOnly:
+            base, base_fk, loc = 'stoqs_sampledparameter', 'sample_id', 'stoqs_sample'
+            # Cast in the database, avoiding Decimal construction for legacy numeric Sample columns
+            depth = psql.SQL('{}.depth::double precision').format(psql.Identifier(loc))
         else:
-            # Only Measured -or- Sampled and Measured
-            depth_item = 'DISTINCT stoqs_measurement.depth, '
-
-        add_to_from = ''
-        select_items = depth_item + xyzc_items
-
-        # Construct INNER JOINS and WHERE sql for Sampled and Measured Parameter selections
-        # Use aliases for joins on each axis
-        where_sql = '' 
-        for axis, pid in list(pDict.items()):
-            if pid:
-                self.logger.debug('axis, pid = %s, %s', axis, pid)
-                add_to_from += '\n'
-                try:
-                    if self.isParameterMeasured(int(pid)):
-                        add_to_from += '\nINNER JOIN stoqs_measurement m_' + axis + ' '
-                        add_to_from += '\non m_' + axis + '.instantpoint_id = stoqs_instantpoint.id'
-                        add_to_from += '\nINNER JOIN stoqs_measuredparameter mp_' + axis + ' '
-                        add_to_from += '\non mp_' + axis + '.measurement_id = m_' + axis + '.id '
-                        add_to_from += '\nINNER JOIN stoqs_parameter p_' + axis + ' '
-                        add_to_from += '\non mp_' + axis + '.parameter_id = p_' + axis + '.id '
-                    elif self.isParameterSampled(int(pid)):
-                        add_to_from += '\nINNER JOIN stoqs_sample s_' + axis + ' '
-                        add_to_from += '\non s_' + axis + '.instantpoint_id = stoqs_instantpoint.id'
-                        add_to_from += '\nINNER JOIN stoqs_sampledparameter sp_' + axis + ' '
-                        add_to_from += '\non sp_' + axis + '.sample_id = s_' + axis + '.id '
-                        add_to_from += '\nINNER JOIN stoqs_parameter p_' + axis + ' '
-                        add_to_from += '\non sp_' + axis + '.parameter_id = p_' + axis + '.id '
-                    else:
-                        self.logger.warn('Encountered parameter (id=%s) that is not in the Measured nor in the Sampled ParameterGroup', pid)
-                    where_sql = where_sql + '(p_' + axis + '.id = ' + str(pid) + ') AND '
-                except ValueError:
-                    # pid likely a coordinate, ignore
-                    pass
-
-        # Modify original SQL with new joins and where sql - almost a total rewrite
-        # - Need to preserve subqueries with their own FROM and WHERE words
-        q = query
-        select_items = select_items[:-2] + ' '                      # Remove ', '
-        q = 'SELECT ' + select_items + q[q.find('FROM'):]           # Override original select items, finds first FROM which is what we want
-
-        if q.find('WHERE') == -1 and where_sql:
-            # Case where no filters applied from UI - no selections and no WHERE clause, add ours
-            q += ' WHERE ' + where_sql[:-4]                         # Remove last 'AND '
-        else:
-            # Insert our WHERE clause into the filters that are in the original query
-            self.logger.debug('q = %s', q)
-            q = q.replace(' WHERE ', ' WHERE ' + where_sql, 1)      # Replace only first occurance to preserve subquery
-
-        # Brute-force fixup of query string to deal with Sample-only query
-        if containsSampleFlag and not containsMeasuredFlag:
-            q = q.replace('FROM stoqs_measuredparameter', 'FROM stoqs_sampledparameter')
-            q = q.replace('INNER JOIN stoqs_measurement ON (stoqs_measuredparameter.measurement_id = stoqs_measurement.id)', 
-                          'INNER JOIN stoqs_sample ON (stoqs_sampledparameter.sample_id = stoqs_sample.id)')
-            q = q.replace('INNER JOIN stoqs_instantpoint ON (stoqs_measurement.instantpoint_id = stoqs_instantpoint.id)',
-                          'INNER JOIN stoqs_instantpoint ON (stoqs_sample.instantpoint_id = stoqs_instantpoint.id)')
-            q = q.replace('INNER JOIN stoqs_parameter ON (stoqs_measuredparameter.parameter_id = stoqs_parameter.id)',
-                          'INNER JOIN stoqs_parameter ON (stoqs_sampledparameter.parameter_id = stoqs_parameter.id)')
-            q = q.replace('AND stoqs_measurement.depth', 'AND stoqs_sample.depth')
-
-        # Add stoqs_measurement inner join if missing and needed for the select
-        if select_items.find('stoqs_measurement') != -1:
-            p = re.compile('FROM stoqs_measuredparameter.* stoqs_measurement')
-            if not p.search(q):
-                put_before = ' inner join stoqs_measurement on stoqs_measurement.id = stoqs_measuredparameter.measurement_id '
-                put_before += ' inner join stoqs_instantpoint on stoqs_measurement.instantpoint_id = stoqs_instantpoint.id ' 
-                add_to_from = put_before + add_to_from
-    
-        # Add stoqs_sample inner join if missing and needed for the select
-        if select_items.find('stoqs_sample') != -1:
-            p = re.compile('FROM stoqs_sampledparameter.* stoqs_sample')
-            if not p.search(q):
-                put_before = ' inner join stoqs_sample on stoqs_sample.id = stoqs_sampledparameter.sample_id '
-                put_before += ' inner join stoqs_instantpoint on stoqs_sample.instantpoint_id = stoqs_instantpoint.id ' 
-                add_to_from = put_before + add_to_from
-
-        if q.lower().find('where') == -1:
-            q += add_to_from
-        else:
-            q = q.replace(' WHERE ', add_to_from + ' WHERE ', 1)    # Replace only first occurance to preserve subquery
-
-        self.logger.debug('q = %s', q)
-        q = sqlparse.format(q, reindent=True, keyword_case='upper')
-
-        return q
-
-    def addSampleConstraint(self, query):
-        '''
-        Modify query to get sample informtation
-        '''
-        # Modified to return just depth, x, y points for places where there are samples (new SQL is all lower case):
-        # 
-        # SELECT DISTINCT stoqs_measurement.depth,
-        #                 mp_x.datavalue AS x,
-        #                 mp_y.datavalue AS y
-        # FROM stoqs_activity
-        # INNER JOIN stoqs_platform ON stoqs_platform.id = stoqs_activity.platform_id
-        # INNER JOIN stoqs_instantpoint ON stoqs_instantpoint.activity_id = stoqs_activity.id
-        # INNER JOIN stoqs_measurement ON stoqs_measurement.instantpoint_id = stoqs_instantpoint.id
-        # INNER JOIN stoqs_measurement m_y ON m_y.instantpoint_id = stoqs_instantpoint.id
-        # INNER JOIN stoqs_measuredparameter mp_y ON mp_y.measurement_id = m_y.id
-        # INNER JOIN stoqs_parameter p_y ON mp_y.parameter_id = p_y.id
-        # INNER JOIN stoqs_measurement m_x ON m_x.instantpoint_id = stoqs_instantpoint.id
-        # INNER JOIN stoqs_measuredparameter mp_x ON mp_x.measurement_id = m_x.id
-        # INNER JOIN stoqs_parameter p_x ON mp_x.parameter_id = p_x.id
-        # 
-        # inner join stoqs_sample on stoqs_sample.instantpoint_id = stoqs_instantpoint.id
-        # 
-        # WHERE (p_y.id = 8)
-        #   AND (p_x.id = 6)
-        # 
-        #   and stoqs_sample.id is not null;
-        # 
-        #        depth       |          x          |          y           
-        # -------------------+---------------------+----------------------
-        #  -0.85070807630861 |  0.0150373139209564 | 0.000853291921996732
-        #   20.8333460743087 | 0.00611123921903796 | 0.000356326309018604
-        #   47.0254516097659 |  0.0166342378584501 | 0.000125864557424297
-        #   41.0084011951115 |  0.0106893958691858 | 0.000111319997500448
-        #   20.7215864415311 |  0.0027162356341817 |  0.00029715946267329
-        #   9.18344644259678 | 0.00478679339998439 | 0.000845079474062416
-        # (6 rows)
-
-        q = query
-
-        # Remove any color and z selections
-        p = re.compile(',\s.+datavalue AS c')
-        q = p.sub(' ', q)
-        p = re.compile(',\s.+datavalue AS z')
-        q = p.sub(' ', q)
-
-        # Add sample name to SELECT for labeling the Parameter-Parameter plot
-        q = q.replace('FROM', ', stoqs_sample.name FROM', 1)                # Replace just first occurance
-
-        # Make sure we are getting stoqs_sample in our query - warning: very hackish
-        if q.find('FROM stoqs_measuredparameter') != -1:
-            if q.lower().find('inner join stoqs_sample on') == -1 :
-                add_to_from = ''
-                if q.lower().find('inner join stoqs_measurement on ') == -1:
-                    add_to_from += ' inner join stoqs_measurement on stoqs_measurement.instantpoint_id = stoqs_instantpoint.id'
-                add_to_from += ' inner join stoqs_sample on stoqs_sample.instantpoint_id = stoqs_instantpoint.id'
-                if q.lower().find('where') == -1:
-                    # No where clause, so add the inner joins we need - a bit of a hack
-                    q += add_to_from + ' WHERE'
+            base, base_fk, loc = 'stoqs_measuredparameter', 'measurement_id', 'stoqs_measurement'
+            depth = psql.SQL('{}.depth').format(psql.Identifier(loc))
+
+        items = []
+        item_params = []
+        joins = []
+        join_params = []
+        ids = []
+        for axis in select_order:
+            if not pDict.get(axis):
+                continue
+            try:
+                pid = int(pDict[axis])
+            except ValueError:
+                # A coordinate rather than a Parameter id
+                if pDict[axis] == 'longitude':
+                    item = psql.SQL('ST_X({}.geom)').format(psql.Identifier(loc))
+                elif pDict[axis] == 'latitude':
+                    item = psql.SQL('ST_Y({}.geom)').format(psql.Identifier(loc))
+                elif pDict[axis] == 'depth':
+                    item = depth
+                elif pDict[axis] == 'time':
+                    item = psql.SQL('EXTRACT(EPOCH FROM stoqs_instantpoint.timevalue - %s::timestamp) / 86400')
+                    if not sampleFlag or axis in ('x', 'y'):
+                        item_params.append(EPOCH_STRING)
                 else:
-                    q = q.replace('WHERE', add_to_from + ' WHERE', 1)       # Replace just first occurance
-
-            if not q.strip().lower().endswith('where'):
-                q += ' and '
-    
-            q += ' stoqs_sample.id is not null'
+                    self.logger.error('axis = %s is not a coordinate', pDict[axis])
+                    continue
+            else:
+                if self.isParameterSampled(pid) and not self.isParameterMeasured(pid):
+                    loc_alias, dv_alias = psql.Identifier('s_' + axis), psql.Identifier('sp_' + axis)
+                    joins.append(psql.SQL('INNER JOIN stoqs_sample {s} ON {s}.instantpoint_id = stoqs_instantpoint.id '
+                                          'INNER JOIN stoqs_sampledparameter {sp} ON {sp}.sample_id = {s}.id '
+                                          'AND {sp}.parameter_id = %s').format(s=loc_alias, sp=dv_alias))
+                    item = psql.SQL('{}.datavalue::double precision').format(dv_alias)
+                else:
+                    # Default is to assume mp - supports legacy databases w/o the ParameterGroup assignment
+                    loc_alias, dv_alias = psql.Identifier('m_' + axis), psql.Identifier('mp_' + axis)
+                    joins.append(psql.SQL('INNER JOIN stoqs_measurement {m} ON {m}.instantpoint_id = stoqs_instantpoint.id '
+                                          'INNER JOIN stoqs_measuredparameter {mp} ON {mp}.measurement_id = {m}.id '
+                                          'AND {mp}.parameter_id = %s').format(m=loc_alias, mp=dv_alias))
+                    item = psql.SQL('{}.datavalue').format(dv_alias)
+                join_params.append(pid)
+                if axis in ('x', 'y'):
+                    ids.append(psql.SQL('{}.id').format(dv_alias))
+
+            # Sample points are plotted on just the x and y axes
+            if not sampleFlag or axis in ('x', 'y'):
+                items.append(psql.SQL('{} AS {}').format(item, psql.Identifier(axis)))
+
+        columns = []
+        if idsFlag and not sampleOnly:
+            columns.extend(ids)
+        geom = psql.Identifier('stoqs_sample' if sampleFlag else loc)
+        if latlonFlag:
+            columns.append(psql.SQL('ST_X({g}.geom) AS lon, ST_Y({g}.geom) AS lat').format(g=geom))
+        columns.append(depth)
+        columns.extend(items)
+        if sampleFlag:
+            columns.append(psql.SQL('stoqs_sample.name'))
+
+        from_sql = psql.SQL('FROM {base} INNER JOIN {loc} ON {base}.{fk} = {loc}.id '
+                            'INNER JOIN stoqs_instantpoint ON {loc}.instantpoint_id = stoqs_instantpoint.id').format(
+                                base=psql.Identifier(base), loc=psql.Identifier(loc), fk=psql.Identifier(base_fk))
+        if sampleFlag and not sampleOnly:
+            joins.insert(0, psql.SQL('INNER JOIN stoqs_sample ON stoqs_sample.instantpoint_id = stoqs_instantpoint.id'))
+
+        where_sql = psql.SQL('')
+        where_params = []
+        base_qs = self._ppBaseQS(sampleOnly)
+        if base_qs.query.where:
+            try:
+                sub_sql, where_params = base_qs.values('id').query.sql_with_params()
+            except EmptyResultSet:
+                where_sql = psql.SQL(' WHERE FALSE')
+            else:
+                where_sql = psql.SQL(' WHERE {}.id IN ({})').format(psql.Identifier(base), psql.SQL(sub_sql))
 
-        self.logger.debug('q = %s', q)
-        q = sqlparse.format(q, reindent=True, keyword_case='upper')
+        query = psql.SQL('SELECT DISTINCT {columns} {from_sql} {joins}{where}').format(
+                        columns=psql.SQL(', ').join(columns), from_sql=from_sql,
+                        joins=psql.SQL(' ').join(joins), where=where_sql)
+        params = item_params + join_params + list(where_params)
+        self.logger.debug('query = %s, params = %s', query, params)
 
-        return q
+        return query, params
 
     @staticmethod
     def addPrimaryKey(query, table='stoqs_measuredparameter'):
@@ -8,16 +8,21 @@ Mike McCann
 MBARI 26 February 2021
 """
 
+import hashlib
 import os
 import sys
 import logging
+import numpy as np
 import pandas as pd
 import psutil
 import tempfile
 import warnings
+from collections import OrderedDict, defaultdict
 from django.db import connections
+from psycopg2 import sql as psql
 from stoqs.models import Platform
 from time import time
+from .utils import plannerRowEstimate
 
 logger = logging.getLogger(__name__)
 
@@ -30,15 +35,91 @@ class Columnar():
 
     # Set to GB of RAM that have been resourced to the Docker engine
     MAX_CONTAINER_MEMORY = psutil.virtual_memory().total / 1024 / 1024 / 1024
-    DF_TO_RAM_FACTOR = 12.3
+
+    # Rows of the selection read to time the extraction, preview it and measure the bytes of each record
+    SAMPLE_SIZE = 100
+    # Bytes of libpq's PGresAttValue (see libpq-int.h), an int length and a char pointer, for each field
+    PG_VALUE_BYTES = 16
+    # About how many Measurements are sampled to find how many columns of a pivoted row are filled
+    COOCCURRENCE_SAMPLE = 10000
+    # Execute statements through server-side prepared statements, one per shape of export and connection,
+    # keeping the most recently used MAX_PREPARED_STATEMENTS on each of the persistent connections
+    PREPARED_STATEMENTS = True
+    MAX_PREPARED_STATEMENTS = 20
 
     context = ['platform', 'timevalue', 'depth', 'latitude', 'longitude']
 
-    def _sql_to_df(self, sql, extract=False, request=None, set_index=False):
+    joins = psql.SQL('''\nFROM public.stoqs_measuredparameter
+        INNER JOIN stoqs_measurement ON (stoqs_measuredparameter.measurement_id = stoqs_measurement.id)
+        INNER JOIN stoqs_instantpoint ON (stoqs_measurement.instantpoint_id = stoqs_instantpoint.id)
+        INNER JOIN stoqs_activity ON (stoqs_instantpoint.activity_id = stoqs_activity.id)
+        INNER JOIN stoqs_platform ON (stoqs_activity.platform_id = stoqs_platform.id)
+        INNER JOIN stoqs_parameter ON (stoqs_measuredparameter.parameter_id = stoqs_parameter.id)
+        ''')
+
+    def _as_string(self, sql):
+        connections[self.db].ensure_connection()
+        return sql.as_string(connections[self.db].connection)
+
+    def _numbered(self, sql, numbers):
+        '''Return Composed @sql with each Placeholder replaced by the next of the $n parameters
+        of a prepared statement from the iterator @numbers
+        '''
+        if isinstance(sql, psql.Placeholder):
+            return psql.SQL(f'${next(numbers)}')
+        if isinstance(sql, psql.Composed):
+            return psql.Composed([self._numbered(part, numbers) for part in sql.seq])
+        return sql
+
+    def _prepared(self):
+        '''Return the OrderedDict of the names of the statements prepared on the current connection to
+        self.db, least recently used first.  It's kept on Django's connection wrapper and started over
+        when the wrapper opens a new database connection.
+        '''
+        wrapper = connections[self.db]
+        wrapper.ensure_connection()
+        connection, prepared = getattr(wrapper, 'columnar_prepared', (None, None))
+        if connection is not wrapper.connection:
+            prepared = OrderedDict()
+            wrapper.columnar_prepared = (wrapper.connection, prepared)
+
+        return prepared
+
+    def _statement(self, sql, params):
+        '''Return SQL text and params for executing Composed @sql with @params.  With PREPARED_STATEMENTS
+        the text executes a prepared statement named after @sql, prepared on first use by the connection,
+        so that repeated exports of the same shape (filters used and not their values) are planned once.
+        Connections are persistent, so beyond MAX_PREPARED_STATEMENTS the least recently used is deallocated.
+        '''
+        text = self._as_string(sql)
+        if not self.PREPARED_STATEMENTS:
+            return text, params
+
+        name = 'columnar_' + hashlib.md5(text.encode()).hexdigest()
+        prepared = self._prepared()
+        if name in prepared:
+            prepared.move_to_end(name)
+        else:
+            with connections[self.db].cursor() as cursor:
+                logger.debug(f'Preparing statement {name}')
+                cursor.execute(psql.SQL('PREPARE {} AS ').format(psql.Identifier(name)) +
+                               self._numbered(sql, iter(range(1, len(params) + 1))))
+                prepared[name] = True
+                while len(prepared) > self.MAX_PREPARED_STATEMENTS:
+                    oldest, _ = prepared.popitem(last=False)
+                    logger.debug(f'Deallocating statement {oldest}')
+                    cursor.execute(psql.SQL('DEALLOCATE {}').format(psql.Identifier(oldest)))
+        execute = psql.SQL('EXECUTE {}').format(psql.Identifier(name))
+        if params:
+            execute += psql.SQL(' ({})').format(psql.SQL(', ').join([psql.Placeholder()] * len(params)))
+
+        return self._as_string(execute), params
+
+    def _sql_to_df(self, sql, params=None, extract=False, request=None, set_index=False):
         if extract:
-            where_clause = self.request_to_sql_where(request) 
-            total_recs = self._sql_to_df(self._build_sql(count=True,
-                                         where_clause=where_clause))[0]['count'][0]
+            where_clause, where_params = self.request_to_sql_where(request)
+            total_recs = self._sql_to_df(self._build_sql(count=True, where_clause=where_clause),
+                                         where_params)[0]['count'][0]
             logger.info(f'Extracting {total_recs} records from SQL query into DataFrame...')
 
         # More than 10 GB of RAM is needed in Docker Desktop for reading data 
@@ -48,17 +129,18 @@ class Columnar():
         #      https://github.com/pandas-dev/pandas/issues/12265#issuecomment-181809005
         #      https://github.com/pandas-dev/pandas/issues/35689
         stime = time()
+        text, params = self._statement(sql, params or [])
         # See https://github.com/pandas-dev/pandas/issues/45660#issuecomment-1077355514
         with warnings.catch_warnings():
             # Ignore warning for non-SQLAlchemy Connection
             warnings.simplefilter('ignore', UserWarning)
             if set_index or extract:
-                df = pd.read_sql_query(sql, connections[self.db], index_col=self.context)
+                df = pd.read_sql_query(text, connections[self.db], params=params or None, index_col=self.context)
             else:
-                df = pd.read_sql_query(sql, connections[self.db])
+                df = pd.read_sql_query(text, connections[self.db], params=params or None)
         etime = time() - stime
         if extract:
-            logger.info(f"sql = {sql}")
+            logger.info(f"sql = {self._as_string(sql)}, params = {params}")
             logger.info(f"df.shape: {df.shape} <- read_sql_query() in {etime:.1f} sec")
             logger.info(f"Actual df.memory_usage().sum():"
                              f" {(df.memory_usage().sum()/1.e9):.3f} GB")
@@ -69,26 +151,18 @@ class Columnar():
     def _build_sql(self, limit=None, order=True, count=False, where_clause=None):
         
         # Base query that's similar to the one behind the api/measuredparameter.csv request
-        joins = f'''\nFROM public.stoqs_measuredparameter
-        INNER JOIN stoqs_measurement ON (stoqs_measuredparameter.measurement_id = stoqs_measurement.id)
-        INNER JOIN stoqs_instantpoint ON (stoqs_measurement.instantpoint_id = stoqs_instantpoint.id)
-        INNER JOIN stoqs_activity ON (stoqs_instantpoint.activity_id = stoqs_activity.id)
-        INNER JOIN stoqs_platform ON (stoqs_activity.platform_id = stoqs_platform.id)
-        INNER JOIN stoqs_parameter ON (stoqs_measuredparameter.parameter_id = stoqs_parameter.id)
-        '''
-
         if count:
             selects = 'SELECT count(*) '
         else:
-            selects = f'''SELECT stoqs_platform.name as platform,
+            selects = '''SELECT stoqs_platform.name as platform,
                 stoqs_instantpoint.timevalue, stoqs_measurement.depth,
                 ST_X(stoqs_measurement.geom) as longitude,
                 ST_Y(stoqs_measurement.geom) as latitude,'''
             if self.collect:
                 if 'standard_name' in self.collect:
-                    selects += f'\nstoqs_parameter.standard_name,'
+                    selects += '\nstoqs_parameter.standard_name,'
                 elif 'name' in self.collect:
-                    selects += f'\nstoqs_parameter.name,'
+                    selects += '\nstoqs_parameter.name,'
                 if 'activity__name' in self.include:
                     selects += '\nstoqs_activity.name as activity__name,'
                     self.context = ['platform', 'activity__name', 'timevalue', 
@@ -97,54 +171,155 @@ class Columnar():
             else:
                 selects += '\nstoqs_measuredparameter.datavalue'
 
-        sql = selects + joins
+        sql = psql.SQL(selects) + self.joins
 
         if where_clause:
             sql += where_clause
 
         if order and not count:
-            sql += ('\nORDER BY stoqs_platform.name, stoqs_instantpoint.timevalue,'
-                        ' stoqs_measurement.depth, stoqs_parameter.name')
+            sql += psql.SQL('\nORDER BY stoqs_platform.name, stoqs_instantpoint.timevalue,'
+                            ' stoqs_measurement.depth, stoqs_parameter.name')
 
         if limit:
-            sql += f"\nLIMIT {limit}"
+            sql += psql.SQL('\nLIMIT {}').format(psql.Literal(int(limit)))
         logger.debug(f'sql = {sql}')
 
         return sql
 
-    def _estimate_memory(self, where_clause=None):
-        '''Perform a small query on the selection and extrapolate
-        to estimate the server-side memory required for the full extraction.
+    def _collect_column(self):
+        if 'standard_name' in self.collect:
+            return 'standard_name'
+        return 'name'
+
+    def _fetchall(self, sql, params):
+        text, params = self._statement(sql, params)
+        with connections[self.db].cursor() as cursor:
+            cursor.execute(text, params or None)
+            return cursor.fetchall()
+
+    def _parameter_counts(self, activity_where_clause, params):
+        '''Return list of (platform name, activity name, column name, number of records) from the
+        counts stored in ActivityParameter for the Activities and Parameters in the selection
         '''
-        SAMPLE_SIZE = 100
-        sql = self._build_sql(limit=SAMPLE_SIZE, order=False, where_clause=where_clause)
-        df, sample_time = self._sql_to_df(sql, set_index=True)
-
-        sample_memory = df.memory_usage().sum()
-        logger.debug(f"{sample_memory} Bytes for {SAMPLE_SIZE} records")
+        column = psql.Identifier('stoqs_parameter', self._collect_column())
+        sql = psql.SQL('''SELECT stoqs_platform.name, stoqs_activity.name, {column},
+                   sum(stoqs_activityparameter.number)
+        FROM stoqs_activityparameter
+        INNER JOIN stoqs_activity ON (stoqs_activityparameter.activity_id = stoqs_activity.id)
+        INNER JOIN stoqs_platform ON (stoqs_activity.platform_id = stoqs_platform.id)
+        INNER JOIN stoqs_parameter ON (stoqs_activityparameter.parameter_id = stoqs_parameter.id)
+        {where}
+        GROUP BY stoqs_platform.name, stoqs_activity.name, {column}''').format(
+                column=column, where=activity_where_clause or psql.SQL(''))
+
+        return [(p, a, c, n or 0) for p, a, c, n in self._fetchall(sql, params)]
+
+    def _cooccurrence(self, where_clause, params):
+        '''Return the mean number of columns that are filled in a row of the pivoted DataFrame,
+        i.e. how many of the selected parameters are measured together.  Loaders insert the
+        MeasuredParameters of an Activity a parameter at a time, so rather than sampling their pages
+        about COOCCURRENCE_SAMPLE Measurements are sampled with TABLESAMPLE SYSTEM, which reads just the
+        sampled pages of stoqs_measurement, and their MeasuredParameters are found with the index on
+        measurement_id.  Return 1.0, the sparsest pivot, if no sampled Measurement is in the selection.
+        '''
+        measurements = plannerRowEstimate(self.db, 'SELECT id FROM stoqs_measurement')
+        percent = min(100.0, 100.0 * self.COOCCURRENCE_SAMPLE / max(measurements, 1))
+        sample = psql.SQL('stoqs_measuredparameter.measurement_id = ANY(ARRAY('
+                          'SELECT id FROM stoqs_measurement TABLESAMPLE SYSTEM ({})))').format(psql.Placeholder())
+        if where_clause:
+            sample = where_clause + psql.SQL('\n  AND ') + sample
+        else:
+            sample = psql.SQL('WHERE ') + sample
+        sql = psql.SQL('SELECT avg(n) FROM (SELECT count(DISTINCT {}) AS n {} {}'
+                       ' GROUP BY stoqs_measuredparameter.measurement_id) AS m').format(
+                            psql.Identifier('stoqs_parameter', self._collect_column()), self.joins, sample)
+        cooc = self._fetchall(sql, params + [percent])[0][0]
+
+        return float(cooc) if cooc else 1.0
+
+    def _predict(self, where_clause, params, activity_where_clause, activity_params, sample_df=None):
+        '''Predict the records, pivoted rows and bytes of memory for extracting the selection.
+        The records of each Activity and column come from the counts stored in ActivityParameter,
+        scaled to the planner's estimate of the selection if there are time or depth constraints.
+        The bytes of each record are measured on SAMPLE_SIZE rows of the selection, @sample_df is
+        the DataFrame of them from _sql_to_df() if it has already been read.
+        '''
+        counts = self._parameter_counts(activity_where_clause, activity_params)
+        stored_records = sum(n for _, _, _, n in counts)
+        if self.measurement_constrained or not stored_records:
+            records = plannerRowEstimate(self.db, self._as_string(self._build_sql(order=False, where_clause=where_clause)),
+                                         params)
+        else:
+            records = stored_records
+        scale = records / stored_records if stored_records else 0
+
+        columns = set()
+        activity_max = defaultdict(float)
+        for _, activity, column, number in counts:
+            columns.add(column)
+            activity_max[activity] = max(activity_max[activity], number * scale)
+
+        sample_sql = self._build_sql(limit=self.SAMPLE_SIZE, order=False, where_clause=where_clause)
+        rows = self._fetchall(sample_sql, params)
+        if sample_df is None:
+            sample_df, _ = self._sql_to_df(sample_sql, params, set_index=True)
+        # Python objects that psycopg2 creates for a record: its slot in the list, the tuple and each value
+        record_bytes = (sys.getsizeof(rows) + sum(sys.getsizeof(r) + sum(map(sys.getsizeof, r)) for r in rows)
+                       ) / max(len(rows), 1)
+        # libpq holds the whole result as NUL terminated text until it is fetched
+        pg_record_bytes = sum(sum(self.PG_VALUE_BYTES + len(str(v)) + 1 for v in r) for r in rows) / max(len(rows), 1)
+        # A row of the long DataFrame and of its MultiIndex of the context columns
+        df_record_bytes = sample_df.memory_usage(index=True, deep=True).sum() / max(len(sample_df), 1)
+        index_row_bytes = sample_df.index.memory_usage(deep=True) / max(len(sample_df), 1)
+
+        # Each pivoted row has the Measurement's values of cooccurrence columns, bounded by
+        # every column being measured together in each Activity and by none being
+        cooccurrence = self._cooccurrence(where_clause, params)
+        pivot_rows = int(min(records, max(sum(activity_max.values()), records / cooccurrence)))
+        pivot_bytes = pivot_rows * (len(columns) * np.dtype('float64').itemsize + index_row_bytes)
+
+        python_bytes = records * record_bytes
+        pg_bytes = records * pg_record_bytes
+        df_bytes = records * df_record_bytes
+        # read_sql_query() holds the fetched records while it builds the long DataFrame, then pivot_table()
+        # aggregates it into a copy of about its size that is unstacked into the pivoted DataFrame
+        heap_bytes = max(python_bytes + df_bytes, 2 * df_bytes + pivot_bytes)
+
+        logger.info(f"Predicted {records} records into {pivot_rows} rows of {len(columns)} columns"
+                    f" (cooccurrence = {cooccurrence:.2f}), {python_bytes/1.e9:.3f} GB of Python objects,"
+                    f" {pg_bytes/1.e9:.3f} GB of libpq result, {heap_bytes/1.e9:.3f} GB peak heap")
+
+        return {'records': int(records),
+                'pivot_rows': pivot_rows,
+                'columns': len(columns),
+                'heap_bytes': heap_bytes,
+                'peak_bytes': max(python_bytes + pg_bytes, heap_bytes),
+                'file_bytes': pivot_bytes}
+
+    def _estimate_memory(self, where_clause, params, activity_where_clause, activity_params):
+        '''Predict the memory and pivoted rows for the full extraction with _predict() and
+        time a small query on the selection to extrapolate the time required.
+        '''
+        sql = self._build_sql(limit=self.SAMPLE_SIZE, order=False, where_clause=where_clause)
+        df, sample_time = self._sql_to_df(sql, params, set_index=True)
 
-        total_recs = self._sql_to_df(self._build_sql(count=True,
-                                     where_clause=where_clause))[0]['count'][0]
+        prediction = self._predict(where_clause, params, activity_where_clause, activity_params, sample_df=df)
+        total_recs = prediction['records']
         logger.debug(f"total_recs = {total_recs}")
 
-        required_memory = total_recs * sample_memory / SAMPLE_SIZE / 1.e9
-        container_memory = self.DF_TO_RAM_FACTOR * required_memory 
-        logger.info(f"Estimated required_memory:"
-                         f" {required_memory:.3f} GB for DataFrame,"
-                         f" {container_memory:.3f} GB for container RAM,")
+        container_memory = prediction['peak_bytes'] / 1.e9
+        logger.info(f"Estimated {container_memory:.3f} GB for container RAM")
 
         sample_time = sample_time / 60
-        required_time = total_recs * sample_time / SAMPLE_SIZE /60
+        required_time = total_recs * sample_time / self.SAMPLE_SIZE /60
         logger.info(f"sample_time = {sample_time} min,"
                     f" required_time = {required_time} min")
 
         logger.debug(f"pivot_table(index={self.context}, columns={self.collect}, values='datavalue')")
         dfp = df.pivot_table(index=self.context, columns=self.collect, values='datavalue')
         logger.debug(f"dfp.head() = {dfp.head()}")
-        sample_est_records = dfp.shape[0]
-        est_records = int(total_recs * sample_est_records / SAMPLE_SIZE)
-        logger.info(f"sample_est_records = {sample_est_records},"
-                    f" est_records = {est_records}")
+        est_records = prediction['pivot_rows']
+        logger.info(f"est_records = {est_records}")
 
         if container_memory > self.MAX_CONTAINER_MEMORY:
             logger.exception(f"Request of {container_memory:.3f} GB would"
@@ -160,14 +335,16 @@ class Columnar():
 
         return {'RAM_GB': container_memory, 
                 'avl_RAM_GB': self.MAX_CONTAINER_MEMORY,
-                'size_MB': required_memory * 1.e3,
+                'size_MB': prediction['file_bytes'] / 1.e6,
                 'est_records': est_records, 
                 'time_min': required_time, 
                 'time_avl': time_available / 60,    # minutes
                 'preview': dfp.head(2).to_html()}
 
-    def request_to_sql_where(self, request):
-        '''Convert query sring parameters to SQL WHERE statements
+    def request_to_sql_where(self, request, measurements=True):
+        '''Convert query sring parameters to a SQL WHERE clause, returned as a Composed with the
+        list of its parameters.  With measurements=False the time and depth constraints are left out
+        so that it can be used for Activity tables.
         '''
         logger.debug(f"request = {request}") 
         self.db = request.META['dbAlias']
@@ -193,6 +370,7 @@ class Columnar():
         logger.debug(f"stime = {self.min_depth}")
         self.max_depth = request.GET.get('measurement__depth__lte')
         logger.debug(f"etime = {self.max_depth}")
+        self.measurement_constrained = any((self.stime, self.etime, self.min_depth, self.max_depth))
 
         self.activitynames = request.GET.getlist("activitynames")
         logger.debug(f"activitynames = {self.activitynames}")
@@ -208,50 +386,54 @@ class Columnar():
         logger.debug(f"activity__name__contains = {self.activity__name__contains}")
 
         where_list = []
+        params = []
         if self.platforms:
-            where_list.append(f"stoqs_platform.name IN ({repr(self.platforms)[1:-1]})")
+            where_list.append(psql.SQL("stoqs_platform.name = ANY({})").format(psql.Placeholder()))
+            params.append(self.platforms)
         if 'standard_name' in self.collect:
-            where_list.append(f"stoqs_parameter.standard_name is not null")
+            where_list.append(psql.SQL("stoqs_parameter.standard_name is not null"))
         if 'name' in self.collect:
-            where_list.append(f"stoqs_parameter.name is not null")
+            where_list.append(psql.SQL("stoqs_parameter.name is not null"))
         if self.parameters:
-            where_list.append(f"stoqs_parameter.name IN ({repr(self.parameters)[1:-1]})")
-        if self.stime:
-            where_list.append(f"stoqs_instantpoint.timevalue >= '{self.stime}'")
-        if self.etime:
-            where_list.append(f"stoqs_instantpoint.timevalue <= '{self.etime}'")
-        if self.min_depth:
-            where_list.append(f"stoqs_measurement.depth >= '{self.min_depth}'")
-        if self.max_depth:
-            where_list.append(f"stoqs_measurement.depth <= '{self.max_depth}'")
+            where_list.append(psql.SQL("stoqs_parameter.name = ANY({})").format(psql.Placeholder()))
+            params.append(self.parameters)
+        if self.stime and measurements:
+            where_list.append(psql.SQL("stoqs_instantpoint.timevalue >= {}").format(psql.Placeholder()))
+            params.append(self.stime)
+        if self.etime and measurements:
+            where_list.append(psql.SQL("stoqs_instantpoint.timevalue <= {}").format(psql.Placeholder()))
+            params.append(self.etime)
+        if self.min_depth and measurements:
+            where_list.append(psql.SQL("stoqs_measurement.depth >= {}").format(psql.Placeholder()))
+            params.append(float(self.min_depth))
+        if self.max_depth and measurements:
+            where_list.append(psql.SQL("stoqs_measurement.depth <= {}").format(psql.Placeholder()))
+            params.append(float(self.max_depth))
         if self.activitynames:
-            where_list.append(f"stoqs_activity.name IN ({repr(self.activitynames)[1:-1]})")
+            where_list.append(psql.SQL("stoqs_activity.name = ANY({})").format(psql.Placeholder()))
+            params.append(self.activitynames)
         if self.activity__name__contains:
-            anc_list = []
-            for name in self.activity__name__contains:
-                anc_list.append(f"stoqs_activity.name LIKE '%{name}%'")
-            logger.debug('(' + ' OR '.join(anc_list) + ')')
-            where_list.append('(' + ' OR '.join(anc_list) + ')')
+            where_list.append(psql.SQL("stoqs_activity.name LIKE ANY({})").format(psql.Placeholder()))
+            params.append([f'%{name}%' for name in self.activity__name__contains])
         if self.activity__name:
-            an_list = []
-            for name in self.activity__name:
-                an_list.append(f"stoqs_activity.name = '{name}'")
-            logger.debug('(' + ' OR '.join(an_list) + ')')
-            where_list.append('(' + ' OR '.join(an_list) + ')')
+            where_list.append(psql.SQL("stoqs_activity.name = ANY({})").format(psql.Placeholder()))
+            params.append(self.activity__name)
 
-        where_clause = ''
+        # Lists are bound as arrays so that the statement is the same for any number of values
+        where_clause = None
         if where_list:
-            where_clause = 'WHERE ' + '\n  AND '.join(where_list)
-            logger.debug(f"where_clause = {where_clause}")
+            where_clause = psql.SQL('WHERE ') + psql.SQL('\n  AND ').join(where_list)
+            logger.debug(f"where_clause = {where_clause}, params = {params}")
 
-        return where_clause
+        return where_clause, params
 
     def request_estimate(self, request):
-        return self._estimate_memory(self.request_to_sql_where(request))
+        return self._estimate_memory(*self.request_to_sql_where(request),
+                                     *self.request_to_sql_where(request, measurements=False))
 
     def request_to_parquet(self, request):
-        sql = self._build_sql(where_clause=self.request_to_sql_where(request))
-        df, _ = self._sql_to_df(sql, extract=True, request=request)
+        where_clause, params = self.request_to_sql_where(request)
+        df, _ = self._sql_to_df(self._build_sql(where_clause=where_clause), params, extract=True, request=request)
         dfp = df.pivot_table(index=self.context, columns=self.collect, values='datavalue')
         logger.debug(dfp.shape)
 
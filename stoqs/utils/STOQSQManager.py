@@ -21,15 +21,17 @@ from collections import defaultdict
 from collections.abc import Mapping
 from django.conf import settings
 from django.db import transaction
-from django.db.models import Q, Max, Min, Sum, Avg
+from django.db.models import Q, F, Max, Min, Sum, Avg, FloatField
+from django.db.models.functions import Cast
 from django.db.models.sql import query
 from django.contrib.gis.db.models import Extent, Union
 from django.contrib.gis.geos import fromstr, MultiPoint, Point
 from django.db.utils import DatabaseError, DataError
-from django.core.exceptions import ObjectDoesNotExist
+from django.core.exceptions import EmptyResultSet, ObjectDoesNotExist
 from django.http import HttpResponse
 from stoqs import models
 from loaders import MEASUREDINSITU, X3DPLATFORMMODEL, X3D_MODEL
+from loaders.pyramid import bucket_seconds, choose_level, DEPTH_BIN
 from loaders.SampleLoaders import SAMPLED, NETTOW, PLANKTONPUMP, ESP_FILTERING, sample_simplify_crit, SAMPLE_TYPES
 from matplotlib.colors import rgb2hex
 from .utils import round_to_n, postgresifySQL, EPOCH_STRING, EPOCH_DATETIME
@@ -42,7 +44,7 @@ from .PQuery import PQuery
 from .Viz import MeasuredParameter, ParameterParameter, PPDatabaseException, PlatformAnimation
 from tools import colormaps
 from coards import to_udunits
-from datetime import datetime
+from datetime import datetime, timedelta
 from django.contrib.gis import gdal
 import logging
 import matplotlib.pyplot as plt
@@ -92,6 +94,11 @@ class STOQSQManager(object):
         self.initialQuery = True
         self.platformTypeHash = {}
 
+        # Results of the aggregates, counts and lists evaluated for this request, keyed by their SQL
+        self._memo = {}
+        self.memo_hits = 0
+        self.memo_misses = 0
+
         # monkey patch sql/query.py to make it use our database for sql generation
         query.DEFAULT_DB_ALIAS = dbname
 
@@ -258,6 +265,7 @@ class STOQSQManager(object):
                 continue
 
             start_time = time.time()
+            hits, misses = self.memo_hits, self.memo_misses
             if k == 'measuredparametersgroup':
                 results[k] = v(MEASUREDINSITU)
             elif k == 'sampledparametersgroup':
@@ -265,9 +273,44 @@ class STOQSQManager(object):
             else:
                 results[k] = v()
 
-            logger.info(f"Built in {1000*(time.time()-start_time):6.1f} ms {k} with {str(v).split('.')[1].split(' ')[0]}()")
+            logger.info(f"Built in {1000*(time.time()-start_time):6.1f} ms {k} with {str(v).split('.')[1].split(' ')[0]}()"
+                        f" - memo hits: {self.memo_hits - hits}, misses: {self.memo_misses - misses}")
         
+        logger.info(f"Query memo for this request: {self.memo_hits} hits, {self.memo_misses} misses")
+
         return results
+
+    def _memoize(self, qs, operation, evaluate):
+        '''
+        Return evaluate() for QuerySet @qs, remembering the result for the rest of the request.
+        The key is @operation along with the compiled SQL and params of @qs, so equal queries
+        built by different get*() methods are run only once.
+        '''
+        if not settings.QUERY_MEMO:
+            return evaluate()
+        try:
+            sql, params = qs.query.sql_with_params()
+        except EmptyResultSet:
+            return evaluate()
+
+        key = (qs.db, operation, sql, repr(params))
+        if key in self._memo:
+            self.memo_hits += 1
+        else:
+            self.memo_misses += 1
+            self._memo[key] = evaluate()
+
+        return self._memo[key]
+
+    def _memoCount(self, qs):
+        return self._memoize(qs, 'count', qs.count)
+
+    def _memoAggregate(self, qs, *args, **kwargs):
+        operation = ('aggregate', repr(args), repr(sorted(kwargs.items())))
+        return dict(self._memoize(qs, operation, lambda: qs.aggregate(*args, **kwargs)))
+
+    def _memoList(self, qs):
+        return self._memoize(qs, 'list', lambda: list(qs))
     
     #
     # Methods that generate summary data, based on the current query criteria
@@ -293,22 +336,23 @@ class STOQSQManager(object):
         '''
         # Always get approximate count
         logger.debug('str(self.getActivityParametersQS(forCount=True).query) = %s', str(self.getActivityParametersQS(forCount=True).query))
-        approximate_count = self.getActivityParametersQS(forCount=True).aggregate(Sum('number'))['number__sum']
+        approximate_count = self._memoAggregate(self.getActivityParametersQS(forCount=True), Sum('number'))['number__sum']
         locale.setlocale(locale.LC_ALL, 'en_US.UTF-8')
 
         # Actual counts are None unless the 'Get actual count' box is checked
         actual_count = None
         actual_count_localized = None
+        actual_count_approximate = False
         if getGet_Actual_Count(self.kwargs):
             if not self.mpq.qs_mp:
                 self.mpq.buildMPQuerySet(*self.args, **self.kwargs)
 
             if self._actual_count:
-                actual_count = self._actual_count
+                actual_count, actual_count_approximate = self._actual_count
             else:
-                logger.debug('Calling self.mpq.getMPCount()')
-                actual_count = self.mpq.getMPCount()
-                logger.debug('actual_count = %s', actual_count)
+                logger.debug('Calling self.mpq.getMPCountEstimate()')
+                actual_count, actual_count_approximate = self.mpq.getMPCountEstimate()
+                logger.debug('actual_count = %s, actual_count_approximate = %s', actual_count, actual_count_approximate)
 
         try:
             approximate_count_localized = locale.format("%d", approximate_count, grouping=True)
@@ -327,7 +371,8 @@ class STOQSQManager(object):
                     'approximate_count': approximate_count,
                     'approximate_count_localized': approximate_count_localized,
                     'actual_count': actual_count,
-                    'actual_count_localized': actual_count_localized
+                    'actual_count_localized': actual_count_localized,
+                    'actual_count_approximate': actual_count_approximate
                 }
 
     def getMeasuredParametersPostgreSQL(self):
@@ -340,7 +385,7 @@ class STOQSQManager(object):
         self.mpq.initialQuery = self.initialQuery
         try:
             sql = self.mpq.getMeasuredParametersPostgreSQL()
-            self._actual_count = self.mpq.getMPCount()
+            self._actual_count = self.mpq.getMPCountEstimate()
         except Exception as e:
             logger.warn('Could not get MeasuredParametersPostgreSQL: %s', e)
 
@@ -362,8 +407,8 @@ class STOQSQManager(object):
         Return count of ActivityParameters given the current constraints
         ''' 
         qs_ap = self.getActivityParametersQS()                  # Approximate count from ActivityParameter
-        if qs_ap:
-            return qs_ap.count()
+        if qs_ap is not None:
+            return self._memoCount(qs_ap)
         else:
             return 0
         
@@ -484,7 +529,7 @@ class STOQSQManager(object):
             try:
                 if percentileAggregateType == 'extrema':
                     logger.debug('self.getActivityParametersQS().filter(parameter__id=%s) = %s', pid, str(self.getActivityParametersQS().filter(parameter__id=pid).query))
-                    qs = self.getActivityParametersQS().filter(parameter__id=pid).aggregate(Min('p010'), Max('p990'), Avg('median'))
+                    qs = self._memoAggregate(self.getActivityParametersQS().filter(parameter__id=pid), Min('p010'), Max('p990'), Avg('median'))
                     logger.debug('qs = %s', qs)
                     try:
                         plot_results = [pid, round_to_n(qs['p010__min'],4), round_to_n(qs['p990__max'],4)]
@@ -493,16 +538,16 @@ class STOQSQManager(object):
                 else:
                     # Eliminate Gulper Activities which skew the result badly resulting in a bad color lookup table
                     qs = self.getActivityParametersQS().filter(parameter__id=pid, number__gt=4)
-                    if qs.count() == 0:
+                    if self._memoCount(qs) == 0:
                         # Relax the constraint eliminating Gulper Activities that have a number of 4 or less
                         qs = self.getActivityParametersQS().filter(parameter__id=pid)
-                    qs = qs.aggregate(Avg('p025'), Avg('p975'))
+                    qs = self._memoAggregate(qs, Avg('p025'), Avg('p975'))
 
                     try:
                         plot_results = [pid, round_to_n(qs['p025__avg'],4), round_to_n(qs['p975__avg'],4)]
                         if plot_results[1] == plot_results[2]:
                             logger.debug('Standard min and max for for pid %s are the same. Getting the overall min and max values.', pid)
-                            qs = self.getActivityParametersQS().filter(parameter__id=pid).aggregate(Min('p025'), Max('p975'))
+                            qs = self._memoAggregate(self.getActivityParametersQS().filter(parameter__id=pid), Min('p025'), Max('p975'))
                             plot_results = [pid, round_to_n(qs['p025__min'],4), round_to_n(qs['p975__max'],4)]
                     except TypeError:
                         logger.debug('Failed to get plot_results for qs = %s', qs)
@@ -515,11 +560,11 @@ class STOQSQManager(object):
                     if pid == 'latitude':
                         plot_results = ['latitude', round_to_n(extent[0][1], 4), round_to_n(extent[1][1],4)]
                 elif pid == 'depth':
-                    dminmax = self.qs.aggregate(Min('mindepth'), Max('maxdepth'))
+                    dminmax = self._memoAggregate(self.qs, Min('mindepth'), Max('maxdepth'))
                     plot_results = ['depth', round_to_n(dminmax['mindepth__min'], 4), round_to_n(dminmax['maxdepth__max'],4)]
                 elif pid == 'time':
                     epoch = EPOCH_DATETIME
-                    tminmax = self.qs.aggregate(Min('startdate'), Max('enddate'))
+                    tminmax = self._memoAggregate(self.qs, Min('startdate'), Max('enddate'))
                     tmin = (tminmax['startdate__min'] - epoch).days + (tminmax['startdate__min'] - epoch).seconds / 86400.
                     tmax = (tminmax['enddate__max'] - epoch).days + (tminmax['enddate__max'] - epoch).seconds / 86400.
                     plot_results = ['time', tmin, tmax]
@@ -538,15 +583,15 @@ class STOQSQManager(object):
                 parameterID = self.kwargs['parameterplot'][0]
                 try:
                     if percentileAggregateType == 'extrema':
-                        qs = self.getActivityParametersQS().filter(parameter__id=parameterID).aggregate(Min('p025'), Max('p975'))
+                        qs = self._memoAggregate(self.getActivityParametersQS().filter(parameter__id=parameterID), Min('p025'), Max('p975'))
                         plot_results = [parameterID, round_to_n(qs['p025__min'],4), round_to_n(qs['p975__max'],4)]
                     else:
                         # Eliminate Gulper Activities which skew the result badly resulting in a bad color lookup table
                         qs = self.getActivityParametersQS().filter(parameter__id=parameterID, number__gt=4)
-                        if qs.count() == 0:
+                        if self._memoCount(qs) == 0:
                             # Relax the constraint eliminating Gulper Activities that have a number of 4 or less
                             qs = self.getActivityParametersQS().filter(parameter__id=parameterID)
-                        qs = qs.aggregate(Avg('p025'), Avg('p975'))
+                        qs = self._memoAggregate(qs, Avg('p025'), Avg('p975'))
                         plot_results = [parameterID, round_to_n(qs['p025__avg'],4), round_to_n(qs['p975__avg'],4)]
                 except TypeError as e:
                     # Likely 'Cannot plot Parameter' that is not in selection, ignore for cleaner functional tests
@@ -563,10 +608,10 @@ class STOQSQManager(object):
                     pid = models.Parameter.objects.using(self.dbname).get(id=mpid).id
                     logger.debug('pid = %s', pid)
                     if percentileAggregateType == 'extrema':
-                        qs = self.getActivityParametersQS().filter(parameter__id=pid).aggregate(Min('p010'), Max('p990'))
+                        qs = self._memoAggregate(self.getActivityParametersQS().filter(parameter__id=pid), Min('p010'), Max('p990'))
                         da_results = [pid, round_to_n(qs['p010__min'],4), round_to_n(qs['p990__max'],4)]
                     else:
-                        qs = self.getActivityParametersQS().filter(parameter__id=pid).aggregate(Avg('p025'), Avg('p975'))
+                        qs = self._memoAggregate(self.getActivityParametersQS().filter(parameter__id=pid), Avg('p025'), Avg('p975'))
                         da_results = [pid, round_to_n(qs['p025__avg'],4), round_to_n(qs['p975__avg'],4)]
                 except TypeError as e:
                     logger.exception(e)
@@ -582,10 +627,10 @@ class STOQSQManager(object):
                     pid = models.Parameter.objects.using(self.dbname).get(id=spid).id
                     logger.debug('pid = %s', pid)
                     if percentileAggregateType == 'extrema':
-                        qs = self.getActivityParametersQS().filter(parameter__id=pid).aggregate(Min('p010'), Max('p990'))
+                        qs = self._memoAggregate(self.getActivityParametersQS().filter(parameter__id=pid), Min('p010'), Max('p990'))
                         da_results = [pid, round_to_n(qs['p010__min'],4), round_to_n(qs['p990__max'],4)]
                     else:
-                        qs = self.getActivityParametersQS().filter(parameter__id=pid).aggregate(Avg('p025'), Avg('p975'))
+                        qs = self._memoAggregate(self.getActivityParametersQS().filter(parameter__id=pid), Avg('p025'), Avg('p975'))
                         da_results = [pid, round_to_n(qs['p025__avg'],4), round_to_n(qs['p975__avg'],4)]
                 except TypeError as e:
                     logger.exception(e)
@@ -595,10 +640,10 @@ class STOQSQManager(object):
                 sname = self.kwargs['parameterstandardname'][0]
                 try:
                     if percentileAggregateType == 'extrema':
-                        qs = self.getActivityParametersQS().filter(parameter__standard_name=sname).aggregate(Min('p025'), Max('p975'))
+                        qs = self._memoAggregate(self.getActivityParametersQS().filter(parameter__standard_name=sname), Min('p025'), Max('p975'))
                         da_results = [sname, round_to_n(qs['p025__min'],4), round_to_n(qs['p975__max'],4)]
                     else:
-                        qs = self.getActivityParametersQS().filter(parameter__standard_name=sname).aggregate(Avg('p025'), Avg('p975'))
+                        qs = self._memoAggregate(self.getActivityParametersQS().filter(parameter__standard_name=sname), Avg('p025'), Avg('p975'))
                         da_results = [sname, round_to_n(qs['p025__avg'],4), round_to_n(qs['p975__avg'],4)]
                 except TypeError as e:
                     logger.exception(e)
@@ -728,7 +773,7 @@ class STOQSQManager(object):
                     platformTypeHash[platformType].append((name, id, color, featureType, ))
                 else:
                     # Filter out models from static platforms not in the selection
-                    if name in self.qs.values_list('platform__name', flat=True):
+                    if name in self._memoList(self.qs.values_list('platform__name', flat=True)):
                         logger.debug(f"Seeing if Platform {name} has an x3dModel...")
                         x3dModel, x, y, z = self._getPlatformModel(name) 
                         if not x3dModel:
@@ -794,7 +839,7 @@ class STOQSQManager(object):
         #
         # While only a fraction of a second different, it is 342 times faster!
 
-        qs=self.qs.aggregate(Max('enddate'), Min('startdate'))
+        qs = self._memoAggregate(self.qs, Max('enddate'), Min('startdate'))
         try:
             times = (time.mktime(qs['startdate__min'].timetuple())*1000, time.mktime(qs['enddate__max'].timetuple())*1000,)
         except AttributeError:
@@ -813,7 +858,7 @@ class STOQSQManager(object):
         ##return (qs['instantpoint__measurement__depth__min'],qs['instantpoint__measurement__depth__max'])
 
         # Alternate query to use stats stored with the Activity
-        qs=self.qs.aggregate(Max('maxdepth'), Min('mindepth'))
+        qs = self._memoAggregate(self.qs, Max('maxdepth'), Min('mindepth'))
         try:
             depths = ('%.2f' % qs['mindepth__min'], '%.2f' % qs['maxdepth__max'])
         except TypeError:
@@ -1211,18 +1256,8 @@ class STOQSQManager(object):
             tv = mp['measurement__instantpoint__timevalue']
             ems = int(1000 * to_udunits(tv, 'seconds since 1970-01-01'))
 
-            nd = mp['measurement__nominallocation__depth']
-            if nd:
-                an_nd = "%s - %s - %s @ %s" % (pa_units[p], p, a.name, nd,)
-            elif a in a_nds:
-                try:
-                    an_nd = "%s - %s - %s starting @ %s m" % (pa_units[p], p, a.name, a_nds[a],)
-                except KeyError:
-                    # Likely data from a load before plotTimeSeriesDepth was added to ActivityResource
-                    an_nd = "%s - %s - %s starting @ ? m" % (pa_units[p], p, a.name)
-            else:
-                an_nd = "%s - %s - %s" % (pa_units[p], p, a.name)
-   
+            an_nd = self._timeSeriesKey(pa_units, a, p, mp['measurement__nominallocation__depth'], a_nds)
+
             if save_mp_for_plot: 
                 try:
                     pt[pa_units[p]][an_nd].append((ems, mp['datavalue']))
@@ -1231,7 +1266,68 @@ class STOQSQManager(object):
                     pt[pa_units[p]][an_nd].append((ems, mp['datavalue']))
 
         return pt, units_dict, strides
-        
+
+    def _timeSeriesKey(self, pa_units, a, p, nd, a_nds):
+        '''Return the "activity__name + nominal depth" key of a time series line for flot
+        '''
+        if nd:
+            an_nd = "%s - %s - %s @ %s" % (pa_units[p], p, a.name, nd,)
+        elif a in a_nds:
+            try:
+                an_nd = "%s - %s - %s starting @ %s m" % (pa_units[p], p, a.name, a_nds[a],)
+            except KeyError:
+                # Likely data from a load before plotTimeSeriesDepth was added to ActivityResource
+                an_nd = "%s - %s - %s starting @ ? m" % (pa_units[p], p, a.name)
+        else:
+            an_nd = "%s - %s - %s" % (pa_units[p], p, a.name)
+
+        return an_nd
+
+    def _getParameterTimeFromPyramid(self, pt, pa_units, a, p, is_standard_name, level, a_nds, save_mp_for_plot=True):
+        '''
+        Return hash of time series of bucket mean datavalues from the ParameterTimeBuckets at level, the number
+        of points and the equivalent stride.  The number of points is 0 if the Activity has no pyramid for p.
+        Time and depth constraints are applied to the resolution of the buckets.
+        '''
+        qs = models.ParameterTimeBucket.objects.using(self.dbname).filter(activity=a, level=level)
+        if is_standard_name[p]:
+            qs = qs.filter(parameter__standard_name=p)
+        else:
+            qs = qs.filter(parameter__name=p)
+        if self.kwargs.get('time'):
+            if self.kwargs['time'][0] is not None:
+                start = datetime.strptime(self.kwargs['time'][0], '%Y-%m-%d %H:%M:%S') - timedelta(seconds=bucket_seconds(level))
+                qs = qs.filter(timebucket__gt=start.strftime('%Y-%m-%d %H:%M:%S'))
+            if self.kwargs['time'][1] is not None:
+                qs = qs.filter(timebucket__lte=self.kwargs['time'][1])
+        if self.kwargs.get('depth'):
+            if self.kwargs['depth'][0] is not None:
+                qs = qs.filter(depthbin__gt=float(self.kwargs['depth'][0]) - DEPTH_BIN)
+            if self.kwargs['depth'][1] is not None:
+                qs = qs.filter(depthbin__lte=self.kwargs['depth'][1])
+
+        # Combine the depth bins of each nominal depth
+        qs = (qs.values('nominaldepth', 'timebucket')
+                .annotate(total=Sum('count'), wsum=Sum(F('mean') * F('count'), output_field=FloatField()))
+                .order_by('nominaldepth', 'timebucket'))
+
+        num_points = 0
+        num_mps = 0
+        for b in qs:
+            num_points += 1
+            num_mps += b['total']
+            if not save_mp_for_plot:
+                continue
+            # Plot the mean at the center of the bucket
+            ems = int(1000 * (b['timebucket'].timestamp() + bucket_seconds(level) / 2))
+            an_nd = self._timeSeriesKey(pa_units, a, p, b['nominaldepth'], a_nds)
+            pt[pa_units[p]].setdefault(an_nd, []).append((ems, b['wsum'] / b['total']))
+
+        logger.debug(f'Got {num_points} points for {p} from {a.name} at pyramid level {level}')
+        stride = int(round(num_mps / num_points)) if num_points else 1
+
+        return pt, num_points, stride
+
     def _getParameterTimeFromAP(self, pt, pa_units, a, p):
         '''
         Return hash of time series min and max values for specified activity and parameter.  To be used when duration
@@ -1277,6 +1373,24 @@ class STOQSQManager(object):
 
         return isInSelection 
 
+    def _selectedSeconds(self, a):
+        '''Return the number of seconds of Activity a's time span that are within the time selection
+        '''
+        start, end = a.startdate, a.enddate
+        if self.kwargs.get('time'):
+            if self.kwargs['time'][0] is not None:
+                start = max(start, datetime.strptime(self.kwargs['time'][0], '%Y-%m-%d %H:%M:%S'))
+            if self.kwargs['time'][1] is not None:
+                end = min(end, datetime.strptime(self.kwargs['time'][1], '%Y-%m-%d %H:%M:%S'))
+
+        return max((end - start).total_seconds(), 0)
+
+    def _pyramidUsable(self):
+        '''The ParameterTimeBuckets aggregate all the datavalues of a Parameter, they can't satisfy
+        parameter value or measured parameter label constraints
+        '''
+        return not (self.kwargs.get('parametervalues') or self.kwargs.get('mplabels'))
+
     def _buildParameterTime(self, pa_units, is_standard_name, ndCounts, pt, strides, pt_qs_mp):
         '''
         Build structure of timeseries/timeseriesprofile parameters organized by units
@@ -1350,14 +1464,23 @@ class STOQSQManager(object):
                              a.name, a.startdate, a.enddate, aseconds, secondsperpixel)
                 if float(aseconds) > float(secondsperpixel) or len(self.kwargs.get('platforms')) == 1:
                     # Multiple points of this activity can be displayed in the flot, get an appropriate stride
-                    logger.debug('PIXELS_WIDE = %s, ndCounts[p] = %s', PIXELS_WIDE, ndCounts[p])
-                    stride = int(round(qs_mp_a.count() / PIXELS_WIDE / ndCounts[p]))
-                    if stride < 1:
-                        stride = 1
-                    logger.debug('Getting timeseries from MeasuredParameter table with stride = %s', stride)
-                    strides[p][a.name] = stride
-                    logger.debug('Adding timeseries for p = %s, a = %s', p, a)
-                    pt, units, strides = self._getParameterTimeFromMP(qs_mp_a, pt, pa_units, a, p, is_standard_name, stride, a_nds, units, strides, save_mp_for_plot)
+                    # Use the coarsest pyramid level that gives about PIXELS_WIDE points for each nominal depth
+                    num_points = 0
+                    level = choose_level(self._selectedSeconds(a) / PIXELS_WIDE) if self._pyramidUsable() else None
+                    if level is not None:
+                        pt, num_points, stride = self._getParameterTimeFromPyramid(pt, pa_units, a, p, is_standard_name,
+                                                                                   level, a_nds, save_mp_for_plot)
+                    if num_points:
+                        strides[p][a.name] = stride
+                    else:
+                        logger.debug('PIXELS_WIDE = %s, ndCounts[p] = %s', PIXELS_WIDE, ndCounts[p])
+                        stride = int(round(qs_mp_a.count() / PIXELS_WIDE / ndCounts[p]))
+                        if stride < 1:
+                            stride = 1
+                        logger.debug('Getting timeseries from MeasuredParameter table with stride = %s', stride)
+                        strides[p][a.name] = stride
+                        logger.debug('Adding timeseries for p = %s, a = %s', p, a)
+                        pt, units, strides = self._getParameterTimeFromMP(qs_mp_a, pt, pa_units, a, p, is_standard_name, stride, a_nds, units, strides, save_mp_for_plot)
                     if self.kwargs['parametertimeplotcoord'] and acount == 0 and pcount == 0:
                         pt, units, strides = self._append_coords_to_pt(qs_mp, pt, pa_units, a, stride, units, strides)
 
@@ -1441,9 +1564,10 @@ class STOQSQManager(object):
         '''
         samples = []
         if self.getSampleQS():
-            qs = self.getSampleQS().values_list(
+            # Cast to float in the database, avoiding Decimal construction for legacy numeric depth columns
+            qs = self.getSampleQS().annotate(float_depth=Cast('depth', FloatField())).values_list(
                                     'instantpoint__timevalue', 
-                                    'depth',
+                                    'float_depth',
                                     'instantpoint__activity__name',
                                     'name'
                                 ).order_by('instantpoint__timevalue')
@@ -1499,9 +1623,9 @@ class STOQSQManager(object):
         if self.getSampleQS() and (nettow or planktonpump):
             qs = self.getSampleQS().filter(  Q(sampletype=nettow)
                                            | Q(sampletype=planktonpump)
-                                          ).values_list(
+                                          ).annotate(float_depth=Cast('depth', FloatField())).values_list(
                                     'instantpoint__timevalue', 
-                                    'depth',
+                                    'float_depth',
                                     'instantpoint__activity__name',
                                     'name',
                                     'instantpoint__activity__startdate',
@@ -2555,7 +2679,7 @@ class STOQSQManager(object):
         extentList = [] 
         for geom_field in (('maptrack', 'mappoint', 'plannedtrack')):
             try:
-                qs_ext = self.qs.aggregate(Extent(geom_field))
+                qs_ext = self._memoAggregate(self.qs, Extent(geom_field))
                 extentList.append(qs_ext[geom_field + '__extent'])
             except DatabaseError:
                 logger.warn('Database %s does not have field %s', self.dbname, geom_field)
@@ -2616,7 +2740,7 @@ class STOQSQManager(object):
             # Compute midpoint of extent for use in GeoViewpoint for Virtual Reality (WebVR) viewpoint setting
             lon_midpoint = (extent[0][0] + extent[1][0]) / 2.0
             lat_midpoint = (extent[0][1] + extent[1][1]) / 2.0
-            qs = self.qs.aggregate(Max('maxdepth'), Min('mindepth'))
+            qs = self._memoAggregate(self.qs, Max('maxdepth'), Min('mindepth'))
             depth_midpoint = (qs['mindepth__min'] + qs['maxdepth__max']) / 2.0
             if np.isnan(depth_midpoint):
                 depth_midpoint = 0.0
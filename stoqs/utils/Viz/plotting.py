@@ -22,9 +22,13 @@ from pylab import polyval
 from collections import namedtuple
 from django.conf import settings
 from django.db import connections, DatabaseError, transaction
-from datetime import datetime
+from django.db.models import F, FloatField, Sum
+from django.db.models.functions import Cast
+from psycopg2 import sql as psql
+from datetime import datetime, timedelta, timezone
 from stoqs import models
 from utils.utils import pearsonr, round_to_n, EPOCH_STRING
+from loaders.pyramid import bucket_seconds, choose_level, DEPTH_BIN
 from loaders.SampleLoaders import SAMPLED, NETTOW, VERTICALNETTOW, PLANKTONPUMP, ESP_FILTERING
 from loaders import MEASUREDINSITU, X3DPLATFORMMODEL, X3D_MODEL, X3D_MODEL_SCALEFACTOR
 import seawater.eos80 as sw
@@ -35,7 +39,7 @@ import logging
 import string
 import random
 import time
-import re
+import sqlparse
 import warnings
 
 logger = logging.getLogger(__name__)
@@ -353,9 +357,147 @@ class MeasuredParameter(BaseParameter):
                 self.lat.append(mp['measurement__geom'].y)
                 self.lat_by_act.setdefault(mp['measurement__instantpoint__activity__name'], []).append(mp['measurement__geom'].y)
 
-    def loadData(self, qs_mp):
+    def _precomputed_usable(self, parameterID, parameterGroups):
         '''
-        Read the data from the database into member variables for use by the methods that output various products
+        Return True if the selection may be satisfied from the data precomputed by the loaders
+        (ActivityParameterArrays and ParameterTimeBuckets), False if it needs the MeasuredParameter
+        query, e.g. with parameter value constraints.
+        '''
+        if not parameterID or SAMPLED in parameterGroups:
+            return False
+        for constraint in ('parametervalues', 'mplabels', 'measuredparametersgroup', 'parameterstandardname'):
+            if self.kwargs.get(constraint):
+                return False
+
+        return True
+
+    def _filter_activities(self, qs):
+        '''Apply the platforms and activitynames selections to a QuerySet with an activity ForeignKey
+        '''
+        if self.kwargs.get('platforms'):
+            qs = qs.filter(activity__platform__name__in=self.kwargs['platforms'])
+        if self.kwargs.get('activitynames'):
+            qs = qs.filter(activity__name__in=self.kwargs['activitynames'])
+
+        return qs
+
+    def _arrays_qs(self, parameterID, parameterGroups):
+        '''
+        Return QuerySet of ActivityParameterArrays that hold all the data for the current selection, or None
+        if the selection can be satisfied only by the MeasuredParameter query.
+        '''
+        if not self._precomputed_usable(parameterID, parameterGroups):
+            return None
+
+        dbAlias = self.request.META['dbAlias']
+        apa_qs = self._filter_activities(models.ActivityParameterArray.objects.using(dbAlias).filter(parameter__id=int(parameterID)))
+        ap_qs = self._filter_activities(models.ActivityParameter.objects.using(dbAlias).filter(parameter__id=int(parameterID)))
+
+        # Databases loaded before ActivityParameterArrays existed, or by loaders that don't save them
+        num_arrays = apa_qs.count()
+        if not num_arrays or num_arrays < ap_qs.count():
+            return None
+
+        return apa_qs.select_related('activity').order_by('activity__startdate', 'activity__name')
+
+    def _loadDataFromPyramid(self, parameterID, parameterGroups, resolution):
+        '''
+        Fill x, y and z with the bucket means of the coarsest level of the ParameterTimeBucket pyramid whose
+        buckets are no wider than resolution seconds.  For gridded sections, where finer detail is lost anyway.
+        Return False if the pyramid can't be used.
+        '''
+        level = choose_level(resolution)
+        if level is None or not self._precomputed_usable(parameterID, parameterGroups):
+            return False
+
+        dbAlias = self.request.META['dbAlias']
+        ptb_qs = self._filter_activities(models.ParameterTimeBucket.objects.using(dbAlias).filter(
+                                            parameter__id=int(parameterID), level=level))
+        ap_qs = self._filter_activities(models.ActivityParameter.objects.using(dbAlias).filter(parameter__id=int(parameterID)))
+        if ptb_qs.values('activity').distinct().count() < ap_qs.count():
+            return False
+
+        try:
+            if self.kwargs.get('time') and self.kwargs['time'][0] is not None:
+                start = datetime.strptime(self.kwargs['time'][0], '%Y-%m-%d %H:%M:%S') - timedelta(seconds=bucket_seconds(level))
+                ptb_qs = ptb_qs.filter(timebucket__gt=start.strftime('%Y-%m-%d %H:%M:%S'))
+            if self.kwargs.get('time') and self.kwargs['time'][1] is not None:
+                ptb_qs = ptb_qs.filter(timebucket__lte=self.kwargs['time'][1])
+            if self.kwargs.get('depth') and self.kwargs['depth'][0] is not None:
+                ptb_qs = ptb_qs.filter(depthbin__gt=float(self.kwargs['depth'][0]) - DEPTH_BIN)
+            if self.kwargs.get('depth') and self.kwargs['depth'][1] is not None:
+                ptb_qs = ptb_qs.filter(depthbin__lte=float(self.kwargs['depth'][1]))
+        except (TypeError, ValueError) as e:
+            self.logger.debug(f'Using MeasuredParameter query for time and depth constraints that can not be parsed: {e}')
+            return False
+
+        ptb_qs = (ptb_qs.values('timebucket', 'depthbin')
+                        .annotate(total=Sum('count'), wsum=Sum(F('mean') * F('count'), output_field=FloatField()))
+                        .order_by('timebucket', 'depthbin'))
+
+        self.logger.debug(f'Loading data from ParameterTimeBuckets at level {level} for resolution = {resolution:.0f} s')
+        half_bucket = bucket_seconds(level) / 2
+        for b in ptb_qs:
+            esecs = b['timebucket'].timestamp() + half_bucket
+            self.x.append(esecs / self.scale_factor if self.scale_factor else esecs)
+            self.y.append(b['depthbin'] + DEPTH_BIN / 2)
+            self.z.append(b['wsum'] / b['total'])
+
+        return True
+
+    def _loadDataFromArrays(self, parameterID, parameterGroups):
+        '''
+        Fill the member variables that loadData() fills by slicing the packed ActivityParameterArrays
+        in memory for the time and depth constraints.  Return False if the arrays can't be used.
+        '''
+        apa_qs = self._arrays_qs(parameterID, parameterGroups)
+        if apa_qs is None:
+            return False
+
+        tmin, tmax = -np.inf, np.inf
+        dmin, dmax = -np.inf, np.inf
+        try:
+            if self.kwargs.get('time') and self.kwargs['time'][0] is not None:
+                tmin = datetime.strptime(self.kwargs['time'][0], '%Y-%m-%d %H:%M:%S').replace(tzinfo=timezone.utc).timestamp()
+            if self.kwargs.get('time') and self.kwargs['time'][1] is not None:
+                tmax = datetime.strptime(self.kwargs['time'][1], '%Y-%m-%d %H:%M:%S').replace(tzinfo=timezone.utc).timestamp()
+            if self.kwargs.get('depth') and self.kwargs['depth'][0] is not None:
+                dmin = float(self.kwargs['depth'][0])
+            if self.kwargs.get('depth') and self.kwargs['depth'][1] is not None:
+                dmax = float(self.kwargs['depth'][1])
+        except (TypeError, ValueError) as e:
+            self.logger.debug(f'Using MeasuredParameter query for time and depth constraints that can not be parsed: {e}')
+            return False
+
+        self.logger.debug(f'Loading data from {apa_qs.count()} ActivityParameterArrays')
+        for apa in apa_qs:
+            esecs = np.array(apa.epochseconds, dtype='float64')
+            depths = np.array(apa.depth, dtype='float64')
+            values = np.array(apa.datavalue, dtype='float64')
+            in_sel = (esecs >= tmin) & (esecs <= tmax) & (depths >= dmin) & (depths <= dmax) & ~np.isnan(values)
+            if not in_sel.any():
+                continue
+
+            xs = esecs[in_sel] / self.scale_factor if self.scale_factor else esecs[in_sel]
+            lons = np.array(apa.longitude, dtype='float64')[in_sel].tolist()
+            lats = np.array(apa.latitude, dtype='float64')[in_sel].tolist()
+            self.x.extend(xs.tolist())
+            self.y.extend(depths[in_sel].tolist())
+            self.z.extend(values[in_sel].tolist())
+            self.lon.extend(lons)
+            self.lat.extend(lats)
+            self.depth_by_act.setdefault(apa.activity.name, []).extend(depths[in_sel].tolist())
+            self.value_by_act.setdefault(apa.activity.name, []).extend(values[in_sel].tolist())
+            self.lon_by_act.setdefault(apa.activity.name, []).extend(lons)
+            self.lat_by_act.setdefault(apa.activity.name, []).extend(lats)
+
+        return True
+
+    def loadData(self, qs_mp, parameterID=None, parameterGroups=None, resolution=None):
+        '''
+        Read the data from the database into member variables for use by the methods that output various products.
+        If parameterID is given and the selection allows, the data are read from ActivityParameterArrays, or,
+        if a coarser time resolution in seconds is acceptable, from the ParameterTimeBucket pyramid.
         '''
         self.logger.debug('type(qs_mp) = %s', type(qs_mp))
 
@@ -370,6 +512,18 @@ class MeasuredParameter(BaseParameter):
         self.lon_by_act_span = {}
         self.lat_by_act_span = {}
 
+        if resolution and self._loadDataFromPyramid(parameterID, parameterGroups or self.parameterGroups, resolution):
+            self.strideInfo = ''
+            self.depth = self.y
+            self.value = self.z
+            return
+
+        if self._loadDataFromArrays(parameterID, parameterGroups or self.parameterGroups):
+            self.strideInfo = ''
+            self.depth = self.y
+            self.value = self.z
+            return
+
         stride = int(qs_mp.count() / MP_MAX_POINTS)
         stride = 1
         if stride < 1:
@@ -427,7 +581,8 @@ class MeasuredParameter(BaseParameter):
         xsamp = []
         ysamp = []
         sname = []
-        qs = self.sampleQS.values('instantpoint__timevalue', 'instantpoint__activity__name', 'depth', 'name')
+        qs = (self.sampleQS.annotate(float_depth=Cast('depth', FloatField()))
+                           .values('instantpoint__timevalue', 'instantpoint__activity__name', 'float_depth', 'name'))
         if act_type_name:
             qs = qs.filter(instantpoint__activity__activitytype__name__contains=act_type_name)
         else:
@@ -439,7 +594,7 @@ class MeasuredParameter(BaseParameter):
                 xsamp.append(s['instantpoint__timevalue'].timestamp() / self.scale_factor)
             else:
                 xsamp.append(s['instantpoint__timevalue'].timestamp())
-            ysamp.append(s['depth'])
+            ysamp.append(s['float_depth'])
             if act_type_name:
                 # Convention is to use Activity information for things like NetTows
                 sname.append(s['instantpoint__activity__name'])
@@ -759,8 +914,13 @@ class MeasuredParameter(BaseParameter):
                 self.logger.debug('self.scale_factor = %f', self.scale_factor)
                 xi = xi / self.scale_factor
 
+            # Gridded sections for Flot are no finer than the xi spacing, the pyramid can supply them
+            resolution = None
+            if forFlot and (contourFlag or self.kwargs.get('showdataas', [None])[:1] == ['contour']):
+                resolution = (tmax - tmin) / len(xi)
+
             if not self.x and not self.y and not self.z and self.qs_mp is not None:
-                self.loadData(self.qs_mp)
+                self.loadData(self.qs_mp, self.parameterID, resolution=resolution)
 
             # Copy x, y, z values for color plot (scatter or "contour")
             cx = list(self.x)
@@ -775,7 +935,7 @@ class MeasuredParameter(BaseParameter):
                 self.x = []
                 self.y = []
                 self.z = []
-                self.loadData(self.contour_qs_mp)
+                self.loadData(self.contour_qs_mp, self.contourParameterID, self.contourParameterGroups, resolution)
                 # Copy x, y, z values for contour line plot
                 clx = list(self.x)
                 cly = list(self.y)
@@ -887,7 +1047,7 @@ class MeasuredParameter(BaseParameter):
         logger.debug("Building X3D data values with vert_ex = %f", vert_ex)
         if not self.lon and not self.lat and not self.depth and not self.value:
             self.logger.debug('Calling self.loadData()...')
-            self.loadData(self.qs_mp)
+            self.loadData(self.qs_mp, self.parameterID)
         try:
             for act in list(self.value_by_act.keys()):
                 self.logger.debug('Reading data from act = %s', act)
@@ -1104,14 +1264,17 @@ class ParameterParameter(BaseParameter):
         elif xaxis_name == 'sea_water_temperature':
             return t, s, sigmat
 
-    def _getCountSQL(self, sql):
+    def _getSQLText(self, sql, params):
         '''
-        Modify Parameter-Parameter SQL to return the count for the query
+        Return Parameter-Parameter SQL composed by PQuery.parameterParameterSQL() as text for display in the UI,
+        with the @params bound to it.  An empty @params list leaves the placeholders in place, e.g. after an error.
         '''
-        p = re.compile('SELECT .+? FROM')           # Non-greedy, match to the first 'FROM'
-        csql = p.sub('''SELECT count(*) FROM''', sql.replace('\n', ' '))
-        self.logger.debug('csql = %s', csql)
-        return csql
+        with connections[self.request.META['dbAlias']].cursor() as cursor:
+            if params:
+                text = cursor.mogrify(sql, params).decode()
+            else:
+                text = sql.as_string(cursor.connection)
+        return sqlparse.format(text, reindent=True, keyword_case='upper')
 
     def _getXYCData(self, strideFlag=True, latlonFlag=False, returnIDs=False, sampleFlag=True):
         @transaction.atomic(using=self.request.META['dbAlias'])
@@ -1120,10 +1283,9 @@ class ParameterParameter(BaseParameter):
             Construct SQL and iterate through cursor to get X, Y, and possibly C Parameter Parameter data
             '''
             # Construct special SQL for P-P plot that returns up to 3 data values for the up to 3 Parameters requested for a 2D plot
-            sql = str(self.pq.qs_mp.query)
-            sql = self.pq.addParameterParameterSelfJoins(sql, self.pDict)
+            sql, params = self.pq.parameterParameterSQL(self.pDict, latlonFlag=latlonFlag, idsFlag=returnIDs)
             if sampleFlag:
-                sample_sql = self.pq.addSampleConstraint(sql)
+                sample_sql, sample_params = self.pq.parameterParameterSQL(self.pDict, latlonFlag=latlonFlag, sampleFlag=True)
 
             # Use cursors so that we can specify the database alias to use.
             cursor = connections[self.request.META['dbAlias']].cursor()
@@ -1131,11 +1293,11 @@ class ParameterParameter(BaseParameter):
 
             # Get count and set a stride value if more than a PP_MAX_POINTS which Matplotlib cannot plot, about 100,000 points
             try:
-                cursor.execute(self._getCountSQL(sql))
+                cursor.execute(psql.SQL('SELECT count(*) FROM ({}) AS pp').format(sql), params)
             except DatabaseError as e:
                 infoText = 'Parameter-Parameter: Cannot get count. Make sure you have no Parameters selected in the Filter.'
                 self.logger.warn(e)
-                raise PPDatabaseException(infoText, sql)
+                raise PPDatabaseException(infoText, self._getSQLText(sql, []))
 
             pp_count = cursor.fetchone()[0]
             self.logger.debug('pp_count = %d', pp_count)
@@ -1147,47 +1309,32 @@ class ParameterParameter(BaseParameter):
                     stride_val = 1
                 self.logger.debug('stride_val = %d', stride_val)
 
-            if latlonFlag:
-                if sql.find('stoqs_measurement') != -1:
-                    self.logger.debug('Adding lon lat to SELECT')
-                    sql = sql.replace('DISTINCT', 'DISTINCT ST_X(stoqs_measurement.geom) AS lon, ST_Y(stoqs_measurement.geom) AS lat,\n')
-                elif sql.find('stoqs_sample') != -1:
-                    self.logger.debug('Adding lon lat to SELECT')
-                    sql = sql.replace('DISTINCT', 'DISTINCT ST_X(stoqs_sample.geom) AS lon, ST_Y(stoqs_sample.geom) AS lat,\n')
-
-                if sampleFlag:
-                    sample_sql = sample_sql.replace('DISTINCT', 'DISTINCT ST_X(stoqs_sample.geom) AS lon, ST_Y(stoqs_sample.geom) AS lat,\n')
-
-            if returnIDs:
-                if sql.find('stoqs_measurement') != -1:
-                    self.logger.debug('Adding ids to SELECT for stoqs_measurement')
-                    sql = sql.replace('DISTINCT', 'DISTINCT mp_x.id, mp_y.id,\n')
-
             # Get the Parameter-Parameter points
             try:
-                self.logger.debug('Executing sql = %s', sql)
-                cursor.execute(sql)
+                self.logger.debug('Executing sql = %s with params = %s', sql, params)
+                cursor.execute(sql, params)
             except DatabaseError as e:
                 infoText = 'Parameter-Parameter: Query failed. Make sure you have no Parameters selected in the Filter.'
                 self.logger.warn('Cannot execute sql query for Parameter-Parameter plot: %s', e)
-                raise PPDatabaseException(infoText, sql)
+                raise PPDatabaseException(infoText, self._getSQLText(sql, []))
+            sql = self._getSQLText(sql, params)
 
             if sampleFlag: 
                 # Get the Sample points
                 try:
-                    self.logger.debug('Executing sample_sql = %s', sample_sql)
-                    sample_cursor.execute(sample_sql)
+                    self.logger.debug('Executing sample_sql = %s with params = %s', sample_sql, sample_params)
+                    sample_cursor.execute(sample_sql, sample_params)
                 except DatabaseError as e:
                     infoText = 'Parameter-Parameter: Sample Query failed.'
                     self.logger.warn('Cannot execute sample_sql query for Parameter-Parameter plot: %s', e)
-                    raise PPDatabaseException(infoText, sample_sql)
+                    raise PPDatabaseException(infoText, self._getSQLText(sample_sql, []))
 
             # Populate MeasuredParameter x,y,c member variables
             counter = 0
             self.logger.debug('Looping through rows in cursor with a stride of %d...', stride_val)
             for row in cursor:
                 if counter % stride_val == 0:
-                    # SampledParameter datavalues are Decimal, convert everything to a float for numpy
+                    # Convert everything to a float for numpy
                     lrow = list(row)
                     if None in lrow or np.nan in lrow:
                         continue
@@ -1440,17 +1587,17 @@ class ParameterParameter(BaseParameter):
                 
             try:
                 # Construct special SQL for P-P plot that returns up to 4 data values for the up to 4 Parameters requested for a 3D plot
-                sql = str(self.pq.qs_mp.query)
                 self.logger.debug('self.pDict = %s', self.pDict)
-                sql = self.pq.addParameterParameterSelfJoins(sql, self.pDict)
+                sql, params = self.pq.parameterParameterSQL(self.pDict)
 
                 # Use cursor so that we can specify the database alias to use. Columns are always 0:x, 1:y, 2:c (optional)
                 cursor = connections[self.request.META['dbAlias']].cursor()
-                cursor.execute(sql)
+                cursor.execute(sql, params)
+                sql = self._getSQLText(sql, params)
                 for row in cursor:
                     if None in row or np.nan in row:
                         continue
-                    # SampledParameter datavalues are Decimal, convert everything to a float for numpy, row[0] is depth
+                    # Convert everything to a float for numpy, row[0] is depth
                     self.depth.append(float(row[0]))
                     self.x.append(float(row[1]))
                     self.y.append(float(row[2]))
@@ -343,6 +343,41 @@ def _quote_ins(FIND_INS, pgq, all_ins, INSTR, incount, in_match):
 
     return quoted_in
 
+def querysetSQL(qs):
+    '''
+    Return the SQL of QuerySet @qs with its parameters bound by psycopg2 so that it can be executed
+    against the postgres database.  Unlike postgresifySQL() no regular expressions are needed, so it
+    works for whatever SQL Django generates, including EXISTS subqueries.
+    '''
+    from django.core.exceptions import EmptyResultSet
+    from django.db import connections
+
+    try:
+        sql, params = qs.query.sql_with_params()
+    except EmptyResultSet:
+        return ''
+    with connections[qs.db].cursor() as cursor:
+        return cursor.mogrify(sql, params).decode()
+
+def plannerRowEstimate(dbAlias, sql, params=None):
+    '''
+    Return the number of rows that the PostgreSQL query planner estimates @sql will return, read from
+    the top node of EXPLAIN (FORMAT JSON).  The query is planned but not run, so this takes milliseconds
+    no matter how large the selection.  The estimate is only as good as the table statistics from ANALYZE.
+    '''
+    import json
+    from django.db import connections
+
+    if not sql:
+        return 0
+    with connections[dbAlias].cursor() as cursor:
+        cursor.execute('EXPLAIN (FORMAT JSON) ' + sql, params)
+        plan = cursor.fetchone()[0]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+
+    return int(plan[0]['Plan']['Plan Rows'])
+
 def postgresifySQL(query, pointFlag=False, translateGeom=False, sampleFlag=False):
     '''
     Given a generic database agnostic Django query string modify it using regular expressions to work